@@ -3,13 +3,19 @@ import json
 import time
 import httpx
 from collections import defaultdict
-from typing import Optional, Literal
+from typing import Optional, Literal, Iterator
 from pydantic import HttpUrl, ValidationError
 from dataclasses import dataclass
 from urllib.parse import quote_plus
 from .blob import BlobData, Blob, BlobType, ChatBlob, OpenAICompatibleMessage
-from .user import UserProfile, UserProfileData, UserEventData, UserEventGistData
-from ..network import unpack_response
+from .user import (
+    UserProfile,
+    UserProfileData,
+    UserEventData,
+    UserEventGistData,
+    ContextStreamChunk,
+)
+from ..network import unpack_response, unpack_stream_line
 from ..error import ServerError
 from ..utils import LOG
 
@@ -26,6 +32,13 @@ def profiles_to_json(profiles: list[UserProfile]) -> dict:
     return dict(results)
 
 
+def users_context_request(user_ids: list[str], **params) -> dict:
+    """Body of the batch context request, unset parameters use the server defaults"""
+    body = {k: v for k, v in params.items() if v is not None}
+    body["user_ids"] = [str(u) for u in user_ids]
+    return body
+
+
 @dataclass
 class MemoBaseClient:
     api_key: Optional[str] = None
@@ -122,10 +135,96 @@ class MemoBaseClient:
         )
         return r.data["users"]
 
+    def iter_users(
+        self,
+        search: str = "",
+        order_by: str = "updated_at",
+        order_desc: bool = True,
+        page_size: int = 100,
+    ) -> Iterator[dict]:
+        """All users of the project, fetched page by page with the server cursor"""
+        cursor = None
+        while True:
+            params = f"search={search}&order_by={order_by}&order_desc={order_desc}&limit={page_size}"
+            if cursor is not None:
+                params += f"&cursor={cursor}"
+            r = unpack_response(self._client.get(f"/project/users?{params}"))
+            for user in r.data["users"]:
+                yield user
+            cursor = r.data["next_cursor"]
+            if cursor is None:
+                return
+
+    def export_archive(self, path: str, compress: bool = True) -> None:
+        """Download the project archive (all users, profiles, events, gists and statuses) to `path`"""
+        with self._client.stream(
+            "GET", f"/project/export?compress={str(compress).lower()}"
+        ) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for chunk in response.iter_bytes():
+                    f.write(chunk)
+
     def get_daily_usage(self, days: int = 7) -> dict:
         r = unpack_response(self._client.get(f"/project/usage?last_days={days}"))
         return r.data
 
+    def batch_insert(
+        self, user_blobs: list[tuple[str, Blob]], sync=False
+    ) -> list[str]:
+        """Insert (user_id, blob) pairs in one request, returns blob ids in order"""
+        r = unpack_response(
+            self._client.post(
+                f"/blobs/insert?wait_process={sync}",
+                json={
+                    "blobs": [
+                        {**blob_data.to_request(), "user_id": user_id}
+                        for user_id, blob_data in user_blobs
+                    ]
+                },
+            )
+        )
+        return r.data["ids"]
+
+    def get_users_context(
+        self,
+        user_ids: list[str],
+        max_token_size: int = 1000,
+        prefer_topics: list[str] = None,
+        only_topics: list[str] = None,
+        max_subtopic_size: int = None,
+        topic_limits: dict[str, int] = None,
+        profile_event_ratio: float = None,
+        require_event_summary: bool = None,
+        chats: list[OpenAICompatibleMessage] = None,
+        event_similarity_threshold: float = None,
+        customize_context_prompt: str = None,
+        full_profile_and_only_search_event: bool = None,
+        fill_window_with_events: bool = None,
+    ) -> dict[str, str]:
+        """Context of many users in one request, returns user id -> context"""
+        r = unpack_response(
+            self._client.post(
+                "/users/context/batch",
+                json=users_context_request(
+                    user_ids,
+                    max_token_size=max_token_size,
+                    prefer_topics=prefer_topics,
+                    only_topics=only_topics,
+                    max_subtopic_size=max_subtopic_size,
+                    topic_limits=topic_limits,
+                    profile_event_ratio=profile_event_ratio,
+                    require_event_summary=require_event_summary,
+                    chats=chats,
+                    event_similarity_threshold=event_similarity_threshold,
+                    customize_context_prompt=customize_context_prompt,
+                    full_profile_and_only_search_event=full_profile_and_only_search_event,
+                    fill_window_with_events=fill_window_with_events,
+                ),
+            )
+        )
+        return {c["user_id"]: c["context"] for c in r.data["contexts"]}
+
 
 @dataclass
 class User:
@@ -142,6 +241,11 @@ class User:
         )
         return r.data["id"]
 
+    def batch_insert(self, blobs: list[Blob], sync=False) -> list[str]:
+        return self.project_client.batch_insert(
+            [(self.user_id, blob_data) for blob_data in blobs], sync=sync
+        )
+
     def get(self, blob_id: str) -> Blob:
         r = unpack_response(
             self.project_client.client.get(f"/blobs/{self.user_id}/{blob_id}")
@@ -156,6 +260,24 @@ class User:
         )
         return r.data["ids"]
 
+    def iter_blobs(self, blob_type: BlobType, page_size: int = 100) -> Iterator[str]:
+        """Ids of all the blobs of a type, oldest first"""
+        cursor = None
+        while True:
+            params = f"page_size={page_size}"
+            if cursor is not None:
+                params += f"&cursor={cursor}"
+            r = unpack_response(
+                self.project_client.client.get(
+                    f"/users/blobs/{self.user_id}/{blob_type}?{params}"
+                )
+            )
+            for blob_id in r.data["ids"]:
+                yield blob_id
+            cursor = r.data["next_cursor"]
+            if cursor is None:
+                return
+
     def delete(self, blob_id: str) -> bool:
         r = unpack_response(
             self.project_client.client.delete(f"/blobs/{self.user_id}/{blob_id}")
@@ -267,6 +389,24 @@ class User:
         )
         return [UserEventData.model_validate(e) for e in r.data["events"]]
 
+    def iter_events(self, page_size: int = 100) -> Iterator[UserEventData]:
+        """Recent events of the user, newest first"""
+        cursor = None
+        while True:
+            params = f"?topk={page_size}"
+            if cursor is not None:
+                params += f"&cursor={cursor}"
+            r = unpack_response(
+                self.project_client.client.get(
+                    f"/users/event/{self.user_id}{params}"
+                )
+            )
+            for e in r.data["events"]:
+                yield UserEventData.model_validate(e)
+            cursor = r.data["next_cursor"]
+            if cursor is None:
+                return
+
     def delete_event(self, event_id: str) -> bool:
         r = unpack_response(
             self.project_client.client.delete(f"/users/event/{self.user_id}/{event_id}")
@@ -311,7 +451,7 @@ class User:
         )
         return [UserEventGistData.model_validate(e) for e in r.data["gists"]]
 
-    def context(
+    def _context_params(
         self,
         max_token_size: int = 1000,
         prefer_topics: list[str] = None,
@@ -325,6 +465,7 @@ class User:
         customize_context_prompt: str = None,
         full_profile_and_only_search_event: bool = None,
         fill_window_with_events: bool = None,
+        deadline_ms: int = None,
     ) -> str:
         params = f"?max_token_size={max_token_size}"
         if prefer_topics:
@@ -361,7 +502,84 @@ class User:
             params += f"&full_profile_and_only_search_event={'true' if full_profile_and_only_search_event else 'false'}"
         if fill_window_with_events is not None:
             params += f"&fill_window_with_events={'true' if fill_window_with_events else 'false'}"
+        if deadline_ms is not None:
+            params += f"&deadline_ms={deadline_ms}"
+        return params
+
+    def context(
+        self,
+        max_token_size: int = 1000,
+        prefer_topics: list[str] = None,
+        only_topics: list[str] = None,
+        max_subtopic_size: int = None,
+        topic_limits: dict[str, int] = None,
+        profile_event_ratio: float = None,
+        require_event_summary: bool = None,
+        chats: list[OpenAICompatibleMessage] = None,
+        event_similarity_threshold: float = None,
+        customize_context_prompt: str = None,
+        full_profile_and_only_search_event: bool = None,
+        fill_window_with_events: bool = None,
+        deadline_ms: int = None,
+    ) -> str:
+        params = self._context_params(
+            max_token_size=max_token_size,
+            prefer_topics=prefer_topics,
+            only_topics=only_topics,
+            max_subtopic_size=max_subtopic_size,
+            topic_limits=topic_limits,
+            profile_event_ratio=profile_event_ratio,
+            require_event_summary=require_event_summary,
+            chats=chats,
+            event_similarity_threshold=event_similarity_threshold,
+            customize_context_prompt=customize_context_prompt,
+            full_profile_and_only_search_event=full_profile_and_only_search_event,
+            fill_window_with_events=fill_window_with_events,
+            deadline_ms=deadline_ms,
+        )
         r = unpack_response(
             self.project_client.client.get(f"/users/context/{self.user_id}{params}")
         )
         return r.data["context"]
+
+    def stream_context(
+        self,
+        max_token_size: int = 1000,
+        prefer_topics: list[str] = None,
+        only_topics: list[str] = None,
+        max_subtopic_size: int = None,
+        topic_limits: dict[str, int] = None,
+        profile_event_ratio: float = None,
+        require_event_summary: bool = None,
+        chats: list[OpenAICompatibleMessage] = None,
+        event_similarity_threshold: float = None,
+        customize_context_prompt: str = None,
+        full_profile_and_only_search_event: bool = None,
+        fill_window_with_events: bool = None,
+        deadline_ms: int = None,
+    ) -> Iterator[ContextStreamChunk]:
+        """Same as `context`, but yields the profile section, the event section
+        and at last the packed context as soon as the server has each of them"""
+        params = self._context_params(
+            max_token_size=max_token_size,
+            prefer_topics=prefer_topics,
+            only_topics=only_topics,
+            max_subtopic_size=max_subtopic_size,
+            topic_limits=topic_limits,
+            profile_event_ratio=profile_event_ratio,
+            require_event_summary=require_event_summary,
+            chats=chats,
+            event_similarity_threshold=event_similarity_threshold,
+            customize_context_prompt=customize_context_prompt,
+            full_profile_and_only_search_event=full_profile_and_only_search_event,
+            fill_window_with_events=fill_window_with_events,
+            deadline_ms=deadline_ms,
+        )
+        with self.project_client.client.stream(
+            "GET", f"/users/context/{self.user_id}{params}&stream=true"
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    r = unpack_stream_line(line)
+                    yield ContextStreamChunk.model_validate(r.data)
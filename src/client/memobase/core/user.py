@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from pydantic import BaseModel, UUID4, UUID5, Field
-from typing import Optional
+from typing import Optional, Literal
 from datetime import datetime
 
 
@@ -81,3 +81,12 @@ class UserEventGistData(BaseModel):
         None, description="Timestamp when the event gist was last updated"
     )
     similarity: Optional[float] = Field(None, description="Similarity score")
+
+
+class ContextStreamChunk(BaseModel):
+    type: Literal["profile", "event", "context"] = Field(
+        ..., description="profile/event section, or the final packed context"
+    )
+    content: str = Field(..., description="Section string, or the whole context")
+    count: int = Field(..., description="Number of profiles/event gists in it")
+    token_size: int = Field(..., description="Token size of the profiles/event gists")
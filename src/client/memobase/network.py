@@ -9,3 +9,9 @@ def unpack_response(response: Response) -> BaseResponse:
     r = BaseResponse.model_validate(response.json())
     r.raise_for_status()
     return r
+
+
+def unpack_stream_line(line: str) -> BaseResponse:
+    r = BaseResponse.model_validate_json(line)
+    r.raise_for_status()
+    return r
@@ -1,12 +1,13 @@
-import threading
+from typing import AsyncIterator
 from openai import OpenAI, AsyncOpenAI
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 from openai._streaming import Stream
 from ..core.entry import MemoBaseClient, User, ChatBlob
+from ..core.async_entry import AsyncMemoBaseClient, AsyncUser
 from ..core.user import UserProfile
 from ..utils import string_to_uuid, LOG
-from ..error import ServerError
+from .writer import MemoryWriter, AsyncMemoryWriter
 
 PROMPT = """
 
@@ -18,27 +19,47 @@ PROMPT = """
 
 def openai_memory(
     openai_client: OpenAI | AsyncOpenAI,
-    mb_client: MemoBaseClient,
+    mb_client: MemoBaseClient | AsyncMemoBaseClient,
     additional_memory_prompt: str = "Make sure the user's query needs the memory, otherwise just return the answer directly.",
     max_context_size: int = 1000,
+    writer: MemoryWriter | AsyncMemoryWriter = None,
 ) -> OpenAI | AsyncOpenAI:
+    """Add memory to the chat completions of `openai_client`.
+
+    The chats are saved by a background `writer`, see `memobase.patch.writer`.
+    `OpenAI` needs a `MemoBaseClient`, `AsyncOpenAI` an `AsyncMemoBaseClient`.
+    """
     if hasattr(openai_client, "_memobase_patched"):
         return openai_client
 
-    openai_client._memobase_patched = True
-    openai_client.get_profile = _get_profile(mb_client)
-    openai_client.get_memory_prompt = _get_memory_prompt(
-        mb_client, max_context_size, additional_memory_prompt
-    )
-    openai_client.flush = _flush(mb_client)
     if isinstance(openai_client, OpenAI):
+        if not isinstance(mb_client, MemoBaseClient):
+            raise ValueError("OpenAI needs a MemoBaseClient")
+        writer = writer or MemoryWriter(mb_client)
+        openai_client.get_profile = _get_profile(mb_client)
+        openai_client.get_memory_prompt = _get_memory_prompt(
+            mb_client, max_context_size, additional_memory_prompt
+        )
+        openai_client.flush = _flush(mb_client, writer)
         openai_client.chat.completions.create = _sync_chat(
-            openai_client, mb_client, additional_memory_prompt, max_context_size
+            openai_client, mb_client, writer, additional_memory_prompt, max_context_size
         )
     elif isinstance(openai_client, AsyncOpenAI):
-        raise ValueError(f"AsyncOpenAI is not supported yet")
+        if not isinstance(mb_client, AsyncMemoBaseClient):
+            raise ValueError("AsyncOpenAI needs an AsyncMemoBaseClient")
+        writer = writer or AsyncMemoryWriter(mb_client)
+        openai_client.get_profile = _async_get_profile(mb_client)
+        openai_client.get_memory_prompt = _async_get_memory_prompt(
+            mb_client, max_context_size, additional_memory_prompt
+        )
+        openai_client.flush = _async_flush(mb_client, writer)
+        openai_client.chat.completions.create = _async_chat(
+            openai_client, mb_client, writer, additional_memory_prompt, max_context_size
+        )
     else:
         raise ValueError(f"Invalid openai_client type: {type(openai_client)}")
+    openai_client.memory_writer = writer
+    openai_client._memobase_patched = True
     return openai_client
 
 
@@ -67,26 +88,73 @@ def _get_memory_prompt(
     return get_memory
 
 
-def _flush(mb_client: MemoBaseClient):
+def _flush(mb_client: MemoBaseClient, writer: MemoryWriter):
     def flush(u_string) -> list[UserProfile]:
         uid = string_to_uuid(u_string)
+        # the chats still waiting in the writer first
+        writer.flush()
         return mb_client.get_user(uid, no_get=True).flush()
 
     return flush
 
 
-def add_message_to_user(messages: ChatBlob, user: User):
-    try:
-        r = user.insert(messages)
-        LOG.debug(f"Insert {messages}")
-    except ServerError as e:
-        LOG.error(f"Failed to insert message: {e}")
+def _async_get_profile(mb_client: AsyncMemoBaseClient):
+    async def get_profile(u_string) -> list[UserProfile]:
+        uid = string_to_uuid(u_string)
+        return await (await mb_client.get_user(uid, no_get=True)).profile()
+
+    return get_profile
+
+
+def _async_get_memory_prompt(
+    mb_client: AsyncMemoBaseClient,
+    max_context_size: int = 1000,
+    additional_memory_prompt: str = "",
+):
+    async def get_memory(u_string) -> str:
+        uid = string_to_uuid(u_string)
+        u = await mb_client.get_user(uid, no_get=True)
+        context = await u.context(max_token_size=max_context_size)
+        return PROMPT.format(
+            user_context=context, additional_memory_prompt=additional_memory_prompt
+        )
+
+    return get_memory
+
+
+def _async_flush(mb_client: AsyncMemoBaseClient, writer: AsyncMemoryWriter):
+    async def flush(u_string) -> bool:
+        uid = string_to_uuid(u_string)
+        await writer.flush()
+        return await (await mb_client.get_user(uid, no_get=True)).flush()
+
+    return flush
+
+
+def chat_blob(user_query: dict, response: str) -> ChatBlob:
+    return ChatBlob(
+        messages=[
+            {"role": "user", "content": user_query["content"]},
+            {"role": "assistant", "content": response},
+        ]
+    )
 
 
 def user_context_insert(
     messages, u: User, additional_memory_prompt: str, max_context_size: int
 ):
     context = u.context(max_token_size=max_context_size)
+    return insert_context_prompt(messages, context, additional_memory_prompt)
+
+
+async def async_user_context_insert(
+    messages, u: AsyncUser, additional_memory_prompt: str, max_context_size: int
+):
+    context = await u.context(max_token_size=max_context_size)
+    return insert_context_prompt(messages, context, additional_memory_prompt)
+
+
+def insert_context_prompt(messages, context: str, additional_memory_prompt: str):
     if not len(context):
         return messages
     sys_prompt = PROMPT.format(
@@ -102,6 +170,7 @@ def user_context_insert(
 def _sync_chat(
     client: OpenAI,
     mb_client: MemoBaseClient,
+    writer: MemoryWriter,
     additional_memory_prompt: str,
     max_context_size: int = 1000,
 ):
@@ -110,7 +179,7 @@ def _sync_chat(
     def sync_chat(*args, **kwargs) -> ChatCompletion | Stream[ChatCompletionChunk]:
         is_streaming = kwargs.get("stream", False)
         if kwargs.get("user_id", None) is None:
-            kwargs.pop("user_id")
+            kwargs.pop("user_id", None)
             if not is_streaming:
                 return _create_chat(*args, **kwargs)
             else:
@@ -149,15 +218,8 @@ def _sync_chat(
                     return
                 if r_role != "assistant":
                     LOG.warning(f"Last response is not assistant response: {r_role}")
-                    return response
-
-                messages = ChatBlob(
-                    messages=[
-                        {"role": "user", "content": user_query["content"]},
-                        {"role": "assistant", "content": total_response},
-                    ]
-                )
-                threading.Thread(target=add_message_to_user, args=(messages, u)).start()
+                    return
+                writer.add(u.user_id, chat_blob(user_query, total_response))
 
             return yield_response_and_log()
 
@@ -167,16 +229,68 @@ def _sync_chat(
                 LOG.warning(f"Last response is not assistant response: {r_role}")
                 return response
             r_string = response.choices[0].message.content
-            messages = ChatBlob(
-                messages=[
-                    {"role": "user", "content": user_query["content"]},
-                    {"role": "assistant", "content": r_string},
-                ]
-            )
-            threading.Thread(target=add_message_to_user, args=(messages, u)).start()
+            writer.add(u.user_id, chat_blob(user_query, r_string))
             return response
 
     return sync_chat
 
 
-# TODO support async openai
+def _async_chat(
+    client: AsyncOpenAI,
+    mb_client: AsyncMemoBaseClient,
+    writer: AsyncMemoryWriter,
+    additional_memory_prompt: str,
+    max_context_size: int = 1000,
+):
+    _create_chat = client.chat.completions.create
+
+    async def async_chat(
+        *args, **kwargs
+    ) -> ChatCompletion | AsyncIterator[ChatCompletionChunk]:
+        is_streaming = kwargs.get("stream", False)
+        user_id = kwargs.pop("user_id", None)
+        user_query = kwargs["messages"][-1]
+        if user_id is not None and user_query["role"] != "user":
+            LOG.warning(f"Last query is not user query: {user_query}")
+            user_id = None
+        if user_id is None:
+            return await _create_chat(*args, **kwargs)
+
+        u = await mb_client.get_or_create_user(string_to_uuid(user_id))
+        kwargs["messages"] = await async_user_context_insert(
+            kwargs["messages"], u, additional_memory_prompt, max_context_size
+        )
+        response = await _create_chat(*args, **kwargs)
+
+        if is_streaming:
+
+            async def yield_response_and_log():
+                total_response = ""
+                r_role = None
+
+                async for r in response:
+                    yield r
+                    try:
+                        r_string = r.choices[0].delta.content
+                        r_role = r_role or r.choices[0].delta.role
+                        total_response += r_string or ""
+                    except Exception:
+                        continue
+                if not len(total_response):
+                    return
+                if r_role != "assistant":
+                    LOG.warning(f"Last response is not assistant response: {r_role}")
+                    return
+                await writer.add(u.user_id, chat_blob(user_query, total_response))
+
+            return yield_response_and_log()
+
+        r_role = response.choices[0].message.role
+        if r_role != "assistant":
+            LOG.warning(f"Last response is not assistant response: {r_role}")
+            return response
+        r_string = response.choices[0].message.content
+        await writer.add(u.user_id, chat_blob(user_query, r_string))
+        return response
+
+    return async_chat
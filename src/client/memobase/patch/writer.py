@@ -0,0 +1,308 @@
+"""
+Background writers of the chats captured by the patches.
+
+A completion only queues its messages. One background thread, or one task
+for the async clients, groups the pending blobs by user and inserts them in
+bulk with `batch_insert`:
+
+- a batch is sent once `max_batch_size` blobs wait, or `flush_interval`
+  seconds after the first one,
+- at most `max_pending` blobs wait. A caller finding the writer full waits up
+  to `put_timeout` seconds for room, then its blob is dropped with a warning,
+- a failed `batch_insert` is retried `retries` times, `retry_delay` seconds
+  apart and doubling, before its blobs are dropped with an error,
+- the blobs still pending at interpreter exit are inserted before it exits.
+"""
+
+import time
+import atexit
+import asyncio
+import threading
+from ..utils import LOG
+from ..core.blob import Blob
+from ..core.entry import MemoBaseClient
+from ..core.async_entry import AsyncMemoBaseClient
+
+
+class BlobBuffer:
+    """Pending blobs grouped by user, in insertion order"""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.size = 0
+        self._users: dict[str, list[Blob]] = {}
+
+    def full(self) -> bool:
+        return self.size >= self.max_pending
+
+    def add(self, user_id: str, blob: Blob):
+        self._users.setdefault(user_id, []).append(blob)
+        self.size += 1
+
+    def take(self, max_size: int) -> list[tuple[str, Blob]]:
+        """Up to `max_size` (user_id, blob) pairs, a user's blobs stay together"""
+        batch = []
+        for user_id in list(self._users):
+            blobs = self._users[user_id]
+            room = max_size - len(batch)
+            batch.extend((user_id, blob) for blob in blobs[:room])
+            if room >= len(blobs):
+                del self._users[user_id]
+            else:
+                self._users[user_id] = blobs[room:]
+            if len(batch) >= max_size:
+                break
+        self.size -= len(batch)
+        return batch
+
+
+def write_with_retries(
+    batch_insert, batch: list[tuple[str, Blob]], retries: int, retry_delay: float
+):
+    for attempt in range(retries + 1):
+        try:
+            batch_insert(batch)
+            LOG.debug(f"Inserted {len(batch)} blobs")
+            return
+        except Exception as e:
+            if attempt == retries:
+                LOG.error(f"Failed to insert {len(batch)} blobs, dropping them: {e}")
+                return
+            delay = retry_delay * 2**attempt
+            LOG.warning(
+                f"Failed to insert {len(batch)} blobs, retrying in {delay}s: {e}"
+            )
+            time.sleep(delay)
+
+
+class MemoryWriter:
+    def __init__(
+        self,
+        mb_client: MemoBaseClient,
+        max_pending: int = 1000,
+        max_batch_size: int = 100,
+        flush_interval: float = 0.5,
+        put_timeout: float = 5,
+        retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.mb_client = mb_client
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._buffer = BlobBuffer(max_pending)
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._inflight = 0
+        self._urgent = False
+        self._closed = False
+        atexit.register(self.close)
+
+    def add(self, user_id: str, blob: Blob) -> bool:
+        """Queue a blob, returns False if it was dropped"""
+        with self._cond:
+            if self._closed:
+                LOG.warning(f"Memory writer is closed, dropping a blob of {user_id}")
+                return False
+            if not self._cond.wait_for(
+                lambda: not self._buffer.full(), timeout=self.put_timeout
+            ):
+                LOG.warning(f"Memory writer is full, dropping a blob of {user_id}")
+                return False
+            self._buffer.add(user_id, blob)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="memobase-writer", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify_all()
+        return True
+
+    def _ready(self) -> bool:
+        return (
+            self._buffer.size >= self.max_batch_size or self._urgent or self._closed
+        )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._buffer.size or self._closed)
+                if not self._buffer.size:
+                    return
+                # let the batch fill up
+                self._cond.wait_for(self._ready, timeout=self.flush_interval)
+                batch = self._buffer.take(self.max_batch_size)
+                self._inflight += 1
+                # room for the callers waiting on a full writer
+                self._cond.notify_all()
+            self._write(batch)
+            with self._cond:
+                self._inflight -= 1
+                if not self._buffer.size and not self._inflight:
+                    self._urgent = False
+                self._cond.notify_all()
+
+    def _write(self, batch: list[tuple[str, Blob]]):
+        write_with_retries(
+            self.mb_client.batch_insert, batch, self.retries, self.retry_delay
+        )
+
+    def flush(self, timeout: float = None) -> bool:
+        """Insert the pending blobs now, returns False on timeout"""
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: not self._buffer.size and not self._inflight, timeout=timeout
+            )
+
+    def close(self, timeout: float = 30):
+        """Insert the pending blobs and stop, runs at interpreter exit too"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        atexit.unregister(self.close)
+
+
+class AsyncMemoryWriter:
+    """`MemoryWriter` for `AsyncMemoBaseClient`, its task runs while blobs are pending"""
+
+    def __init__(
+        self,
+        mb_client: AsyncMemoBaseClient,
+        max_pending: int = 1000,
+        max_batch_size: int = 100,
+        flush_interval: float = 0.5,
+        put_timeout: float = 5,
+        retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.mb_client = mb_client
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._buffer = BlobBuffer(max_pending)
+        self._cond = asyncio.Condition()
+        self._task: asyncio.Task | None = None
+        self._running = False
+        self._inflight = 0
+        self._urgent = False
+        self._closed = False
+        atexit.register(self._drain_at_exit)
+
+    async def add(self, user_id: str, blob: Blob) -> bool:
+        """Queue a blob, returns False if it was dropped"""
+        async with self._cond:
+            if self._closed:
+                LOG.warning(f"Memory writer is closed, dropping a blob of {user_id}")
+                return False
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: not self._buffer.full()),
+                    self.put_timeout,
+                )
+            except asyncio.TimeoutError:
+                LOG.warning(f"Memory writer is full, dropping a blob of {user_id}")
+                return False
+            self._buffer.add(user_id, blob)
+            if not self._running:
+                self._running = True
+                self._task = asyncio.create_task(self._run())
+            self._cond.notify_all()
+        return True
+
+    def _ready(self) -> bool:
+        return (
+            self._buffer.size >= self.max_batch_size or self._urgent or self._closed
+        )
+
+    async def _run(self):
+        while True:
+            async with self._cond:
+                # stop when idle, so no task is left pending on the event loop
+                if not self._buffer.size:
+                    self._running = False
+                    return
+                # let the batch fill up
+                try:
+                    await asyncio.wait_for(
+                        self._cond.wait_for(self._ready), self.flush_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                batch = self._buffer.take(self.max_batch_size)
+                self._inflight += 1
+                # room for the callers waiting on a full writer
+                self._cond.notify_all()
+            await self._write(batch)
+            async with self._cond:
+                self._inflight -= 1
+                if not self._buffer.size and not self._inflight:
+                    self._urgent = False
+                self._cond.notify_all()
+
+    async def _write(self, batch: list[tuple[str, Blob]]):
+        for attempt in range(self.retries + 1):
+            try:
+                await self.mb_client.batch_insert(batch)
+                LOG.debug(f"Inserted {len(batch)} blobs")
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    LOG.error(
+                        f"Failed to insert {len(batch)} blobs, dropping them: {e}"
+                    )
+                    return
+                delay = self.retry_delay * 2**attempt
+                LOG.warning(
+                    f"Failed to insert {len(batch)} blobs, retrying in {delay}s: {e}"
+                )
+                await asyncio.sleep(delay)
+
+    async def flush(self, timeout: float = None) -> bool:
+        """Insert the pending blobs now, returns False on timeout"""
+        async with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(
+                        lambda: not self._buffer.size and not self._inflight
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def close(self):
+        """Insert the pending blobs and stop, call it before the event loop ends"""
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._task is not None:
+            await self._task
+        atexit.unregister(self._drain_at_exit)
+
+    def _drain_at_exit(self):
+        # the event loop is usually gone by now, so use a sync client
+        if not self._buffer.size:
+            return
+        LOG.info(f"Inserting {self._buffer.size} pending blobs before exit")
+        client = MemoBaseClient(
+            api_key=self.mb_client.api_key,
+            project_url=self.mb_client.project_url,
+            api_version=self.mb_client.api_version,
+        )
+        while self._buffer.size:
+            batch = self._buffer.take(self.max_batch_size)
+            write_with_retries(
+                client.batch_insert, batch, self.retries, self.retry_delay
+            )
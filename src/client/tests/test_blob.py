@@ -37,6 +37,20 @@ def test_blob_get_all(api_client):
     a.delete_user(u)
 
 
+def test_blob_iter_blobs(api_client):
+    a = api_client
+    blob = DocBlob(content="test", fields={"1": "fool"})
+    u = a.add_user()
+    ud = a.get_user(u)
+
+    bs = [ud.insert(blob) for _ in range(5)]
+    r = list(ud.iter_blobs(BlobType.doc, page_size=2))
+    assert r == bs
+    users = [user["id"] for user in a.iter_users(search=u[:8], page_size=1)]
+    assert u in users
+    a.delete_user(u)
+
+
 def test_flush_curd_client(api_client):
     mb = api_client
     uid = mb.add_user({"me": "test"})
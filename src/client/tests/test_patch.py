@@ -0,0 +1,206 @@
+import json
+import time
+import httpx
+import asyncio
+import threading
+import pytest
+from openai import OpenAI, AsyncOpenAI
+from memobase import AsyncMemoBaseClient
+from memobase.core.blob import ChatBlob
+from memobase.utils import string_to_uuid
+from memobase.patch.openai import openai_memory
+from memobase.patch.writer import MemoryWriter, AsyncMemoryWriter
+
+
+class RecordingClient:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.batches = []
+
+    def batch_insert(self, user_blobs, sync=False):
+        time.sleep(self.delay)
+        self.batches.append(user_blobs)
+        return [str(i) for i in range(len(user_blobs))]
+
+
+class AsyncRecordingClient(RecordingClient):
+    async def batch_insert(self, user_blobs, sync=False):
+        await asyncio.sleep(self.delay)
+        self.batches.append(user_blobs)
+        return [str(i) for i in range(len(user_blobs))]
+
+
+class FlakyClient(RecordingClient):
+    """Fails the first `failures` inserts"""
+
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+
+    def batch_insert(self, user_blobs, sync=False):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("server unavailable")
+        return super().batch_insert(user_blobs, sync)
+
+
+class AsyncFlakyClient(FlakyClient):
+    async def batch_insert(self, user_blobs, sync=False):
+        return FlakyClient.batch_insert(self, user_blobs, sync)
+
+
+def chat(i: int) -> ChatBlob:
+    return ChatBlob(messages=[{"role": "user", "content": f"hello {i}"}])
+
+
+def test_memory_writer_batches_by_user():
+    client = RecordingClient()
+    writer = MemoryWriter(client, max_batch_size=50, flush_interval=0.05)
+    threads = [
+        threading.Thread(
+            target=lambda u=u: [writer.add(f"user_{u}", chat(i)) for i in range(30)]
+        )
+        for u in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert writer.flush(timeout=5)
+    assert sum(len(b) for b in client.batches) == 120
+    assert all(len(b) <= 50 for b in client.batches)
+    assert len(client.batches) <= 4
+    # every user's chats are inserted in order
+    for u in range(4):
+        contents = [
+            blob.messages[0].content
+            for batch in client.batches
+            for user_id, blob in batch
+            if user_id == f"user_{u}"
+        ]
+        assert contents == [f"hello {i}" for i in range(30)]
+    writer.close()
+
+
+def test_memory_writer_backpressure():
+    client = RecordingClient(delay=0.3)
+    writer = MemoryWriter(
+        client, max_pending=2, max_batch_size=2, flush_interval=0, put_timeout=0.05
+    )
+    results = [writer.add("user", chat(i)) for i in range(6)]
+    # the writer holds 2 blobs and sends 2 at a time, callers wait or drop
+    assert results[:2] == [True, True]
+    assert not all(results)
+    writer.close()
+    assert sum(len(b) for b in client.batches) == sum(results)
+
+
+def test_memory_writer_retries_failed_inserts():
+    client = FlakyClient(failures=2)
+    writer = MemoryWriter(client, flush_interval=0, retries=2, retry_delay=0.01)
+    assert all(writer.add("user", chat(i)) for i in range(5))
+    assert writer.flush(timeout=5)
+    assert client.attempts == 3
+    assert sum(len(b) for b in client.batches) == 5
+
+    # the server stays down, the batch is dropped after the retries
+    client = FlakyClient(failures=10)
+    writer = MemoryWriter(client, flush_interval=0, retries=2, retry_delay=0.01)
+    assert writer.add("user", chat(0))
+    assert writer.flush(timeout=5)
+    assert client.attempts == 3
+    assert not client.batches
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_async_memory_writer_retries_failed_inserts():
+    client = AsyncFlakyClient(failures=2)
+    writer = AsyncMemoryWriter(client, flush_interval=0, retries=2, retry_delay=0.01)
+    await asyncio.gather(*[writer.add("user", chat(i)) for i in range(5)])
+    assert await writer.flush(timeout=5)
+    assert client.attempts == 3
+    assert sum(len(b) for b in client.batches) == 5
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_async_memory_writer_drains_on_close():
+    client = AsyncRecordingClient(delay=0.01)
+    writer = AsyncMemoryWriter(client, max_batch_size=10, flush_interval=0.05)
+    await asyncio.gather(*[writer.add(f"user_{i % 3}", chat(i)) for i in range(25)])
+    assert not client.batches
+    await writer.close()
+    assert sum(len(b) for b in client.batches) == 25
+    assert len(client.batches) == 3
+    assert not await writer.add("user_0", chat(25))
+
+
+def openai_transport(request: httpx.Request) -> httpx.Response:
+    body = json.loads(request.content)
+    return httpx.Response(
+        200,
+        json={
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "Hi Gus"},
+                }
+            ],
+        },
+    )
+
+
+def test_patch_openai_writes_in_background(api_client):
+    client = openai_memory(
+        OpenAI(
+            api_key="test",
+            http_client=httpx.Client(transport=httpx.MockTransport(openai_transport)),
+        ),
+        api_client,
+    )
+    user = f"test_patch_{time.time()}"
+    r = client.chat.completions.create(
+        messages=[{"role": "user", "content": "I'm Gus"}],
+        model="gpt-4o-mini",
+        user_id=user,
+    )
+    assert r.choices[0].message.content == "Hi Gus"
+    assert client.memory_writer.flush(timeout=10)
+    u = api_client.get_user(string_to_uuid(user))
+    assert len(list(u.iter_blobs("chat"))) == 1
+    api_client.delete_user(u.user_id)
+
+
+@pytest.mark.asyncio
+async def test_patch_async_openai_writes_in_background(api_client):
+    mb_client = AsyncMemoBaseClient(
+        project_url=api_client.project_url, api_key=api_client.api_key
+    )
+    client = openai_memory(
+        AsyncOpenAI(
+            api_key="test",
+            http_client=httpx.AsyncClient(
+                transport=httpx.MockTransport(openai_transport)
+            ),
+        ),
+        mb_client,
+    )
+    user = f"test_patch_async_{time.time()}"
+    r = await client.chat.completions.create(
+        messages=[{"role": "user", "content": "I'm Gus"}],
+        model="gpt-4o-mini",
+        user_id=user,
+    )
+    assert r.choices[0].message.content == "Hi Gus"
+    await client.memory_writer.close()
+    u = api_client.get_user(string_to_uuid(user))
+    assert len(list(u.iter_blobs("chat"))) == 1
+    api_client.delete_user(u.user_id)
+    await mb_client.close()
@@ -32,6 +32,31 @@ def test_user_profile_curd_client(api_client):
     assert len(ps) == 0
 
 
+def test_user_stream_context_client(api_client):
+    u = api_client.add_user()
+    ud = api_client.get_user(u)
+    ud.add_profile("user likes to play basketball", "interest", "sports")
+    chunks = list(ud.stream_context())
+    assert chunks[-1].type == "context"
+    assert {c.type for c in chunks} == {"profile", "event", "context"}
+    assert chunks[-1].content == ud.context()
+    assert "basketball" in chunks[-1].content
+    api_client.delete_user(u)
+
+
+def test_users_context_client(api_client):
+    u_ids = [api_client.add_user() for _ in range(2)]
+    api_client.get_user(u_ids[0]).add_profile(
+        "user likes to play basketball", "interest", "sports"
+    )
+    contexts = api_client.get_users_context(u_ids)
+    assert list(contexts) == u_ids
+    assert "basketball" in contexts[u_ids[0]]
+    assert contexts[u_ids[1]] == api_client.get_user(u_ids[1]).context()
+    for u_id in u_ids:
+        api_client.delete_user(u_id)
+
+
 def test_user_curd_client(api_client):
     a = api_client
 
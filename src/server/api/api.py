@@ -1,5 +1,6 @@
 import memobase_server.env
 import os
+import asyncio
 
 # Done setting up env
 from contextlib import asynccontextmanager
@@ -11,21 +12,62 @@ from memobase_server.connectors import (
     init_redis_pool,
 )
 from memobase_server import api_layer
-from memobase_server.env import LOG, TRACE_LOG
+from memobase_server.env import CONFIG, LOG, TRACE_LOG, get_encoder
+from memobase_server.migrate import ensure_schema
 from memobase_server.llms.embeddings import check_embedding_sanity
 from memobase_server.llms import llm_sanity_check
+from memobase_server.controllers.project_cache import (
+    listen_project_cache_invalidation,
+)
+from memobase_server.worker import FLUSH_WORKER
+from memobase_server.telemetry import telemetry_manager, setup_tracing, shutdown_tracing
+from memobase_server.telemetry.capture_key import TELEMETRY_COUNTERS
+from memobase_server.controllers.billing import run_billing_reconciler
 from memobase_server.api_layer.docs import API_X_CODE_DOCS
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 
 
+async def providers_sanity_check():
+    await asyncio.gather(check_embedding_sanity(), llm_sanity_check())
+
+
+async def background_sanity_check():
+    try:
+        await providers_sanity_check()
+    except Exception as e:
+        LOG.error(f"Sanity check failed, the server keeps running: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_redis_pool()
-    await check_embedding_sanity()
-    await llm_sanity_check()
+    telemetry_manager.start_prometheus_server()
+    setup_tracing()
+    await asyncio.gather(
+        asyncio.to_thread(ensure_schema), asyncio.to_thread(get_encoder)
+    )
+    if CONFIG.sanity_check_mode == "startup":
+        await providers_sanity_check()
+    elif CONFIG.sanity_check_mode == "background":
+        sanity_check = asyncio.create_task(background_sanity_check())
+    project_cache_listener = asyncio.create_task(listen_project_cache_invalidation())
+    telemetry_counters = asyncio.create_task(TELEMETRY_COUNTERS.run())
+    billing_reconciler = asyncio.create_task(run_billing_reconciler())
+    if CONFIG.flush_worker_mode == "in_process":
+        flush_worker = asyncio.create_task(FLUSH_WORKER.run())
     LOG.info(f"Start Memobase Server {memobase_server.__version__} 🖼️")
     yield
+    if CONFIG.flush_worker_mode == "in_process":
+        await FLUSH_WORKER.stop()
+        await flush_worker
+    project_cache_listener.cancel()
+    if CONFIG.sanity_check_mode == "background":
+        sanity_check.cancel()
+    billing_reconciler.cancel()
+    await TELEMETRY_COUNTERS.stop()
+    await telemetry_counters
     await close_connection()
+    shutdown_tracing()
 
 
 app = FastAPI(
@@ -132,6 +174,13 @@ router.get(
 )(api_layer.project.get_project_usage)
 
 
+router.get(
+    "/project/export",
+    tags=["project"],
+    openapi_extra=API_X_CODE_DOCS["GET /project/export"],
+)(api_layer.project.export_project_archive)
+
+
 router.post(
     "/users",
     tags=["user"],
@@ -166,6 +215,13 @@ router.get(
 )(api_layer.user.get_user_all_blobs)
 
 
+router.post(
+    "/blobs/insert",
+    tags=["blob"],
+    openapi_extra=API_X_CODE_DOCS["POST /blobs/insert"],
+)(api_layer.blob.insert_blobs)
+
+
 router.post(
     "/blobs/insert/{user_id}",
     tags=["blob"],
@@ -258,6 +314,12 @@ router.get(
     openapi_extra=API_X_CODE_DOCS["GET /users/event_gist/search/{user_id}"],
 )(api_layer.event.search_user_event_gists)
 
+router.post(
+    "/users/context/batch",
+    tags=["context"],
+    openapi_extra=API_X_CODE_DOCS["POST /users/context/batch"],
+)(api_layer.context.get_users_context)
+
 router.get(
     "/users/context/{user_id}",
     tags=["context"],
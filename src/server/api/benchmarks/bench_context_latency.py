@@ -0,0 +1,105 @@
+"""Latency benchmark for `GET /users/context` under concurrent load.
+
+Run it against a live Memobase server (e.g. `docker compose up`):
+
+    python benchmarks/bench_context_latency.py \
+        --url http://localhost:8019 --token secret --concurrency 200 --requests 2000
+
+It creates one user with a handful of profiles, then fires `--requests`
+context calls with at most `--concurrency` in flight and reports p50/p95/p99.
+"""
+
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+import httpx
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index = min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+async def prepare_user(client: httpx.AsyncClient, profiles: int) -> str:
+    user_id = str(uuid.uuid4())
+    r = await client.post("/users", json={"id": user_id, "data": {}})
+    r.raise_for_status()
+    for i in range(profiles):
+        r = await client.post(
+            f"/users/profile/{user_id}",
+            json={
+                "content": f"benchmark profile content number {i}",
+                "attributes": {"topic": f"topic_{i % 5}", "sub_topic": f"sub_{i}"},
+            },
+        )
+        r.raise_for_status()
+    return user_id
+
+
+async def run(args: argparse.Namespace) -> None:
+    limits = httpx.Limits(
+        max_connections=args.concurrency, max_keepalive_connections=args.concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=f"{args.url.rstrip('/')}/api/v1",
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=limits,
+        timeout=args.timeout,
+    ) as client:
+        user_id = await prepare_user(client, args.profiles)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies: list[float] = []
+        errors = 0
+
+        async def one_request():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    r = await client.get(
+                        f"/users/context/{user_id}",
+                        params={"max_token_size": args.max_token_size},
+                    )
+                    if r.status_code != 200 or r.json().get("errno") != 0:
+                        errors += 1
+                        return
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        # warm up connections and caches
+        await asyncio.gather(*[one_request() for _ in range(args.concurrency)])
+        latencies.clear()
+        errors = 0
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one_request() for _ in range(args.requests)])
+        total_s = time.perf_counter() - start
+
+        await client.delete(f"/users/{user_id}")
+
+    print(f"requests: {args.requests}, concurrency: {args.concurrency}")
+    print(f"errors: {errors}")
+    print(f"throughput: {len(latencies) / total_s:.1f} req/s")
+    if latencies:
+        print(f"mean: {statistics.mean(latencies):.1f} ms")
+        for q in (50, 95, 99):
+            print(f"p{q}: {percentile(latencies, q):.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8019")
+    parser.add_argument("--token", default="secret")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--profiles", type=int, default=20)
+    parser.add_argument("--max-token-size", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=60)
+    asyncio.run(run(parser.parse_args()))
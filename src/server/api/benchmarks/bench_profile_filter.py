@@ -0,0 +1,143 @@
+"""Latency benchmark for `filter_profiles_with_chats`, LLM picker vs embedding ranking.
+
+Run it from `src/server/api` with the same environment as the tests
+(`DATABASE_URL`, `REDIS_URL`, `MEMOBASE_LLM_API_KEY`):
+
+    python benchmarks/bench_profile_filter.py --profiles 100 --rounds 50 \
+        --llm-latency-ms 1200 --embedding-latency-ms 80
+
+The LLM and embedding providers are replaced by fakes that sleep for the given
+latency, so the numbers are the pipeline overhead plus the provider latency you
+expect. It writes one user with `--profiles` profiles (their embeddings are
+stored on write), times both modes with a different chat every round, then
+times the in-process cosine ranking alone for a few profile counts.
+"""
+
+import time
+import asyncio
+import hashlib
+import argparse
+import statistics
+from unittest.mock import patch
+import numpy as np
+from memobase_server.env import CONFIG
+from memobase_server import llms
+from memobase_server.llms import embeddings
+from memobase_server.models import response as res
+from memobase_server.models.database import DEFAULT_PROJECT_ID
+from memobase_server.controllers import full as controllers
+from memobase_server.controllers.post_process.profile import (
+    filter_profiles_with_chats,
+    top_k_cosine,
+)
+
+FAKE_PICK_RESPONSE = '{"reason": "benchmark", "ids": [0, 1, 2, 3, 4]}'
+
+
+def percentile(samples: list[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))]
+
+
+def install_fake_providers(args: argparse.Namespace, stats: dict) -> None:
+    async def fake_complete(model, prompt, system_prompt=None, **kwargs):
+        stats["llm_calls"] += 1
+        await asyncio.sleep(args.llm_latency_ms / 1000)
+        return FAKE_PICK_RESPONSE
+
+    async def fake_embedding(model, texts, phase):
+        stats["embedding_calls"] += 1
+        await asyncio.sleep(args.embedding_latency_ms / 1000)
+        vectors = []
+        for t in texts:
+            seed = int.from_bytes(hashlib.sha256(t.encode()).digest()[:8], "big")
+            vectors.append(np.random.default_rng(seed).standard_normal(CONFIG.embedding_dim))
+        return np.array(vectors, dtype=np.float32)
+
+    llms.FACTORIES[CONFIG.llm_style] = fake_complete
+    embeddings.FACTORIES[CONFIG.embedding_provider] = fake_embedding
+
+
+async def time_mode(user_id: str, mode: str, rounds: int) -> list[float]:
+    samples = []
+    with patch.object(CONFIG, "profile_filter_mode", mode):
+        for i in range(rounds):
+            profiles = (
+                await controllers.profile.get_user_profiles(user_id, DEFAULT_PROJECT_ID)
+            ).data()
+            chats = [
+                res.OpenAICompatibleMessage(
+                    role="user", content=f"round {i} {mode}: what should I eat tonight?"
+                )
+            ]
+            start = time.perf_counter()
+            p = await filter_profiles_with_chats(
+                user_id, DEFAULT_PROJECT_ID, profiles, chats
+            )
+            samples.append((time.perf_counter() - start) * 1000)
+            assert p.ok(), p.msg()
+    return samples
+
+
+def time_ranking(n: int, rounds: int) -> list[float]:
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((n, CONFIG.embedding_dim)).astype(np.float32)
+    query = rng.standard_normal(CONFIG.embedding_dim).astype(np.float32)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        top_k_cosine(query, matrix, CONFIG.profile_filter_topk)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+async def run(args: argparse.Namespace) -> None:
+    stats = {"llm_calls": 0, "embedding_calls": 0}
+    install_fake_providers(args, stats)
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok(), p.msg()
+    user_id = p.data().id
+    try:
+        with patch.object(CONFIG, "profile_filter_mode", "embedding"):
+            p = await controllers.profile.add_user_profiles(
+                user_id,
+                DEFAULT_PROJECT_ID,
+                [f"user mentioned fact number {i}" for i in range(args.profiles)],
+                [
+                    {"topic": f"topic_{i % 10}", "sub_topic": f"sub_topic_{i}"}
+                    for i in range(args.profiles)
+                ],
+            )
+            assert p.ok(), p.msg()
+
+        print(
+            f"profiles: {args.profiles}, rounds: {args.rounds}, "
+            f"llm latency: {args.llm_latency_ms}ms, embedding latency: {args.embedding_latency_ms}ms"
+        )
+        for mode in ("llm", "embedding"):
+            stats.update(llm_calls=0, embedding_calls=0)
+            samples = await time_mode(user_id, mode, args.rounds)
+            print(
+                f"{mode:<10} mean {statistics.mean(samples):8.1f} ms"
+                f"  p50 {percentile(samples, 50):8.1f} ms"
+                f"  p95 {percentile(samples, 95):8.1f} ms"
+                f"  llm calls {stats['llm_calls']}, embedding calls {stats['embedding_calls']}"
+            )
+    finally:
+        await controllers.user.delete_user(user_id, DEFAULT_PROJECT_ID)
+
+    for n in (100, 1000, 10000):
+        samples = time_ranking(n, args.rounds)
+        print(
+            f"top_k_cosine {n:>6} profiles  mean {statistics.mean(samples):8.3f} ms"
+            f"  p95 {percentile(samples, 95):8.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profiles", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--llm-latency-ms", type=float, default=1200)
+    parser.add_argument("--embedding-latency-ms", type=float, default=80)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""Micro-benchmark for `truncate_profiles` and `truncate_event_gists`.
+
+Run it from `src/server/api` with the same environment as the tests
+(`DATABASE_URL`, `REDIS_URL`, `MEMOBASE_LLM_API_KEY`):
+
+    python benchmarks/bench_truncate.py --profiles 1000 --rounds 200
+
+Each case is timed three ways: stored token sizes (rows written by this
+version), counted through the token-count cache (warm), and re-tokenized from
+scratch (cold cache, the old behaviour).
+"""
+
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+from datetime import datetime
+from memobase_server.models.response import (
+    ProfileData,
+    UserProfilesData,
+    UserEventGistData,
+    UserEventGistsData,
+)
+from memobase_server.controllers.profile import truncate_profiles
+from memobase_server.controllers.event_gist import truncate_event_gists
+from memobase_server.utils import (
+    TOKEN_COUNT_CACHE,
+    count_tokens,
+    get_profile_token_size,
+)
+
+
+def build_profiles(n: int, stored: bool) -> UserProfilesData:
+    profiles = []
+    for i in range(n):
+        content = f"user mentioned fact number {i}, likes topic {i % 13} and item {i * 7}"
+        attributes = {"topic": f"topic_{i % 20}", "sub_topic": f"sub_topic_{i}"}
+        profiles.append(
+            ProfileData(
+                id=uuid.uuid4(),
+                content=content,
+                attributes=attributes,
+                token_size=get_profile_token_size(content, attributes) if stored else None,
+                created_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
+        )
+    return UserProfilesData(profiles=profiles)
+
+
+def build_gists(n: int, stored: bool) -> UserEventGistsData:
+    gists = []
+    for i in range(n):
+        content = f"- user went to place {i} with friend {i % 17} [mentioned at 2025/01/{i % 28 + 1:02d}]"
+        gists.append(
+            UserEventGistData(
+                id=uuid.uuid4(),
+                gist_data={"content": content},
+                token_size=count_tokens(content) if stored else None,
+                created_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
+        )
+    return UserEventGistsData(gists=gists)
+
+
+async def time_case(build, truncate, n: int, rounds: int, mode: str) -> list[float]:
+    data = build(n, stored=mode == "stored")
+    samples = []
+    for _ in range(rounds):
+        if mode == "cold":
+            TOKEN_COUNT_CACHE.clear()
+        items = data.model_copy(deep=False)
+        start = time.perf_counter()
+        await truncate(items)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+async def run(args: argparse.Namespace) -> None:
+    cases = {
+        "truncate_profiles": (
+            build_profiles,
+            lambda d: truncate_profiles(d, max_token_size=args.max_token_size),
+        ),
+        "truncate_event_gists": (
+            build_gists,
+            lambda d: truncate_event_gists(d, max_token_size=args.max_token_size),
+        ),
+    }
+    print(f"items: {args.profiles}, rounds: {args.rounds}, max_token_size: {args.max_token_size}")
+    for name, (build, truncate) in cases.items():
+        for mode in ("stored", "warm", "cold"):
+            samples = await time_case(build, truncate, args.profiles, args.rounds, mode)
+            print(
+                f"{name:<22} {mode:<7} mean {statistics.mean(samples):8.3f} ms"
+                f"  p95 {sorted(samples)[int(len(samples) * 0.95) - 1]:8.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profiles", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=200)
+    # large enough that every item is visited
+    parser.add_argument("--max-token-size", type=int, default=10**7)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,308 @@
+"""Offline load test of the Memobase server with fake LLM and embedding providers.
+
+Run it from `src/server/api` with the same environment as the tests
+(`DATABASE_URL`, `REDIS_URL`, `MEMOBASE_LLM_API_KEY`):
+
+    python benchmarks/load_test.py --users 50 --requests 5000 --concurrency 100 \
+        --mix insert=60,context=20,profile=15,flush=5 --llm-latency-ms 300
+
+It starts `api.py` with uvicorn in a child process. In that process,
+`llm_complete` and `get_embedding` go to deterministic fakes that sleep for the
+given latency, so no provider is called. The parent drives a random mix of
+routes against it and prints:
+- throughput and p50/p95/p99 per route;
+- DB pool utilization sampled from `get_pool_status`;
+- LLM calls per buffer flush.
+
+Keep the numbers of one machine as a baseline and compare before deploying.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import signal
+import asyncio
+import hashlib
+import argparse
+import logging
+import statistics
+import subprocess
+import tempfile
+import httpx
+import numpy as np
+from bench_context_latency import percentile
+
+# parses as profile facts for extract and as actions for merge, other prompts take it as text.
+# The number changes per call, so events don't all hit the embedding cache.
+FAKE_LLM_RESPONSE = """- basic_info::name::load test user
+- interest::sports::likes running {n} kilometers in the morning
+1. UPDATE::load test user
+2. UPDATE::likes running {n} kilometers in the morning"""
+
+CHAT_MESSAGES = [
+    {"role": "user", "content": "I went running this morning before work, it was cold."},
+    {"role": "assistant", "content": "Nice! How far did you run today?"},
+    {"role": "user", "content": "About five kilometers, I'm training for a half marathon."},
+]
+
+ROUTES = ("insert", "context", "profile", "flush")
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        assert name in ROUTES, f"Unknown route {name}, available: {ROUTES}"
+        weights[name] = int(weight)
+    return weights
+
+
+# ---------------------------------------------------------------- server side
+
+
+def install_fake_providers(args: argparse.Namespace, stats: dict) -> None:
+    from memobase_server.env import CONFIG
+    from memobase_server import llms
+    from memobase_server.llms import embeddings
+    from memobase_server.controllers import modal
+
+    async def fake_complete(model, prompt, system_prompt=None, **kwargs):
+        stats["llm_calls"] += 1
+        n = stats["llm_calls"]
+        await asyncio.sleep(args.llm_latency_ms / 1000)
+        return FAKE_LLM_RESPONSE.format(n=n)
+
+    async def fake_embedding(model, texts, phase):
+        stats["embedding_calls"] += 1
+        await asyncio.sleep(args.embedding_latency_ms / 1000)
+        vectors = []
+        for t in texts:
+            seed = int.from_bytes(hashlib.sha256(t.encode()).digest()[:8], "big")
+            v = np.random.default_rng(seed).standard_normal(CONFIG.embedding_dim)
+            vectors.append(v / np.linalg.norm(v))
+        return np.array(vectors, dtype=np.float32)
+
+    llms.FACTORIES[CONFIG.llm_style] = fake_complete
+    embeddings.FACTORIES[CONFIG.embedding_provider] = fake_embedding
+
+    for blob_type, process in list(modal.BLOBS_PROCESS.items()):
+
+        async def counted_process(user_id, project_id, blobs, _process=process):
+            stats["flushes"] += 1
+            stats["flushed_blobs"] += len(blobs)
+            return await _process(user_id, project_id, blobs)
+
+        modal.BLOBS_PROCESS[blob_type] = counted_process
+
+
+async def sample_pool_status(stats: dict, interval_s: float) -> None:
+    from memobase_server.connectors import get_pool_status
+
+    while True:
+        status = get_pool_status()
+        stats["pool_utilization"].append(status["utilization_percent"])
+        stats["pool_checked_out"].append(status["checked_out"])
+        stats["pool_capacity"] = status["total_capacity"]
+        await asyncio.sleep(interval_s)
+
+
+def serve(args: argparse.Namespace) -> None:
+    import uvicorn
+
+    sys.path.insert(0, os.getcwd())
+    from api import app
+    from memobase_server.env import LOG
+
+    if isinstance(LOG, logging.Logger):
+        LOG.setLevel(args.log_level.upper())
+    stats = {
+        "llm_calls": 0,
+        "embedding_calls": 0,
+        "flushes": 0,
+        "flushed_blobs": 0,
+        "pool_utilization": [],
+        "pool_checked_out": [],
+        "pool_capacity": 0,
+    }
+    install_fake_providers(args, stats)
+
+    # uvicorn re-raises the stop signal after shutdown, don't let it kill us before the stats are written
+    signal.signal(signal.SIGTERM, lambda *_: None)
+
+    async def main():
+        server = uvicorn.Server(
+            uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning")
+        )
+        sampler = asyncio.create_task(sample_pool_status(stats, 0.1))
+        try:
+            await server.serve()
+        finally:
+            sampler.cancel()
+            with open(args.stats_file, "w") as f:
+                json.dump(stats, f)
+
+    asyncio.run(main())
+
+
+# ---------------------------------------------------------------- client side
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout_s: float) -> None:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        try:
+            r = await client.get("/healthcheck")
+            if r.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError("Server didn't become healthy in time")
+
+
+async def call_route(
+    client: httpx.AsyncClient, route: str, user_id: str, args: argparse.Namespace
+) -> httpx.Response:
+    if route == "insert":
+        return await client.post(
+            f"/blobs/insert/{user_id}",
+            json={"blob_type": "chat", "blob_data": {"messages": CHAT_MESSAGES}},
+        )
+    if route == "context":
+        return await client.get(
+            f"/users/context/{user_id}", params={"max_token_size": 500}
+        )
+    if route == "profile":
+        return await client.get(f"/users/profile/{user_id}")
+    return await client.post(
+        f"/users/buffer/{user_id}/chat",
+        params={"wait_process": args.wait_process},
+    )
+
+
+async def drive(args: argparse.Namespace) -> None:
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(
+        max_connections=args.concurrency, max_keepalive_connections=args.concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{args.port}/api/v1",
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=limits,
+        timeout=args.timeout,
+    ) as client:
+        await wait_until_ready(client, args.startup_timeout)
+        user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+        for user_id in user_ids:
+            r = await client.post("/users", json={"id": user_id, "data": {}})
+            r.raise_for_status()
+
+        plan = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+        targets = [rng.choice(user_ids) for _ in plan]
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies: dict[str, list[float]] = {route: [] for route in weights}
+        errors: dict[str, int] = {route: 0 for route in weights}
+
+        async def one_request(route: str, user_id: str):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    r = await call_route(client, route, user_id, args)
+                    ok = r.status_code == 200 and r.json().get("errno") == 0
+                except httpx.HTTPError:
+                    ok = False
+                if not ok:
+                    errors[route] += 1
+                    return
+                latencies[route].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one_request(r, u) for r, u in zip(plan, targets)])
+        total_s = time.perf_counter() - start
+
+        # let background flushes finish before the server stops
+        await asyncio.sleep(args.drain_seconds)
+        for user_id in user_ids:
+            await client.delete(f"/users/{user_id}")
+
+    done = sum(len(v) for v in latencies.values())
+    print(
+        f"users: {args.users}, requests: {args.requests}, concurrency: {args.concurrency}, "
+        f"llm latency: {args.llm_latency_ms} ms, embedding latency: {args.embedding_latency_ms} ms"
+    )
+    print(f"throughput: {done / total_s:.1f} req/s, errors: {sum(errors.values())}")
+    print(f"{'route':<8} {'count':>6} {'errors':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for route, samples in latencies.items():
+        mean = statistics.mean(samples) if samples else 0.0
+        print(
+            f"{route:<8} {len(samples):>6} {errors[route]:>6} {mean:>7.1f}ms"
+            + "".join(f" {percentile(samples, q):>7.1f}ms" for q in (50, 95, 99))
+        )
+
+
+def report_server_stats(stats_file: str) -> None:
+    with open(stats_file) as f:
+        stats = json.load(f)
+    utilization = stats["pool_utilization"] or [0]
+    print(
+        f"db pool utilization: mean {statistics.mean(utilization):.1f}%, "
+        f"max {max(utilization):.1f}%, "
+        f"max checked out {max(stats['pool_checked_out'] or [0])}/{stats['pool_capacity']}"
+    )
+    flushes = stats["flushes"]
+    print(
+        f"flushes: {flushes}, blobs flushed: {stats['flushed_blobs']}, "
+        f"llm calls: {stats['llm_calls']}, embedding calls: {stats['embedding_calls']}"
+    )
+    if flushes:
+        print(f"llm calls per flush: {stats['llm_calls'] / flushes:.2f}")
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.serve:
+        serve(args)
+        return
+    stats_file = os.path.join(tempfile.mkdtemp(), "server_stats.json")
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--serve",
+            f"--stats-file={stats_file}",
+            *sys.argv[1:],
+        ]
+    )
+    try:
+        asyncio.run(drive(args))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=args.startup_timeout)
+    report_server_stats(stats_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8029)
+    parser.add_argument("--token", default=os.getenv("ACCESS_TOKEN", "secret"))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--mix", default="insert=60,context=20,profile=15,flush=5")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument(
+        "--wait-process", action="store_true", help="flush requests wait for the LLM"
+    )
+    parser.add_argument("--drain-seconds", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--log-level", default="warning")
+    # internal, set on the server process
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--stats-file", help=argparse.SUPPRESS)
+    main(parser.parse_args())
@@ -7,7 +7,7 @@ import logging
 
 logging.disable(logging.CRITICAL)
 from memobase_server import __version__
-from memobase_server.connectors import DB_ENGINE
+from memobase_server.connectors import get_db_engine
 from memobase_server.models.database import (
     User,
     GeneralBlob,
@@ -20,7 +20,7 @@ print("--", f"Synced from backend {__version__}")
 for db in [User, GeneralBlob, BufferZone, UserProfile]:
     table_obj = db if isinstance(db, Table) else db.__table__
     # Print table creation
-    print(str(CreateTable(table_obj).compile(DB_ENGINE)).strip() + ";")
+    print(str(CreateTable(table_obj).compile(get_db_engine())).strip() + ";")
     # Print indexes
     for index in table_obj.indexes:
-        print(str(CreateIndex(index).compile(DB_ENGINE)).strip() + ";")
+        print(str(CreateIndex(index).compile(get_db_engine())).strip() + ";")
@@ -4,7 +4,7 @@ import traceback
 
 from ..controllers import full as controllers
 
-from ..env import TelemetryKeyName, TRACE_LOG
+from ..env import CONFIG, TelemetryKeyName, TRACE_LOG
 from ..models.response import CODE
 from ..models.utils import Promise
 from ..models import response as res
@@ -25,19 +25,9 @@ async def insert_blob(
         capture_int_key, TelemetryKeyName.insert_blob_request, project_id=project_id
     )
 
-    p = await controllers.billing.get_project_billing(project_id)
+    p = await controllers.billing.check_project_quota(project_id)
     if not p.ok():
         return p.to_response(res.IdResponse)
-    billing = p.data()
-
-    if billing.token_left is not None and billing.token_left < 0:
-        return Promise.reject(
-            CODE.SERVICE_UNAVAILABLE,
-            f"Your project reaches Memobase token limit, "
-            f"Left: {billing.token_left}, this project used: {billing.project_token_cost_month}. "
-            f"Your quota will be refilled on {billing.next_refill_at}. "
-            "\nhttps://www.memobase.io/pricing for more information.",
-        ).to_response(res.IdResponse)
 
     try:
         insert_result = await controllers.blob.insert_blob(
@@ -69,8 +59,7 @@ async def insert_blob(
                 )
                 if not p.ok():
                     return p.to_response(res.BaseResponse)
-                if p.data() is not None:
-                    final_results.append(p.data())
+                final_results.extend(p.data())
             else:
                 # async
                 background_tasks.add_task(
@@ -98,6 +87,85 @@ async def insert_blob(
     )
 
 
+async def insert_blobs(
+    request: Request,
+    wait_process: bool = Query(
+        False, description="Whether to wait for the blobs to be processed"
+    ),
+    batch_data: res.BlobsBatchData = Body(..., description="The blobs to insert"),
+    background_tasks: BackgroundTasks = BackgroundTasks(),
+) -> res.BlobsInsertResponse:
+    project_id = request.state.memobase_project_id
+    blobs = batch_data.blobs
+    if len(blobs) > CONFIG.max_blob_batch_size:
+        return Promise.reject(
+            CODE.BAD_REQUEST,
+            f"Too many blobs in one batch, {len(blobs)} > {CONFIG.max_blob_batch_size}",
+        ).to_response(res.BlobsInsertResponse)
+    background_tasks.add_task(
+        capture_int_key,
+        TelemetryKeyName.insert_blob_request,
+        len(blobs),
+        project_id=project_id,
+    )
+
+    p = await controllers.billing.check_project_quota(project_id)
+    if not p.ok():
+        return p.to_response(res.BlobsInsertResponse)
+
+    try:
+        insert_result = await controllers.blob.insert_blobs(project_id, blobs)
+        if not insert_result.ok():
+            return insert_result.to_response(res.BlobsInsertResponse)
+
+        final_results = []
+        # evaluate the buffer threshold once per user and blob type
+        for user_id, blob_type in dict.fromkeys(
+            (str(b.user_id), b.blob_type) for b in blobs
+        ):
+            process_ids = await controllers.buffer.detect_buffer_full_or_not(
+                user_id, project_id, blob_type
+            )
+            if not process_ids.ok():
+                return process_ids.to_response(res.BlobsInsertResponse)
+            if process_ids.data() is None or not len(process_ids.data().ids):
+                continue
+            if wait_process:
+                p = await controllers.buffer.flush_buffer_by_ids(
+                    user_id, project_id, blob_type, process_ids.data().ids
+                )
+                if not p.ok():
+                    return p.to_response(res.BlobsInsertResponse)
+                final_results.extend(p.data())
+            else:
+                background_tasks.add_task(
+                    controllers.buffer_background.flush_buffer_by_ids_in_background,
+                    user_id,
+                    project_id,
+                    blob_type,
+                    process_ids.data().ids,
+                )
+    except Exception as e:
+        TRACE_LOG.error(
+            project_id,
+            "batch",
+            f"Error inserting blobs: {e}, {traceback.format_exc()}",
+        )
+        return Promise.reject(
+            CODE.INTERNAL_SERVER_ERROR, f"Error inserting blobs: {e}"
+        ).to_response(res.BlobsInsertResponse)
+
+    background_tasks.add_task(
+        capture_int_key,
+        TelemetryKeyName.insert_blob_success_request,
+        len(blobs),
+        project_id=project_id,
+    )
+    return res.BlobsInsertResponse(
+        data={"ids": insert_result.data().ids, "chat_results": final_results}
+    )
+
+
 async def get_blob(
     request: Request,
     user_id: str = Path(..., description="The ID of the user"),
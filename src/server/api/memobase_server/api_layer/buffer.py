@@ -36,8 +36,7 @@ async def flush_buffer(
         )
         if not p.ok():
             return p.to_response(res.BaseResponse)
-        if p.data() is not None:
-            return res.ChatModalAPIResponse(data=[p.data()])
+        return res.ChatModalAPIResponse(data=p.data())
     else:
         background_tasks.add_task(
             controllers.buffer_background.flush_buffer_by_ids_in_background,
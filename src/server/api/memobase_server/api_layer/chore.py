@@ -10,7 +10,7 @@ from ..llms import llm_sanity_check
 
 async def healthcheck() -> BaseResponse:
     """Check if your memobase is set up correctly"""
-    if not db_health_check():
+    if not await db_health_check():
         raise HTTPException(
             status_code=CODE.INTERNAL_SERVER_ERROR.value,
             detail="Database not available",
@@ -31,7 +31,7 @@ async def root_running_status_check(request: Request) -> BaseResponse:
             status_code=CODE.METHOD_NOT_ALLOWED.value,
             detail="Only Root can access this",
         )
-    if not db_health_check():
+    if not await db_health_check():
         raise HTTPException(
             status_code=CODE.INTERNAL_SERVER_ERROR.value,
             detail="Database not available",
@@ -2,11 +2,13 @@ import json
 
 from ..controllers import full as controllers
 
+from ..env import CONFIG
 from ..models.response import CODE
 from ..models.utils import Promise
 from ..models import response as res
 from fastapi import Request
-from fastapi import Path, Query
+from fastapi import Path, Query, Body
+from fastapi.responses import StreamingResponse
 
 
 async def get_user_context(
@@ -83,14 +85,35 @@ Unless the user has relevant queries, do not actively mention those memories in
         True,
         description="""If you pass `chats_str` and set this to `False`, Memobase will search for relevant profiles and events at the same time.
 **NOTICE**
-- It will increase your latency by 2-5(based on the profile size) seconds, because Memobase will use LLM and Embedding to search for relevant profiles and events.
-- It will cost your Memobase tokens, roughly 100~1000 tokens per chat based on the profile size.
+- Profiles are ranked by embedding similarity to the chats, it will increase your latency by 0.1-1 seconds.
+- If the server sets `profile_filter_mode: llm`, a LLM picks the profiles instead, it will increase your latency by 2-5(based on the profile size) seconds and cost your Memobase tokens, roughly 100~1000 tokens per chat based on the profile size.
 """,
     ),
     fill_window_with_events: bool = Query(
         False,
         description="If set to `True`, Memobase will fill the token window with the rest events.",
     ),
+    deadline_ms: int = Query(
+        None,
+        description="""Latency budget of this call in milliseconds, default is no budget.
+When the deadline is near, Memobase degrades step by step instead of waiting:
+- skip the LLM profile filtering of `chats_str` and keep the latest profiles
+- skip the event search of `chats_str` and use the latest events
+- return the context without the profiles/events that are still loading
+
+The skipped stages are returned in `skipped_stages`.
+""",
+    ),
+    stream: bool = Query(
+        False,
+        description="""If set to `True`, return NDJSON (`application/x-ndjson`) instead, one response per line, sent as soon as each part is ready:
+- `{"data": {"type": "profile", ...}}`: the profile section
+- `{"data": {"type": "event", ...}}`: the event section
+- `{"data": {"type": "context", ...}}`: the packed context, always the last line
+
+Each part has its `content`, the `count` of profiles/event gists and their `token_size`. If a step fails, the last line has a non-zero `errno` instead.
+""",
+    ),
 ) -> res.UserContextDataResponse:
     project_id = request.state.memobase_project_id
     topic_limits_json = topic_limits_json or "{}"
@@ -102,6 +125,36 @@ Unless the user has relevant queries, do not actively mention those memories in
         return Promise.reject(CODE.BAD_REQUEST, f"Invalid JSON: {e}").to_response(
             res.UserContextDataResponse
         )
+    if deadline_ms is not None and deadline_ms <= 0:
+        return Promise.reject(
+            CODE.BAD_REQUEST, "deadline_ms must be greater than 0"
+        ).to_response(res.UserContextDataResponse)
+    if stream:
+
+        async def stream_lines():
+            async for p in controllers.context.stream_user_context(
+                user_id,
+                project_id,
+                max_token_size,
+                prefer_topics,
+                only_topics,
+                max_subtopic_size,
+                topic_limits,
+                profile_event_ratio,
+                require_event_summary,
+                chats,
+                event_similarity_threshold,
+                time_range_in_days,
+                customize_context_prompt=customize_context_prompt,
+                full_profile_and_only_search_event=full_profile_and_only_search_event,
+                fill_window_with_events=fill_window_with_events,
+                deadline_ms=deadline_ms,
+            ):
+                yield p.to_response(res.ContextStreamChunkResponse).model_dump_json()
+                yield "\n"
+
+        return StreamingResponse(stream_lines(), media_type="application/x-ndjson")
+
     p = await controllers.context.get_user_context(
         user_id,
         project_id,
@@ -118,5 +171,38 @@ Unless the user has relevant queries, do not actively mention those memories in
         customize_context_prompt=customize_context_prompt,
         full_profile_and_only_search_event=full_profile_and_only_search_event,
         fill_window_with_events=fill_window_with_events,
+        deadline_ms=deadline_ms,
     )
     return p.to_response(res.UserContextDataResponse)
+
+
+async def get_users_context(
+    request: Request,
+    batch_data: res.UsersContextRequest = Body(
+        ..., description="The users and the context parameters shared by all of them"
+    ),
+) -> res.UsersContextDataResponse:
+    project_id = request.state.memobase_project_id
+    if len(batch_data.user_ids) > CONFIG.max_context_batch_size:
+        return Promise.reject(
+            CODE.BAD_REQUEST,
+            f"Too many users in one batch, {len(batch_data.user_ids)} > {CONFIG.max_context_batch_size}",
+        ).to_response(res.UsersContextDataResponse)
+    p = await controllers.context.get_users_context(
+        batch_data.user_ids,
+        project_id,
+        batch_data.max_token_size,
+        batch_data.prefer_topics,
+        batch_data.only_topics,
+        batch_data.max_subtopic_size,
+        batch_data.topic_limits,
+        batch_data.profile_event_ratio,
+        batch_data.require_event_summary,
+        batch_data.chats,
+        batch_data.event_similarity_threshold,
+        batch_data.time_range_in_days,
+        customize_context_prompt=batch_data.customize_context_prompt,
+        full_profile_and_only_search_event=batch_data.full_profile_and_only_search_event,
+        fill_window_with_events=batch_data.fill_window_with_events,
+    )
+    return p.to_response(res.UsersContextDataResponse)
@@ -422,3 +422,34 @@ func main() {
 """
     ),
 )
+
+# Insert blobs in batch
+add_api_code_docs(
+    "POST",
+    "/blobs/insert",
+    py_code(
+        """
+from memobase import MemoBaseClient
+from memobase.core.blob import ChatBlob
+
+client = MemoBaseClient(project_url='PROJECT_URL', api_key='PROJECT_TOKEN')
+
+b = ChatBlob(messages=[
+    {
+        "role": "user",
+        "content": "Hi, I'm here again"
+    },
+    {
+        "role": "assistant",
+        "content": "Hi, Gus! How can I help you?"
+    }
+])
+# blobs of different users can go in one batch
+bids = client.batch_insert([(uid_1, b), (uid_2, b)])
+
+# or for a single user
+u = client.get_user(uid_1)
+bids = u.batch_insert([b, b])
+"""
+    ),
+)
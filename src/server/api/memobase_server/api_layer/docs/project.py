@@ -295,3 +295,18 @@ func main() {
 """
     ),
 )
+
+# Project export endpoint
+add_api_code_docs(
+    "GET",
+    "/project/export",
+    py_code(
+        """
+from memobase import MemoBaseClient
+
+memobase = MemoBaseClient(project_url='PROJECT_URL', api_key='PROJECT_TOKEN')
+
+memobase.export_archive("memobase-archive.ndjson.gz", compress=True)
+"""
+    ),
+)
@@ -284,3 +284,19 @@ func main() {
 """
     ),
 )
+
+# Get the context of many users
+add_api_code_docs(
+    "POST",
+    "/users/context/batch",
+    py_code(
+        """
+from memobase import MemoBaseClient
+
+client = MemoBaseClient(project_url='PROJECT_URL', api_key='PROJECT_TOKEN')
+
+# user id -> context, the parameters are shared by all users
+contexts = client.get_users_context([uid_1, uid_2], max_token_size=500)
+"""
+    ),
+)
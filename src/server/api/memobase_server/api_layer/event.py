@@ -16,10 +16,14 @@ async def get_user_events(
         False,
         description="Whether to return events with summaries",
     ),
+    cursor: str = Query(
+        None,
+        description="The `next_cursor` of the previous page, to get the older events",
+    ),
 ) -> res.UserEventsDataResponse:
     project_id = request.state.memobase_project_id
     p = await controllers.event.get_user_events(
-        user_id, project_id, topk=topk, need_summary=need_summary
+        user_id, project_id, topk=topk, need_summary=need_summary, cursor=cursor
     )
     if not p.ok():
         return p.to_response(res.UserEventsDataResponse)
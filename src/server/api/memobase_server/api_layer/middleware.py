@@ -15,6 +15,7 @@ from ..telemetry import (
     telemetry_manager,
     CounterMetricName,
     HistogramMetricName,
+    tag_current_span,
 )
 from .. import __version__
 from ..models.response import BaseResponse, CODE
@@ -48,6 +49,8 @@ async def global_wrapper_middleware(request: Request, call_next):
     structlog.contextvars.bind_contextvars(
         request_id=req_id, project_id=project_id, memobase_version=__version__
     )
+    # the server span of the request, so traces can be found by request id
+    tag_current_span(request_id=req_id)
 
     url = get_path_with_query_string(request.scope)
     client_host = request.client.host
@@ -147,6 +150,7 @@ class AuthMiddleware(BaseHTTPMiddleware):
                     ).model_dump(),
                 )
             request.state.memobase_project_id = p.data()
+        tag_current_span(project_id=request.state.memobase_project_id)
         # await capture_int_key(TelemetryKeyName.has_request)
 
         normalized_path = self.normalize_path(request.url.path)
@@ -136,19 +136,9 @@ async def import_user_context(
     ),
 ) -> res.BaseResponse:
     project_id = request.state.memobase_project_id
-    p = await controllers.billing.get_project_billing(project_id)
+    p = await controllers.billing.check_project_quota(project_id)
     if not p.ok():
-        return p.to_response(res.IdResponse)
-    billing = p.data()
-
-    if billing.token_left is not None and billing.token_left < 0:
-        return Promise.reject(
-            CODE.SERVICE_UNAVAILABLE,
-            f"Your project reaches Memobase token limit, "
-            f"Left: {billing.token_left}, this project used: {billing.project_token_cost_month}. "
-            f"Your quota will be refilled on {billing.next_refill_at}. "
-            "\nhttps://www.memobase.io/pricing for more information.",
-        ).to_response(res.BaseResponse)
+        return p.to_response(res.BaseResponse)
 
     prompt = f"""Below is my information, please remember them:
 {content.context}
@@ -5,6 +5,7 @@ from ..models.response import BaseResponse, CODE
 from ..models.utils import Promise
 from ..models import response as res
 from fastapi import Request
+from fastapi.responses import StreamingResponse
 from typing import Literal
 from fastapi import Body, Path, Query
 
@@ -41,20 +42,27 @@ async def get_project_billing(request: Request) -> res.BillingResponse:
 
 async def get_project_users(
     request: Request,
-    search: str = Query("", description="Search string in username field"),
+    search: str = Query("", description="Search users whose id starts with this string"),
     order_by: Literal["updated_at", "profile_count", "event_count"] = Query(
         "updated_at", description="Order by field"
     ),
     order_desc: bool = Query(True, description="Order descending or ascending"),
     limit: int = Query(10, description="Limit the number of results returned"),
-    offset: int = Query(0, description="Offset the starting point for pagination"),
+    offset: int = Query(
+        0,
+        description="Offset the starting point for pagination, prefer `cursor` for large projects",
+    ),
+    cursor: str = Query(
+        None,
+        description="The `next_cursor` of the previous page, `offset` is ignored when given",
+    ),
 ) -> res.ProjectUsersDataResponse:
     """
     Get the users of a project in different orders
     """
     project_id = request.state.memobase_project_id
     users = await controllers.project.get_project_users(
-        project_id, search, limit, offset, order_by, order_desc
+        project_id, search, limit, offset, order_by, order_desc, cursor
     )
     return users.to_response(res.ProjectUsersDataResponse)
 
@@ -69,3 +77,23 @@ async def get_project_usage(
     project_id = request.state.memobase_project_id
     p = await controllers.project.get_project_usage(project_id, last_days)
     return p.to_response(res.UsageResponse)
+
+
+async def export_project_archive(
+    request: Request,
+    compress: bool = Query(False, description="Gzip the archive"),
+) -> StreamingResponse:
+    """
+    Stream all the users, profiles, events, event gists and statuses of the project as NDJSON
+    """
+    project_id = request.state.memobase_project_id
+    chunks = controllers.archive.export_project_archive(project_id)
+    filename = f"memobase-{project_id}.ndjson"
+    if compress:
+        chunks = controllers.archive.gzip_chunks(chunks)
+        filename += ".gz"
+    return StreamingResponse(
+        chunks,
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -53,9 +53,13 @@ async def get_user_all_blobs(
     blob_type: BlobType = Path(..., description="The type of blobs to retrieve"),
     page: int = Query(0, description="Page number for pagination, starting from 0"),
     page_size: int = Query(10, description="Number of items per page, default is 10"),
-) -> res.IdsResponse:
+    cursor: str = Query(
+        None,
+        description="The `next_cursor` of the previous page, `page` is ignored when given",
+    ),
+) -> res.IdsPageResponse:
     project_id = request.state.memobase_project_id
     p = await controllers.user.get_user_all_blobs(
-        user_id, project_id, blob_type, page, page_size
+        user_id, project_id, blob_type, page, page_size, cursor
     )
-    return p.to_response(res.IdsResponse)
+    return p.to_response(res.IdsPageResponse)
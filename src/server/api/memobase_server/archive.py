@@ -0,0 +1,66 @@
+"""
+Export or import the memory of a project as an archive file.
+
+    python -m memobase_server.archive export PROJECT_ID memobase.ndjson.gz
+    python -m memobase_server.archive import PROJECT_ID memobase.ndjson.gz
+
+Files ending with `.gz` are gzip-compressed. The import target project must
+exist, and must not have the archived users yet.
+"""
+
+import sys
+import gzip
+import time
+import asyncio
+import argparse
+from .env import LOG
+from .connectors import close_connection
+from .controllers.archive import export_project_archive, import_project_archive
+
+
+def open_archive(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode)
+
+
+async def export_archive(project_id: str, path: str) -> int:
+    start, size = time.monotonic(), 0
+    with open_archive(path, "wb") as f:
+        async for chunk in export_project_archive(project_id):
+            f.write(chunk)
+            size += len(chunk)
+    LOG.info(
+        f"Exported project {project_id} to {path}, {size} bytes in {time.monotonic() - start:.1f}s"
+    )
+    return 0
+
+
+async def import_archive(project_id: str, path: str) -> int:
+    start = time.monotonic()
+    with open_archive(path, "rb") as f:
+        p = await import_project_archive(f, project_id)
+    if not p.ok():
+        LOG.error(f"Failed to import {path}: {p.msg()}")
+        return 1
+    LOG.info(
+        f"Imported {path} into project {project_id}, {p.data()} rows in {time.monotonic() - start:.1f}s"
+    )
+    return 0
+
+
+async def main(args: argparse.Namespace) -> int:
+    try:
+        if args.command == "export":
+            return await export_archive(args.project_id, args.path)
+        return await import_archive(args.project_id, args.path)
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m memobase_server.archive")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("project_id")
+    parser.add_argument("path")
+    sys.exit(asyncio.run(main(parser.parse_args())))
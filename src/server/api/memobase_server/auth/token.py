@@ -7,6 +7,7 @@ from ..models.utils import Promise
 from ..models.response import CODE
 from ..connectors import get_redis_client
 from ..controllers import project
+from ..controllers.project_cache import get_or_load_project_value
 
 
 def parse_project_id(secret_key: str) -> Promise[str]:
@@ -28,6 +29,15 @@ def project_status_redis_key(project_id: str) -> str:
 
 
 async def check_project_secret(project_id: str, secret_key: str) -> Promise[bool]:
+    p = await get_or_load_project_value(
+        project_id, "secret", lambda: load_project_secret(project_id)
+    )
+    if not p.ok():
+        return p
+    return Promise.resolve(p.data() == secret_key)
+
+
+async def load_project_secret(project_id: str) -> Promise[str]:
     async with get_redis_client() as client:
         secret = await client.get(token_redis_key(project_id))
         if secret is None:
@@ -36,10 +46,16 @@ async def check_project_secret(project_id: str, secret_key: str) -> Promise[bool
                 return Promise.reject(CODE.UNAUTHORIZED, "Your project is not exists!")
             secret = p.data()
             await client.set(token_redis_key(project_id), secret, ex=None)
-    return Promise.resolve(secret == secret_key)
+    return Promise.resolve(secret)
 
 
 async def get_project_status(project_id: str) -> Promise[str]:
+    return await get_or_load_project_value(
+        project_id, "status", lambda: load_project_status(project_id)
+    )
+
+
+async def load_project_status(project_id: str) -> Promise[str]:
     async with get_redis_client() as client:
         status = await client.get(project_status_redis_key(project_id))
         if status is None:
@@ -2,12 +2,16 @@ import os
 import asyncio
 import redis.exceptions as redis_exceptions
 import redis.asyncio as redis
-from sqlalchemy import create_engine, text
+from sqlalchemy import Engine, create_engine, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    create_async_engine,
+    async_sessionmaker,
+)
 from sqlalchemy.exc import OperationalError
-from uuid import uuid4
 from .env import LOG
-from .models.database import REG, Project, UserEvent, UserEventGist
+from .models.database import embedding_search_settings
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 REDIS_URL = os.getenv("REDIS_URL")
@@ -22,57 +26,112 @@ LOG.info(f"Project ID: {PROJECT_ID}")
 LOG.info(f"Database URL: {DATABASE_URL}")
 LOG.info(f"Redis URL: {REDIS_URL}")
 
-# Create an engine
-DB_ENGINE = create_engine(
-    DATABASE_URL,
-    pool_size=75,  # Increased from 50 to handle more concurrent operations
-    max_overflow=50,  # Increased from 30 to provide more buffer
-    pool_recycle=300,  # Reduced from 600 to recycle connections more frequently
-    pool_pre_ping=True,  # Verify connections before using
-    pool_timeout=45,  # Increased from 30 seconds for better handling under load
-    pool_reset_on_return="commit",  # Ensure clean state when connections are returned
-    echo_pool=False,  # Set to True for debugging pool issues
-)
+
+def get_async_database_url(url: str) -> str:
+    """Rewrite a sync postgres URL to use the asyncpg driver."""
+    _, sep, rest = url.partition("://")
+    if not sep:
+        return url
+    return f"postgresql+asyncpg://{rest}"
+
+
+def get_asyncpg_dsn(url: str) -> str:
+    """Rewrite a SQLAlchemy postgres URL to a plain DSN for raw asyncpg connections."""
+    _, sep, rest = url.partition("://")
+    if not sep:
+        return url
+    return f"postgresql://{rest}"
+
+
+# Engines and clients are created on first use, so importing the server never
+# connects to anything. The schema is created by `python -m memobase_server.migrate`.
+DB_ENGINE = None
+DB_ASYNC_ENGINE = None
 REDIS_POOL = None
+REDIS_BINARY_POOL = None
+
+
+def get_db_engine() -> Engine:
+    """Sync engine, only used for migrations/table creation and scripts"""
+    global DB_ENGINE
+    if DB_ENGINE is None:
+        DB_ENGINE = create_engine(
+            DATABASE_URL,
+            pool_size=5,
+            max_overflow=5,
+            pool_recycle=300,
+            pool_pre_ping=True,
+            pool_timeout=45,
+            pool_reset_on_return="commit",
+            echo_pool=False,
+        )
+    return DB_ENGINE
+
+
+def get_async_db_engine() -> AsyncEngine:
+    """Async engine, used by all the controllers in the request path.
+
+    pgvector columns go through asyncpg's text codec, which is what
+    pgvector.sqlalchemy binds/parses, so no extra codec registration is needed.
+    """
+    global DB_ASYNC_ENGINE
+    if DB_ASYNC_ENGINE is None:
+        DB_ASYNC_ENGINE = create_async_engine(
+            get_async_database_url(DATABASE_URL),
+            pool_size=75,  # Increased from 50 to handle more concurrent operations
+            max_overflow=50,  # Increased from 30 to provide more buffer
+            pool_recycle=300,  # Reduced from 600 to recycle connections more frequently
+            pool_pre_ping=True,  # Verify connections before using
+            pool_timeout=45,  # Increased from 30 seconds for better handling under load
+            pool_reset_on_return="commit",  # Ensure clean state when connections are returned
+            echo_pool=False,  # Set to True for debugging pool issues
+        )
+    return DB_ASYNC_ENGINE
 
-Session = sessionmaker(bind=DB_ENGINE)
 
+class LazySessionmaker(sessionmaker):
+    """Binds to the engine when the first session is opened"""
 
-def create_pgvector_extension():
-    try:
-        with Session() as session:
-            session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
-            session.commit()
-            LOG.info("pgvector extension created or already exists")
-    except Exception as e:
-        LOG.error(f"Failed to create pgvector extension: {e}")
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_db_engine())
+        return super().__call__(**local_kw)
 
 
-def create_tables():
-    create_pgvector_extension()
+class LazyAsyncSessionmaker(async_sessionmaker):
+    """Binds to the engine when the first session is opened"""
 
-    REG.metadata.create_all(DB_ENGINE)
-    with Session() as session:
-        Project.initialize_root_project(session)
-        UserEvent.check_legal_embedding_dim(session)
-        UserEventGist.check_legal_embedding_dim(session)
-    LOG.info("Database tables created successfully")
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_async_db_engine())
+        return super().__call__(**local_kw)
 
 
-create_tables()
+Session = LazySessionmaker()
+# expire_on_commit=False: attributes can't be lazily refreshed outside the greenlet
+AsyncSession = LazyAsyncSessionmaker(expire_on_commit=False)
 
 
-def db_health_check() -> bool:
+async def db_health_check() -> bool:
     try:
-        conn = DB_ENGINE.connect()
-    except OperationalError as e:
+        async with get_async_db_engine().connect() as conn:
+            await conn.execute(text("SELECT 1"))
+    except (OperationalError, OSError) as e:
         LOG.error(f"Database connection failed: {e}")
         return False
     else:
-        conn.close()
         return True
 
 
+async def apply_embedding_search_settings(session) -> None:
+    """Set the ANN search parameters for the current transaction only"""
+    for name, value in embedding_search_settings().items():
+        await session.execute(
+            text("SELECT set_config(:name, :value, true)"),
+            {"name": name, "value": value},
+        )
+
+
 async def redis_health_check() -> bool:
     try:
         async with get_redis_client() as redis_client:
@@ -85,15 +144,21 @@ async def redis_health_check() -> bool:
 
 
 async def close_connection():
-    DB_ENGINE.dispose()
+    if DB_ASYNC_ENGINE is not None:
+        await DB_ASYNC_ENGINE.dispose()
+    if DB_ENGINE is not None:
+        DB_ENGINE.dispose()
     if REDIS_POOL is not None:
         await REDIS_POOL.aclose()
+    if REDIS_BINARY_POOL is not None:
+        await REDIS_BINARY_POOL.aclose()
     LOG.info("Connections closed")
 
 
 def init_redis_pool():
-    global REDIS_POOL
+    global REDIS_POOL, REDIS_BINARY_POOL
     REDIS_POOL = redis.ConnectionPool.from_url(REDIS_URL, decode_responses=True)
+    REDIS_BINARY_POOL = redis.ConnectionPool.from_url(REDIS_URL)
 
 
 def get_redis_client() -> redis.Redis:
@@ -103,18 +168,42 @@ def get_redis_client() -> redis.Redis:
         return redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
 
+def get_redis_binary_client() -> redis.Redis:
+    """Client that returns raw bytes, for values that are not utf-8 text"""
+    if REDIS_BINARY_POOL is not None:
+        return redis.Redis(connection_pool=REDIS_BINARY_POOL)
+    else:
+        return redis.Redis.from_url(REDIS_URL)
+
+
 def get_pool_status() -> dict:
     """Get current connection pool status for monitoring."""
-    pool = DB_ENGINE.pool
+    pool = get_async_db_engine().pool
+    if not hasattr(pool, "checkedout"):  # e.g. NullPool
+        return {
+            "size": 0,
+            "checked_in": 0,
+            "checked_out": 0,
+            "overflow": 0,
+            "total_capacity": 0,
+            "utilization_percent": 0,
+        }
+    # overflow() counts up from -pool_size, so size() + overflow() is only the
+    # connections opened so far. The capacity is the configured upper bound.
+    max_overflow = pool._max_overflow
+    if max_overflow < 0:  # unlimited overflow
+        total_capacity = pool.size() + max(pool.overflow(), 0)
+    else:
+        total_capacity = pool.size() + max_overflow
     return {
         "size": pool.size(),
         "checked_in": pool.checkedin(),
         "checked_out": pool.checkedout(),
         "overflow": pool.overflow(),
-        "total_capacity": pool.size() + pool.overflow(),
+        "total_capacity": total_capacity,
         "utilization_percent": (
-            round((pool.checkedout() / (pool.size() + pool.overflow())) * 100, 2)
-            if (pool.size() + pool.overflow()) > 0
+            round((pool.checkedout() / total_capacity) * 100, 2)
+            if total_capacity > 0
             else 0
         ),
     }
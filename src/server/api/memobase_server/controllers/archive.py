@@ -0,0 +1,237 @@
+"""
+Project archive, the memory of a project as NDJSON, one row per line.
+
+The first line is a header with the format version, the source project, the
+embedding dimension and the columns of every table. Every other line is
+`{"table": ..., "row": {...}}`. Embeddings are base64 of packed little-endian
+float32, about 3x smaller than floats in JSON. Tables are written parents
+first, so loading the lines in order never breaks a foreign key.
+
+Export reads all tables in one REPEATABLE READ transaction with server-side
+cursors, so the archive is a consistent snapshot and memory stays flat for any
+project size. Import uses binary COPY on a dedicated asyncpg connection, in a
+single transaction: either the whole archive is loaded or nothing.
+"""
+
+import json
+import zlib
+import uuid
+import base64
+import asyncpg
+import numpy as np
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Iterable
+from pgvector.sqlalchemy import Vector
+from pgvector.asyncpg import register_vector
+from sqlalchemy import JSON, DateTime, Table, Uuid, func, select
+from ..models.database import User, UserProfile, UserEvent, UserEventGist, UserStatus
+from ..models.utils import Promise, CODE
+from ..connectors import AsyncSession, DATABASE_URL, get_asyncpg_dsn
+from ..env import CONFIG, LOG
+from .profile_cache import invalidate_users_profile_cache
+
+ARCHIVE_FORMAT = "memobase.archive"
+ARCHIVE_VERSION = 1
+# parents first, the import loads the tables in this order
+ARCHIVE_TABLES: tuple[Table, ...] = (
+    User.__table__,
+    UserProfile.__table__,
+    UserEvent.__table__,
+    UserEventGist.__table__,
+    UserStatus.__table__,
+)
+ARCHIVE_FETCH_SIZE = 2000
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+ARCHIVE_COPY_BATCH_SIZE = 10000
+
+
+def pack_embedding(value) -> str:
+    return base64.b64encode(np.asarray(value, dtype="<f4").tobytes()).decode()
+
+
+def unpack_embedding(value: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(value), dtype="<f4")
+
+
+def pack_vector_send(value: bytes) -> str:
+    """`vector_send` output is a 4 bytes header then big-endian float32"""
+    return pack_embedding(np.frombuffer(value, dtype=">f4", offset=4))
+
+
+def export_column(column):
+    # parsing the text form of a vector is the slowest part of an export
+    if isinstance(column.type, Vector):
+        return func.vector_send(column).label(column.name)
+    return column
+
+
+def column_packer(column) -> Callable:
+    if isinstance(column.type, Vector):
+        return pack_vector_send
+    if isinstance(column.type, Uuid):
+        return str
+    if isinstance(column.type, DateTime):
+        return datetime.isoformat
+    return lambda v: v
+
+
+def column_unpacker(column) -> Callable:
+    """Archive value to the value asyncpg's binary COPY expects"""
+    if isinstance(column.type, Vector):
+        return unpack_embedding
+    if isinstance(column.type, Uuid):
+        return uuid.UUID
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, JSON):
+        return json.dumps
+    return lambda v: v
+
+
+def archive_header(project_id: str) -> dict:
+    return {
+        "format": ARCHIVE_FORMAT,
+        "version": ARCHIVE_VERSION,
+        "project_id": project_id,
+        "embedding_dim": CONFIG.embedding_dim,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "tables": {t.name: [c.name for c in t.columns] for t in ARCHIVE_TABLES},
+    }
+
+
+async def export_project_archive(project_id: str) -> AsyncIterator[bytes]:
+    """NDJSON chunks of about `ARCHIVE_CHUNK_SIZE` bytes, ending at a line break"""
+    chunk = [json.dumps(archive_header(project_id)).encode(), b"\n"]
+    size = len(chunk[0])
+    async with AsyncSession() as session:
+        await session.connection(
+            execution_options={"isolation_level": "REPEATABLE READ"}
+        )
+        for table in ARCHIVE_TABLES:
+            packers = [(c.name, column_packer(c)) for c in table.columns]
+            result = await session.stream(
+                select(*[export_column(c) for c in table.columns])
+                .where(table.c.project_id == project_id)
+                .execution_options(yield_per=ARCHIVE_FETCH_SIZE)
+            )
+            async for rows in result.partitions():
+                for row in rows:
+                    line = json.dumps(
+                        {
+                            "table": table.name,
+                            "row": {
+                                name: None if v is None else pack(v)
+                                for (name, pack), v in zip(packers, row)
+                            },
+                        },
+                        ensure_ascii=False,
+                    ).encode()
+                    chunk.extend((line, b"\n"))
+                    size += len(line) + 1
+                if size >= ARCHIVE_CHUNK_SIZE:
+                    yield b"".join(chunk)
+                    chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def check_archive_header(header: dict) -> Promise[None]:
+    if header.get("format") != ARCHIVE_FORMAT:
+        return Promise.reject(CODE.BAD_REQUEST, "Not a Memobase archive")
+    if header.get("version") != ARCHIVE_VERSION:
+        return Promise.reject(
+            CODE.BAD_REQUEST, f"Unsupported archive version {header.get('version')}"
+        )
+    if header.get("embedding_dim") != CONFIG.embedding_dim:
+        return Promise.reject(
+            CODE.BAD_REQUEST,
+            f"Archive embedding dim {header.get('embedding_dim')} doesn't match the configured {CONFIG.embedding_dim}",
+        )
+    return Promise.resolve(None)
+
+
+async def import_project_archive(
+    lines: Iterable[bytes], project_id: str
+) -> Promise[dict[str, int]]:
+    """Load an archive into `project_id`, returns the row count of every table.
+
+    The project must exist, and the archived users must not exist in it yet.
+    """
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError) as e:
+        return Promise.reject(CODE.BAD_REQUEST, f"Invalid archive header: {e}")
+    p = check_archive_header(header)
+    if not p.ok():
+        return p
+    tables = {t.name: t for t in ARCHIVE_TABLES}
+    loaders = {}
+    for name, columns in header["tables"].items():
+        if name not in tables:
+            return Promise.reject(CODE.BAD_REQUEST, f"Unknown table {name}")
+        table = tables[name]
+        known = [c for c in columns if c in table.c]
+        loaders[name] = (known, [column_unpacker(table.c[c]) for c in known])
+
+    counts = {name: 0 for name in loaders}
+    user_ids = []
+    conn = await asyncpg.connect(get_asyncpg_dsn(DATABASE_URL))
+    try:
+        await register_vector(conn)
+        async with conn.transaction():
+            current, batch = None, []
+
+            async def copy_batch():
+                if not batch:
+                    return
+                await conn.copy_records_to_table(
+                    current, records=batch, columns=loaders[current][0]
+                )
+                counts[current] += len(batch)
+                batch.clear()
+
+            for line_no, line in enumerate(lines, start=2):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    name, row = record["table"], record["row"]
+                    columns, unpackers = loaders[name]
+                    row["project_id"] = project_id
+                    values = tuple(
+                        None if row.get(c) is None else unpack(row[c])
+                        for c, unpack in zip(columns, unpackers)
+                    )
+                except (ValueError, KeyError, TypeError) as e:
+                    raise ValueError(f"Invalid archive line {line_no}: {e}") from e
+                if name == User.__table__.name:
+                    user_ids.append(str(row["id"]))
+                if name != current:
+                    await copy_batch()
+                    current = name
+                batch.append(values)
+                if len(batch) >= ARCHIVE_COPY_BATCH_SIZE:
+                    await copy_batch()
+            await copy_batch()
+    except ValueError as e:
+        return Promise.reject(CODE.BAD_REQUEST, str(e))
+    except asyncpg.PostgresError as e:
+        LOG.error(f"Failed to import archive into {project_id}: {e}")
+        return Promise.reject(
+            CODE.INTERNAL_SERVER_ERROR, f"Failed to import archive: {e}"
+        )
+    finally:
+        await conn.close()
+    # profiles read before the import cached these users as empty
+    await invalidate_users_profile_cache(user_ids, project_id)
+    return Promise.resolve(counts)
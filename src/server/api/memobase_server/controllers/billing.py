@@ -1,14 +1,33 @@
-from pydantic import ValidationError
+"""
+Project token quota.
+
+LLM calls debit a project with an atomic `INCRBY` on a Redis counter, so
+concurrent flushes never wait on or overwrite each other's debit. The
+reconciler claims the counters and subtracts them from `billings.usage_left`
+in one `UPDATE` every `billing_reconcile_interval` seconds.
+
+The billing row is cached per worker with the project cache, the tokens left
+are that row minus the debits not reconciled yet. A quota check is one Redis
+`MGET` then, without a DB query. Reconciling invalidates the project cache of
+all workers, since the row changes as the debit leaves Redis.
+"""
+
+import asyncio
+from typing import NamedTuple, Optional
+from uuid import UUID
+from sqlalchemy import select, update, func
 from ..models.utils import Promise
 from ..models.database import (
     ProjectBilling,
     Billing,
     next_month_first_day,
 )
-from ..models.response import CODE, IdData, IdsData, UserProfilesData, BillingData
-from ..connectors import Session, ADMIN_URL
-from ..telemetry.capture_key import get_int_key, capture_int_key
+from ..models.response import CODE, BillingData
+from ..connectors import AsyncSession, ADMIN_URL, PROJECT_ID, get_redis_client
+from ..telemetry.capture_key import capture_int_keys, int_key, month_key
 from ..env import (
+    CONFIG,
+    LOG,
     TelemetryKeyName,
     USAGE_TOKEN_LIMIT_MAP,
     BILLING_REFILL_AMOUNT_MAP,
@@ -16,65 +35,115 @@ from ..env import (
 )
 from datetime import datetime, date
 from ..auth import admin_api
+from .project_cache import get_or_load_project_value, invalidate_project_cache
 
+BILLING_DEBIT_PROJECTS_KEY = f"memobase::billing_debit_projects::{PROJECT_ID}"
 
-async def get_project_billing(project_id: str) -> Promise[BillingData]:
-    if ADMIN_URL is not None:
-        return await admin_api.get_project_usage(project_id)
+# KEYS: project debit, debit projects. ARGV: project id
+CLAIM_DEBIT_SCRIPT = """
+local amount = redis.call('GET', KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+return amount
+"""
 
-    with Session() as session:
+
+def billing_debit_key(project_id: str) -> str:
+    return f"memobase::billing_debit::{PROJECT_ID}::{project_id}"
+
+
+class ProjectQuota(NamedTuple):
+    # None if the project has no billing
+    billing_id: Optional[UUID]
+    usage_left: Optional[int]
+    next_refill_at: Optional[datetime]
+
+
+async def load_project_quota(project_id: str) -> Promise[ProjectQuota]:
+    async with AsyncSession() as session:
         billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
-            .first()
-        )
-        if billing is None:
-            return await fallback_billing_data(project_id)
-            # return Promise.reject(CODE.NOT_FOUND, "Billing not found").to_response(
-            #     BillingData
-            # )
-        billing = billing.billing
-
-        this_month_token_costs_in = await get_int_key(
-            TelemetryKeyName.llm_input_tokens, project_id, in_month=True
+            await session.execute(
+                select(Billing.id, Billing.usage_left, Billing.next_refill_at)
+                .join(ProjectBilling, ProjectBilling.billing_id == Billing.id)
+                .where(ProjectBilling.project_id == project_id)
+                .limit(1)
+            )
+        ).one_or_none()
+    if billing is None:
+        return Promise.resolve(ProjectQuota(None, None, None))
+    return Promise.resolve(ProjectQuota(*billing))
+
+
+async def get_project_usage_counters(project_id: str) -> tuple[int, int]:
+    """Tokens debited but not reconciled yet, and the token costs of this month"""
+    async with get_redis_client() as r_c:
+        debit, costs_in, costs_out = await r_c.mget(
+            billing_debit_key(project_id),
+            int_key(TelemetryKeyName.llm_input_tokens, project_id, month_key()),
+            int_key(TelemetryKeyName.llm_output_tokens, project_id, month_key()),
         )
-        this_month_token_costs_out = await get_int_key(
-            TelemetryKeyName.llm_output_tokens, project_id, in_month=True
+    return int(debit or 0), int(costs_in or 0) + int(costs_out or 0)
+
+
+async def refill_project_billing(project_id: str, quota: ProjectQuota):
+    async with AsyncSession() as session:
+        await session.execute(
+            update(Billing)
+            .where(
+                Billing.id == quota.billing_id,
+                Billing.next_refill_at < func.now(),
+            )
+            .values(
+                usage_left=BILLING_REFILL_AMOUNT_MAP[BillingStatus.free],
+                next_refill_at=next_month_first_day(),
+            )
         )
-        usage_left_this_billing = billing.usage_left
-
-        next_refill_date = billing.next_refill_at
-        today = datetime.now(next_refill_date.tzinfo)
-        if (
-            today > next_refill_date
-            and usage_left_this_billing is not None
-            and BILLING_REFILL_AMOUNT_MAP[BillingStatus.free] is not None
-            and usage_left_this_billing < BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
-        ):
-            usage_left_this_billing = BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
-
-            billing.next_refill_at = next_month_first_day()
-            billing.usage_left = usage_left_this_billing
-            session.commit()
+        await session.commit()
+    await invalidate_project_cache(project_id)
+
+
+async def get_project_billing(project_id: str) -> Promise[BillingData]:
+    if ADMIN_URL is not None:
+        return await admin_api.get_project_usage(project_id)
+
+    p = await get_or_load_project_value(
+        project_id, "billing", lambda: load_project_quota(project_id)
+    )
+    if not p.ok():
+        return p
+    quota = p.data()
+    if quota.billing_id is None:
+        return await fallback_billing_data(project_id)
+
+    debit, this_month_token_costs = await get_project_usage_counters(project_id)
+    usage_left_this_billing = (
+        None if quota.usage_left is None else quota.usage_left - debit
+    )
+    next_refill_date = quota.next_refill_at
+    if (
+        next_refill_date is not None
+        and datetime.now(next_refill_date.tzinfo) > next_refill_date
+        and usage_left_this_billing is not None
+        and BILLING_REFILL_AMOUNT_MAP[BillingStatus.free] is not None
+        and usage_left_this_billing < BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
+    ):
+        # the pending debits belong to the month that ends, not to the refill
+        await reconcile_project_debit(project_id)
+        await refill_project_billing(project_id, quota)
+        usage_left_this_billing = BILLING_REFILL_AMOUNT_MAP[BillingStatus.free]
+        next_refill_date = next_month_first_day()
     billing_data = BillingData(
         token_left=usage_left_this_billing,
         next_refill_at=next_refill_date,
-        project_token_cost_month=this_month_token_costs_in + this_month_token_costs_out,
+        project_token_cost_month=this_month_token_costs,
     )
     return Promise.resolve(billing_data)
 
 
 async def fallback_billing_data(project_id: str) -> Promise[BillingData]:
-    from .project import get_project_status
+    from ..auth.token import get_project_status
 
-    this_month_token_costs_in = await get_int_key(
-        TelemetryKeyName.llm_input_tokens, project_id, in_month=True
-    )
-    this_month_token_costs_out = await get_int_key(
-        TelemetryKeyName.llm_output_tokens, project_id, in_month=True
-    )
-
-    this_month_token_costs = this_month_token_costs_in + this_month_token_costs_out
+    _, this_month_token_costs = await get_project_usage_counters(project_id)
     p = await get_project_status(project_id)
     if not p.ok():
         return p
@@ -105,30 +174,108 @@ async def fallback_billing_data(project_id: str) -> Promise[BillingData]:
     )
 
 
+async def check_project_quota(project_id: str) -> Promise[BillingData]:
+    """Reject if the project used up its tokens, called before accepting new data"""
+    p = await get_project_billing(project_id)
+    if not p.ok():
+        return p
+    billing = p.data()
+    if billing.token_left is not None and billing.token_left < 0:
+        return Promise.reject(
+            CODE.SERVICE_UNAVAILABLE,
+            f"Your project reaches Memobase token limit, "
+            f"Left: {billing.token_left}, this project used: {billing.project_token_cost_month}. "
+            f"Your quota will be refilled on {billing.next_refill_at}. "
+            "\nhttps://www.memobase.io/pricing for more information.",
+        )
+    return p
+
+
 async def project_cost_token_billing(
     project_id: str, input_tokens: int, output_tokens: int
 ) -> Promise[None]:
-    await capture_int_key(
-        TelemetryKeyName.llm_input_tokens, input_tokens, project_id=project_id
-    )
-    await capture_int_key(
-        TelemetryKeyName.llm_output_tokens, output_tokens, project_id=project_id
+    await capture_int_keys(
+        {
+            TelemetryKeyName.llm_input_tokens: input_tokens,
+            TelemetryKeyName.llm_output_tokens: output_tokens,
+        },
+        project_id=project_id,
     )
     if ADMIN_URL is not None:
         return await admin_api.cost_project_usage(
             project_id, input_tokens, output_tokens
         )
-    with Session() as session:
-        _billing = (
-            session.query(ProjectBilling)
-            .filter(ProjectBilling.project_id == project_id)
-            .one_or_none()
+    async with get_redis_client() as r_c:
+        async with r_c.pipeline(transaction=True) as pipe:
+            pipe.incrby(billing_debit_key(project_id), input_tokens + output_tokens)
+            pipe.sadd(BILLING_DEBIT_PROJECTS_KEY, project_id)
+            await pipe.execute()
+    return Promise.resolve(None)
+
+
+async def reconcile_project_debit(project_id: str) -> int:
+    """Move the project's debit from Redis to `usage_left`, returns the tokens moved"""
+    async with get_redis_client() as r_c:
+        amount = int(
+            await r_c.eval(
+                CLAIM_DEBIT_SCRIPT,
+                2,
+                billing_debit_key(project_id),
+                BILLING_DEBIT_PROJECTS_KEY,
+                project_id,
+            )
+            or 0
         )
-        if _billing is None:
-            return Promise.reject(CODE.NOT_FOUND, "Billing not found")
-        billing = _billing.billing
+    if not amount:
+        return 0
+    try:
+        async with AsyncSession() as session:
+            await session.execute(
+                update(Billing)
+                .where(
+                    Billing.id
+                    == select(ProjectBilling.billing_id)
+                    .where(ProjectBilling.project_id == project_id)
+                    .scalar_subquery(),
+                    Billing.usage_left.is_not(None),
+                )
+                .values(usage_left=Billing.usage_left - amount)
+            )
+            await session.commit()
+    except Exception:
+        # give the claimed debit back, the next run retries it
+        async with get_redis_client() as r_c:
+            async with r_c.pipeline(transaction=True) as pipe:
+                pipe.incrby(billing_debit_key(project_id), amount)
+                pipe.sadd(BILLING_DEBIT_PROJECTS_KEY, project_id)
+                await pipe.execute()
+        raise
+    # the debit is gone from Redis, so every worker must reload the row now
+    await invalidate_project_cache(project_id)
+    return amount
 
-        if billing.usage_left is not None:
-            billing.usage_left -= input_tokens + output_tokens
-            session.commit()
-    return Promise.resolve(None)
+
+async def reconcile_billing_debits() -> int:
+    async with get_redis_client() as r_c:
+        project_ids = await r_c.smembers(BILLING_DEBIT_PROJECTS_KEY)
+    total = 0
+    for project_id in project_ids:
+        try:
+            total += await reconcile_project_debit(project_id)
+        except Exception as e:
+            LOG.error(f"Failed to reconcile the billing of {project_id}: {e}")
+    return total
+
+
+async def run_billing_reconciler():
+    """Reconcile every `billing_reconcile_interval`, run as a background task.
+
+    The debits stay in Redis until some process reconciles them, so nothing is
+    lost when this one stops.
+    """
+    while True:
+        await asyncio.sleep(CONFIG.billing_reconcile_interval)
+        try:
+            await reconcile_billing_debits()
+        except Exception as e:
+            LOG.error(f"Billing reconciler error, retrying: {e}")
@@ -1,9 +1,14 @@
+import uuid
 import pydantic
+from sqlalchemy import select, delete, insert
+from ..env import BufferStatus
+from ..utils import get_blob_token_size
 from ..models.utils import Promise
-from ..models.database import GeneralBlob, DEFAULT_PROJECT_ID
-from ..models.response import CODE, BlobData, IdData
+from ..models.database import GeneralBlob, BufferZone, User, DEFAULT_PROJECT_ID
+from ..models.response import CODE, BlobData, IdData, IdsData, UserBlobData
 from ..models.blob import ChatBlob, DocBlob, BlobType
-from ..connectors import Session
+from ..connectors import AsyncSession
+from .buffer_counter import add_buffer_token_size, recount_buffer_token_size
 
 
 async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[IdData]:
@@ -11,7 +16,7 @@ async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[
         blob_parsed = blob.to_blob()
     except pydantic.ValidationError as e:
         return Promise.reject(CODE.BAD_REQUEST, f"Unable to parse blob: {e}")
-    with Session() as session:
+    async with AsyncSession() as session:
         blob_db = GeneralBlob(
             blob_type=blob_parsed.type,
             blob_data=blob_parsed.get_blob_data(),
@@ -20,17 +25,87 @@ async def insert_blob(user_id: str, project_id: str, blob: BlobData) -> Promise[
             project_id=project_id,
         )
         session.add(blob_db)
-        session.commit()
+        await session.commit()
         b_id = blob_db.id
     return Promise.resolve(IdData(id=b_id))
 
 
+async def insert_blobs(
+    project_id: str, blobs: list[UserBlobData]
+) -> Promise[IdsData]:
+    """Insert blobs of one or many users together with their buffer entries.
+
+    Everything is written with multi-row INSERTs in a single transaction,
+    the returned ids follow the order of `blobs`.
+    """
+    blob_rows = []
+    buffer_rows = []
+    for i, blob in enumerate(blobs):
+        try:
+            blob_parsed = blob.to_blob()
+        except pydantic.ValidationError as e:
+            return Promise.reject(CODE.BAD_REQUEST, f"Unable to parse blob {i}: {e}")
+        blob_id = uuid.uuid4()
+        blob_rows.append(
+            {
+                "id": blob_id,
+                "user_id": blob.user_id,
+                "project_id": project_id,
+                "blob_type": blob_parsed.type.value,
+                "blob_data": blob_parsed.get_blob_data(),
+                "additional_fields": blob_parsed.fields,
+            }
+        )
+        buffer_rows.append(
+            {
+                "id": uuid.uuid4(),
+                "user_id": blob.user_id,
+                "project_id": project_id,
+                "blob_id": blob_id,
+                "blob_type": blob_parsed.type.value,
+                "token_size": get_blob_token_size(blob_parsed),
+                "status": BufferStatus.idle,
+            }
+        )
+    if not blob_rows:
+        return Promise.resolve(IdsData(ids=[]))
+
+    user_ids = {row["user_id"] for row in blob_rows}
+    async with AsyncSession() as session:
+        existing_user_ids = set(
+            await session.scalars(
+                select(User.id).where(
+                    User.id.in_(user_ids), User.project_id == project_id
+                )
+            )
+        )
+        missing_user_ids = user_ids - existing_user_ids
+        if missing_user_ids:
+            return Promise.reject(
+                CODE.NOT_FOUND,
+                f"Users not found: {', '.join(sorted(str(u) for u in missing_user_ids))}",
+            )
+        await session.execute(insert(GeneralBlob), blob_rows)
+        await session.execute(insert(BufferZone), buffer_rows)
+        buffer_token_sizes = {}
+        for row in buffer_rows:
+            key = (str(row["user_id"]), row["blob_type"])
+            buffer_token_sizes[key] = buffer_token_sizes.get(key, 0) + row["token_size"]
+        # same lock order in every batch, so concurrent batches can't deadlock
+        for (user_id, blob_type), token_size in sorted(buffer_token_sizes.items()):
+            await add_buffer_token_size(
+                session, user_id, project_id, blob_type, token_size
+            )
+        await session.commit()
+    return Promise.resolve(IdsData(ids=[row["id"] for row in blob_rows]))
+
+
 async def get_blob(user_id: str, project_id: str, blob_id: str) -> Promise[BlobData]:
-    with Session() as session:
-        blob_db = (
-            session.query(GeneralBlob)
-            .filter_by(id=blob_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        blob_db = await session.scalar(
+            select(GeneralBlob).filter_by(
+                id=blob_id, user_id=user_id, project_id=project_id
+            )
         )
         if not blob_db:
             return Promise.reject(
@@ -47,15 +122,18 @@ async def get_blob(user_id: str, project_id: str, blob_id: str) -> Promise[BlobD
 
 
 async def remove_blob(user_id: str, project_id: str, blob_id: str) -> Promise[None]:
-    with Session() as session:
-        blob_db = (
-            session.query(GeneralBlob)
-            .filter_by(id=blob_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        blob_type = await session.scalar(
+            delete(GeneralBlob)
+            .where(
+                GeneralBlob.id == blob_id,
+                GeneralBlob.user_id == user_id,
+                GeneralBlob.project_id == project_id,
+            )
+            .returning(GeneralBlob.blob_type)
         )
-        if not blob_db:
-            return Promise.resolve(None)
-        else:
-            session.delete(blob_db)
-            session.commit()
+        if blob_type is not None:
+            # its buffer is deleted by the cascade
+            await recount_buffer_token_size(session, user_id, project_id, blob_type)
+        await session.commit()
     return Promise.resolve(None)
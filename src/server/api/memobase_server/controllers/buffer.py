@@ -1,4 +1,4 @@
-from sqlalchemy import func
+from sqlalchemy import func, select, update, delete
 from pydantic import BaseModel
 from ..env import CONFIG, BufferStatus, TRACE_LOG
 from ..utils import (
@@ -9,23 +9,27 @@ from ..models.utils import Promise
 from ..models.response import CODE, ChatModalResponse, IdsData
 from ..models.database import BufferZone, GeneralBlob
 from ..models.blob import BlobType, Blob
-from ..connectors import Session, log_pool_status
+from ..connectors import AsyncSession, log_pool_status
 from .modal import BLOBS_PROCESS
+from .buffer_counter import (
+    add_buffer_token_size,
+    get_buffer_token_size,
+    claim_idle_buffers,
+)
+from ..telemetry import traced
 
 
 async def get_buffer_capacity(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[int]:
-    with Session() as session:
-        buffer_count = (
-            session.query(BufferZone.id)
-            .filter_by(
+    async with AsyncSession() as session:
+        buffer_count = await session.scalar(
+            select(func.count(BufferZone.id)).filter_by(
                 user_id=user_id,
                 blob_type=str(blob_type),
                 project_id=project_id,
                 status=BufferStatus.idle,
             )
-            .count()
         )
     return Promise.resolve(buffer_count)
 
@@ -33,7 +37,7 @@ async def get_buffer_capacity(
 async def insert_blob_to_buffer(
     user_id: str, project_id: str, blob_id: str, blob_data: Blob
 ) -> Promise[None]:
-    with Session() as session:
+    async with AsyncSession() as session:
         buffer = BufferZone(
             user_id=user_id,
             blob_id=blob_id,
@@ -43,55 +47,50 @@ async def insert_blob_to_buffer(
             status=BufferStatus.idle,
         )
         session.add(buffer)
-        session.commit()
+        await add_buffer_token_size(
+            session, user_id, project_id, blob_data.type, buffer.token_size
+        )
+        await session.commit()
     return Promise.resolve(None)
 
 
 async def wait_insert_done_then_flush(
     user_id: str, project_id: str, blob_type: BlobType
-) -> Promise[ChatModalResponse | None]:
+) -> Promise[list[ChatModalResponse]]:
     p = await get_unprocessed_buffer_ids(user_id, project_id, blob_type)
     if not p.ok():
         return p
     if p.data() is None:
         return Promise.resolve([])
-    p = await flush_buffer_by_ids(user_id, project_id, blob_type, p.data().ids)
-    if not p.ok():
-        return p
-    if p.data() is not None:
-        return Promise.resolve(p.data())
-    return Promise.resolve(None)
+    return await flush_buffer_by_ids(user_id, project_id, blob_type, p.data().ids)
 
 
 async def detect_buffer_full_or_not(
     user_id: str, project_id: str, blob_type: BlobType
 ) -> Promise[IdsData | None]:
-    with Session() as session:
+    async with AsyncSession() as session:
         # 1. if buffer size reach maximum, flush it
-        buffer_zone = (
-            session.query(BufferZone.id, BufferZone.token_size)
-            .filter_by(
-                user_id=user_id,
-                blob_type=str(blob_type),
-                project_id=project_id,
-                status=BufferStatus.idle,
-            )
-            .all()
+        buffer_token_size = await get_buffer_token_size(
+            session, user_id, project_id, blob_type
         )
-        buffer_ids = [row.id for row in buffer_zone]
-        buffer_token_size = sum(row.token_size for row in buffer_zone)
-        if (
-            buffer_token_size
-            and buffer_token_size > CONFIG.max_chat_blob_buffer_token_size
-        ):
-            TRACE_LOG.info(
-                project_id,
-                user_id,
-                f"Flush {blob_type} buffer due to reach maximum token size({buffer_token_size} > {CONFIG.max_chat_blob_buffer_token_size})",
+        if buffer_token_size <= CONFIG.max_chat_blob_buffer_token_size:
+            return Promise.resolve(IdsData(ids=[]))
+        TRACE_LOG.info(
+            project_id,
+            user_id,
+            f"Flush {blob_type} buffer due to reach maximum token size({buffer_token_size} > {CONFIG.max_chat_blob_buffer_token_size})",
+        )
+        buffer_ids = (
+            await session.scalars(
+                select(BufferZone.id).filter_by(
+                    user_id=user_id,
+                    blob_type=str(blob_type),
+                    project_id=project_id,
+                    status=BufferStatus.idle,
+                )
             )
-
-            return Promise.resolve(IdsData(ids=buffer_ids))
-    return Promise.resolve(IdsData(ids=[]))
+        ).all()
+    return Promise.resolve(IdsData(ids=list(buffer_ids)))
 
 
 async def get_unprocessed_buffer_ids(
@@ -100,68 +99,76 @@ async def get_unprocessed_buffer_ids(
     blob_type: BlobType,
     select_status: str = BufferStatus.idle,
 ) -> Promise[IdsData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         buffer_ids = (
-            session.query(BufferZone.id)
-            .filter_by(
-                user_id=user_id,
-                blob_type=str(blob_type),
-                project_id=project_id,
-                status=select_status,
+            await session.scalars(
+                select(BufferZone.id).filter_by(
+                    user_id=user_id,
+                    blob_type=str(blob_type),
+                    project_id=project_id,
+                    status=select_status,
+                )
             )
-            .all()
-        )
-        return Promise.resolve(IdsData(ids=[row.id for row in buffer_ids]))
+        ).all()
+        return Promise.resolve(IdsData(ids=list(buffer_ids)))
 
 
+@traced("flush_buffer")
 async def flush_buffer_by_ids(
     user_id: str,
     project_id: str,
     blob_type: BlobType,
     buffer_ids: list[str],
     select_status: str = BufferStatus.idle,
-) -> Promise[ChatModalResponse | None]:
-    # FIXME: parallel calling will cause duplicated flush
+) -> Promise[list[ChatModalResponse]]:
+    """Process the buffers, in batches that fit `max_chat_blob_buffer_process_token_size`"""
     if blob_type not in BLOBS_PROCESS:
         return Promise.reject(CODE.BAD_REQUEST, f"Blob type {blob_type} not supported")
     if not len(buffer_ids):
-        return Promise.resolve(None)
+        return Promise.resolve([])
 
     # Log initial pool status
     log_pool_status(f"flush_buffer_by_ids_start_{blob_type}")
 
-    with Session() as session:
+    async with AsyncSession() as session:
+        if select_status == BufferStatus.idle:
+            # claim the buffers first, a parallel flush of the same ids gets none of them
+            claimed = await claim_idle_buffers(
+                session, user_id, project_id, blob_type, buffer_ids
+            )
+            buffer_ids = [row.id for row in claimed]
+            select_status = BufferStatus.processing
         # Join BufferZone with GeneralBlob to get all data in one query
         buffer_blob_data = (
-            session.query(
-                BufferZone.id.label("buffer_id"),
-                BufferZone.blob_id,
-                BufferZone.token_size,
-                BufferZone.created_at.label("buffer_created_at"),
-                GeneralBlob.created_at,
-                GeneralBlob.blob_data,
-            )
-            .join(GeneralBlob, BufferZone.blob_id == GeneralBlob.id)
-            .filter(
-                BufferZone.user_id == user_id,
-                BufferZone.blob_type == str(blob_type),
-                BufferZone.project_id == project_id,
-                GeneralBlob.user_id == user_id,
-                GeneralBlob.project_id == project_id,
-                BufferZone.status == select_status,
-                BufferZone.id.in_(buffer_ids),
+            await session.execute(
+                select(
+                    BufferZone.id.label("buffer_id"),
+                    BufferZone.blob_id,
+                    BufferZone.token_size,
+                    BufferZone.created_at.label("buffer_created_at"),
+                    GeneralBlob.created_at,
+                    GeneralBlob.blob_data,
+                )
+                .join(GeneralBlob, BufferZone.blob_id == GeneralBlob.id)
+                .where(
+                    BufferZone.user_id == user_id,
+                    BufferZone.blob_type == str(blob_type),
+                    BufferZone.project_id == project_id,
+                    GeneralBlob.user_id == user_id,
+                    GeneralBlob.project_id == project_id,
+                    BufferZone.status == select_status,
+                    BufferZone.id.in_(buffer_ids),
+                )
+                .order_by(BufferZone.created_at)
             )
-            .order_by(BufferZone.created_at)
-            .all()
-        )
+        ).all()
         # Update buffer status to processing
         process_buffer_ids = [row.buffer_id for row in buffer_blob_data]
         if select_status != BufferStatus.processing:
-            session.query(BufferZone).filter(
-                BufferZone.id.in_(process_buffer_ids),
-            ).update(
-                {BufferZone.status: BufferStatus.processing},
-                synchronize_session=False,
+            await session.execute(
+                update(BufferZone)
+                .where(BufferZone.id.in_(process_buffer_ids))
+                .values(status=BufferStatus.processing)
             )
 
         if not buffer_blob_data:
@@ -170,10 +177,8 @@ async def flush_buffer_by_ids(
                 user_id,
                 f"No {blob_type} buffer to flush",
             )
-            return Promise.resolve(None)
+            return Promise.resolve([])
 
-        blob_ids = [row.blob_id for row in buffer_blob_data]
-        blobs = [pack_blob_from_db(row, blob_type) for row in buffer_blob_data]
         total_token_size = sum(row.token_size for row in buffer_blob_data)
         TRACE_LOG.info(
             project_id,
@@ -181,46 +186,95 @@ async def flush_buffer_by_ids(
             f"Flush {blob_type} buffer with {len(buffer_blob_data)} blobs and total token size({total_token_size})",
         )
 
-        session.commit()
+        await session.commit()
+
+    batches = split_buffer_batches(
+        buffer_blob_data, CONFIG.max_chat_blob_buffer_process_token_size
+    )
+    results = []
+    for i, batch in enumerate(batches):
+        try:
+            p = await process_buffer_batch(user_id, project_id, blob_type, batch)
+        except Exception:
+            await set_buffers_failed(batches[i + 1 :])
+            raise
+        if not p.ok():
+            # the later batches were claimed but never processed
+            await set_buffers_failed(batches[i + 1 :])
+            return p
+        if p.data() is not None:
+            results.append(p.data())
+    return Promise.resolve(results)
 
+
+def split_buffer_batches(rows: list, max_token_size: int) -> list[list]:
+    """Split buffers, oldest first, into batches of at most `max_token_size` tokens.
+
+    The modal truncates its input to that size, so a larger flush is processed
+    batch by batch instead of dropping the older blobs.
+    """
+    batches = []
+    batch_token_size = 0
+    for row in rows:
+        if not batches or batch_token_size + row.token_size > max_token_size:
+            batches.append([])
+            batch_token_size = 0
+        batches[-1].append(row)
+        batch_token_size += row.token_size
+    return batches
+
+
+async def set_buffers_failed(batches: list[list]) -> None:
+    buffer_ids = [row.buffer_id for batch in batches for row in batch]
+    if not buffer_ids:
+        return
+    async with AsyncSession() as session:
+        await session.execute(
+            update(BufferZone)
+            .where(BufferZone.id.in_(buffer_ids))
+            .values(status=BufferStatus.failed)
+        )
+        await session.commit()
+
+
+async def process_buffer_batch(
+    user_id: str, project_id: str, blob_type: BlobType, buffer_blob_data: list
+) -> Promise[ChatModalResponse | None]:
+    process_buffer_ids = [row.buffer_id for row in buffer_blob_data]
+    blob_ids = [row.blob_id for row in buffer_blob_data]
     try:
         # Pack blobs from the joined data
+        blobs = [pack_blob_from_db(row, blob_type) for row in buffer_blob_data]
 
         # Process blobs first (moved outside the session)
         p = await BLOBS_PROCESS[blob_type](user_id, project_id, blobs)
         if not p.ok():
             # Rollback buffer status to failed if the process failed
-            with Session() as session:
-                session.query(BufferZone).filter(
-                    BufferZone.id.in_(process_buffer_ids),
-                ).update(
-                    {BufferZone.status: BufferStatus.failed},
-                    synchronize_session=False,
-                )
-                session.commit()
+            await set_buffers_failed([buffer_blob_data])
             return p
-        with Session() as session:
+        async with AsyncSession() as session:
             try:
                 # Update buffer status to done
-                session.query(BufferZone).filter(
-                    BufferZone.id.in_(process_buffer_ids),
-                ).update(
-                    {BufferZone.status: BufferStatus.done},
-                    synchronize_session=False,
+                await session.execute(
+                    update(BufferZone)
+                    .where(BufferZone.id.in_(process_buffer_ids))
+                    .values(status=BufferStatus.done)
                 )
                 if blob_type == BlobType.chat and not CONFIG.persistent_chat_blobs:
-                    session.query(GeneralBlob).filter(
-                        GeneralBlob.id.in_(blob_ids),
-                        GeneralBlob.project_id == project_id,
-                    ).delete(synchronize_session=False)
-                session.commit()
+                    await session.execute(
+                        delete(GeneralBlob).where(
+                            GeneralBlob.id.in_(blob_ids),
+                            GeneralBlob.project_id == project_id,
+                        )
+                    )
+                await session.commit()
                 TRACE_LOG.info(
                     project_id,
                     user_id,
                     f"Flushed {blob_type} buffer(size: {len(buffer_blob_data)})",
                 )
             except Exception as e:
-                session.rollback()
+                await session.rollback()
                 TRACE_LOG.error(
                     project_id,
                     user_id,
@@ -232,14 +286,7 @@ async def flush_buffer_by_ids(
         return p
 
     except Exception as e:
-        with Session() as session:
-            session.query(BufferZone).filter(
-                BufferZone.id.in_(process_buffer_ids),
-            ).update(
-                {BufferZone.status: BufferStatus.failed},
-                synchronize_session=False,
-            )
-            session.commit()
+        await set_buffers_failed([buffer_blob_data])
         TRACE_LOG.error(
             project_id,
             user_id,
@@ -251,7 +298,7 @@ async def flush_buffer_by_ids(
 
 async def flush_buffer(
     user_id: str, project_id: str, blob_type: BlobType
-) -> Promise[ChatModalResponse | None]:
+) -> Promise[list[ChatModalResponse]]:
     p = await get_unprocessed_buffer_ids(user_id, project_id, blob_type)
     if not p.ok():
         return p
@@ -1,3 +1,4 @@
+import json
 import uuid
 import asyncio
 import traceback
@@ -8,9 +9,11 @@ from ..models.utils import Promise
 from ..models.response import CODE, ChatModalResponse, IdsData, UUID
 from ..models.database import BufferZone, GeneralBlob
 from ..models.blob import BlobType, Blob
-from ..connectors import Session, PROJECT_ID, get_redis_client
+from ..connectors import AsyncSession, PROJECT_ID, get_redis_client
+from ..telemetry import inject_trace_context, continue_trace
 from .modal import BLOBS_PROCESS
-from .buffer import flush_buffer_by_ids
+from .buffer import flush_buffer_by_ids, split_buffer_batches
+from .buffer_counter import claim_idle_buffers
 
 REDIS_LUA_CHECK_AND_DELETE_LOCK = """
 if redis.call("get", KEYS[1]) == ARGV[1] then
@@ -29,14 +32,58 @@ def get_user_buffer_queue_key(user_id: str, project_id: str, scope: str) -> str:
     return f"memobase:user_buffer_queue:{PROJECT_ID}:{scope}:{project_id}:{user_id}"
 
 
-def pack_ids_to_str(ids: list[str]) -> str:
-    return "::".join([str(i) for i in ids])
+# users with queued buffers, one sorted set per project scored by pending tokens
+FLUSH_PENDING_PROJECTS_KEY = f"memobase:flush_pending_projects:{PROJECT_ID}"
+# wakes up the in-process flush worker
+FLUSH_PENDING_EVENT = asyncio.Event()
+
+
+def get_flush_pending_key(project_id: str) -> str:
+    return f"memobase:flush_pending:{PROJECT_ID}:{project_id}"
+
+
+def pack_flush_job(user_id: str, blob_type: BlobType) -> str:
+    return f"{blob_type}::{user_id}"
+
+
+def unpack_flush_job(job: str) -> tuple[str, BlobType]:
+    blob_type, user_id = job.split("::", 1)
+    return user_id, BlobType(blob_type)
+
+
+async def schedule_user_flush(
+    user_id: str, project_id: str, blob_type: BlobType, token_size: int
+) -> None:
+    """Mark the user's buffer queue as pending for the flush worker"""
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zincrby(
+                get_flush_pending_key(project_id),
+                token_size,
+                pack_flush_job(user_id, blob_type),
+            )
+            pipe.sadd(FLUSH_PENDING_PROJECTS_KEY, project_id)
+            await pipe.execute()
+    FLUSH_PENDING_EVENT.set()
 
 
 def unpack_ids_from_str(ids_str: str) -> list[str]:
     return [i.strip() for i in ids_str.split("::") if i.strip()]
 
 
+def pack_buffer_batch(ids: list[str]) -> str:
+    """Queued buffer ids, with the trace context of the request that queued them"""
+    return json.dumps({"ids": [str(i) for i in ids], "trace": inject_trace_context()})
+
+
+def unpack_buffer_batch(batch: str) -> tuple[list[str], dict[str, str]]:
+    # batches queued by older versions are `::` joined ids
+    if not batch.startswith("{"):
+        return unpack_ids_from_str(batch), {}
+    data = json.loads(batch)
+    return data["ids"], data.get("trace") or {}
+
+
 async def flush_buffer_by_ids_in_background(
     user_id: str, project_id: str, blob_type: BlobType, buffer_ids: list[str]
 ) -> None:
@@ -46,50 +93,44 @@ async def flush_buffer_by_ids_in_background(
         return
 
     # 1. mark buffer as processing
-    with Session() as session:
-        buffer_blob_data = (
-            session.query(BufferZone.id)
-            .filter(
-                BufferZone.user_id == user_id,
-                BufferZone.blob_type == str(blob_type),
-                BufferZone.project_id == project_id,
-                BufferZone.status == BufferStatus.idle,
-                BufferZone.id.in_(buffer_ids),
-            )
-            .order_by(BufferZone.created_at)
-            .all()
+    async with AsyncSession() as session:
+        claimed = await claim_idle_buffers(
+            session, user_id, project_id, blob_type, buffer_ids
         )
-        actual_buffer_ids = [row.id for row in buffer_blob_data]
-        if not len(actual_buffer_ids):
+        if not len(claimed):
             return
-        session.query(BufferZone).filter(
-            BufferZone.id.in_(actual_buffer_ids),
-        ).update(
-            {BufferZone.status: BufferStatus.processing},
-            synchronize_session=False,
-        )
+        await session.commit()
 
-        session.commit()
-
-    # 2. add actual buffer ids to a redis queue
+    # 2. add actual buffer ids to a redis queue, one entry per batch the modal
+    # can process without truncating it
     buffer_queue_key = get_user_buffer_queue_key(
         user_id, project_id, f"flush_buffer_background_{blob_type}"
     )
-    buffer_ids_str = pack_ids_to_str(actual_buffer_ids)
+    buffer_batches = [
+        pack_buffer_batch([row.id for row in batch])
+        for batch in split_buffer_batches(
+            claimed, CONFIG.max_chat_blob_buffer_process_token_size
+        )
+    ]
 
     try:
         async with get_redis_client() as redis_client:
-            await redis_client.rpush(buffer_queue_key, buffer_ids_str)
+            await redis_client.rpush(buffer_queue_key, *buffer_batches)
 
             queue_size = await redis_client.llen(buffer_queue_key)
 
             TRACE_LOG.info(
                 project_id,
                 user_id,
-                f"[background] Enqueued {len(actual_buffer_ids)} buffer IDs to queue (queue size: {queue_size})",
+                f"[background] Enqueued {len(claimed)} buffer IDs in {len(buffer_batches)} batches to queue (queue size: {queue_size})",
             )
 
-        await flush_buffer_background_running(user_id, project_id, blob_type)
+        if CONFIG.flush_worker_mode == "background":
+            await flush_buffer_background_running(user_id, project_id, blob_type)
+        else:
+            await schedule_user_flush(
+                user_id, project_id, blob_type, sum(row.token_size for row in claimed)
+            )
     except Exception as e:
         TRACE_LOG.error(
             project_id,
@@ -107,7 +148,8 @@ async def flush_buffer_background_running(
     process_interval_s: float = 60 * 5,  # Reduced from 10 minutes to 5 minutes
     max_processing_time_s: float = 60 * 15,  # Maximum 15 minutes total processing time
     max_consecutive_errors=5,  # Stop after 5 consecutive errors
-):
+) -> bool:
+    """Drain the user's buffer queue, returns False if another run holds the lock"""
     user_key = get_user_lock_key(
         user_id, project_id, f"flush_buffer_background_{blob_type}"
     )
@@ -129,7 +171,7 @@ async def flush_buffer_background_running(
                 user_id,
                 f"[background] Lock already acquired",
             )
-            return
+            return False
 
     try:
         iteration_count = 0
@@ -177,7 +219,7 @@ async def flush_buffer_background_running(
                 f"[background]({iteration_count}/{max_iterations}) Processing buffer (left queue size: {current_queue_size})",
             )
 
-            buffer_ids = unpack_ids_from_str(buffer_ids_str or "")
+            buffer_ids, trace_carrier = unpack_buffer_batch(buffer_ids_str or "")
             if not buffer_ids:
                 continue
 
@@ -185,13 +227,33 @@ async def flush_buffer_background_running(
                 # Process the buffer with timeout protection
                 processing_start = asyncio.get_event_loop().time()
 
-                p = await flush_buffer_by_ids(
-                    user_id,
-                    project_id,
-                    blob_type,
-                    buffer_ids,
-                    select_status=BufferStatus.processing,
-                )
+                with continue_trace(
+                    "flush_buffer.background",
+                    trace_carrier,
+                    project_id=project_id,
+                    user_id=user_id,
+                    blob_type=str(blob_type),
+                    buffers=len(buffer_ids),
+                ):
+                    try:
+                        p = await flush_buffer_by_ids(
+                            user_id,
+                            project_id,
+                            blob_type,
+                            buffer_ids,
+                            select_status=BufferStatus.processing,
+                        )
+                    except asyncio.CancelledError:
+                        # the buffers are still processing, put the batch back so
+                        # the next run flushes them again
+                        async with get_redis_client() as redis_client:
+                            await redis_client.lpush(buffer_queue_key, buffer_ids_str)
+                        TRACE_LOG.warning(
+                            project_id,
+                            user_id,
+                            f"[background] Flush cancelled, requeued {len(buffer_ids)} buffer IDs",
+                        )
+                        raise
 
                 processing_time = asyncio.get_event_loop().time() - processing_start
 
@@ -273,3 +335,4 @@ async def flush_buffer_background_running(
                 user_id,
                 f"[background] Failed to release lock: {e}",
             )
+    return True
@@ -0,0 +1,148 @@
+"""
+Running token size of the idle buffers, one row per (user, project, blob type).
+
+The counter is written in the same transaction as the buffer rows it counts:
+inserting idle buffers adds their token size, claiming buffers for a flush
+recomputes it from the buffers that are still idle. Claims lock the counter
+row first, so concurrent inserts and claims of one user are serialized and
+every idle buffer is claimed by exactly one flush.
+"""
+
+from sqlalchemy import Row, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession as AsyncSessionType
+from ..env import BufferStatus
+from ..models.database import BufferZone, BufferTokenCounter
+from ..models.blob import BlobType
+
+
+def _counter_filter(user_id: str, project_id: str, blob_type: BlobType) -> tuple:
+    return (
+        BufferTokenCounter.user_id == user_id,
+        BufferTokenCounter.project_id == project_id,
+        BufferTokenCounter.blob_type == str(blob_type),
+    )
+
+
+def _idle_buffer_token_size(user_id: str, project_id: str, blob_type: BlobType):
+    return (
+        select(func.coalesce(func.sum(BufferZone.token_size), 0))
+        .where(
+            BufferZone.user_id == user_id,
+            BufferZone.project_id == project_id,
+            BufferZone.blob_type == str(blob_type),
+            BufferZone.status == BufferStatus.idle,
+        )
+        .scalar_subquery()
+    )
+
+
+async def add_buffer_token_size(
+    session: AsyncSessionType,
+    user_id: str,
+    project_id: str,
+    blob_type: BlobType,
+    token_size: int,
+) -> int:
+    """Add newly inserted idle buffers to the counter, returns the new total.
+
+    Call it after the buffer rows are added and before the commit. The first
+    call for a user sums the idle buffers, which already include the new ones.
+    """
+    await session.flush()
+    total = await session.scalar(
+        update(BufferTokenCounter)
+        .where(*_counter_filter(user_id, project_id, blob_type))
+        .values(
+            token_size=BufferTokenCounter.token_size + token_size,
+            updated_at=func.now(),
+        )
+        .returning(BufferTokenCounter.token_size)
+        .execution_options(synchronize_session=False)
+    )
+    if total is not None:
+        return total
+    # VALUES is evaluated even on conflict, so the sum only runs for a new counter
+    stmt = (
+        insert(BufferTokenCounter)
+        .values(
+            user_id=user_id,
+            project_id=project_id,
+            blob_type=str(blob_type),
+            token_size=_idle_buffer_token_size(user_id, project_id, blob_type),
+        )
+        .on_conflict_do_update(
+            index_elements=["user_id", "project_id", "blob_type"],
+            set_={
+                "token_size": BufferTokenCounter.token_size + token_size,
+                "updated_at": func.now(),
+            },
+        )
+        .returning(BufferTokenCounter.token_size)
+    )
+    return await session.scalar(stmt)
+
+
+async def get_buffer_token_size(
+    session: AsyncSessionType, user_id: str, project_id: str, blob_type: BlobType
+) -> int:
+    token_size = await session.scalar(
+        select(BufferTokenCounter.token_size).where(
+            *_counter_filter(user_id, project_id, blob_type)
+        )
+    )
+    return token_size or 0
+
+
+async def recount_buffer_token_size(
+    session: AsyncSessionType, user_id: str, project_id: str, blob_type: BlobType
+) -> None:
+    """Recompute the counter from the idle buffers, e.g. after they are deleted"""
+    await session.execute(
+        update(BufferTokenCounter)
+        .where(*_counter_filter(user_id, project_id, blob_type))
+        .values(
+            token_size=_idle_buffer_token_size(user_id, project_id, blob_type),
+            updated_at=func.now(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def claim_idle_buffers(
+    session: AsyncSessionType,
+    user_id: str,
+    project_id: str,
+    blob_type: BlobType,
+    buffer_ids: list[str],
+) -> list[Row]:
+    """Move idle buffers to processing, returns the (id, token_size, created_at)
+    rows this call got, oldest first.
+
+    A buffer that another flush already claimed is skipped, so parallel
+    flushes of the same ids never process a buffer twice.
+    """
+    # inserts of this user wait here until the claim commits
+    await session.execute(
+        select(BufferTokenCounter.token_size)
+        .where(*_counter_filter(user_id, project_id, blob_type))
+        .with_for_update()
+    )
+    claimed = (
+        await session.execute(
+            update(BufferZone)
+            .where(
+                BufferZone.user_id == user_id,
+                BufferZone.project_id == project_id,
+                BufferZone.blob_type == str(blob_type),
+                BufferZone.status == BufferStatus.idle,
+                BufferZone.id.in_(buffer_ids),
+            )
+            .values(status=BufferStatus.processing)
+            .returning(BufferZone.id, BufferZone.token_size, BufferZone.created_at)
+            .execution_options(synchronize_session=False)
+        )
+    ).all()
+    if claimed:
+        await recount_buffer_token_size(session, user_id, project_id, blob_type)
+    return sorted(claimed, key=lambda row: row.created_at)
@@ -1,19 +1,41 @@
+import time
+import asyncio
 from functools import partial
+from typing import AsyncIterator, Callable, Optional
 from ..models.utils import Promise, CODE
-from ..models.response import ContextData, OpenAICompatibleMessage, UserEventGistsData
+from ..models.response import (
+    ContextData,
+    ContextStreamChunk,
+    OpenAICompatibleMessage,
+    UserContextData,
+    UsersContextData,
+    UserEventGistsData,
+    UserProfilesData,
+)
 from ..prompts.chat_context_pack import CONTEXT_PROMPT_PACK
-from ..utils import get_encoded_tokens, event_str_repr
+from ..utils import event_str_repr, profile_str_repr
 from ..env import CONFIG, TRACE_LOG
 from .project import get_project_profile_config
-from .profile import get_user_profiles, truncate_profiles
-from .post_process.profile import filter_profiles_with_chats
+from .profile import (
+    get_user_profiles,
+    get_users_profiles,
+    get_users_profile_embeddings,
+    use_profile_embeddings,
+    truncate_profiles,
+    profile_token_size,
+)
+from ..llms.embeddings import get_embedding
+from .post_process.profile import filter_profiles_with_chats, pack_profile_query
 
 # from .event import get_user_events, search_user_events, truncate_events
 from .event_gist import (
     get_user_event_gists,
     truncate_event_gists,
     search_user_event_gists,
+    get_users_event_gists,
+    event_gist_token_size,
 )
+from ..telemetry import traced
 
 
 def customize_context_prompt_func(
@@ -24,10 +46,18 @@ def customize_context_prompt_func(
     )
 
 
+def time_left(deadline: Optional[float], reserve_ms: int = 0) -> Optional[float]:
+    """Seconds left before the monotonic `deadline` minus a reserve, None if there is no deadline"""
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic() - reserve_ms / 1000)
+
+
 def pack_latest_chat(chats: list[OpenAICompatibleMessage], chat_num: int = 3) -> str:
     return "\n".join([f"{m.content}" for m in chats[-chat_num:]])
 
 
+@traced("context.profiles")
 async def get_user_profiles_data(
     user_id: str,
     project_id: str,
@@ -38,51 +68,89 @@ async def get_user_profiles_data(
     topic_limits: dict[str, int],
     chats: list[OpenAICompatibleMessage],
     full_profile_and_only_search_event: bool,
+    deadline: Optional[float] = None,
+    skipped_stages: Optional[list[str]] = None,
 ) -> Promise[tuple[str, list]]:
-    """Retrieve and process user profiles."""
-    p = await get_user_profiles(user_id, project_id)
+    """Retrieve and process user profiles.
+
+    With a `deadline`, the LLM filtering is skipped when there is no time left
+    for it, and no profile is returned if even loading them is too slow. The
+    skipped stages are appended to `skipped_stages`.
+    """
+    skipped_stages = skipped_stages if skipped_stages is not None else []
+    try:
+        p = await asyncio.wait_for(
+            asyncio.shield(get_user_profiles(user_id, project_id)),
+            time_left(deadline),
+        )
+    except asyncio.TimeoutError:
+        skipped_stages.append("profiles")
+        return Promise.resolve(("", []))
     if not p.ok():
         return p
     total_profiles = p.data()
 
-    if max_profile_token_size > 0:
-        if chats and (not full_profile_and_only_search_event):
-            p = await filter_profiles_with_chats(
-                user_id,
-                project_id,
-                total_profiles,
-                chats,
-                only_topics=only_topics,
+    if max_profile_token_size > 0 and chats and not full_profile_and_only_search_event:
+        budget = time_left(deadline, CONFIG.context_deadline_reserve_ms)
+        try:
+            if budget == 0:
+                raise asyncio.TimeoutError()
+            p = await asyncio.wait_for(
+                filter_profiles_with_chats(
+                    user_id,
+                    project_id,
+                    total_profiles,
+                    chats,
+                    only_topics=only_topics,
+                ),
+                budget,
             )
             if p.ok():
                 total_profiles.profiles = p.data()["profiles"]
+        except asyncio.TimeoutError:
+            # fall back to the most recent profiles
+            skipped_stages.append("profile_filter")
+
+    return await pack_profile_section(
+        total_profiles,
+        max_profile_token_size,
+        prefer_topics,
+        only_topics,
+        max_subtopic_size,
+        topic_limits,
+    )
 
-        user_profiles = total_profiles
-        use_profiles = await truncate_profiles(
-            user_profiles,
-            prefer_topics=prefer_topics,
-            only_topics=only_topics,
-            max_token_size=max_profile_token_size,
-            max_subtopic_size=max_subtopic_size,
-            topic_limits=topic_limits,
-        )
-        if not use_profiles.ok():
-            return use_profiles
-        use_profiles = use_profiles.data().profiles
-
-        profile_section = "- " + "\n- ".join(
-            [
-                f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-                for p in use_profiles
-            ]
-        )
-    else:
-        profile_section = ""
-        use_profiles = []
 
+async def pack_profile_section(
+    user_profiles: UserProfilesData,
+    max_profile_token_size: int,
+    prefer_topics: list[str],
+    only_topics: list[str],
+    max_subtopic_size: int,
+    topic_limits: dict[str, int],
+) -> Promise[tuple[str, list]]:
+    """Truncate the profiles, returns the section and the profiles in it"""
+    if max_profile_token_size <= 0:
+        return Promise.resolve(("", []))
+    use_profiles = await truncate_profiles(
+        user_profiles,
+        prefer_topics=prefer_topics,
+        only_topics=only_topics,
+        max_token_size=max_profile_token_size,
+        max_subtopic_size=max_subtopic_size,
+        topic_limits=topic_limits,
+    )
+    if not use_profiles.ok():
+        return use_profiles
+    use_profiles = use_profiles.data().profiles
+
+    profile_section = "- " + "\n- ".join(
+        [profile_str_repr(p.content, p.attributes) for p in use_profiles]
+    )
     return Promise.resolve((profile_section, use_profiles))
 
 
+@traced("context.event_gists")
 async def get_user_event_gists_data(
     user_id: str,
     project_id: str,
@@ -90,28 +158,103 @@ async def get_user_event_gists_data(
     require_event_summary: bool,
     event_similarity_threshold: float,
     time_range_in_days: int,
+    deadline: Optional[float] = None,
+    skipped_stages: Optional[list[str]] = None,
 ) -> Promise[UserEventGistsData]:
-    """Retrieve user events data."""
+    """Retrieve user events data.
+
+    With a `deadline`, the vector search falls back to the latest event gists
+    when there is no time left for it, and no gist is returned if even loading
+    them is too slow. The skipped stages are appended to `skipped_stages`.
+    """
+    skipped_stages = skipped_stages if skipped_stages is not None else []
     if chats and CONFIG.enable_event_embedding:
         search_query = pack_latest_chat(chats)
-        p = await search_user_event_gists(
-            user_id,
-            project_id,
-            query=search_query,
-            topk=60,
-            similarity_threshold=event_similarity_threshold,
-            time_range_in_days=time_range_in_days,
-        )
-    else:
-        p = await get_user_event_gists(
-            user_id,
-            project_id,
-            topk=60,
-            time_range_in_days=time_range_in_days,
+        budget = time_left(deadline, CONFIG.context_deadline_reserve_ms)
+        if budget != 0:
+            try:
+                return await asyncio.wait_for(
+                    search_user_event_gists(
+                        user_id,
+                        project_id,
+                        query=search_query,
+                        topk=60,
+                        similarity_threshold=event_similarity_threshold,
+                        time_range_in_days=time_range_in_days,
+                    ),
+                    budget,
+                )
+            except asyncio.TimeoutError:
+                pass
+        skipped_stages.append("event_search")
+    try:
+        p = await asyncio.wait_for(
+            asyncio.shield(
+                get_user_event_gists(
+                    user_id,
+                    project_id,
+                    topk=60,
+                    time_range_in_days=time_range_in_days,
+                )
+            ),
+            time_left(deadline),
         )
+    except asyncio.TimeoutError:
+        skipped_stages.append("events")
+        return Promise.resolve(UserEventGistsData(gists=[]))
     return p
 
 
+async def get_context_prompt_func(
+    project_id: str, customize_context_prompt: str = None
+) -> Promise[Callable[[str, str], str]]:
+    p = await get_project_profile_config(project_id)
+    if not p.ok():
+        return p
+    profile_config = p.data()
+    use_language = profile_config.language or CONFIG.language
+    context_prompt_func = CONTEXT_PROMPT_PACK[use_language]
+    if customize_context_prompt is not None:
+        context_prompt_func = partial(
+            customize_context_prompt_func, customize_context_prompt
+        )
+    return Promise.resolve(context_prompt_func)
+
+
+def get_max_event_token_size(
+    max_token_size: int,
+    max_profile_token_size: int,
+    profile_section_tokens: int,
+    fill_window_with_events: bool,
+) -> int:
+    if fill_window_with_events:
+        return max_token_size - profile_section_tokens
+    return min(
+        max_token_size - profile_section_tokens,
+        max_token_size - max_profile_token_size,
+    )
+
+
+async def pack_event_section(
+    user_event_gists: UserEventGistsData, max_event_token_size: int
+) -> Promise[tuple[str, int, int]]:
+    """Truncate the event gists, returns the section, its gist number and token size"""
+    if max_event_token_size <= 0:
+        return Promise.resolve(("", 0, 0))
+    p = await truncate_event_gists(user_event_gists, max_event_token_size)
+    if not p.ok():
+        return p
+    user_event_gists = p.data()
+    event_section = "\n".join([ed.gist_data.content for ed in user_event_gists.gists])
+    event_section_tokens = sum(
+        event_gist_token_size(ed) for ed in user_event_gists.gists
+    )
+    return Promise.resolve(
+        (event_section, len(user_event_gists.gists), event_section_tokens)
+    )
+
+
+@traced("context")
 async def get_user_context(
     user_id: str,
     project_id: str,
@@ -128,22 +271,17 @@ async def get_user_context(
     customize_context_prompt: str = None,
     full_profile_and_only_search_event: bool = False,
     fill_window_with_events: bool = False,
+    deadline_ms: Optional[int] = None,
 ) -> Promise[ContextData]:
-    import asyncio
-
     assert 0 < profile_event_ratio <= 1, "profile_event_ratio must be between 0 and 1"
     max_profile_token_size = int(max_token_size * profile_event_ratio)
+    deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms else None
+    skipped_stages = []
 
-    p = await get_project_profile_config(project_id)
+    p = await get_context_prompt_func(project_id, customize_context_prompt)
     if not p.ok():
         return p
-    profile_config = p.data()
-    use_language = profile_config.language or CONFIG.language
-    context_prompt_func = CONTEXT_PROMPT_PACK[use_language]
-    if customize_context_prompt is not None:
-        context_prompt_func = partial(
-            customize_context_prompt_func, customize_context_prompt
-        )
+    context_prompt_func = p.data()
 
     # Execute profile and event retrieval in parallel
     profile_result, event_gist_result = await asyncio.gather(
@@ -157,6 +295,8 @@ async def get_user_context(
             topic_limits,
             chats,
             full_profile_and_only_search_event,
+            deadline=deadline,
+            skipped_stages=skipped_stages,
         ),
         get_user_event_gists_data(
             user_id,
@@ -165,6 +305,8 @@ async def get_user_context(
             require_event_summary,
             event_similarity_threshold,
             time_range_in_days,
+            deadline=deadline,
+            skipped_stages=skipped_stages,
         ),
         return_exceptions=True,
     )
@@ -187,36 +329,346 @@ async def get_user_context(
         return event_gist_result
     user_event_gists = event_gist_result.data()
 
-    # Calculate token sizes and truncate events if needed
-    profile_section_tokens = len(get_encoded_tokens(profile_section))
-    if fill_window_with_events:
-        max_event_token_size = max_token_size - profile_section_tokens
-    else:
-        max_event_token_size = min(
-            max_token_size - profile_section_tokens,
-            max_token_size - max_profile_token_size,
+    p = await pack_user_context(
+        user_id,
+        project_id,
+        context_prompt_func,
+        profile_section,
+        use_profiles,
+        user_event_gists,
+        max_token_size,
+        max_profile_token_size,
+        fill_window_with_events,
+    )
+    if not p.ok():
+        return p
+    if skipped_stages:
+        TRACE_LOG.warning(
+            project_id,
+            user_id,
+            f"Context deadline of {deadline_ms}ms, skipped stages: {skipped_stages}",
         )
 
+    return Promise.resolve(
+        ContextData(context=p.data(), skipped_stages=skipped_stages)
+    )
+
+
+@traced("context.pack")
+async def pack_user_context(
+    user_id: str,
+    project_id: str,
+    context_prompt_func: Callable[[str, str], str],
+    profile_section: str,
+    use_profiles: list,
+    user_event_gists: UserEventGistsData,
+    max_token_size: int,
+    max_profile_token_size: int,
+    fill_window_with_events: bool,
+) -> Promise[str]:
+    """Fill the rest of the window with events and render the context"""
+    # stored token sizes plus the "- " bullet of each line, no re-tokenizing
+    profile_section_tokens = sum(profile_token_size(p) + 1 for p in use_profiles)
+
+    # Truncate events if needed
+    max_event_token_size = get_max_event_token_size(
+        max_token_size,
+        max_profile_token_size,
+        profile_section_tokens,
+        fill_window_with_events,
+    )
     if max_event_token_size <= 0:
-        return Promise.resolve(
-            ContextData(context=context_prompt_func(profile_section, ""))
-        )
+        return Promise.resolve(context_prompt_func(profile_section, ""))
 
     # Truncate events based on calculated token size
-    p = await truncate_event_gists(user_event_gists, max_event_token_size)
+    p = await pack_event_section(user_event_gists, max_event_token_size)
     if not p.ok():
         return p
-    user_event_gists = p.data()
-
-    event_section = "\n".join([ed.gist_data.content for ed in user_event_gists.gists])
-    event_section_tokens = len(get_encoded_tokens(event_section))
+    event_section, event_num, event_section_tokens = p.data()
 
     TRACE_LOG.info(
         project_id,
         user_id,
-        f"Retrieved {len(use_profiles)} profiles({profile_section_tokens} tokens), {len(user_event_gists.gists)} event gists({event_section_tokens} tokens)",
+        f"Retrieved {len(use_profiles)} profiles({profile_section_tokens} tokens), {event_num} event gists({event_section_tokens} tokens)",
     )
+    return Promise.resolve(context_prompt_func(profile_section, event_section))
 
-    return Promise.resolve(
-        ContextData(context=context_prompt_func(profile_section, event_section))
+
+@traced("context.batch")
+async def get_users_context(
+    user_ids: list[str],
+    project_id: str,
+    max_token_size: int,
+    prefer_topics: list[str],
+    only_topics: list[str],
+    max_subtopic_size: int,
+    topic_limits: dict[str, int],
+    profile_event_ratio: float,
+    require_event_summary: bool,
+    chats: list[OpenAICompatibleMessage],
+    event_similarity_threshold: float,
+    time_range_in_days: int,
+    customize_context_prompt: str = None,
+    full_profile_and_only_search_event: bool = False,
+    fill_window_with_events: bool = False,
+) -> Promise[UsersContextData]:
+    """Same as `get_user_context` for many users with the same parameters.
+
+    The project config is loaded once, the profiles of all users come from one
+    cache round trip (plus one query for the misses), the chats are embedded
+    once and the event gists of all users come from one statement.
+    """
+    assert 0 < profile_event_ratio <= 1, "profile_event_ratio must be between 0 and 1"
+    max_profile_token_size = int(max_token_size * profile_event_ratio)
+    user_ids = list(dict.fromkeys(str(u) for u in user_ids))
+
+    p = await get_context_prompt_func(project_id, customize_context_prompt)
+    if not p.ok():
+        return p
+    context_prompt_func = p.data()
+
+    filter_profiles = (
+        max_profile_token_size > 0
+        and bool(chats)
+        and not full_profile_and_only_search_event
+    )
+    # the same query texts as `get_user_context`, embedded once for all users
+    event_query = (
+        pack_latest_chat(chats) if chats and CONFIG.enable_event_embedding else None
+    )
+    profile_query = (
+        pack_profile_query(chats)
+        if filter_profiles and use_profile_embeddings()
+        else None
+    )
+    query_embeddings = {}
+    query_texts = list(dict.fromkeys(q for q in (event_query, profile_query) if q))
+    if query_texts:
+        p = await get_embedding(
+            project_id,
+            query_texts,
+            phase="query",
+            model=CONFIG.embedding_model,
+        )
+        if not p.ok():
+            return p
+        query_embeddings = dict(zip(query_texts, p.data()))
+    query_embedding = query_embeddings.get(event_query)
+
+    profiles_p, event_gists_p = await asyncio.gather(
+        get_users_profiles(user_ids, project_id),
+        get_users_event_gists(
+            user_ids,
+            project_id,
+            topk=60,
+            time_range_in_days=time_range_in_days,
+            query_embedding=query_embedding,
+            similarity_threshold=event_similarity_threshold,
+        ),
+    )
+    if not profiles_p.ok():
+        return profiles_p
+    if not event_gists_p.ok():
+        return event_gists_p
+    users_profiles = profiles_p.data()
+    users_event_gists = event_gists_p.data()
+
+    if filter_profiles:
+        stored_embeddings = None
+        if use_profile_embeddings():
+            p = await get_users_profile_embeddings(
+                user_ids,
+                project_id,
+                [str(up.id) for ups in users_profiles.values() for up in ups.profiles],
+            )
+            if not p.ok():
+                return p
+            stored_embeddings = p.data()
+        filter_results = await asyncio.gather(
+            *[
+                filter_profiles_with_chats(
+                    user_id,
+                    project_id,
+                    users_profiles[user_id],
+                    chats,
+                    only_topics=only_topics,
+                    query_embedding=query_embeddings.get(profile_query),
+                    stored_embeddings=stored_embeddings,
+                )
+                for user_id in user_ids
+            ]
+        )
+        for user_id, p in zip(user_ids, filter_results):
+            if p.ok():
+                users_profiles[user_id].profiles = p.data()["profiles"]
+
+    contexts = []
+    for user_id in user_ids:
+        p = await pack_profile_section(
+            users_profiles[user_id],
+            max_profile_token_size,
+            prefer_topics,
+            only_topics,
+            max_subtopic_size,
+            topic_limits,
+        )
+        if not p.ok():
+            return p
+        profile_section, use_profiles = p.data()
+        p = await pack_user_context(
+            user_id,
+            project_id,
+            context_prompt_func,
+            profile_section,
+            use_profiles,
+            users_event_gists[user_id],
+            max_token_size,
+            max_profile_token_size,
+            fill_window_with_events,
+        )
+        if not p.ok():
+            return p
+        contexts.append(UserContextData(user_id=user_id, context=p.data()))
+    return Promise.resolve(UsersContextData(contexts=contexts))
+
+
+async def _tagged(name: str, coro) -> tuple[str, Promise]:
+    try:
+        return name, await coro
+    except Exception as e:
+        return name, Promise.reject(
+            CODE.SERVER_PARSE_ERROR, f"{name.capitalize()} retrieval failed: {str(e)}"
+        )
+
+
+async def stream_user_context(
+    user_id: str,
+    project_id: str,
+    max_token_size: int,
+    prefer_topics: list[str],
+    only_topics: list[str],
+    max_subtopic_size: int,
+    topic_limits: dict[str, int],
+    profile_event_ratio: float,
+    require_event_summary: bool,
+    chats: list[OpenAICompatibleMessage],
+    event_similarity_threshold: float,
+    time_range_in_days: int,
+    customize_context_prompt: str = None,
+    full_profile_and_only_search_event: bool = False,
+    fill_window_with_events: bool = False,
+    deadline_ms: Optional[int] = None,
+) -> AsyncIterator[Promise[ContextStreamChunk]]:
+    """Same as `get_user_context`, but yields each section as soon as it's ready.
+
+    The event section only waits for the profiles if `fill_window_with_events`,
+    otherwise its budget is known upfront. The last chunk is the packed context,
+    or a rejected Promise if a step failed.
+    """
+    assert 0 < profile_event_ratio <= 1, "profile_event_ratio must be between 0 and 1"
+    max_profile_token_size = int(max_token_size * profile_event_ratio)
+    deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms else None
+    skipped_stages = []
+
+    p = await get_context_prompt_func(project_id, customize_context_prompt)
+    if not p.ok():
+        yield p
+        return
+    context_prompt_func = p.data()
+
+    tasks = [
+        asyncio.create_task(
+            _tagged(
+                "profile",
+                get_user_profiles_data(
+                    user_id,
+                    project_id,
+                    max_profile_token_size,
+                    prefer_topics,
+                    only_topics,
+                    max_subtopic_size,
+                    topic_limits,
+                    chats,
+                    full_profile_and_only_search_event,
+                    deadline=deadline,
+                    skipped_stages=skipped_stages,
+                ),
+            )
+        ),
+        asyncio.create_task(
+            _tagged(
+                "event",
+                get_user_event_gists_data(
+                    user_id,
+                    project_id,
+                    chats,
+                    require_event_summary,
+                    event_similarity_threshold,
+                    time_range_in_days,
+                    deadline=deadline,
+                    skipped_stages=skipped_stages,
+                ),
+            )
+        ),
+    ]
+    profile_chunk = None
+    event_chunk = None
+    user_event_gists = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            name, p = await next_done
+            if not p.ok():
+                yield p
+                return
+            if name == "profile":
+                profile_section, use_profiles = p.data()
+                profile_chunk = ContextStreamChunk(
+                    type="profile",
+                    content=profile_section,
+                    count=len(use_profiles),
+                    token_size=sum(profile_token_size(p) + 1 for p in use_profiles),
+                )
+                yield Promise.resolve(profile_chunk)
+            else:
+                user_event_gists = p.data()
+            if user_event_gists is None or event_chunk is not None:
+                continue
+            if profile_chunk is None and fill_window_with_events:
+                # the rest of the window is only known after the profiles
+                continue
+            max_event_token_size = get_max_event_token_size(
+                max_token_size,
+                max_profile_token_size,
+                profile_chunk.token_size if profile_chunk is not None else 0,
+                fill_window_with_events,
+            )
+            p = await pack_event_section(user_event_gists, max_event_token_size)
+            if not p.ok():
+                yield p
+                return
+            event_section, event_num, event_section_tokens = p.data()
+            event_chunk = ContextStreamChunk(
+                type="event",
+                content=event_section,
+                count=event_num,
+                token_size=event_section_tokens,
+            )
+            yield Promise.resolve(event_chunk)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Streamed {profile_chunk.count} profiles({profile_chunk.token_size} tokens), {event_chunk.count} event gists({event_chunk.token_size} tokens)",
+    )
+    yield Promise.resolve(
+        ContextStreamChunk(
+            type="context",
+            content=context_prompt_func(profile_chunk.content, event_chunk.content),
+            count=profile_chunk.count + event_chunk.count,
+            token_size=profile_chunk.token_size + event_chunk.token_size,
+            skipped_stages=skipped_stages,
+        )
     )
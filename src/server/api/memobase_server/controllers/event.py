@@ -1,13 +1,16 @@
+import asyncio
 from pydantic import ValidationError
 from ..models.database import UserEvent, UserEventGist
 from ..models.response import UserEventData, UserEventsData, EventData
 from ..models.utils import Promise, CODE
-from ..connectors import Session
-from ..utils import get_encoded_tokens, event_str_repr, event_embedding_str
+from ..connectors import AsyncSession, apply_embedding_search_settings
+from ..utils import count_tokens, event_str_repr, event_embedding_str
 
 from ..llms.embeddings import get_embedding
+from .user_counter import add_user_counts
+from .pagination import after_cursor, decode_cursor, encode_cursor, next_page_cursor
 from datetime import timedelta
-from sqlalchemy import desc, select
+from sqlalchemy import select, delete
 from sqlalchemy.sql import func
 from ..env import TRACE_LOG, CONFIG
 
@@ -18,12 +21,13 @@ async def get_user_events(
     topk: int = 10,
     need_summary: bool = False,
     time_range_in_days: int = 21,
+    cursor: str | None = None,
 ) -> Promise[UserEventsData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         query = (
-            session.query(UserEvent)
+            select(UserEvent)
             .filter_by(user_id=user_id, project_id=project_id)
-            .filter(
+            .where(
                 UserEvent.created_at > (func.now() - timedelta(days=time_range_in_days))
             )
         )
@@ -32,9 +36,28 @@ async def get_user_events(
         #     query = query.filter(
         #         UserEvent.event_data.contains({"event_tip": None}).is_(False)
         #     ).filter(UserEvent.event_data.has_key("event_tip"))
-        user_events = query.order_by(UserEvent.created_at.desc()).limit(topk).all()
-        if user_events is None:
-            return Promise.resolve(UserEventsData(events=[]))
+        if cursor is not None:
+            try:
+                value, row_id = decode_cursor(cursor, "created_at")
+            except ValueError as e:
+                return Promise.reject(CODE.BAD_REQUEST, f"Invalid cursor: {e}")
+            query = query.where(
+                after_cursor(
+                    (UserEvent.created_at, UserEvent.id), (value, row_id), desc=True
+                )
+            )
+        user_events = list(
+            (
+                await session.scalars(
+                    query.order_by(
+                        UserEvent.created_at.desc(), UserEvent.id.desc()
+                    ).limit(topk + 1)
+                )
+            ).all()
+        )
+        next_cursor = next_page_cursor(
+            user_events, topk, "created_at", lambda ue: ue.created_at
+        )
         results = [
             {
                 "id": ue.id,
@@ -44,7 +67,7 @@ async def get_user_events(
             }
             for ue in user_events
         ]
-    events = UserEventsData(events=results)
+    events = UserEventsData(events=results, next_cursor=next_cursor)
     return Promise.resolve(events)
 
 
@@ -57,10 +80,21 @@ async def truncate_events(
     c_tokens = 0
     truncated_results = []
     for r in events.events:
-        c_tokens += len(get_encoded_tokens(event_str_repr(r)))
+        c_tokens += count_tokens(event_str_repr(r))
         if c_tokens > max_token_size:
             break
         truncated_results.append(r)
+    if len(truncated_results) < len(events.events):
+        # the next page starts after the last event that is returned
+        events.next_cursor = (
+            encode_cursor(
+                "created_at",
+                truncated_results[-1].created_at,
+                truncated_results[-1].id,
+            )
+            if len(truncated_results)
+            else None
+        )
     events.events = truncated_results
     return Promise.resolve(events)
 
@@ -81,67 +115,76 @@ async def append_user_event(
             f"Invalid event data: {str(e)}",
         )
 
-    if CONFIG.enable_event_embedding:
-        event_data_str = event_embedding_str(validated_event)
-        embedding = await get_embedding(
-            project_id,
-            [event_data_str],
-            phase="document",
-            model=CONFIG.embedding_model,
+    event_gists = []
+    if validated_event.event_tip is not None:
+        event_gists = validated_event.event_tip.split("\n")
+        event_gists = [l.strip() for l in event_gists if l.strip().startswith("-")]
+        TRACE_LOG.info(
+            project_id, user_id, f"Processing {len(event_gists)} event gists"
         )
-        if not embedding.ok():
+
+    embedding = [None]
+    event_gists_embedding = [None] * len(event_gists)
+    if CONFIG.enable_event_embedding:
+        # Issued together, so the embedding batcher sends them in one request
+        embedding_tasks = [
+            get_embedding(
+                project_id,
+                [event_embedding_str(validated_event)],
+                phase="document",
+                model=CONFIG.embedding_model,
+            )
+        ]
+        if len(event_gists) > 0:
+            embedding_tasks.append(
+                get_embedding(
+                    project_id,
+                    event_gists,
+                    phase="document",
+                    model=CONFIG.embedding_model,
+                )
+            )
+        embedding_results = await asyncio.gather(*embedding_tasks)
+
+        event_embedding = embedding_results[0]
+        if not event_embedding.ok():
             TRACE_LOG.error(
                 project_id,
                 user_id,
-                f"Failed to get embeddings: {embedding.msg()}",
+                f"Failed to get embeddings: {event_embedding.msg()}",
             )
-            embedding = [None]
         else:
-            embedding = embedding.data()
-            embedding_dim_current = embedding.shape[-1]
+            event_embedding = event_embedding.data()
+            embedding_dim_current = event_embedding.shape[-1]
             if embedding_dim_current != CONFIG.embedding_dim:
                 TRACE_LOG.error(
                     project_id,
                     user_id,
                     f"Embedding dimension mismatch! Expected {CONFIG.embedding_dim}, got {embedding_dim_current}.",
                 )
-                embedding = [None]
-    else:
-        embedding = [None]
+            else:
+                embedding = event_embedding
 
-    event_gist_dbs = []
-    if validated_event.event_tip is not None:
-        event_gists = validated_event.event_tip.split("\n")
-        event_gists = [l.strip() for l in event_gists if l.strip().startswith("-")]
-        TRACE_LOG.info(
-            project_id, user_id, f"Processing {len(event_gists)} event gists"
-        )
-        if CONFIG.enable_event_embedding and len(event_gists) > 0:
-            event_gists_embedding = await get_embedding(
-                project_id,
-                event_gists,
-                phase="document",
-                model=CONFIG.embedding_model,
-            )
-            if not event_gists_embedding.ok():
+        if len(event_gists) > 0:
+            gists_embedding = embedding_results[1]
+            if not gists_embedding.ok():
                 TRACE_LOG.error(
                     project_id,
                     user_id,
-                    f"Failed to get embeddings: {event_gists_embedding.msg()}",
+                    f"Failed to get embeddings: {gists_embedding.msg()}",
                 )
-                event_gists_embedding = [None] * len(event_gists)
             else:
-                event_gists_embedding = event_gists_embedding.data()
-        else:
-            event_gists_embedding = [None] * len(event_gists)
-        for event_gist, event_gist_embedding in zip(event_gists, event_gists_embedding):
-            event_gist_dbs.append(
-                {
-                    "gist_data": {"content": event_gist},
-                    "embedding": event_gist_embedding,
-                }
-            )
-    with Session() as session:
+                event_gists_embedding = gists_embedding.data()
+
+    event_gist_dbs = []
+    for event_gist, event_gist_embedding in zip(event_gists, event_gists_embedding):
+        event_gist_dbs.append(
+            {
+                "gist_data": {"content": event_gist},
+                "embedding": event_gist_embedding,
+            }
+        )
+    async with AsyncSession() as session:
         user_event = UserEvent(
             user_id=user_id,
             project_id=project_id,
@@ -157,9 +200,11 @@ async def append_user_event(
                     event_id=user_event.id,
                     gist_data=event_gist_data["gist_data"],
                     embedding=event_gist_data["embedding"],
+                    token_size=count_tokens(event_gist_data["gist_data"]["content"]),
                 )
             )
-        session.commit()
+        await add_user_counts(session, user_id, project_id, events=1)
+        await session.commit()
         eid = user_event.id
     return Promise.resolve(eid)
 
@@ -167,19 +212,21 @@ async def append_user_event(
 async def delete_user_event(
     user_id: str, project_id: str, event_id: str
 ) -> Promise[None]:
-    with Session() as session:
-        user_event = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id, id=event_id)
-            .first()
+    async with AsyncSession() as session:
+        result = await session.execute(
+            delete(UserEvent).where(
+                UserEvent.user_id == user_id,
+                UserEvent.project_id == project_id,
+                UserEvent.id == event_id,
+            )
         )
-        if user_event is None:
+        if result.rowcount == 0:
             return Promise.reject(
                 CODE.NOT_FOUND,
                 f"User event {event_id} not found",
             )
-        session.delete(user_event)
-        session.commit()
+        await add_user_counts(session, user_id, project_id, events=-1)
+        await session.commit()
     return Promise.resolve(None)
 
 
@@ -194,11 +241,11 @@ async def update_user_event(
             f"Invalid event data: {str(e)}",
         )
     need_to_update = {k: v for k, v in event_data.items() if v is not None}
-    with Session() as session:
-        user_event = (
-            session.query(UserEvent)
-            .filter_by(user_id=user_id, project_id=project_id, id=event_id)
-            .first()
+    async with AsyncSession() as session:
+        user_event = await session.scalar(
+            select(UserEvent).filter_by(
+                user_id=user_id, project_id=project_id, id=event_id
+            )
         )
         if user_event is None:
             return Promise.reject(
@@ -209,7 +256,7 @@ async def update_user_event(
         new_events.update(need_to_update)
 
         user_event.event_data = new_events
-        session.commit()
+        await session.commit()
     return Promise.resolve(None)
 
 
@@ -244,30 +291,29 @@ async def search_user_events(
         return query_embeddings
     query_embedding = query_embeddings.data()[0]
 
+    # ORDER BY the raw distance so an ANN index can serve the query,
+    # the similarity threshold is applied on the top-k candidates afterwards
+    distance_expr = UserEvent.embedding.cosine_distance(query_embedding)
+
     stmt = (
-        select(
-            UserEvent,
-            (1 - UserEvent.embedding.cosine_distance(query_embedding)).label(
-                "similarity"
-            ),
-        )
+        select(UserEvent, distance_expr.label("distance"))
         .where(UserEvent.user_id == user_id, UserEvent.project_id == project_id)
         .where(UserEvent.created_at > func.now() - timedelta(days=time_range_in_days))
-        .where(
-            (1 - UserEvent.embedding.cosine_distance(query_embedding))
-            > similarity_threshold
-        )
-        .order_by(desc("similarity"))
+        .where(UserEvent.embedding.is_not(None))
+        .order_by(distance_expr)
         .limit(topk)
     )
 
-    with Session() as session:
+    async with AsyncSession() as session:
+        await apply_embedding_search_settings(session)
         # Use .all() instead of .scalars().all() to get both columns
-        result = session.execute(stmt).all()
+        result = (await session.execute(stmt)).all()
         user_events: list[UserEventData] = []
         for row in result:
             user_event: UserEvent = row[0]  # UserEvent object
-            similarity: float = row[1]  # similarity value
+            similarity: float = 1 - row[1]  # cosine distance to similarity
+            if similarity <= similarity_threshold:
+                continue
             user_events.append(
                 UserEventData(
                     id=user_event.id,
@@ -277,6 +323,8 @@ async def search_user_events(
                     similarity=similarity,
                 )
             )
+        # iterative index scans may return slightly out-of-order rows
+        user_events.sort(key=lambda e: e.similarity, reverse=True)
 
         # Create UserEventsData with the events
         user_events_data = UserEventsData(events=user_events)
@@ -309,24 +357,22 @@ async def filter_user_events(
     Returns:
         Promise containing filtered UserEventsData
     """
-    with Session() as session:
-        query = session.query(UserEvent).filter_by(
-            user_id=user_id, project_id=project_id
-        )
+    async with AsyncSession() as session:
+        query = select(UserEvent).filter_by(user_id=user_id, project_id=project_id)
 
         # Apply tag filters if provided
         if has_event_tag or event_tag_equal:
             # Build filter conditions for events that have event_tags
-            query = query.filter(UserEvent.event_data.has_key("event_tags"))
-            query = query.filter(UserEvent.event_data["event_tags"].isnot(None))
+            query = query.where(UserEvent.event_data.has_key("event_tags"))
+            query = query.where(UserEvent.event_data["event_tags"].isnot(None))
 
             # Filter by tag existence (has_event_tag)
             if has_event_tag:
                 for tag_name in has_event_tag:
                     # Check if any event_tag in the array has the specified tag name
-                    query = query.filter(
-                        UserEvent.event_data["event_tags"].op("@>")(
-                            f'[{{"tag": "{tag_name}"}}]'
+                    query = query.where(
+                        UserEvent.event_data["event_tags"].contains(
+                            [{"tag": tag_name}]
                         )
                     )
 
@@ -334,13 +380,17 @@ async def filter_user_events(
             if event_tag_equal:
                 for tag_name, tag_value in event_tag_equal.items():
                     # Check if any event_tag in the array has both the tag name and value
-                    query = query.filter(
-                        UserEvent.event_data["event_tags"].op("@>")(
-                            f'[{{"tag": "{tag_name}", "value": "{tag_value}"}}]'
+                    query = query.where(
+                        UserEvent.event_data["event_tags"].contains(
+                            [{"tag": tag_name, "value": tag_value}]
                         )
                     )
 
-        user_events = query.order_by(UserEvent.created_at.desc()).limit(topk).all()
+        user_events = (
+            await session.scalars(
+                query.order_by(UserEvent.created_at.desc()).limit(topk)
+            )
+        ).all()
 
         if user_events is None:
             return Promise.resolve(UserEventsData(events=[]))
@@ -1,14 +1,15 @@
+import numpy as np
 from pydantic import ValidationError
 from ..models.database import UserEventGist
 from ..models.response import UserEventGistsData, UserEventGistData
 from ..models.utils import Promise, CODE
-from ..connectors import Session
-from ..utils import get_encoded_tokens, event_str_repr, event_embedding_str
+from ..connectors import AsyncSession, apply_embedding_search_settings
+from ..utils import count_tokens, event_str_repr, event_embedding_str
 
 from ..llms.embeddings import get_embedding
 from datetime import timedelta
-from sqlalchemy import desc, select
-from sqlalchemy.sql import func
+from sqlalchemy import select
+from sqlalchemy.sql import func, null
 from ..env import TRACE_LOG, CONFIG
 
 
@@ -18,24 +19,27 @@ async def get_user_event_gists(
     topk: int = 10,
     time_range_in_days: int = 21,
 ) -> Promise[UserEventGistsData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         query = (
-            session.query(UserEventGist)
+            select(UserEventGist)
             .filter_by(user_id=user_id, project_id=project_id)
-            .filter(
+            .where(
                 UserEventGist.created_at
                 > (func.now() - timedelta(days=time_range_in_days))
             )
         )
         user_event_gists = (
-            query.order_by(UserEventGist.created_at.desc()).limit(topk).all()
-        )
+            await session.scalars(
+                query.order_by(UserEventGist.created_at.desc()).limit(topk)
+            )
+        ).all()
         if user_event_gists is None:
             return Promise.resolve(UserEventGistsData(gists=[]))
         results = [
             {
                 "id": ue.id,
                 "gist_data": ue.gist_data,
+                "token_size": ue.token_size,
                 "created_at": ue.created_at,
                 "updated_at": ue.updated_at,
             }
@@ -45,6 +49,13 @@ async def get_user_event_gists(
     return Promise.resolve(gists)
 
 
+def event_gist_token_size(gist: UserEventGistData) -> int:
+    if gist.token_size is not None:
+        return gist.token_size
+    # gists written before token sizes were stored
+    return count_tokens(gist.gist_data.content)
+
+
 async def truncate_event_gists(
     events: UserEventGistsData,
     max_token_size: int | None,
@@ -54,7 +65,7 @@ async def truncate_event_gists(
     c_tokens = 0
     truncated_results = []
     for r in events.gists:
-        c_tokens += len(get_encoded_tokens(r.gist_data.content))
+        c_tokens += event_gist_token_size(r)
         if c_tokens > max_token_size:
             break
         truncated_results.append(r)
@@ -95,32 +106,35 @@ async def search_user_event_gists(
     # Calculate the time cutoff once
     time_cutoff = func.now() - timedelta(days=time_range_in_days)
 
-    # Store the similarity expression to avoid recomputation
-    similarity_expr = 1 - UserEventGist.embedding.cosine_distance(query_embedding)
+    # ORDER BY the raw distance so an ANN index can serve the query,
+    # the similarity threshold is applied on the top-k candidates afterwards
+    distance_expr = UserEventGist.embedding.cosine_distance(query_embedding)
 
     stmt = (
         select(
             UserEventGist,
-            similarity_expr.label("similarity"),
+            distance_expr.label("distance"),
         )
         .where(
             UserEventGist.user_id == user_id,
             UserEventGist.project_id == project_id,
             UserEventGist.created_at > time_cutoff,
-            similarity_expr > similarity_threshold,
             UserEventGist.embedding.is_not(None),  # Skip null embeddings
         )
-        .order_by(desc("similarity"))
+        .order_by(distance_expr)
         .limit(topk)
     )
 
-    with Session() as session:
+    async with AsyncSession() as session:
+        await apply_embedding_search_settings(session)
         # Use .all() instead of .scalars().all() to get both columns
-        result = session.execute(stmt).all()
+        result = (await session.execute(stmt)).all()
         user_event_gists: list[UserEventGistData] = []
         for row in result:
             user_event: UserEventGist = row[0]  # UserEventGist object
-            similarity: float = row[1]  # similarity value
+            similarity: float = 1 - row[1]  # cosine distance to similarity
+            if similarity <= similarity_threshold:
+                continue
             user_event_gists.append(
                 UserEventGistData(
                     id=user_event.id,
@@ -128,8 +142,11 @@ async def search_user_event_gists(
                     created_at=user_event.created_at,
                     updated_at=user_event.updated_at,
                     similarity=similarity,
+                    token_size=user_event.token_size,
                 )
             )
+        # iterative index scans may return slightly out-of-order rows
+        user_event_gists.sort(key=lambda g: g.similarity, reverse=True)
 
         # Create UserEventsData with the events
         user_event_gists_data = UserEventGistsData(gists=user_event_gists)
@@ -140,3 +157,72 @@ async def search_user_event_gists(
         )
 
     return Promise.resolve(user_event_gists_data)
+
+
+async def get_users_event_gists(
+    user_ids: list[str],
+    project_id: str,
+    topk: int = 10,
+    time_range_in_days: int = 21,
+    query_embedding: np.ndarray | None = None,
+    similarity_threshold: float = 0.2,
+) -> Promise[dict[str, UserEventGistsData]]:
+    """Top event gists of many users in one statement, partitioned by user.
+
+    With a `query_embedding` the gists are ranked by similarity like
+    `search_user_event_gists`, otherwise the latest gists are returned.
+    """
+    conditions = [
+        UserEventGist.user_id.in_(user_ids),
+        UserEventGist.project_id == project_id,
+        UserEventGist.created_at > func.now() - timedelta(days=time_range_in_days),
+    ]
+    if query_embedding is not None:
+        distance_expr = UserEventGist.embedding.cosine_distance(query_embedding)
+        order_by = distance_expr
+        conditions.append(UserEventGist.embedding.is_not(None))
+    else:
+        distance_expr = null()
+        order_by = UserEventGist.created_at.desc()
+    ranked = (
+        select(
+            UserEventGist.id,
+            UserEventGist.user_id,
+            UserEventGist.gist_data,
+            UserEventGist.token_size,
+            UserEventGist.created_at,
+            UserEventGist.updated_at,
+            distance_expr.label("distance"),
+            func.row_number()
+            .over(partition_by=UserEventGist.user_id, order_by=order_by)
+            .label("rank"),
+        )
+        .where(*conditions)
+        .subquery()
+    )
+    stmt = (
+        select(ranked)
+        .where(ranked.c.rank <= topk)
+        .order_by(ranked.c.user_id, ranked.c.rank)
+    )
+    async with AsyncSession() as session:
+        rows = (await session.execute(stmt)).all()
+
+    results = {user_id: UserEventGistsData(gists=[]) for user_id in user_ids}
+    for row in rows:
+        similarity = None
+        if row.distance is not None:
+            similarity = 1 - row.distance
+            if similarity <= similarity_threshold:
+                continue
+        results[str(row.user_id)].gists.append(
+            UserEventGistData(
+                id=row.id,
+                gist_data=row.gist_data,
+                token_size=row.token_size,
+                created_at=row.created_at,
+                updated_at=row.updated_at,
+                similarity=similarity,
+            )
+        )
+    return Promise.resolve(results)
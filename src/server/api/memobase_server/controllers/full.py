@@ -8,3 +8,4 @@ from . import event
 from . import event_gist
 from . import context
 from . import billing
+from . import archive
@@ -1,11 +1,11 @@
 import asyncio
 from ...project import get_project_profile_config
-from ....connectors import Session
 from ....env import ProfileConfig, CONFIG, TRACE_LOG
-from ....utils import get_blob_str, get_encoded_tokens
+from ....utils import get_blob_str, count_tokens
 from ....models.blob import Blob
 from ....models.utils import Promise, CODE
 from ....models.response import IdsData, ChatModalResponse, UserProfilesData
+from ....llms import track_llm_stages
 from ...profile import add_update_delete_user_profiles
 from ...event import append_user_event
 from ...profile import get_user_profiles
@@ -18,6 +18,8 @@ from .organize import organize_profiles
 from .types import MergeAddResult
 from .event_summary import tag_event
 from .entry_summary import entry_chat_summary
+from .fused import fused_extract_merge_tag
+from ....telemetry import traced
 
 
 def truncate_chat_blobs(
@@ -26,7 +28,7 @@ def truncate_chat_blobs(
     results = []
     total_token_size = 0
     for b in blobs[::-1]:
-        ts = len(get_encoded_tokens(get_blob_str(b)))
+        ts = count_tokens(get_blob_str(b), cache=False)
         total_token_size += ts
         if total_token_size <= max_token_size:
             results.append(b)
@@ -35,8 +37,27 @@ def truncate_chat_blobs(
     return results[::-1]
 
 
+@traced("modal.chat")
 async def process_blobs(
     user_id: str, project_id: str, blobs: list[Blob]
+) -> Promise[ChatModalResponse]:
+    with track_llm_stages() as stages:
+        p = await process_blobs_stages(user_id, project_id, blobs)
+    if stages:
+        TRACE_LOG.info(
+            project_id,
+            user_id,
+            "LLM stages: "
+            + ", ".join(
+                f"{stage} {s['calls']} calls {s['latency_ms']:.0f}ms"
+                for stage, s in stages.items()
+            ),
+        )
+    return p
+
+
+async def process_blobs_stages(
+    user_id: str, project_id: str, blobs: list[Blob]
 ) -> Promise[ChatModalResponse]:
     # 1. Extract patch profiles
     blobs = truncate_chat_blobs(blobs, CONFIG.max_chat_blob_buffer_process_token_size)
@@ -72,26 +93,57 @@ async def process_blobs(
             )
         )
 
-    processing_results = await asyncio.gather(
-        process_profile_res(
-            user_id, project_id, user_memo_str, project_profiles, current_user_profiles
-        ),
-        process_event_res(
-            user_id, project_id, user_memo_str, project_profiles, current_user_profiles
-        ),
+    chat_process_mode = (
+        project_profiles.chat_process_mode
+        if project_profiles.chat_process_mode is not None
+        else CONFIG.chat_process_mode
     )
+    p = Promise.reject(CODE.SERVER_PARSE_ERROR, "Fused mode is not enabled")
+    if chat_process_mode == "fused":
+        p = await fused_extract_merge_tag(
+            user_id, project_id, user_memo_str, project_profiles, current_user_profiles
+        )
+        if not p.ok():
+            TRACE_LOG.warning(
+                project_id,
+                user_id,
+                f"Fused processing failed, fallback to staged: {p.msg()}",
+            )
 
-    profile_results: Promise = processing_results[0]
-    event_results: Promise = processing_results[1]
-
-    if not profile_results.ok() or not event_results.ok():
-        return Promise.reject(
-            CODE.SERVER_PARSE_ERROR,
-            f"Failed to process profile or event: {profile_results.msg()}, {event_results.msg()}",
+    if p.ok():
+        intermediate_profile, delta_profile_data, event_tags = p.data()
+        await organize_and_re_summary(
+            user_id, project_id, intermediate_profile, project_profiles
+        )
+    else:
+        processing_results = await asyncio.gather(
+            process_profile_res(
+                user_id,
+                project_id,
+                user_memo_str,
+                project_profiles,
+                current_user_profiles,
+            ),
+            process_event_res(
+                user_id,
+                project_id,
+                user_memo_str,
+                project_profiles,
+                current_user_profiles,
+            ),
         )
 
-    intermediate_profile, delta_profile_data = profile_results.data()
-    event_tags = event_results.data()
+        profile_results: Promise = processing_results[0]
+        event_results: Promise = processing_results[1]
+
+        if not profile_results.ok() or not event_results.ok():
+            return Promise.reject(
+                CODE.SERVER_PARSE_ERROR,
+                f"Failed to process profile or event: {profile_results.msg()}, {event_results.msg()}",
+            )
+
+        intermediate_profile, delta_profile_data = profile_results.data()
+        event_tags = event_results.data()
 
     p = await handle_session_event(
         user_id,
@@ -151,6 +203,18 @@ async def process_profile_res(
         p for p in (intermediate_profile["add"] + intermediate_profile["update_delta"])
     ]
 
+    await organize_and_re_summary(
+        user_id, project_id, intermediate_profile, project_profiles
+    )
+    return Promise.resolve((intermediate_profile, delta_profile_data))
+
+
+async def organize_and_re_summary(
+    user_id: str,
+    project_id: str,
+    intermediate_profile: MergeAddResult,
+    project_profiles: ProfileConfig,
+) -> None:
     # 3. Check if we need to organize profiles
     p = await organize_profiles(
         user_id,
@@ -179,8 +243,6 @@ async def process_profile_res(
             f"Failed to re-summary profiles: {p.msg()}",
         )
 
-    return Promise.resolve((intermediate_profile, delta_profile_data))
-
 
 async def process_event_res(
     user_id: str,
@@ -201,6 +263,7 @@ async def process_event_res(
     return Promise.resolve(event_tags)
 
 
+@traced("modal.chat.save_event")
 async def handle_session_event(
     user_id: str,
     project_id: str,
@@ -223,6 +286,7 @@ async def handle_session_event(
     return eid
 
 
+@traced("modal.chat.save_profiles")
 async def handle_user_profile_db(
     user_id: str, project_id: str, intermediate_profile: MergeAddResult
 ) -> Promise[IdsData]:
@@ -10,8 +10,10 @@ from ....prompts.utils import tag_chat_blobs_in_order_xml
 from .types import FactResponse, PROMPTS
 from ....models.response import UserProfilesData
 from .utils import pack_current_user_profiles
+from ....telemetry import traced
 
 
+@traced("modal.chat.entry_summary")
 async def entry_chat_summary(
     user_id: str,
     project_id: str,
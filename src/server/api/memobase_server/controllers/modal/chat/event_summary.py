@@ -9,8 +9,10 @@ from ....prompts.profile_init_utils import read_out_event_tags
 from ....llms import llm_complete
 
 from ....prompts import event_tagging as event_tagging_prompt
+from ....telemetry import traced
 
 
+@traced("modal.chat.tag_event")
 async def tag_event(
     project_id: str, config: ProfileConfig, event_summary: str
 ) -> Promise[Optional[list]]:
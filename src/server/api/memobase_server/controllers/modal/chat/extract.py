@@ -10,6 +10,7 @@ from ....prompts.profile_init_utils import read_out_profile_config, UserProfileT
 from ...project import ProfileConfig
 from .types import FactResponse, PROMPTS
 from .utils import pack_current_user_profiles
+from ....telemetry import traced
 
 
 def merge_by_topic_sub_topics(new_facts: list[FactResponse]):
@@ -23,6 +24,7 @@ def merge_by_topic_sub_topics(new_facts: list[FactResponse]):
     return list(topic_subtopic.values())
 
 
+@traced("modal.chat.extract")
 async def extract_topics(
     user_id: str,
     project_id: str,
@@ -0,0 +1,173 @@
+from typing import Optional
+from ....env import CONFIG, TRACE_LOG, ProfileConfig, ContanstTable
+from ....models.utils import Promise, CODE
+from ....models.response import UserProfilesData
+from ....llms import llm_complete
+from ....prompts import fused_extract_merge as fused_prompt
+from ....prompts.utils import attribute_unify
+from ....prompts.profile_init_utils import read_out_event_tags
+from ....types import SubTopic
+from .types import MergeAddResult, PROMPTS
+from .utils import pack_current_user_profiles
+from .merge_yolo import apply_merge_action
+from ....telemetry import traced
+
+FUSED_ACTIONS = {"APPEND", "UPDATE", "ABORT"}
+
+
+def parse_fused_response(data: dict) -> Optional[tuple[list[dict], list[dict]]]:
+    """Check the JSON of the fused completion, None if it's malformed"""
+    if not isinstance(data, dict):
+        return None
+    profiles = data.get("profiles") or []
+    event_tags = data.get("event_tags") or []
+    if not isinstance(profiles, list) or not isinstance(event_tags, list):
+        return None
+    for item in profiles:
+        if not isinstance(item, dict):
+            return None
+        if not all(
+            isinstance(item.get(k), str) for k in ("topic", "sub_topic", "new_info")
+        ):
+            return None
+        if item.get("action") not in FUSED_ACTIONS:
+            return None
+        if item["action"] == "UPDATE" and not isinstance(item.get("memo"), str):
+            return None
+    for et in event_tags:
+        if not isinstance(et, dict) or not all(
+            isinstance(et.get(k), str) for k in ("tag", "value")
+        ):
+            return None
+    return profiles, event_tags
+
+
+@traced("modal.chat.fused")
+async def fused_extract_merge_tag(
+    user_id: str,
+    project_id: str,
+    user_memo: str,
+    project_profiles: ProfileConfig,
+    current_user_profiles: UserProfilesData,
+) -> Promise[tuple[MergeAddResult, list[dict], Optional[list]]]:
+    """Extract, merge and tag the event in one JSON completion.
+
+    Returns the same results as `process_profile_res` (before organizing) and
+    `tag_event`. Rejects if the response is malformed, so the caller can fall
+    back to the staged pipeline.
+    """
+    profiles = current_user_profiles.profiles
+    CURRENT_PROFILE_INFO = pack_current_user_profiles(
+        current_user_profiles, project_profiles
+    )
+    USE_LANGUAGE = CURRENT_PROFILE_INFO["use_language"]
+    project_profiles_slots = CURRENT_PROFILE_INFO["project_profile_slots"]
+    PROFILE_VALIDATE_MODE = (
+        project_profiles.profile_validate_mode
+        if project_profiles.profile_validate_mode is not None
+        else CONFIG.profile_validate_mode
+    )
+    DEFINE_MAPS = {
+        (p.topic, sp.name): sp for p in project_profiles_slots for sp in p.sub_topics
+    }
+    RUNTIME_MAPS = {
+        (p.attributes[ContanstTable.topic], p.attributes[ContanstTable.sub_topic]): p
+        for p in profiles
+    }
+
+    tab = CONFIG.llm_tab_separator
+    # the merge decision needs the whole current memo, not the truncated one of extract
+    current_memos = "\n".join(
+        f"- {topic}{tab}{sub_topic}{tab}{content}"
+        for (topic, sub_topic), content in sorted(
+            CURRENT_PROFILE_INFO["already_topic_subtopics_values"].items()
+        )
+    )
+    update_instructions = "\n".join(
+        f"- {topic}{tab}{sub_topic}: {sp.update_description}"
+        for (topic, sub_topic), sp in DEFINE_MAPS.items()
+        if sp.update_description
+    )
+    event_tags = read_out_event_tags(project_profiles)
+    available_event_tags = set([et.name for et in event_tags])
+    event_tags_str = "\n".join([f"- {et.name}({et.description})" for et in event_tags])
+
+    p = await llm_complete(
+        project_id,
+        fused_prompt.pack_input(
+            current_memos, user_memo, strict_mode=CURRENT_PROFILE_INFO["strict_mode"]
+        ),
+        system_prompt=fused_prompt.get_prompt(
+            PROMPTS[USE_LANGUAGE]["profile"].get_prompt(project_profiles_slots),
+            update_instructions,
+            event_tags_str,
+        ),
+        json_mode=True,
+        temperature=0.2,  # precise
+        **fused_prompt.get_kwargs(),
+    )
+    if not p.ok():
+        return p
+    parsed = parse_fused_response(p.data())
+    if parsed is None:
+        return Promise.reject(
+            CODE.SERVER_PARSE_ERROR, f"Malformed fused response: {p.data()}"
+        )
+    fused_profiles, fused_event_tags = parsed
+
+    profile_session_results: MergeAddResult = {
+        "add": [],
+        "update": [],
+        "delete": [],
+        "update_delta": [],
+        "before_profiles": profiles,
+    }
+    seen_keys = set()
+    for item in fused_profiles:
+        KEY = (attribute_unify(item["topic"]), attribute_unify(item["sub_topic"]))
+        if KEY in seen_keys:
+            continue
+        seen_keys.add(KEY)
+        if (
+            CURRENT_PROFILE_INFO["allowed_topic_subtopics"] is not None
+            and KEY not in CURRENT_PROFILE_INFO["allowed_topic_subtopics"]
+        ):
+            continue
+        f_c = item["new_info"].strip()
+        f_a = {ContanstTable.topic: KEY[0], ContanstTable.sub_topic: KEY[1]}
+        runtime_profile = RUNTIME_MAPS.get(KEY, None)
+        action = {"action": item["action"], "memo": (item.get("memo") or "").strip()}
+        if action["action"] == "ABORT":
+            define_sub_topic = DEFINE_MAPS.get(KEY, SubTopic(name=""))
+            # same as the staged merge: unvalidated new slots are added as they are
+            if (
+                not PROFILE_VALIDATE_MODE
+                and not define_sub_topic.validate_value
+                and runtime_profile is None
+            ):
+                action["action"] = "APPEND"
+            else:
+                continue
+        apply_merge_action(profile_session_results, runtime_profile, action, f_c, f_a)
+
+    delta_profile_data = (
+        profile_session_results["add"] + profile_session_results["update_delta"]
+    )
+    if not available_event_tags:
+        strict_event_tags = None
+    else:
+        strict_event_tags = [
+            {"tag": attribute_unify(et["tag"]), "value": et["value"]}
+            for et in fused_event_tags
+        ]
+        strict_event_tags = [
+            et for et in strict_event_tags if et["tag"] in available_event_tags
+        ]
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Fused extract/merge: {len(profile_session_results['add'])} add, {len(profile_session_results['update'])} update",
+    )
+    return Promise.resolve(
+        (profile_session_results, delta_profile_data, strict_event_tags)
+    )
@@ -10,8 +10,10 @@ from ....prompts.utils import (
 from ....prompts.profile_init_utils import UserProfileTopic
 from ....types import SubTopic
 from .types import UpdateResponse, PROMPTS, AddProfile, UpdateProfile, MergeAddResult
+from ....telemetry import traced
 
 
+@traced("modal.chat.merge")
 async def merge_or_valid_new_memos(
     user_id: str,
     project_id: str,
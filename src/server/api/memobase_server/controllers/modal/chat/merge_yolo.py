@@ -9,8 +9,75 @@ from ....prompts.utils import (
 from ....prompts.profile_init_utils import UserProfileTopic
 from ....types import SubTopic
 from .types import UpdateResponse, PROMPTS, AddProfile, UpdateProfile, MergeAddResult
+from ....telemetry import traced
 
 
+def apply_merge_action(
+    profile_session_results: MergeAddResult,
+    runtime_profile: ProfileData | None,
+    update_response: UpdateResponse,
+    f_c: str,
+    f_a: dict,
+) -> bool:
+    """Apply an UPDATE/APPEND decision on one new fact, False for other actions"""
+    if update_response["action"] == "UPDATE":
+        if runtime_profile is None:
+            profile_session_results["add"].append(
+                {
+                    "content": update_response["memo"],
+                    "attributes": f_a,
+                }
+            )
+        else:
+            if ContanstTable.update_hits not in runtime_profile.attributes:
+                runtime_profile.attributes[ContanstTable.update_hits] = 1
+            else:
+                runtime_profile.attributes[ContanstTable.update_hits] += 1
+            profile_session_results["update"].append(
+                {
+                    "profile_id": runtime_profile.id,
+                    "content": update_response["memo"],
+                    "attributes": runtime_profile.attributes,
+                }
+            )
+            profile_session_results["update_delta"].append(
+                {
+                    "content": f_c,
+                    "attributes": f_a,
+                }
+            )
+    elif update_response["action"] == "APPEND":
+        if runtime_profile is None:
+            profile_session_results["add"].append(
+                {
+                    "content": f_c,
+                    "attributes": f_a,
+                }
+            )
+        else:
+            if ContanstTable.update_hits not in runtime_profile.attributes:
+                runtime_profile.attributes[ContanstTable.update_hits] = 1
+            else:
+                runtime_profile.attributes[ContanstTable.update_hits] += 1
+            profile_session_results["update"].append(
+                {
+                    "profile_id": runtime_profile.id,
+                    "content": f"{runtime_profile.content};{f_c}",
+                    "attributes": runtime_profile.attributes,
+                }
+            )
+            profile_session_results["update_delta"].append(
+                {
+                    "content": f_c,
+                    "attributes": f_a,
+                }
+            )
+    else:
+        return False
+    return True
+
+
+@traced("modal.chat.merge")
 async def merge_or_valid_new_memos(
     user_id: str,
     project_id: str,
@@ -115,61 +182,11 @@ async def merge_or_valid_new_memos(
         f_c, f_a = m[1], m[2]
         KEY = (f_a[ContanstTable.topic], f_a[ContanstTable.sub_topic])
         runtime_profile = RUNTIME_MAPS.get(KEY, None)
-        if update_response["action"] == "UPDATE":
-            if runtime_profile is None:
-                profile_session_results["add"].append(
-                    {
-                        "content": update_response["memo"],
-                        "attributes": f_a,
-                    }
-                )
-            else:
-                if ContanstTable.update_hits not in runtime_profile.attributes:
-                    runtime_profile.attributes[ContanstTable.update_hits] = 1
-                else:
-                    runtime_profile.attributes[ContanstTable.update_hits] += 1
-                profile_session_results["update"].append(
-                    {
-                        "profile_id": runtime_profile.id,
-                        "content": update_response["memo"],
-                        "attributes": runtime_profile.attributes,
-                    }
-                )
-                profile_session_results["update_delta"].append(
-                    {
-                        "content": f_c,
-                        "attributes": f_a,
-                    }
-                )
-        elif update_response["action"] == "APPEND":
-            if runtime_profile is None:
-                profile_session_results["add"].append(
-                    {
-                        "content": f_c,
-                        "attributes": f_a,
-                    }
-                )
-            else:
-                if ContanstTable.update_hits not in runtime_profile.attributes:
-                    runtime_profile.attributes[ContanstTable.update_hits] = 1
-                else:
-                    runtime_profile.attributes[ContanstTable.update_hits] += 1
-                profile_session_results["update"].append(
-                    {
-                        "profile_id": runtime_profile.id,
-                        "content": f"{runtime_profile.content};{f_c}",
-                        "attributes": runtime_profile.attributes,
-                    }
-                )
-                profile_session_results["update_delta"].append(
-                    {
-                        "content": f_c,
-                        "attributes": f_a,
-                    }
-                )
-        elif update_response["action"] == "ABORT":
+        if update_response["action"] == "ABORT":
             abort_infos.append(new_memos_input[i])
-        else:
+        elif not apply_merge_action(
+            profile_session_results, runtime_profile, update_response, f_c, f_a
+        ):
             TRACE_LOG.warning(
                 project_id,
                 user_id,
@@ -7,8 +7,10 @@ from ....models.utils import Promise
 from ....models.response import ProfileData
 from ....env import CONFIG, TRACE_LOG, ProfileConfig, ContanstTable
 from ....llms import llm_complete
+from ....telemetry import traced
 
 
+@traced("modal.chat.organize")
 async def organize_profiles(
     user_id: str,
     project_id: str,
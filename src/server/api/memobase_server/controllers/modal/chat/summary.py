@@ -1,14 +1,16 @@
 import asyncio
 from ....models.utils import Promise
 from ....env import CONFIG, TRACE_LOG
-from ....utils import get_blob_str, get_encoded_tokens, truncate_string
+from ....utils import get_blob_str, count_tokens, truncate_string
 from ....llms import llm_complete
 from ....prompts import (
     summary_profile,
 )
 from .types import UpdateProfile, AddProfile
+from ....telemetry import traced
 
 
+@traced("modal.chat.re_summary")
 async def re_summary(
     user_id: str,
     project_id: str,
@@ -28,7 +30,7 @@ async def summary_memo(
     user_id: str, project_id: str, content_pack: dict
 ) -> Promise[None]:
     content = content_pack["content"]
-    if len(get_encoded_tokens(content)) <= CONFIG.max_pre_profile_token_size:
+    if count_tokens(content) <= CONFIG.max_pre_profile_token_size:
         return Promise.resolve(None)
     r = await llm_complete(
         project_id,
@@ -0,0 +1,63 @@
+"""
+Keyset cursors for the listing APIs.
+
+A cursor is an opaque string holding the sort key and the (value, id) of the
+last row of a page. The next page starts right after that row through an index
+range scan, so later pages cost the same as the first one, unlike OFFSET, and
+rows written in between don't shift the pages.
+"""
+
+import json
+from uuid import UUID
+from datetime import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from sqlalchemy import tuple_
+
+
+def encode_cursor(key: str, value, row_id) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([key, value, str(row_id)], separators=(",", ":"))
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, key: str) -> tuple:
+    """The (value, id) of a cursor made for `key`, raises ValueError otherwise"""
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_key, value, row_id = json.loads(raw)
+        row_id = UUID(str(row_id))
+    except (ValueError, TypeError) as e:
+        raise ValueError("malformed cursor") from e
+    if cursor_key != key:
+        raise ValueError(f"cursor was made for ordering by {cursor_key}, not {key}")
+    if key.endswith("_at"):
+        if not isinstance(value, str):
+            raise ValueError("malformed cursor")
+        value = datetime.fromisoformat(value)
+    elif not isinstance(value, int):
+        raise ValueError("malformed cursor")
+    return value, row_id
+
+
+def after_cursor(columns: tuple, values: tuple, desc: bool):
+    """Rows after the cursor row in `ORDER BY columns` (all DESC if `desc`)"""
+    if desc:
+        return tuple_(*columns) < tuple_(*values)
+    return tuple_(*columns) > tuple_(*values)
+
+
+def next_page_cursor(rows: list, limit: int, key: str, value_of) -> str | None:
+    """Cursor after the last row, None on the last page.
+
+    Query `limit + 1` rows, the extra row only tells there is a next page and
+    is dropped from `rows` here.
+    """
+    if len(rows) <= limit:
+        return None
+    del rows[limit:]
+    return encode_cursor(key, value_of(rows[-1]), rows[-1].id)
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
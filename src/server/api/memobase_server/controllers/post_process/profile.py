@@ -1,15 +1,19 @@
 import json
 import re
+import asyncio
+import numpy as np
 from pydantic import ValidationError
 from typing import TypedDict
 from ...models.utils import Promise
 from ...models.database import GeneralBlob, UserProfile
 from ...models.blob import OpenAICompatibleMessage
-from ...models.response import CODE, IdData, IdsData, UserProfilesData
-from ...utils import truncate_string, find_list_int_or_none
+from ...models.response import CODE, IdData, IdsData, ProfileData, UserProfilesData
+from ...utils import truncate_string, find_list_int_or_none, profile_str_repr
 from ...env import TRACE_LOG, CONFIG
 from ...prompts import pick_related_profiles as pick_prompt
-from ...llms import llm_complete
+from ...llms import llm_complete, LLMPriority
+from ...llms.embeddings import get_embedding
+from ..profile import use_profile_embeddings, get_user_profile_embeddings
 
 
 class FilterProfilesResult(TypedDict):
@@ -35,16 +39,40 @@ async def filter_profiles_with_chats(
     only_topics: list[str] | None = None,
     max_value_token_size: int = 10,
     max_previous_chats: int = 4,
-    max_filter_num: int = 10,
+    max_filter_num: int = None,
+    query_embedding: np.ndarray | None = None,
+    stored_embeddings: dict[str, np.ndarray] | None = None,
 ) -> Promise[FilterProfilesResult]:
-    """Filter profiles with chats"""
+    """Filter profiles with chats, by embedding similarity or by asking the LLM
+    (`profile_filter_mode`).
+
+    Batch callers can pass the embedding of the chats and the stored profile
+    embeddings they already loaded, otherwise they are fetched here.
+    """
     if not len(chats) or not len(profiles.profiles):
         return Promise.reject(CODE.BAD_REQUEST, "No chats or profiles to filter")
+    max_filter_num = max_filter_num or CONFIG.profile_filter_topk
     chats = chats[-(max_previous_chats + 1) :]
     if only_topics:
         only_topics = [t.strip() for t in only_topics]
         only_topics = set(only_topics)
 
+    if use_profile_embeddings():
+        candidates = [
+            p
+            for p in profiles.profiles
+            if only_topics is None or p.attributes["topic"].strip() in only_topics
+        ]
+        return await rank_profiles_with_embeddings(
+            user_id,
+            project_id,
+            candidates,
+            chats,
+            max_filter_num,
+            query_embedding=query_embedding,
+            stored_embeddings=stored_embeddings,
+        )
+
     topics_index = [
         {
             "index": i,
@@ -65,6 +93,7 @@ async def filter_profiles_with_chats(
         system_prompt=system_prompt,
         temperature=0.2,  # precise
         model=CONFIG.summary_llm_model,
+        priority=LLMPriority.interactive,
         **pick_prompt.get_kwargs(),
     )
     if not r.ok():
@@ -93,3 +122,92 @@ async def filter_profiles_with_chats(
         f"Filter profiles with chats: {reason}, {found_ids}",
     )
     return Promise.resolve({"reason": reason, "profiles": profiles})
+
+
+async def _resolved(data) -> Promise:
+    return Promise.resolve(data)
+
+
+def top_k_cosine(query: np.ndarray, matrix: np.ndarray, k: int) -> np.ndarray:
+    """Row indices of the `k` rows of `matrix` most similar to `query`, best first"""
+    k = min(k, len(matrix))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    scores = (matrix @ query) / np.maximum(norms, 1e-12)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def pack_profile_query(
+    chats: list[OpenAICompatibleMessage], max_previous_chats: int = 4
+) -> str:
+    """The text embedded to rank the profiles against the chats"""
+    return "\n".join(m.content for m in chats[-(max_previous_chats + 1) :])
+
+
+async def rank_profiles_with_embeddings(
+    user_id: str,
+    project_id: str,
+    candidates: list[ProfileData],
+    chats: list[OpenAICompatibleMessage],
+    max_filter_num: int,
+    query_embedding: np.ndarray | None = None,
+    stored_embeddings: dict[str, np.ndarray] | None = None,
+) -> Promise[FilterProfilesResult]:
+    """Pick the profiles closest to the recent chats, without a LLM call.
+
+    Profiles are embedded when written, the ones without a stored embedding
+    (written before, or the embedding failed) are embedded here.
+    """
+    if not len(candidates):
+        return Promise.resolve({"reason": None, "profiles": []})
+    query_p, stored_p = await asyncio.gather(
+        (
+            get_embedding(
+                project_id,
+                [pack_profile_query(chats)],
+                phase="query",
+                model=CONFIG.embedding_model,
+            )
+            if query_embedding is None
+            else _resolved(query_embedding[None, :])
+        ),
+        (
+            get_user_profile_embeddings(
+                user_id, project_id, [str(p.id) for p in candidates]
+            )
+            if stored_embeddings is None
+            else _resolved(stored_embeddings)
+        ),
+    )
+    if not query_p.ok():
+        return query_p
+    if not stored_p.ok():
+        return stored_p
+    query_embedding = query_p.data()[0]
+    stored = dict(stored_p.data())
+    missing = [p for p in candidates if str(p.id) not in stored]
+    if len(missing):
+        p = await get_embedding(
+            project_id,
+            [profile_str_repr(p.content, p.attributes) for p in missing],
+            phase="document",
+            model=CONFIG.embedding_model,
+        )
+        if not p.ok():
+            return p
+        stored.update({str(mp.id): e for mp, e in zip(missing, p.data())})
+
+    matrix = np.stack([stored[str(p.id)] for p in candidates]).astype(
+        np.float32, copy=False
+    )
+    top = top_k_cosine(query_embedding, matrix, max_filter_num)
+    TRACE_LOG.info(
+        project_id,
+        user_id,
+        f"Rank profiles with chats: top {len(top)} of {len(candidates)}, {len(missing)} embedded on the fly",
+    )
+    return Promise.resolve(
+        {"reason": None, "profiles": [candidates[i] for i in top]}
+    )
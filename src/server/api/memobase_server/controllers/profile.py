@@ -1,10 +1,36 @@
+import asyncio
+import numpy as np
 from pydantic import ValidationError
+from sqlalchemy import select, delete, update, bindparam
+from sqlalchemy.exc import SQLAlchemyError
 from ..models.utils import Promise
 from ..models.database import GeneralBlob, UserProfile
-from ..models.response import CODE, IdData, IdsData, UserProfilesData, ProfileAttributes
-from ..connectors import Session, get_redis_client
-from ..utils import get_encoded_tokens
+from ..models.response import (
+    CODE,
+    IdData,
+    IdsData,
+    ProfileData,
+    UserProfilesData,
+    ProfileAttributes,
+)
+from ..connectors import AsyncSession
+from ..utils import get_profile_token_size, profile_str_repr
 from ..env import CONFIG, TRACE_LOG
+from ..llms.embeddings import get_embedding
+from .user_counter import add_user_counts
+from .profile_cache import (
+    pack_profile_from_db,
+    get_cached_user_profiles,
+    get_cached_users_profiles,
+    get_user_profile_cache_version,
+    get_users_profile_cache_versions,
+    fill_user_profile_cache,
+    write_through_user_profile_cache,
+    invalidate_user_profile_cache,
+    acquire_user_profile_load_lock,
+    release_user_profile_load_lock,
+    wait_for_cached_user_profiles,
+)
 
 
 async def truncate_profiles(
@@ -18,7 +44,7 @@ async def truncate_profiles(
 ) -> Promise[UserProfilesData]:
     if not len(profiles.profiles):
         return Promise.resolve(profiles)
-    profiles.profiles.sort(key=lambda p: p.updated_at, reverse=True)
+    profiles.profiles.sort(key=lambda p: (p.updated_at, str(p.id)), reverse=True)
     if prefer_topics:
         prefer_topics = [t.strip() for t in prefer_topics]
         priority_weights = {t: i for i, t in enumerate(prefer_topics)}
@@ -63,8 +89,7 @@ async def truncate_profiles(
         current_length = 0
         use_index = 0
         for max_i, p in enumerate(profiles.profiles):
-            single_p = f"{p.attributes.get('topic')}::{p.attributes.get('sub_topic')}: {p.content}"
-            current_length += len(get_encoded_tokens(single_p))
+            current_length += profile_token_size(p)
             if current_length > max_token_size:
                 break
             use_index = max_i
@@ -72,49 +97,96 @@ async def truncate_profiles(
     return Promise.resolve(profiles)
 
 
+def profile_token_size(profile: ProfileData) -> int:
+    if profile.token_size is not None:
+        return profile.token_size
+    # profiles written before token sizes were stored
+    return get_profile_token_size(profile.content, profile.attributes)
+
+
 async def get_user_profiles(user_id: str, project_id: str) -> Promise[UserProfilesData]:
-    async with get_redis_client() as redis_client:
-        user_profiles = await redis_client.get(
-            f"user_profiles::{project_id}::{user_id}"
-        )
-        if user_profiles:
-            try:
-                return Promise.resolve(
-                    UserProfilesData.model_validate_json(user_profiles)
+    cached = await get_cached_user_profiles(user_id, project_id)
+    if cached is not None:
+        return Promise.resolve(cached)
+    return Promise.resolve(await load_user_profiles_once(user_id, project_id))
+
+
+# in-flight cache fills of this worker, keyed by (event loop, project, user)
+_USER_PROFILE_LOADS: dict[tuple, asyncio.Task] = {}
+
+
+async def load_user_profiles_once(user_id: str, project_id: str) -> UserProfilesData:
+    """Single-flight cache fill, concurrent misses for one user share one DB load"""
+    key = (id(asyncio.get_running_loop()), project_id, user_id)
+    task = _USER_PROFILE_LOADS.get(key)
+    if task is None:
+        task = asyncio.create_task(load_and_cache_user_profiles(user_id, project_id))
+        _USER_PROFILE_LOADS[key] = task
+        task.add_done_callback(lambda _: _USER_PROFILE_LOADS.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def load_and_cache_user_profiles(
+    user_id: str, project_id: str
+) -> UserProfilesData:
+    locked = await acquire_user_profile_load_lock(user_id, project_id)
+    if not locked:
+        # another worker is loading this user
+        cached = await wait_for_cached_user_profiles(user_id, project_id)
+        if cached is not None:
+            return cached
+    try:
+        version = await get_user_profile_cache_version(user_id, project_id)
+        async with AsyncSession() as session:
+            user_profiles = (
+                await session.scalars(
+                    select(UserProfile)
+                    .filter_by(user_id=user_id, project_id=project_id)
+                    .order_by(UserProfile.updated_at.desc(), UserProfile.id.desc())
                 )
-            except ValidationError as e:
-                TRACE_LOG.error(
-                    project_id,
-                    user_id,
-                    f"Invalid user profiles: {e}",
+            ).all()
+            return_profiles = UserProfilesData(
+                profiles=[pack_profile_from_db(up) for up in user_profiles]
+            )
+        await fill_user_profile_cache(user_id, project_id, return_profiles, version)
+    finally:
+        if locked:
+            await release_user_profile_load_lock(user_id, project_id)
+    return return_profiles
+
+
+async def get_users_profiles(
+    user_ids: list[str], project_id: str
+) -> Promise[dict[str, UserProfilesData]]:
+    """Profiles of many users, read from the cache in one round trip and the
+    misses from the DB in one query"""
+    profiles = await get_cached_users_profiles(user_ids, project_id)
+    missing = [user_id for user_id, cached in profiles.items() if cached is None]
+    if not len(missing):
+        return Promise.resolve(profiles)
+    versions = await get_users_profile_cache_versions(missing, project_id)
+    async with AsyncSession() as session:
+        db_profiles = (
+            await session.scalars(
+                select(UserProfile)
+                .where(
+                    UserProfile.user_id.in_(missing),
+                    UserProfile.project_id == project_id,
                 )
-                await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
-    with Session() as session:
-        user_profiles = (
-            session.query(UserProfile)
-            .filter_by(user_id=user_id, project_id=project_id)
-            .order_by(UserProfile.updated_at.desc())
-            .all()
-        )
-        results = []
-        for up in user_profiles:
-            results.append(
-                {
-                    "id": up.id,
-                    "content": up.content,
-                    "attributes": up.attributes,
-                    "created_at": up.created_at,
-                    "updated_at": up.updated_at,
-                }
+                .order_by(UserProfile.updated_at.desc(), UserProfile.id.desc())
             )
-    return_profiles = UserProfilesData(profiles=results)
-    async with get_redis_client() as redis_client:
-        await redis_client.set(
-            f"user_profiles::{project_id}::{user_id}",
-            return_profiles.model_dump_json(),
-            ex=CONFIG.cache_user_profiles_ttl,
-        )
-    return Promise.resolve(return_profiles)
+        ).all()
+    for user_id in missing:
+        profiles[user_id] = UserProfilesData(profiles=[])
+    for up in db_profiles:
+        profiles[str(up.user_id)].profiles.append(pack_profile_from_db(up))
+    await asyncio.gather(
+        *[
+            fill_user_profile_cache(user_id, project_id, profiles[user_id], version)
+            for user_id, version in zip(missing, versions)
+        ]
+    )
+    return Promise.resolve(profiles)
 
 
 async def add_user_profiles(
@@ -133,17 +205,25 @@ async def add_user_profiles(
             return Promise.reject(
                 CODE.SERVER_PARSE_ERROR, f"Invalid profile attributes: {e}"
             )
-    with Session() as session:
+    async with AsyncSession() as session:
         db_profiles = [
             UserProfile(
-                user_id=user_id, project_id=project_id, content=content, attributes=attr
+                user_id=user_id,
+                project_id=project_id,
+                content=content,
+                attributes=attr,
+                token_size=get_profile_token_size(content, attr),
             )
             for content, attr in zip(profiles, attributes)
         ]
         session.add_all(db_profiles)
-        session.commit()
+        await add_user_counts(
+            session, user_id, project_id, profiles=len(db_profiles)
+        )
+        await session.commit()
         profile_ids = [profile.id for profile in db_profiles]
-    await refresh_user_profile_cache(user_id, project_id)
+    await write_through_user_profile_cache(user_id, project_id, db_profiles, [])
+    await embed_user_profiles(user_id, project_id, db_profiles)
     return Promise.resolve(IdsData(ids=profile_ids))
 
 
@@ -160,14 +240,14 @@ async def update_user_profiles(
     assert len(profile_ids) == len(
         attributes
     ), "Length of profile_ids, attributes must be equal"
-    with Session() as session:
+    async with AsyncSession() as session:
+        existing_profiles = await load_user_profiles_by_ids(
+            session, user_id, project_id, profile_ids
+        )
         db_profiles = []
+        updated_db_profiles = []
         for profile_id, content, attribute in zip(profile_ids, contents, attributes):
-            db_profile = (
-                session.query(UserProfile)
-                .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                .one_or_none()
-            )
+            db_profile = existing_profiles.get(str(profile_id))
             if db_profile is None:
                 TRACE_LOG.error(
                     project_id,
@@ -178,48 +258,75 @@ async def update_user_profiles(
             db_profile.content = content
             if attribute is not None:
                 db_profile.attributes = attribute
+            db_profile.token_size = get_profile_token_size(
+                content, db_profile.attributes
+            )
+            db_profile.embedding = None
             db_profiles.append(profile_id)
-        session.commit()
-    await refresh_user_profile_cache(user_id, project_id)
+            updated_db_profiles.append(db_profile)
+        await session.commit()
+    await write_through_user_profile_cache(
+        user_id, project_id, updated_db_profiles, []
+    )
+    await embed_user_profiles(user_id, project_id, updated_db_profiles)
     return Promise.resolve(IdsData(ids=db_profiles))
 
 
 async def delete_user_profile(
     user_id: str, project_id: str, profile_id: str
 ) -> Promise[None]:
-    with Session() as session:
-        db_profile = (
-            session.query(UserProfile)
-            .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        result = await session.execute(
+            delete(UserProfile).where(
+                UserProfile.id == profile_id,
+                UserProfile.user_id == user_id,
+                UserProfile.project_id == project_id,
+            )
         )
-        if db_profile is None:
+        if result.rowcount == 0:
             return Promise.reject(
                 CODE.NOT_FOUND, f"Profile {profile_id} not found for user {user_id}"
             )
-        session.delete(db_profile)
-        session.commit()
-    await refresh_user_profile_cache(user_id, project_id)
+        await add_user_counts(session, user_id, project_id, profiles=-1)
+        await session.commit()
+    await write_through_user_profile_cache(user_id, project_id, [], [profile_id])
     return Promise.resolve(None)
 
 
 async def delete_user_profiles(
     user_id: str, project_id: str, profile_ids: list[str]
 ) -> Promise[IdsData]:
-    with Session() as session:
-        session.query(UserProfile).filter(
+    async with AsyncSession() as session:
+        result = await session.execute(
+            delete(UserProfile).where(
+                UserProfile.id.in_(profile_ids),
+                UserProfile.user_id == user_id,
+                UserProfile.project_id == project_id,
+            )
+        )
+        await add_user_counts(session, user_id, project_id, profiles=-result.rowcount)
+        await session.commit()
+    await write_through_user_profile_cache(user_id, project_id, [], profile_ids)
+    return Promise.resolve(IdsData(ids=profile_ids))
+
+
+async def load_user_profiles_by_ids(
+    session, user_id: str, project_id: str, profile_ids: list[str]
+) -> dict[str, UserProfile]:
+    if not len(profile_ids):
+        return {}
+    db_profiles = await session.scalars(
+        select(UserProfile).where(
             UserProfile.id.in_(profile_ids),
             UserProfile.user_id == user_id,
             UserProfile.project_id == project_id,
-        ).delete(synchronize_session=False)
-        session.commit()
-    await refresh_user_profile_cache(user_id, project_id)
-    return Promise.resolve(IdsData(ids=profile_ids))
+        )
+    )
+    return {str(p.id): p for p in db_profiles}
 
 
 async def refresh_user_profile_cache(user_id: str, project_id: str) -> Promise[None]:
-    async with get_redis_client() as redis_client:
-        await redis_client.delete(f"user_profiles::{project_id}::{user_id}")
+    await invalidate_user_profile_cache(user_id, project_id)
     return Promise.resolve(None)
 
 
@@ -254,7 +361,7 @@ async def add_update_delete_user_profiles(
             )
     # Sanity Check done
 
-    with Session() as session:
+    async with AsyncSession() as session:
         try:
             # 1. add new profiles
             if len(add_profiles):
@@ -264,23 +371,24 @@ async def add_update_delete_user_profiles(
                         project_id=project_id,
                         content=content,
                         attributes=attr,
+                        token_size=get_profile_token_size(content, attr),
                     )
                     for content, attr in zip(add_profiles, add_attributes)
                 ]
                 session.add_all(add_db_profiles)
                 add_profile_ids = [p.id for p in add_db_profiles]
             else:
+                add_db_profiles = []
                 add_profile_ids = []
             # 2. update existing profiles
+            existing_profiles = await load_user_profiles_by_ids(
+                session, user_id, project_id, update_profile_ids
+            )
             update_db_profiles = []
             for profile_id, content, attribute in zip(
                 update_profile_ids, update_contents, update_attributes
             ):
-                db_profile = (
-                    session.query(UserProfile)
-                    .filter_by(id=profile_id, user_id=user_id, project_id=project_id)
-                    .one_or_none()
-                )
+                db_profile = existing_profiles.get(str(profile_id))
                 if db_profile is None:
                     TRACE_LOG.error(
                         project_id,
@@ -291,26 +399,132 @@ async def add_update_delete_user_profiles(
                 db_profile.content = content
                 if attribute is not None:
                     db_profile.attributes = attribute
-                update_db_profiles.append(profile_id)
+                db_profile.token_size = get_profile_token_size(
+                    content, db_profile.attributes
+                )
+                db_profile.embedding = None
+                update_db_profiles.append(db_profile)
 
             # 3. delete profiles
-            session.query(UserProfile).filter(
-                UserProfile.id.in_(delete_profile_ids),
-                UserProfile.user_id == user_id,
-                UserProfile.project_id == project_id,
-            ).delete(synchronize_session=False)
+            deleted_count = 0
+            if len(delete_profile_ids):
+                result = await session.execute(
+                    delete(UserProfile).where(
+                        UserProfile.id.in_(delete_profile_ids),
+                        UserProfile.user_id == user_id,
+                        UserProfile.project_id == project_id,
+                    )
+                )
+                deleted_count = result.rowcount
 
-            session.commit()
+            await add_user_counts(
+                session,
+                user_id,
+                project_id,
+                profiles=len(add_db_profiles) - deleted_count,
+            )
+            await session.commit()
         except Exception as e:
             TRACE_LOG.error(
                 project_id,
                 user_id,
                 f"Error merging user profiles: {e}",
             )
-            session.rollback()
+            await session.rollback()
             return Promise.reject(
                 CODE.SERVER_PARSE_ERROR, f"Error merging user profiles: {e}"
             )
 
-    await refresh_user_profile_cache(user_id, project_id)
+    await write_through_user_profile_cache(
+        user_id,
+        project_id,
+        add_db_profiles + update_db_profiles,
+        delete_profile_ids,
+    )
+    await embed_user_profiles(
+        user_id, project_id, add_db_profiles + update_db_profiles
+    )
     return Promise.resolve(IdsData(ids=add_profile_ids))
+
+
+def use_profile_embeddings() -> bool:
+    return CONFIG.enable_event_embedding and CONFIG.profile_filter_mode == "embedding"
+
+
+async def embed_user_profiles(
+    user_id: str, project_id: str, db_profiles: list[UserProfile]
+) -> None:
+    """Store the embeddings of written profiles, after the commit so the
+    embedding call never holds a DB connection. On failure the embedding stays
+    NULL and is computed again when the profiles are ranked."""
+    if not len(db_profiles) or not use_profile_embeddings():
+        return
+    embedded = [(up.id, up.content, up.attributes) for up in db_profiles]
+    p = await get_embedding(
+        project_id,
+        [profile_str_repr(content, attributes) for _, content, attributes in embedded],
+        phase="document",
+        model=CONFIG.embedding_model,
+    )
+    if not p.ok():
+        TRACE_LOG.error(
+            project_id, user_id, f"Failed to get profile embeddings: {p.msg()}"
+        )
+        return
+    table = UserProfile.__table__
+    try:
+        async with AsyncSession() as session:
+            await session.execute(
+                update(table)
+                .where(
+                    table.c.id == bindparam("profile_id"),
+                    table.c.project_id == bindparam("profile_project_id"),
+                    # a later update may have committed while this one embedded
+                    table.c.content == bindparam("profile_content"),
+                    table.c.attributes.is_not_distinct_from(
+                        bindparam("profile_attributes")
+                    ),
+                )
+                .values(embedding=bindparam("profile_embedding")),
+                [
+                    {
+                        "profile_id": profile_id,
+                        "profile_project_id": project_id,
+                        "profile_content": content,
+                        "profile_attributes": attributes,
+                        "profile_embedding": embedding,
+                    }
+                    for (profile_id, content, attributes), embedding in zip(
+                        embedded, p.data()
+                    )
+                ],
+            )
+            await session.commit()
+    except SQLAlchemyError as e:
+        TRACE_LOG.error(project_id, user_id, f"Failed to store profile embeddings: {e}")
+
+
+async def get_user_profile_embeddings(
+    user_id: str, project_id: str, profile_ids: list[str]
+) -> Promise[dict[str, np.ndarray]]:
+    """Stored embeddings of the profiles, profiles without one are left out"""
+    return await get_users_profile_embeddings([user_id], project_id, profile_ids)
+
+
+async def get_users_profile_embeddings(
+    user_ids: list[str], project_id: str, profile_ids: list[str]
+) -> Promise[dict[str, np.ndarray]]:
+    if not len(profile_ids):
+        return Promise.resolve({})
+    async with AsyncSession() as session:
+        rows = await session.execute(
+            select(UserProfile.id, UserProfile.embedding).where(
+                UserProfile.id.in_(profile_ids),
+                UserProfile.user_id.in_(user_ids),
+                UserProfile.project_id == project_id,
+                UserProfile.embedding.is_not(None),
+            )
+        )
+        return Promise.resolve(
+            {str(profile_id): embedding for profile_id, embedding in rows}
+        )
@@ -0,0 +1,230 @@
+"""
+Redis cache of user profiles, one hash per user keyed by profile id.
+
+Writes update the hash in place after the DB commit instead of dropping it.
+A per-user version counter is bumped on every write, so a cache fill that
+read the DB before a concurrent write never overwrites the newer state.
+"""
+
+import asyncio
+from pydantic import ValidationError
+from ..models.database import UserProfile
+from ..models.response import ProfileData, UserProfilesData
+from ..connectors import get_redis_client
+from ..env import CONFIG, TRACE_LOG
+from ..telemetry import traced
+
+LOADED_FIELD = "__loaded__"
+# how long other workers wait for the worker that is loading a user
+LOAD_LOCK_MS = 5000
+LOAD_WAIT_INTERVAL = 0.02
+LOAD_WAIT_ROUNDS = 50
+
+# KEYS: hash, version. ARGV: ttl, number of upserts, upsert id/json pairs..., deleted ids...
+WRITE_THROUGH_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+if redis.call('HEXISTS', KEYS[1], ARGV[3]) == 0 then
+    return 0
+end
+local n_upserts = tonumber(ARGV[2])
+for i = 0, n_upserts - 1 do
+    redis.call('HSET', KEYS[1], ARGV[4 + i * 2], ARGV[5 + i * 2])
+end
+for i = 4 + n_upserts * 2, #ARGV do
+    redis.call('HDEL', KEYS[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# KEYS: hash, version. ARGV: ttl, version read before the DB load, loaded field, id/json pairs...
+FILL_SCRIPT = """
+local current = redis.call('GET', KEYS[2]) or '0'
+if current ~= ARGV[2] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], ARGV[3], '1')
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def user_profiles_cache_key(user_id: str, project_id: str) -> str:
+    return f"user_profiles_hash::{project_id}::{user_id}"
+
+
+def user_profiles_version_key(user_id: str, project_id: str) -> str:
+    return f"user_profiles_version::{project_id}::{user_id}"
+
+
+def user_profiles_lock_key(user_id: str, project_id: str) -> str:
+    return f"user_profiles_loading::{project_id}::{user_id}"
+
+
+def pack_profile_from_db(profile: UserProfile) -> ProfileData:
+    return ProfileData(
+        id=profile.id,
+        content=profile.content,
+        attributes=profile.attributes,
+        token_size=profile.token_size,
+        created_at=profile.created_at,
+        updated_at=profile.updated_at,
+    )
+
+
+@traced("redis.profile_cache")
+async def get_cached_user_profiles(
+    user_id: str, project_id: str
+) -> UserProfilesData | None:
+    cache_key = user_profiles_cache_key(user_id, project_id)
+    async with get_redis_client() as redis_client:
+        cached = await redis_client.hgetall(cache_key)
+    return await parse_cached_user_profiles(user_id, project_id, cached)
+
+
+@traced("redis.profile_cache.batch")
+async def get_cached_users_profiles(
+    user_ids: list[str], project_id: str
+) -> dict[str, UserProfilesData | None]:
+    """Cached profiles of many users in one round trip, None for the misses"""
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(user_profiles_cache_key(user_id, project_id))
+            results = await pipe.execute()
+    return {
+        user_id: await parse_cached_user_profiles(user_id, project_id, cached)
+        for user_id, cached in zip(user_ids, results)
+    }
+
+
+async def parse_cached_user_profiles(
+    user_id: str, project_id: str, cached: dict[str, str]
+) -> UserProfilesData | None:
+    if LOADED_FIELD not in cached:
+        return None
+    cached.pop(LOADED_FIELD)
+    try:
+        profiles = [ProfileData.model_validate_json(v) for v in cached.values()]
+    except ValidationError as e:
+        TRACE_LOG.error(project_id, user_id, f"Invalid user profiles: {e}")
+        await invalidate_user_profile_cache(user_id, project_id)
+        return None
+    profiles.sort(key=lambda p: (p.updated_at, str(p.id)), reverse=True)
+    return UserProfilesData(profiles=profiles)
+
+
+async def get_user_profile_cache_version(user_id: str, project_id: str) -> str:
+    async with get_redis_client() as redis_client:
+        version = await redis_client.get(user_profiles_version_key(user_id, project_id))
+    return version or "0"
+
+
+async def get_users_profile_cache_versions(
+    user_ids: list[str], project_id: str
+) -> list[str]:
+    async with get_redis_client() as redis_client:
+        versions = await redis_client.mget(
+            [user_profiles_version_key(user_id, project_id) for user_id in user_ids]
+        )
+    return [v or "0" for v in versions]
+
+
+async def fill_user_profile_cache(
+    user_id: str, project_id: str, profiles: UserProfilesData, version: str
+) -> bool:
+    args = [CONFIG.cache_user_profiles_ttl, version, LOADED_FIELD]
+    for p in profiles.profiles:
+        args.extend([str(p.id), p.model_dump_json()])
+    async with get_redis_client() as redis_client:
+        filled = await redis_client.eval(
+            FILL_SCRIPT,
+            2,
+            user_profiles_cache_key(user_id, project_id),
+            user_profiles_version_key(user_id, project_id),
+            *args,
+        )
+    return bool(filled)
+
+
+async def write_through_user_profile_cache(
+    user_id: str,
+    project_id: str,
+    upsert_profiles: list[UserProfile],
+    delete_profile_ids: list[str],
+) -> None:
+    """Apply committed changes to the cached hash, if this user is cached"""
+    args = [CONFIG.cache_user_profiles_ttl, len(upsert_profiles), LOADED_FIELD]
+    for p in upsert_profiles:
+        args.extend([str(p.id), pack_profile_from_db(p).model_dump_json()])
+    args.extend([str(pid) for pid in delete_profile_ids])
+    async with get_redis_client() as redis_client:
+        await redis_client.eval(
+            WRITE_THROUGH_SCRIPT,
+            2,
+            user_profiles_cache_key(user_id, project_id),
+            user_profiles_version_key(user_id, project_id),
+            *args,
+        )
+
+
+async def invalidate_user_profile_cache(user_id: str, project_id: str) -> None:
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(user_profiles_cache_key(user_id, project_id))
+            pipe.incr(user_profiles_version_key(user_id, project_id))
+            pipe.expire(
+                user_profiles_version_key(user_id, project_id),
+                CONFIG.cache_user_profiles_ttl,
+            )
+            await pipe.execute()
+
+
+async def invalidate_users_profile_cache(user_ids: list[str], project_id: str) -> None:
+    """`invalidate_user_profile_cache` for many users in one round trip"""
+    if not len(user_ids):
+        return
+    async with get_redis_client() as redis_client:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.delete(user_profiles_cache_key(user_id, project_id))
+                pipe.incr(user_profiles_version_key(user_id, project_id))
+                pipe.expire(
+                    user_profiles_version_key(user_id, project_id),
+                    CONFIG.cache_user_profiles_ttl,
+                )
+            await pipe.execute()
+
+
+async def acquire_user_profile_load_lock(user_id: str, project_id: str) -> bool:
+    async with get_redis_client() as redis_client:
+        return bool(
+            await redis_client.set(
+                user_profiles_lock_key(user_id, project_id),
+                "1",
+                nx=True,
+                px=LOAD_LOCK_MS,
+            )
+        )
+
+
+async def release_user_profile_load_lock(user_id: str, project_id: str) -> None:
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(user_profiles_lock_key(user_id, project_id))
+
+
+async def wait_for_cached_user_profiles(
+    user_id: str, project_id: str
+) -> UserProfilesData | None:
+    """Wait for another worker to fill the cache, None if it didn't in time"""
+    for _ in range(LOAD_WAIT_ROUNDS):
+        await asyncio.sleep(LOAD_WAIT_INTERVAL)
+        cached = await get_cached_user_profiles(user_id, project_id)
+        if cached is not None:
+            return cached
+    return None
@@ -1,43 +1,52 @@
-from sqlalchemy import cast, String, func, desc
-from ..models.database import Project, User, UserProfile, UserEvent
+from sqlalchemy import cast, TEXT, func, select
+from ..models.database import Project, User
 from ..models.utils import Promise, CODE
 from ..models.response import IdData, ProfileConfigData, ProjectUsersData, DailyUsage
-from ..connectors import Session
+from ..connectors import AsyncSession
 from ..env import ProfileConfig, TelemetryKeyName
-from ..telemetry.capture_key import get_int_key, date_past_key
+from ..telemetry.capture_key import get_int_keys, date_past_key
+from .project_cache import get_or_load_project_value, invalidate_project_cache
+from .pagination import after_cursor, decode_cursor, escape_like, next_page_cursor
 
 
 async def get_project_secret(project_id: str) -> Promise[str]:
-    with Session() as session:
-        p = (
-            session.query(Project)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        project_secret = await session.scalar(
+            select(Project.project_secret).where(Project.project_id == project_id)
         )
-        if not p:
+        if project_secret is None:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
-        return Promise.resolve(p.project_secret)
+        return Promise.resolve(project_secret)
 
 
 async def get_project_status(project_id: str) -> Promise[str]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.status)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.status).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(p.status)
 
 
 async def get_project_profile_config(project_id: str) -> Promise[ProfileConfig]:
-    with Session() as session:
+    """Parsed project profile config, shared between requests, never mutate it"""
+    return await get_or_load_project_value(
+        project_id,
+        "profile_config",
+        lambda: load_project_profile_config(project_id),
+    )
+
+
+async def load_project_profile_config(project_id: str) -> Promise[ProfileConfig]:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.profile_config)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.profile_config).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         if not p.profile_config:
@@ -49,33 +58,37 @@ async def get_project_profile_config(project_id: str) -> Promise[ProfileConfig]:
 async def update_project_profile_config(
     project_id: str, profile_config: str | None
 ) -> Promise[None]:
-    with Session() as session:
-        p = (
-            session.query(Project)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+    async with AsyncSession() as session:
+        p = await session.scalar(select(Project).where(Project.project_id == project_id))
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         p.profile_config = profile_config
-        session.commit()
+        await session.commit()
+    await invalidate_project_cache(project_id)
     return Promise.resolve(None)
 
 
 async def get_project_profile_config_string(
     project_id: str,
 ) -> Promise[ProfileConfigData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         p = (
-            session.query(Project.profile_config)
-            .filter(Project.project_id == project_id)
-            .one_or_none()
-        )
+            await session.execute(
+                select(Project.profile_config).where(Project.project_id == project_id)
+            )
+        ).one_or_none()
         if not p:
             return Promise.reject(CODE.NOT_FOUND, "Project not found")
         return Promise.resolve(ProfileConfigData(profile_config=p.profile_config or ""))
 
 
+USER_ORDER_COLUMNS = {
+    "updated_at": User.updated_at,
+    "profile_count": User.profile_count,
+    "event_count": User.event_count,
+}
+
+
 async def get_project_users(
     project_id: str,
     search: str = "",
@@ -83,96 +96,81 @@ async def get_project_users(
     offset: int = 0,
     order_by: str = "updated_at",
     order_desc: bool = True,
+    cursor: str | None = None,
 ) -> Promise[ProjectUsersData]:
-    with Session() as session:
-        profile_subq = (
-            session.query(
-                UserProfile.user_id.label("user_id"),
-                func.count(UserProfile.id).label("profile_count"),
-            )
-            .filter(UserProfile.project_id == project_id)
-            .group_by(UserProfile.user_id)
-            .subquery()
+    if order_by not in USER_ORDER_COLUMNS:
+        order_by = "updated_at"
+    order_column = USER_ORDER_COLUMNS[order_by]
+    filters = [User.project_id == project_id]
+    if search:
+        # prefix match, served by idx_users_project_id_id_text
+        filters.append(
+            cast(User.id, TEXT).like(f"{escape_like(search)}%", escape="\\")
         )
-
-        event_subq = (
-            session.query(
-                UserEvent.user_id.label("user_id"),
-                func.count(UserEvent.id).label("event_count"),
-            )
-            .filter(UserEvent.project_id == project_id)
-            .group_by(UserEvent.user_id)
-            .subquery()
+    query = select(User).where(*filters)
+    if cursor is not None:
+        try:
+            value, row_id = decode_cursor(cursor, order_by)
+        except ValueError as e:
+            return Promise.reject(CODE.BAD_REQUEST, f"Invalid cursor: {e}")
+        query = query.where(
+            after_cursor((order_column, User.id), (value, row_id), order_desc)
         )
-
-        query = (
-            session.query(
-                User,
-                func.coalesce(profile_subq.c.profile_count, 0).label("profile_count"),
-                func.coalesce(event_subq.c.event_count, 0).label("event_count"),
-            )
-            .filter(User.project_id == project_id)
-            .filter(cast(User.id, String).like(f"%{search}%"))
-            .outerjoin(profile_subq, profile_subq.c.user_id == User.id)
-            .outerjoin(event_subq, event_subq.c.user_id == User.id)
+    else:
+        query = query.offset(offset)
+    if order_desc:
+        query = query.order_by(order_column.desc(), User.id.desc())
+    else:
+        query = query.order_by(order_column, User.id)
+
+    async with AsyncSession() as session:
+        users = list((await session.scalars(query.limit(limit + 1))).all())
+        next_cursor = next_page_cursor(
+            users, limit, order_by, lambda u: getattr(u, order_by)
         )
-
-        if order_by == "profile_count":
-            query = query.order_by(
-                desc("profile_count") if order_desc else "profile_count"
-            )
-        elif order_by == "event_count":
-            query = query.order_by(desc("event_count") if order_desc else "event_count")
-        else:
-            query = query.order_by(
-                desc(User.updated_at) if order_desc else User.updated_at
+        # only the first page counts, the next pages follow the cursor
+        count = None
+        if cursor is None:
+            count = await session.scalar(
+                select(func.count()).select_from(User).where(*filters)
             )
 
-        count = (
-            session.query(func.count())
-            .filter(User.project_id == project_id)
-            .filter(cast(User.id, String).like(f"%{search}%"))
-            .scalar()
-        )
-
-        users_with_counts = query.limit(limit).offset(offset).all()
-
-        user_dicts = []
-        for user, profile_count, event_count in users_with_counts:
-            user_data = user.__dict__.copy()
-            user_data.pop("_sa_instance_state", None)
-            user_data["profile_count"] = profile_count
-            user_data["event_count"] = event_count
-            user_dicts.append(user_data)
-
-        return Promise.resolve(ProjectUsersData(users=user_dicts, count=count))
+    user_dicts = []
+    for user in users:
+        user_data = user.__dict__.copy()
+        user_data.pop("_sa_instance_state", None)
+        user_data["profile_count"] = user.profile_count or 0
+        user_data["event_count"] = user.event_count or 0
+        user_dicts.append(user_data)
+    return Promise.resolve(
+        ProjectUsersData(users=user_dicts, count=count, next_cursor=next_cursor)
+    )
 
 
 async def get_project_usage(
     project_id: str, last_days: int = 7
 ) -> Promise[list[DailyUsage]]:
     query_dates = [date_past_key(i) for i in range(last_days)]
-    results = []
-    for qd in query_dates:
-        total_insert = await get_int_key(
-            TelemetryKeyName.insert_blob_request, project_id, use_date=qd
-        )
-        total_success_insert = await get_int_key(
-            TelemetryKeyName.insert_blob_success_request, project_id, use_date=qd
-        )
-        total_input_token = await get_int_key(
-            TelemetryKeyName.llm_input_tokens, project_id, use_date=qd
-        )
-        total_output_token = await get_int_key(
-            TelemetryKeyName.llm_output_tokens, project_id, use_date=qd
-        )
-        results.append(
-            DailyUsage(
-                date=qd,
-                total_insert=total_insert,
-                total_success_insert=total_success_insert,
-                total_input_token=total_input_token,
-                total_output_token=total_output_token,
-            )
+    counts = await get_int_keys(
+        [
+            TelemetryKeyName.insert_blob_request,
+            TelemetryKeyName.insert_blob_success_request,
+            TelemetryKeyName.llm_input_tokens,
+            TelemetryKeyName.llm_output_tokens,
+        ],
+        project_id,
+        query_dates,
+    )
+    results = [
+        DailyUsage(
+            date=qd,
+            total_insert=counts[(TelemetryKeyName.insert_blob_request, qd)],
+            total_success_insert=counts[
+                (TelemetryKeyName.insert_blob_success_request, qd)
+            ],
+            total_input_token=counts[(TelemetryKeyName.llm_input_tokens, qd)],
+            total_output_token=counts[(TelemetryKeyName.llm_output_tokens, qd)],
         )
+        for qd in query_dates
+    ]
     return Promise.resolve(results)
@@ -0,0 +1,114 @@
+"""
+Per-worker L1 cache for project secret, status and parsed ProfileConfig.
+
+Entries live for `project_cache_ttl` seconds. Every project change bumps a
+version counter in Redis and publishes it, so all workers drop their stale
+entries right away. If a message is lost, the TTL still bounds staleness.
+A fill that read an older version than the latest one seen is not cached.
+"""
+
+import time
+import asyncio
+from typing import Any, Awaitable, Callable
+import redis.exceptions as redis_exceptions
+from ..env import CONFIG, LOG
+from ..models.utils import Promise
+from ..connectors import get_redis_client, PROJECT_ID
+
+PROJECT_CACHE_CHANNEL = f"memobase::project_cache_invalidation::{PROJECT_ID}"
+LISTENER_RETRY_SECONDS = 1
+
+
+def project_cache_version_key(project_id: str) -> str:
+    return f"memobase::project_cache_version::{PROJECT_ID}::{project_id}"
+
+
+class ProjectLocalCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # (project_id, kind) -> (value, version, expire_at)
+        self._entries: dict[tuple[str, str], tuple[Any, int, float]] = {}
+        self._versions: dict[str, int] = {}
+
+    def get(self, project_id: str, kind: str) -> Any | None:
+        entry = self._entries.get((project_id, kind))
+        if entry is None:
+            return None
+        value, _, expire_at = entry
+        if expire_at < time.monotonic():
+            self._entries.pop((project_id, kind), None)
+            return None
+        return value
+
+    def set(self, project_id: str, kind: str, value: Any, version: int):
+        if self.ttl <= 0 or version < self._versions.get(project_id, 0):
+            return
+        self._entries[(project_id, kind)] = (
+            value,
+            version,
+            time.monotonic() + self.ttl,
+        )
+
+    def discard(self, project_id: str, kind: str):
+        self._entries.pop((project_id, kind), None)
+
+    def invalidate(self, project_id: str, version: int):
+        self._versions[project_id] = max(self._versions.get(project_id, 0), version)
+        for key in [k for k in self._entries if k[0] == project_id]:
+            if self._entries[key][1] < version:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+PROJECT_LOCAL_CACHE = ProjectLocalCache(CONFIG.project_cache_ttl)
+
+
+async def get_project_cache_version(project_id: str) -> int:
+    async with get_redis_client() as client:
+        version = await client.get(project_cache_version_key(project_id))
+    return int(version or 0)
+
+
+async def get_or_load_project_value(
+    project_id: str, kind: str, loader: Callable[[], Awaitable[Promise]]
+) -> Promise:
+    value = PROJECT_LOCAL_CACHE.get(project_id, kind)
+    if value is not None:
+        return Promise.resolve(value)
+    # read the version before loading, so a concurrent change is never cached over
+    version = await get_project_cache_version(project_id)
+    p = await loader()
+    if p.ok():
+        PROJECT_LOCAL_CACHE.set(project_id, kind, p.data(), version)
+    return p
+
+
+async def invalidate_project_cache(project_id: str) -> None:
+    """Call after changing a project's secret, status or profile config"""
+    async with get_redis_client() as client:
+        version = await client.incr(project_cache_version_key(project_id))
+        await client.publish(PROJECT_CACHE_CHANNEL, f"{version}:{project_id}")
+    PROJECT_LOCAL_CACHE.invalidate(project_id, version)
+
+
+async def listen_project_cache_invalidation() -> None:
+    """Keep this worker's L1 cache in sync, run as a background task"""
+    while True:
+        try:
+            async with get_redis_client() as client:
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(PROJECT_CACHE_CHANNEL)
+                    # messages may have been missed while disconnected
+                    PROJECT_LOCAL_CACHE.clear()
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        version, project_id = message["data"].split(":", 1)
+                        PROJECT_LOCAL_CACHE.invalidate(project_id, int(version))
+        except asyncio.CancelledError:
+            raise
+        except (redis_exceptions.RedisError, ValueError) as e:
+            LOG.warning(f"Project cache listener error, retrying: {e}")
+            await asyncio.sleep(LISTENER_RETRY_SECONDS)
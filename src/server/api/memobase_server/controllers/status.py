@@ -1,44 +1,68 @@
 from pydantic import ValidationError
+from sqlalchemy import select
 from ..models.utils import Promise
 from ..models.database import UserStatus
 from ..models.response import CODE, UserStatusesData, UserStatusData, IdData
-from ..connectors import Session
+from ..connectors import AsyncSession
+from .pagination import after_cursor, decode_cursor, next_page_cursor
 
 
 async def get_user_statuses(
-    user_id: str, project_id: str, type: str, page: int = 1, page_size: int = 10
+    user_id: str,
+    project_id: str,
+    type: str,
+    page: int = 1,
+    page_size: int = 10,
+    cursor: str | None = None,
 ) -> Promise[UserStatusesData]:
-    with Session() as session:
-        status = (
-            session.query(UserStatus)
-            .filter_by(user_id=user_id, project_id=project_id, type=type)
-            .order_by(UserStatus.created_at.desc())
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-            .all()
+    query = select(UserStatus).filter_by(
+        user_id=user_id, project_id=project_id, type=type
+    )
+    if cursor is not None:
+        try:
+            value, row_id = decode_cursor(cursor, "created_at")
+        except ValueError as e:
+            return Promise.reject(CODE.BAD_REQUEST, f"Invalid cursor: {e}")
+        query = query.where(
+            after_cursor(
+                (UserStatus.created_at, UserStatus.id), (value, row_id), desc=True
+            )
         )
-        if status is None:
-            return Promise.resolve(UserStatusesData(statuses=[]))
-        data = [
-            {
-                "id": s.id,
-                "type": s.type,
-                "attributes": s.attributes,
-                "created_at": s.created_at,
-                "updated_at": s.updated_at,
-            }
-            for s in status
-        ]
-        return Promise.resolve(UserStatusesData(statuses=data))
+    else:
+        query = query.offset((page - 1) * page_size)
+    async with AsyncSession() as session:
+        status = list(
+            (
+                await session.scalars(
+                    query.order_by(
+                        UserStatus.created_at.desc(), UserStatus.id.desc()
+                    ).limit(page_size + 1)
+                )
+            ).all()
+        )
+    next_cursor = next_page_cursor(
+        status, page_size, "created_at", lambda s: s.created_at
+    )
+    data = [
+        {
+            "id": s.id,
+            "type": s.type,
+            "attributes": s.attributes,
+            "created_at": s.created_at,
+            "updated_at": s.updated_at,
+        }
+        for s in status
+    ]
+    return Promise.resolve(UserStatusesData(statuses=data, next_cursor=next_cursor))
 
 
 async def append_user_status(
     user_id: str, project_id: str, type: str, attributes: dict
 ) -> Promise[IdData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         status = UserStatus(
             user_id=user_id, project_id=project_id, type=type, attributes=attributes
         )
         session.add(status)
-        session.commit()
+        await session.commit()
         return Promise.resolve(IdData(id=status.id))
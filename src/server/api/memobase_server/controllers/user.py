@@ -1,27 +1,34 @@
+from sqlalchemy import select, delete
 from ..models.utils import Promise
 from ..models.database import User, GeneralBlob, UserProfile
-from ..models.response import CODE, UserData, IdData, IdsData, UserProfilesData
-from ..connectors import Session
+from ..models.response import (
+    CODE,
+    UserData,
+    IdData,
+    IdsData,
+    IdsPageData,
+    UserProfilesData,
+)
+from ..connectors import AsyncSession
 from .profile import refresh_user_profile_cache
+from .pagination import after_cursor, decode_cursor, next_page_cursor
 from ..models.blob import BlobType
 
 
 async def create_user(data: UserData, project_id: str) -> Promise[IdData]:
-    with Session() as session:
+    async with AsyncSession() as session:
         db_user = User(additional_fields=data.data, project_id=project_id)
         if data.id is not None:
             db_user.id = str(data.id)
         session.add(db_user)
-        session.commit()
+        await session.commit()
         return Promise.resolve(IdData(id=db_user.id))
 
 
 async def get_user(user_id: str, project_id: str) -> Promise[UserData]:
-    with Session() as session:
-        db_user = (
-            session.query(User)
-            .filter_by(id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        db_user = await session.scalar(
+            select(User).filter_by(id=user_id, project_id=project_id)
         )
         if db_user is None:
             return Promise.reject(CODE.NOT_FOUND, f"User {user_id} not found")
@@ -35,30 +42,26 @@ async def get_user(user_id: str, project_id: str) -> Promise[UserData]:
 
 
 async def update_user(user_id: str, project_id: str, data: dict) -> Promise[IdData]:
-    with Session() as session:
-        db_user = (
-            session.query(User)
-            .filter_by(id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        db_user = await session.scalar(
+            select(User).filter_by(id=user_id, project_id=project_id)
         )
         if db_user is None:
             return Promise.reject(CODE.NOT_FOUND, f"User {user_id} not found")
         db_user.additional_fields = data
-        session.commit()
+        await session.commit()
         return Promise.resolve(IdData(id=db_user.id))
 
 
 async def delete_user(user_id: str, project_id: str) -> Promise[None]:
-    with Session() as session:
-        db_user = (
-            session.query(User)
-            .filter_by(id=user_id, project_id=project_id)
-            .one_or_none()
+    async with AsyncSession() as session:
+        # Related rows are removed by the ON DELETE CASCADE foreign keys
+        result = await session.execute(
+            delete(User).where(User.id == user_id, User.project_id == project_id)
         )
-        if db_user is None:
+        if result.rowcount == 0:
             return Promise.reject(CODE.NOT_FOUND, f"User {user_id} not found")
-        session.delete(db_user)
-        session.commit()
+        await session.commit()
     await refresh_user_profile_cache(user_id, project_id)
     return Promise.resolve(None)
 
@@ -69,16 +72,36 @@ async def get_user_all_blobs(
     blob_type: BlobType,
     page: int = 0,
     page_size: int = 10,
-) -> Promise[IdsData]:
-    with Session() as session:
-        user_blobs = (
-            session.query(GeneralBlob.id)
-            .filter_by(user_id=user_id, blob_type=str(blob_type), project_id=project_id)
-            .order_by(GeneralBlob.created_at)
-            .offset(page * page_size)
-            .limit(page_size)
-            .all()
+    cursor: str | None = None,
+) -> Promise[IdsPageData]:
+    query = select(GeneralBlob.id, GeneralBlob.created_at).filter_by(
+        user_id=user_id, blob_type=str(blob_type), project_id=project_id
+    )
+    if cursor is not None:
+        try:
+            value, row_id = decode_cursor(cursor, "created_at")
+        except ValueError as e:
+            return Promise.reject(CODE.BAD_REQUEST, f"Invalid cursor: {e}")
+        query = query.where(
+            after_cursor(
+                (GeneralBlob.created_at, GeneralBlob.id), (value, row_id), desc=False
+            )
         )
-        if user_blobs is None:
-            return Promise.reject(CODE.NOT_FOUND, f"User {user_id} not found")
-        return Promise.resolve(IdsData(ids=[blob.id for blob in user_blobs]))
+    else:
+        query = query.offset(page * page_size)
+    async with AsyncSession() as session:
+        user_blobs = list(
+            (
+                await session.execute(
+                    query.order_by(GeneralBlob.created_at, GeneralBlob.id).limit(
+                        page_size + 1
+                    )
+                )
+            ).all()
+        )
+    next_cursor = next_page_cursor(
+        user_blobs, page_size, "created_at", lambda b: b.created_at
+    )
+    return Promise.resolve(
+        IdsPageData(ids=[b.id for b in user_blobs], next_cursor=next_cursor)
+    )
@@ -0,0 +1,35 @@
+"""
+Profile and event counts of a user, stored on the `users` row.
+
+The counts are changed in the same transaction as the rows they count, so the
+project user listing can sort and page on them without aggregating all the
+profiles and events of the project.
+"""
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession as AsyncSessionType
+from ..models.database import User
+
+
+async def add_user_counts(
+    session: AsyncSessionType,
+    user_id: str,
+    project_id: str,
+    profiles: int = 0,
+    events: int = 0,
+) -> None:
+    """Add (or subtract) profiles/events to the counts, call it before the commit"""
+    values = {}
+    if profiles:
+        values["profile_count"] = User.profile_count + profiles
+    if events:
+        values["event_count"] = User.event_count + events
+    if not values:
+        return
+    await session.execute(
+        update(User)
+        .where(User.id == user_id, User.project_id == project_id)
+        # counting isn't a user update, keep the order of the user listing
+        .values(**values, updated_at=User.updated_at)
+        .execution_options(synchronize_session=False)
+    )
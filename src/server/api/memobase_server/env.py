@@ -8,6 +8,7 @@ import json
 import yaml
 import logging
 import tiktoken
+import functools
 import dataclasses
 from dataclasses import dataclass, field
 from typing import Optional, Literal, Union
@@ -85,10 +86,28 @@ class Config:
     buffer_flush_interval: int = 60 * 60  # 1 hour
     max_chat_blob_buffer_token_size: int = 1024
     max_chat_blob_buffer_process_token_size: int = 16384
+    max_blob_batch_size: int = 1000
+    max_context_batch_size: int = 100
+    # where background buffer flushes run: in the request's BackgroundTasks,
+    # in a worker pool inside the API process, or in `python -m memobase_server.worker`
+    flush_worker_mode: Literal["background", "in_process", "external"] = "in_process"
+    flush_worker_concurrency: int = 16
+    flush_worker_drain_timeout: float = 30
+    # migrate an outdated database on startup, otherwise run `python -m memobase_server.migrate`
+    auto_migrate: bool = True
+    # check the LLM/embedding providers before serving, after it, or never
+    sanity_check_mode: Literal["startup", "background", "off"] = "startup"
     max_profile_subtopics: int = 15
     max_pre_profile_token_size: int = 128
     llm_tab_separator: str = "::"
     cache_user_profiles_ttl: int = 60 * 20  # 20 minutes
+    token_count_cache_size: int = 65536
+    # per-worker cache of project secret/status/profile config, 0 disables it
+    project_cache_ttl: int = 30
+    # seconds between moving the token debits of the projects from Redis to the billings
+    billing_reconcile_interval: float = 10
+    # time kept for fallbacks and packing when a context call has a deadline_ms
+    context_deadline_reserve_ms: int = 100
 
     # LLM
     language: Literal["en", "zh"] = "en"
@@ -100,14 +119,45 @@ class Config:
     best_llm_model: str = "gpt-4o-mini"
     thinking_llm_model: str = "o4-mini"
     summary_llm_model: str = None
+    # send a prompt_cache_key to OpenAI, other compatible providers may reject it
+    llm_prompt_cache_key: bool = False
+    # requests/tokens per minute shared by all workers, None means no limit
+    llm_rpm_limit: Optional[int] = None
+    llm_tpm_limit: Optional[int] = None
+    llm_project_rpm_limit: Optional[int] = None
+    llm_project_tpm_limit: Optional[int] = None
+    llm_rate_limit_max_wait: float = 300
+    # retries of calls rejected by the provider with 429
+    llm_retry_times: int = 3
+    llm_retry_base_delay: float = 1
 
     enable_event_embedding: bool = True
-    embedding_provider: Literal["openai", "jina"] = "openai"
+    embedding_provider: Literal["openai", "jina", "lmstudio"] = "openai"
     embedding_api_key: str = None
     embedding_base_url: str = None
     embedding_dim: int = 1536
     embedding_model: str = "text-embedding-3-small"
     embedding_max_token_size: int = 8192
+    # ANN index on the embedding columns, None means exact search
+    embedding_index_type: Optional[Literal["hnsw", "ivfflat"]] = None
+    embedding_hnsw_m: int = 16
+    embedding_hnsw_ef_construction: int = 64
+    embedding_hnsw_ef_search: int = 100
+    embedding_ivfflat_lists: int = 100
+    embedding_ivfflat_probes: int = 10
+    # the index is project-wide, without iterative scans a search filtered by
+    # user only sees the nearest rows of all users
+    embedding_index_iterative_scan: Literal["relaxed_order", "strict_order"] = (
+        "relaxed_order"
+    )
+    # embedding cache, keyed on provider/model/phase/text hash
+    embedding_cache_enabled: bool = True
+    embedding_cache_local_size: int = 4096
+    embedding_cache_ttl: int = 60 * 60 * 24 * 7
+    embedding_cache_dtype: Literal["float16", "float32"] = "float32"
+    # coalesce concurrent embedding calls, 0 disables batching
+    embedding_batch_wait_ms: float = 5
+    embedding_batch_max_tokens: int = None
 
     additional_user_profiles: list[dict] = field(default_factory=list)
     overwrite_user_profiles: Optional[list[dict]] = None
@@ -116,11 +166,23 @@ class Config:
     )
     profile_strict_mode: bool = False
     profile_validate_mode: bool = True
+    # "fused" extracts, merges and tags a chat in one LLM call
+    chat_process_mode: Literal["staged", "fused"] = "staged"
+    # how profiles are picked for the chats of a context call, "llm" asks the LLM
+    profile_filter_mode: Literal["embedding", "llm"] = "embedding"
+    profile_filter_topk: int = 10
 
     minimum_chats_token_size_for_event_summary: int = 256
     event_tags: list[dict] = field(default_factory=list)
     # Telemetry
     telemetry_deployment_environment: str = "local"
+    # usage counters are added up in memory and written to redis every interval, 0 writes through
+    telemetry_flush_interval: float = 0.5
+    # tracing spans, off by default. `otlp` needs opentelemetry-exporter-otlp-proto-http
+    tracing_exporter: Optional[Literal["otlp", "file"]] = None
+    tracing_otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    tracing_file_path: str = "./memobase-traces.jsonl"
+    tracing_sample_ratio: float = 1.0
 
     @classmethod
     def _process_env_vars(cls, config_dict):
@@ -211,6 +273,54 @@ class Config:
                     "jina-embeddings-v3",
                 }, "embedding_model must be one of the following: jina-embeddings-v3"
 
+        if self.embedding_index_type is not None:
+            # pgvector can't index vectors with more than 2000 dimensions
+            assert (
+                self.embedding_dim <= 2000
+            ), "embedding_index_type requires embedding_dim <= 2000"
+            assert (
+                self.embedding_index_iterative_scan is not None
+            ), "embedding_index_type requires embedding_index_iterative_scan"
+            assert not (
+                self.embedding_index_type == "ivfflat"
+                and self.embedding_index_iterative_scan == "strict_order"
+            ), "ivfflat only supports relaxed_order iterative scan"
+        assert (
+            self.embedding_cache_local_size >= 0
+        ), "embedding_cache_local_size must be >= 0"
+        if self.embedding_batch_max_tokens is None:
+            self.embedding_batch_max_tokens = self.embedding_max_token_size
+        assert self.embedding_batch_wait_ms >= 0, "embedding_batch_wait_ms must be >= 0"
+        assert self.flush_worker_concurrency > 0, "flush_worker_concurrency must be > 0"
+        assert (
+            self.telemetry_flush_interval >= 0
+        ), "telemetry_flush_interval must be >= 0"
+        assert (
+            self.billing_reconcile_interval > 0
+        ), "billing_reconcile_interval must be > 0"
+        for limit in (
+            "llm_rpm_limit",
+            "llm_tpm_limit",
+            "llm_project_rpm_limit",
+            "llm_project_tpm_limit",
+        ):
+            assert (
+                getattr(self, limit) is None or getattr(self, limit) > 0
+            ), f"{limit} must be > 0"
+        assert self.llm_retry_times >= 0, "llm_retry_times must be >= 0"
+        assert (
+            self.context_deadline_reserve_ms >= 0
+        ), "context_deadline_reserve_ms must be >= 0"
+        assert self.chat_process_mode in (
+            "staged",
+            "fused",
+        ), "chat_process_mode must be staged or fused"
+        assert self.profile_filter_mode in (
+            "embedding",
+            "llm",
+        ), "profile_filter_mode must be embedding or llm"
+        assert self.profile_filter_topk > 0, "profile_filter_topk must be > 0"
+
         if self.additional_user_profiles:
             [UserProfileTopic(**up) for up in self.additional_user_profiles]
         if self.overwrite_user_profiles:
@@ -230,6 +340,7 @@ class ProfileConfig:
     language: Literal["en", "zh"] = None
     profile_strict_mode: bool | None = None
     profile_validate_mode: bool | None = None
+    chat_process_mode: Optional[Literal["staged", "fused"]] = None
     additional_user_profiles: list[dict] = field(default_factory=list)
     overwrite_user_profiles: Optional[list[dict]] = None
     event_theme_requirement: Optional[str] = None
@@ -239,6 +350,8 @@ class ProfileConfig:
     def __post_init__(self):
         if self.language not in ["en", "zh"]:
             self.language = None
+        if self.chat_process_mode not in ["staged", "fused"]:
+            self.chat_process_mode = None
         if self.additional_user_profiles:
             [UserProfileTopic(**up) for up in self.additional_user_profiles]
         if self.overwrite_user_profiles:
@@ -286,7 +399,11 @@ else:
     LOG.addHandler(handler)
 
 
-ENCODER = tiktoken.encoding_for_model("gpt-4o")
+@functools.cache
+def get_encoder() -> tiktoken.Encoding:
+    # loading the BPE ranks takes a while, only the processes that count tokens pay it
+    return tiktoken.encoding_for_model("gpt-4o")
+
 
 CONFIG = Config.load_config()
 
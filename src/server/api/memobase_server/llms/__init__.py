@@ -1,22 +1,49 @@
 import asyncio
 import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from ..prompts.utils import convert_response_to_json
-from ..utils import get_encoded_tokens
+from ..utils import count_tokens
 from ..env import CONFIG, LOG
 from ..controllers.billing import project_cost_token_billing
 from ..models.utils import Promise
 from ..models.response import CODE
 from ..models.database import DEFAULT_PROJECT_ID
-from ..telemetry import telemetry_manager, CounterMetricName, HistogramMetricName
+from ..telemetry import (
+    telemetry_manager,
+    CounterMetricName,
+    HistogramMetricName,
+    tag_current_span,
+    traced,
+)
 
 from .openai_model_llm import openai_complete
 from .doubao_cache_llm import doubao_cache_complete
+from .rate_limiter import (
+    LLM_RATE_LIMITER,
+    LLMPriority,
+    is_rate_limit_error,
+    get_retry_delay,
+)
 
 FACTORIES = {"openai": openai_complete, "doubao_cache": doubao_cache_complete}
 assert CONFIG.llm_style in FACTORIES, f"Unsupported LLM style: {CONFIG.llm_style}"
 
+LLM_STAGE_USAGE: ContextVar[dict | None] = ContextVar("llm_stage_usage", default=None)
 
-# TODO: add TPM/Rate limiter
+
+@contextmanager
+def track_llm_stages():
+    """Collect LLM calls and latency per prompt_id of the completions awaited inside"""
+    usage = {}
+    token = LLM_STAGE_USAGE.set(usage)
+    try:
+        yield usage
+    finally:
+        LLM_STAGE_USAGE.reset(token)
+
+
+@traced("llm_complete")
 async def llm_complete(
     project_id,
     prompt,
@@ -25,34 +52,65 @@ async def llm_complete(
     json_mode=False,
     model=None,
     max_tokens=1024,
+    priority: LLMPriority = LLMPriority.background,
     **kwargs,
 ) -> Promise[str | dict]:
     use_model = model or CONFIG.best_llm_model
+    stage = kwargs.get("prompt_id") or "unknown"
+    tag_current_span(
+        prompt_id=stage, model=use_model, priority=LLMPriority(priority).name
+    )
     if json_mode:
         kwargs["response_format"] = {"type": "json_object"}
-    try:
-        start_time = time.time()
-        results = await FACTORIES[CONFIG.llm_style](
-            use_model,
-            prompt,
-            system_prompt=system_prompt,
-            history_messages=history_messages,
-            max_tokens=max_tokens,
-            **kwargs,
+    # system prompts repeat across calls, so only they go through the count cache
+    in_tokens = (
+        count_tokens(prompt, cache=False)
+        + count_tokens(system_prompt or "")
+        + count_tokens(
+            "\n".join([m["content"] for m in history_messages]), cache=False
         )
-        latency = (time.time() - start_time) * 1000
-    except Exception as e:
-        LOG.error(f"Error in llm_complete: {e}")
-        return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}")
+    )
+    for attempt in range(CONFIG.llm_retry_times + 1):
+        # a retry is another request to the provider, it takes from the buckets too
+        p = await LLM_RATE_LIMITER.acquire(project_id, use_model, in_tokens, priority)
+        if not p.ok():
+            LOG.error(f"Error in llm_complete: {p.msg()}")
+            return p
+        try:
+            start_time = time.time()
+            results = await FACTORIES[CONFIG.llm_style](
+                use_model,
+                prompt,
+                system_prompt=system_prompt,
+                history_messages=history_messages,
+                max_tokens=max_tokens,
+                **kwargs,
+            )
+            latency = (time.time() - start_time) * 1000
+            break
+        except Exception as e:
+            if is_rate_limit_error(e) and attempt < CONFIG.llm_retry_times:
+                telemetry_manager.increment_counter_metric(
+                    CounterMetricName.LLM_RATE_LIMITED,
+                    1,
+                    {"project_id": project_id, "stage": stage},
+                )
+                delay = get_retry_delay(e, attempt)
+                LOG.warning(
+                    f"LLM rate limited, retry {attempt + 1}/{CONFIG.llm_retry_times} in {delay:.1f}s: {e}"
+                )
+                await asyncio.sleep(delay)
+                continue
+            LOG.error(f"Error in llm_complete: {e}")
+            return Promise.reject(
+                CODE.SERVICE_UNAVAILABLE, f"Error in llm_complete: {e}"
+            )
 
-    in_tokens = len(
-        get_encoded_tokens(
-            prompt
-            + (system_prompt or "")
-            + "\n".join([m["content"] for m in history_messages])
-        )
+    out_tokens = count_tokens(results, cache=False)
+    tag_current_span(
+        input_tokens=in_tokens, output_tokens=out_tokens, retries=attempt
     )
-    out_tokens = len(get_encoded_tokens(results))
+    await LLM_RATE_LIMITER.charge(project_id, use_model, out_tokens)
 
     # await project_cost_token_billing(project_id, in_tokens, out_tokens)
     asyncio.create_task(project_cost_token_billing(project_id, in_tokens, out_tokens))
@@ -70,13 +128,18 @@ async def llm_complete(
     telemetry_manager.increment_counter_metric(
         CounterMetricName.LLM_INVOCATIONS,
         1,
-        {"project_id": project_id},
+        {"project_id": project_id, "stage": stage},
     )
     telemetry_manager.record_histogram_metric(
         HistogramMetricName.LLM_LATENCY_MS,
         latency,
-        {"project_id": project_id},
+        {"project_id": project_id, "stage": stage},
     )
+    stage_usage = LLM_STAGE_USAGE.get()
+    if stage_usage is not None:
+        s = stage_usage.setdefault(stage, {"calls": 0, "latency_ms": 0.0})
+        s["calls"] += 1
+        s["latency_ms"] += latency
 
     if not json_mode:
         return Promise.resolve(results)
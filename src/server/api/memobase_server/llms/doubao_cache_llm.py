@@ -1,5 +1,6 @@
 import hashlib
 from .utils import get_doubao_async_client_instance, exclude_special_kwargs
+from .prompt_cache import PROMPT_CACHE_REGISTRY
 from ..connectors import get_redis_client
 from ..env import LOG
 
@@ -80,6 +81,9 @@ async def doubao_cache_complete(
             model=model, messages=messages, timeout=120, **kwargs
         )
         LOG.info(f"No Cached {prompt_id} {model} {response.usage.prompt_tokens}")
+        PROMPT_CACHE_REGISTRY.record(
+            prompt_id, system_prompt, response.usage.prompt_tokens, 0
+        )
         return response.choices[0].message.content
 
     context_id = await doubao_cache_create_context_and_save(
@@ -94,6 +98,9 @@ async def doubao_cache_complete(
         response = await doubao_async_client.chat.completions.create(
             model=model, messages=messages, timeout=120, **kwargs
         )
+        PROMPT_CACHE_REGISTRY.record(
+            prompt_id, system_prompt, response.usage.prompt_tokens, 0
+        )
         return response.choices[0].message.content
     else:
         response = await doubao_async_client.context.completions.create(
@@ -102,4 +109,10 @@ async def doubao_cache_complete(
         LOG.info(
             f"Cached {prompt_id} {model} {response.usage.prompt_tokens_details.cached_tokens}/{response.usage.prompt_tokens}"
         )
+        PROMPT_CACHE_REGISTRY.record(
+            prompt_id,
+            system_prompt,
+            response.usage.prompt_tokens,
+            response.usage.prompt_tokens_details.cached_tokens,
+        )
         return response.choices[0].message.content
@@ -9,14 +9,28 @@ from ...models.database import DEFAULT_PROJECT_ID
 from .jina_embedding import jina_embedding
 from .openai_embedding import openai_embedding
 from .lmstudio_embedding import lmstudio_embedding
-from ...telemetry import telemetry_manager, HistogramMetricName, CounterMetricName
-from ...utils import get_encoded_tokens
+from .cache import embedding_cache_key, get_cached_embeddings, set_cached_embeddings
+from .batcher import EmbeddingBatcher
+from ...telemetry import (
+    telemetry_manager,
+    HistogramMetricName,
+    CounterMetricName,
+    tag_current_span,
+    traced,
+)
+from ...utils import count_tokens
 
 FACTORIES = {"openai": openai_embedding, "jina": jina_embedding, "lmstudio": lmstudio_embedding}
 assert (
     CONFIG.embedding_provider in FACTORIES
 ), f"Unsupported embedding provider: {CONFIG.embedding_provider}"
 
+EMBEDDING_BATCHER = EmbeddingBatcher(
+    lambda: FACTORIES[CONFIG.embedding_provider],
+    wait_ms=CONFIG.embedding_batch_wait_ms,
+    max_tokens=CONFIG.embedding_batch_max_tokens,
+)
+
 
 async def check_embedding_sanity():
     if not CONFIG.enable_event_embedding:
@@ -36,6 +50,7 @@ async def check_embedding_sanity():
     LOG.info(f"Embedding dimension matched: {embedding_dim}")
 
 
+@traced("embedding")
 async def get_embedding(
     project_id: str,
     texts: list[str],
@@ -43,14 +58,48 @@ async def get_embedding(
     model: str = None,
 ) -> Promise[np.ndarray]:
     model = model or CONFIG.embedding_model
+    tag_current_span(phase=phase, model=model, texts=len(texts))
+    if not CONFIG.embedding_cache_enabled or not texts:
+        return await _embed_texts(project_id, texts, phase, model)
+
+    keys = [embedding_cache_key(model, phase, t) for t in texts]
+    results = await get_cached_embeddings(project_id, keys)
+    # texts to embed, deduplicated
+    miss_texts = {keys[i]: texts[i] for i, r in enumerate(results) if r is None}
+    tag_current_span(cache_misses=len(miss_texts))
+    if miss_texts:
+        p = await _embed_texts(project_id, list(miss_texts.values()), phase, model)
+        if not p.ok():
+            return p
+        miss_keys = list(miss_texts.keys())
+        fresh = p.data()
+        await set_cached_embeddings(miss_keys, fresh)
+        fresh_by_key = dict(zip(miss_keys, fresh))
+        results = [
+            r if r is not None else fresh_by_key[k] for k, r in zip(keys, results)
+        ]
+    return Promise.resolve(np.stack(results).astype(np.float32, copy=False))
+
+
+@traced("embedding.request")
+async def _embed_texts(
+    project_id: str,
+    texts: list[str],
+    phase: Literal["query", "document"],
+    model: str,
+) -> Promise[np.ndarray]:
+    tag_current_span(provider=CONFIG.embedding_provider, texts=len(texts))
     try:
         start_time = time.time()
-        results = await FACTORIES[CONFIG.embedding_provider](model, texts, phase)
+        if CONFIG.embedding_batch_wait_ms > 0:
+            results = await EMBEDDING_BATCHER.embed(model, texts, phase)
+        else:
+            results = await FACTORIES[CONFIG.embedding_provider](model, texts, phase)
         latency_ms = (time.time() - start_time) * 1000
     except Exception as e:
         LOG.error(f"Error in get_embedding: {e} {format_exc()}")
         return Promise.reject(CODE.SERVICE_UNAVAILABLE, f"Error in get_embedding: {e}")
-    embedding_tokens = len(get_encoded_tokens("\n".join(texts)))
+    embedding_tokens = sum(count_tokens(t) for t in texts)
     telemetry_manager.increment_counter_metric(
         CounterMetricName.EMBEDDING_TOKENS,
         embedding_tokens,
@@ -0,0 +1,114 @@
+"""
+Micro-batching for embedding calls.
+
+Concurrent callers with the same model and phase are collected for
+`embedding_batch_wait_ms`, or until `embedding_batch_max_tokens` is reached,
+and sent to the provider as one request. Results are fanned back out in order.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Literal
+import numpy as np
+from ...env import LOG
+from ...utils import count_tokens
+
+EmbeddingFactory = Callable[[str, list[str], str], Awaitable[np.ndarray]]
+
+# upper bound of inputs per provider request
+MAX_BATCH_INPUTS = 512
+
+
+class _PendingBatch:
+    def __init__(self):
+        self.items: list[tuple[list[str], asyncio.Future]] = []
+        self.inputs = 0
+        self.tokens = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        get_factory: Callable[[], EmbeddingFactory],
+        wait_ms: float,
+        max_tokens: int,
+    ):
+        self.get_factory = get_factory
+        self.wait_ms = wait_ms
+        self.max_tokens = max_tokens
+        self.provider_calls = 0
+        self._pending: dict[tuple, _PendingBatch] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(
+        self, model: str, texts: list[str], phase: Literal["query", "document"]
+    ) -> np.ndarray:
+        if len(texts) > MAX_BATCH_INPUTS:
+            # too many for one provider request, batch the parts separately
+            parts = await asyncio.gather(
+                *[
+                    self.embed(model, texts[i : i + MAX_BATCH_INPUTS], phase)
+                    for i in range(0, len(texts), MAX_BATCH_INPUTS)
+                ]
+            )
+            return np.concatenate(parts)
+        loop = asyncio.get_running_loop()
+        # futures are bound to a loop, so never mix loops in one batch
+        key = (id(loop), model, phase)
+        tokens = sum(count_tokens(t) for t in texts)
+
+        batch = self._pending.get(key)
+        if batch is not None and (
+            batch.tokens + tokens > self.max_tokens
+            or batch.inputs + len(texts) > MAX_BATCH_INPUTS
+        ):
+            self._dispatch(key)
+            batch = None
+        if batch is None:
+            batch = self._pending[key] = _PendingBatch()
+            batch.timer = loop.call_later(
+                self.wait_ms / 1000, self._dispatch, key
+            )
+
+        future = loop.create_future()
+        batch.items.append((texts, future))
+        batch.inputs += len(texts)
+        batch.tokens += tokens
+        if batch.tokens >= self.max_tokens:
+            self._dispatch(key)
+        return await future
+
+    def _dispatch(self, key: tuple):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        _, model, phase = key
+        task = asyncio.create_task(self._run(model, phase, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, model: str, phase: str, batch: _PendingBatch):
+        texts = [t for item_texts, _ in batch.items for t in item_texts]
+        unique_texts = list(dict.fromkeys(texts))
+        try:
+            self.provider_calls += 1
+            unique_embeddings = await self.get_factory()(model, unique_texts, phase)
+            if len(unique_embeddings) != len(unique_texts):
+                raise ValueError(
+                    f"Embedding provider returned {len(unique_embeddings)} vectors for {len(unique_texts)} texts"
+                )
+        except Exception as e:
+            for _, future in batch.items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if len(batch.items) > 1:
+            LOG.debug(
+                f"Batched {len(batch.items)} embedding calls, {len(texts)} texts"
+            )
+        by_text = dict(zip(unique_texts, unique_embeddings))
+        for item_texts, future in batch.items:
+            if not future.done():
+                future.set_result(np.stack([by_text[t] for t in item_texts]))
@@ -0,0 +1,90 @@
+"""
+Content-addressed embedding cache.
+
+Two tiers: an in-process LRU per worker, then Redis shared by all workers.
+Redis stores the raw float16/float32 bytes of each vector instead of JSON.
+"""
+
+import hashlib
+from typing import Literal
+import numpy as np
+import redis.exceptions as redis_exceptions
+from ...env import CONFIG, LOG
+from ...connectors import get_redis_binary_client, PROJECT_ID
+from ...utils import LRUCache
+from ...telemetry import telemetry_manager, CounterMetricName, traced
+
+LOCAL_EMBEDDING_CACHE = LRUCache(CONFIG.embedding_cache_local_size)
+
+
+def embedding_cache_key(
+    model: str, phase: Literal["query", "document"], text: str
+) -> str:
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return (
+        f"memobase::embedding::{PROJECT_ID}::{CONFIG.embedding_provider}::{model}"
+        f"::{phase}::{CONFIG.embedding_cache_dtype}::{text_hash}"
+    )
+
+
+def pack_embedding(embedding: np.ndarray) -> bytes:
+    return np.asarray(embedding, dtype=CONFIG.embedding_cache_dtype).tobytes()
+
+
+def unpack_embedding(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=CONFIG.embedding_cache_dtype).astype(np.float32)
+
+
+@traced("redis.embedding_cache")
+async def get_cached_embeddings(
+    project_id: str, keys: list[str]
+) -> list[np.ndarray | None]:
+    results = [LOCAL_EMBEDDING_CACHE.get(k) for k in keys]
+    local_hits = sum(r is not None for r in results)
+    redis_hits = 0
+    remote_indices = [i for i, r in enumerate(results) if r is None]
+    if remote_indices:
+        try:
+            async with get_redis_binary_client() as client:
+                values = await client.mget([keys[i] for i in remote_indices])
+        except redis_exceptions.RedisError as e:
+            LOG.warning(f"Embedding cache unavailable, skip redis tier: {e}")
+            values = [None] * len(remote_indices)
+        for i, value in zip(remote_indices, values):
+            if value is None:
+                continue
+            embedding = unpack_embedding(value)
+            if embedding.shape[-1] != CONFIG.embedding_dim:
+                continue
+            results[i] = embedding
+            LOCAL_EMBEDDING_CACHE.set(keys[i], embedding)
+            redis_hits += 1
+
+    misses = len(keys) - local_hits - redis_hits
+    for tier, count in (("local", local_hits), ("redis", redis_hits)):
+        if count:
+            telemetry_manager.increment_counter_metric(
+                CounterMetricName.EMBEDDING_CACHE_HIT,
+                count,
+                {"project_id": project_id, "tier": tier},
+            )
+    if misses:
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.EMBEDDING_CACHE_MISS,
+            misses,
+            {"project_id": project_id},
+        )
+    return results
+
+
+async def set_cached_embeddings(keys: list[str], embeddings: np.ndarray) -> None:
+    for key, embedding in zip(keys, embeddings):
+        LOCAL_EMBEDDING_CACHE.set(key, np.asarray(embedding, dtype=np.float32))
+    try:
+        async with get_redis_binary_client() as client:
+            pipe = client.pipeline(transaction=False)
+            for key, embedding in zip(keys, embeddings):
+                pipe.set(key, pack_embedding(embedding), ex=CONFIG.embedding_cache_ttl)
+            await pipe.execute()
+    except redis_exceptions.RedisError as e:
+        LOG.warning(f"Failed to write embedding cache: {e}")
@@ -1,5 +1,6 @@
 from .utils import exclude_special_kwargs, get_openai_async_client_instance
-from ..env import LOG
+from .prompt_cache import PROMPT_CACHE_REGISTRY, get_prompt_fingerprint
+from ..env import CONFIG, LOG
 
 
 async def openai_complete(
@@ -14,6 +15,12 @@ async def openai_complete(
         messages.append({"role": "system", "content": system_prompt})
     messages.extend(history_messages)
     messages.append({"role": "user", "content": prompt})
+    if CONFIG.llm_prompt_cache_key and system_prompt:
+        # route calls with the same system prompt to the same cache
+        kwargs["extra_body"] = {
+            **kwargs.get("extra_body", {}),
+            "prompt_cache_key": f"{prompt_id}-{get_prompt_fingerprint(system_prompt)}",
+        }
 
     response = await openai_async_client.chat.completions.create(
         model=model, messages=messages, timeout=120, **kwargs
@@ -22,4 +29,7 @@ async def openai_complete(
     LOG.info(
         f"Cached {prompt_id} {model} {cached_tokens}/{response.usage.prompt_tokens}"
     )
+    PROMPT_CACHE_REGISTRY.record(
+        prompt_id, system_prompt, response.usage.prompt_tokens, cached_tokens
+    )
     return response.choices[0].message.content
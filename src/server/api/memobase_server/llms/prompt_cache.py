@@ -0,0 +1,96 @@
+"""
+Registry of system prompt fingerprints and provider prompt-cache hits.
+
+Providers only reuse the cached prefix of a prompt if it's byte-identical, so
+the prompts put the static instructions first, then the per-project parts
+(topic slots, event tags), and send the per-user content in the last message.
+
+Every completion records the fingerprint of its system prompt with the input
+and cached tokens reported by the provider. Per `prompt_id` we export:
+- the cached share of input tokens, as a gauge and as a counter of cached tokens;
+- the number of distinct system prompts seen, a high number means the prefix
+  varies and can't be cached.
+"""
+
+import hashlib
+from collections import OrderedDict
+from ..telemetry import (
+    telemetry_manager,
+    CounterMetricName,
+    GaugeMetricName,
+)
+
+# fingerprints remembered per prompt_id, the oldest are forgotten first
+MAX_FINGERPRINTS_PER_PROMPT = 1024
+
+
+def get_prompt_fingerprint(system_prompt: str | None) -> str:
+    return hashlib.sha256((system_prompt or "").encode()).hexdigest()[:16]
+
+
+class PromptCacheStats:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.fingerprints: OrderedDict[str, int] = OrderedDict()
+
+    @property
+    def hit_ratio(self) -> float:
+        if not self.prompt_tokens:
+            return 0.0
+        return self.cached_tokens / self.prompt_tokens
+
+
+class PromptCacheRegistry:
+    def __init__(self):
+        self._stats: dict[str, PromptCacheStats] = {}
+
+    def record(
+        self,
+        prompt_id: str | None,
+        system_prompt: str | None,
+        prompt_tokens: int | None,
+        cached_tokens: int | None,
+    ) -> None:
+        prompt_id = prompt_id or "unknown"
+        stats = self._stats.setdefault(prompt_id, PromptCacheStats())
+        fingerprint = get_prompt_fingerprint(system_prompt)
+        stats.fingerprints[fingerprint] = stats.fingerprints.get(fingerprint, 0) + 1
+        stats.fingerprints.move_to_end(fingerprint)
+        if len(stats.fingerprints) > MAX_FINGERPRINTS_PER_PROMPT:
+            stats.fingerprints.popitem(last=False)
+        stats.calls += 1
+        stats.prompt_tokens += prompt_tokens or 0
+        stats.cached_tokens += cached_tokens or 0
+
+        attributes = {"prompt_id": prompt_id}
+        telemetry_manager.increment_counter_metric(
+            CounterMetricName.LLM_TOKENS_INPUT_CACHED, cached_tokens or 0, attributes
+        )
+        telemetry_manager.set_gauge_metric(
+            GaugeMetricName.LLM_PROMPT_CACHE_HIT_RATIO, stats.hit_ratio, attributes
+        )
+        telemetry_manager.set_gauge_metric(
+            GaugeMetricName.LLM_PROMPT_FINGERPRINTS,
+            len(stats.fingerprints),
+            attributes,
+        )
+
+    def get_stats(self, prompt_id: str) -> PromptCacheStats | None:
+        return self._stats.get(prompt_id)
+
+    def summary(self) -> dict[str, dict]:
+        return {
+            prompt_id: {
+                "calls": s.calls,
+                "prompt_tokens": s.prompt_tokens,
+                "cached_tokens": s.cached_tokens,
+                "hit_ratio": round(s.hit_ratio, 4),
+                "fingerprints": len(s.fingerprints),
+            }
+            for prompt_id, s in self._stats.items()
+        }
+
+
+PROMPT_CACHE_REGISTRY = PromptCacheRegistry()
@@ -0,0 +1,213 @@
+"""
+Rate limiting of LLM calls, shared by all workers through Redis.
+
+Every call, and every retry of it, takes one request and its input tokens
+from token buckets in Redis: one bucket per model (`llm_rpm_limit`,
+`llm_tpm_limit`) and one per project (`llm_project_rpm_limit`,
+`llm_project_tpm_limit`). Output tokens are only known afterwards, they are
+charged when the call returns, so a bucket can go below zero and the next
+callers wait until it refills.
+
+Callers of this process waiting for the same project and model are served by
+priority: interactive requests go before background buffer flushes.
+"""
+
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from enum import IntEnum
+import redis.exceptions as redis_exceptions
+from ..env import CONFIG, LOG
+from ..connectors import get_redis_client, PROJECT_ID
+from ..models.utils import Promise
+from ..models.response import CODE
+from ..telemetry import telemetry_manager, GaugeMetricName, traced
+
+# upper bound of the backoff between two retries of a rate-limited call
+MAX_RETRY_DELAY_S = 30
+
+# KEYS: buckets. ARGV[1]: 1 to charge even if the bucket is short,
+# then capacity, refill per second and cost of each bucket.
+# Returns 0 if the cost is taken, otherwise the milliseconds to wait.
+TAKE_TOKENS_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local force = ARGV[1] == '1'
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    local bucket = redis.call('HMGET', key, 'level', 'ts')
+    local level = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    level = math.min(capacity, level + math.max(0, now - ts) * rate)
+    levels[i] = level
+    -- a call larger than the bucket waits for a full bucket instead of forever
+    local need = math.min(cost, capacity)
+    if level < need then
+        wait = math.max(wait, (need - level) / rate)
+    end
+end
+if wait > 0 and not force then
+    return math.ceil(wait * 1000)
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local rate = tonumber(ARGV[i * 3])
+    local cost = tonumber(ARGV[i * 3 + 1])
+    redis.call('HSET', key, 'level', tostring(levels[i] - cost), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 60)
+end
+return 0
+"""
+
+
+class LLMPriority(IntEnum):
+    interactive = 0
+    background = 1
+
+
+def get_model_bucket_key(model: str, kind: str) -> str:
+    return f"memobase::llm_rate_limit::{PROJECT_ID}::model::{model}::{kind}"
+
+
+def get_project_bucket_key(project_id: str, kind: str) -> str:
+    return f"memobase::llm_rate_limit::{PROJECT_ID}::project::{project_id}::{kind}"
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 429
+
+
+def get_retry_delay(e: Exception, attempt: int) -> float:
+    """Full-jitter exponential backoff, never shorter than the provider's retry-after"""
+    delay = random.uniform(
+        0, min(MAX_RETRY_DELAY_S, CONFIG.llm_retry_base_delay * 2**attempt)
+    )
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        retry_after = 0
+    return max(delay, min(retry_after, MAX_RETRY_DELAY_S))
+
+
+class LLMRateLimiter:
+    def __init__(self):
+        self._queues: dict[tuple, list] = {}
+        self._seq = itertools.count()
+
+    def buckets(
+        self, project_id: str, model: str, tokens: int
+    ) -> list[tuple[str, float, float, int]]:
+        """The (key, capacity, refill per second, cost) of the enabled buckets"""
+        limits = [
+            (get_model_bucket_key(model, "rpm"), CONFIG.llm_rpm_limit, 1),
+            (get_model_bucket_key(model, "tpm"), CONFIG.llm_tpm_limit, tokens),
+            (
+                get_project_bucket_key(project_id, "rpm"),
+                CONFIG.llm_project_rpm_limit,
+                1,
+            ),
+            (
+                get_project_bucket_key(project_id, "tpm"),
+                CONFIG.llm_project_tpm_limit,
+                tokens,
+            ),
+        ]
+        return [
+            (key, limit, limit / 60, cost) for key, limit, cost in limits if limit
+        ]
+
+    async def take(self, buckets: list[tuple], force: bool = False) -> int:
+        """Take the cost from all the buckets at once, returns the ms to wait if they are short"""
+        args = ["1" if force else "0"]
+        for _, capacity, rate, cost in buckets:
+            args.extend([capacity, rate, cost])
+        try:
+            async with get_redis_client() as redis_client:
+                wait_ms = await redis_client.eval(
+                    TAKE_TOKENS_SCRIPT,
+                    len(buckets),
+                    *[b[0] for b in buckets],
+                    *args,
+                )
+        except redis_exceptions.RedisError as e:
+            # don't stop the LLM calls because the limiter is down
+            LOG.warning(f"LLM rate limiter unavailable, skip it: {e}")
+            return 0
+        return int(wait_ms)
+
+    @traced("llm.rate_limit")
+    async def acquire(
+        self,
+        project_id: str,
+        model: str,
+        tokens: int,
+        priority: LLMPriority = LLMPriority.background,
+    ) -> Promise[None]:
+        buckets = self.buckets(project_id, model, tokens)
+        if not buckets:
+            return Promise.resolve(None)
+        # events are bound to a loop, so never mix loops in one queue
+        key = (id(asyncio.get_running_loop()), project_id, model)
+        queue = self._queues.setdefault(key, [])
+        waiter = (int(priority), next(self._seq), asyncio.Event())
+        heapq.heappush(queue, waiter)
+        self._report_depth(project_id, model, queue)
+        deadline = time.monotonic() + CONFIG.llm_rate_limit_max_wait
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return Promise.reject(
+                        CODE.SERVICE_UNAVAILABLE,
+                        f"LLM rate limit of project {project_id}, model {model}: waited more than {CONFIG.llm_rate_limit_max_wait}s",
+                    )
+                if queue[0] is not waiter:
+                    # only the first in line polls Redis, it wakes the next one when it's done
+                    waiter[2].clear()
+                    try:
+                        await asyncio.wait_for(waiter[2].wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                wait_ms = await self.take(buckets)
+                if wait_ms == 0:
+                    return Promise.resolve(None)
+                await asyncio.sleep(min(wait_ms / 1000, remaining))
+        finally:
+            queue.remove(waiter)
+            heapq.heapify(queue)
+            if queue:
+                queue[0][2].set()
+            else:
+                self._queues.pop(key, None)
+            self._report_depth(project_id, model, queue)
+
+    async def charge(self, project_id: str, model: str, tokens: int) -> None:
+        """Charge the output tokens of a finished call to the token buckets"""
+        buckets = [
+            b for b in self.buckets(project_id, model, tokens) if b[0].endswith("tpm")
+        ]
+        if buckets and tokens > 0:
+            await self.take(buckets, force=True)
+
+    def queue_depth(self, project_id: str, model: str) -> int:
+        loop_id = id(asyncio.get_running_loop())
+        return len(self._queues.get((loop_id, project_id, model), []))
+
+    def _report_depth(self, project_id: str, model: str, queue: list):
+        telemetry_manager.set_gauge_metric(
+            GaugeMetricName.LLM_RATE_LIMIT_QUEUE_DEPTH,
+            len(queue),
+            {"project_id": project_id, "model": model},
+        )
+
+
+LLM_RATE_LIMITER = LLMRateLimiter()
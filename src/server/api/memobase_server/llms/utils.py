@@ -1,7 +1,11 @@
+from typing import TYPE_CHECKING
 from openai import AsyncOpenAI
-from volcenginesdkarkruntime import AsyncArk
 from ..env import CONFIG
 
+if TYPE_CHECKING:
+    # the Ark SDK is slow to import and only used with `llm_style: doubao_cache`
+    from volcenginesdkarkruntime import AsyncArk
+
 _global_openai_async_client = None
 _global_doubao_async_client = None
 
@@ -18,10 +22,12 @@ def get_openai_async_client_instance() -> AsyncOpenAI:
     return _global_openai_async_client
 
 
-def get_doubao_async_client_instance() -> AsyncArk:
+def get_doubao_async_client_instance() -> "AsyncArk":
     global _global_doubao_async_client
 
     if _global_doubao_async_client is None:
+        from volcenginesdkarkruntime import AsyncArk
+
         _global_doubao_async_client = AsyncArk(api_key=CONFIG.llm_api_key)
     return _global_doubao_async_client
 
@@ -0,0 +1,283 @@
+"""
+Create or upgrade the database schema, once per deployment.
+
+    python -m memobase_server.migrate
+    python -m memobase_server.migrate --check
+
+The tables, columns and indexes of the models are created if they are missing,
+then the alembic revisions in `migrations/` are applied. A fingerprint of the
+schema is stored when it's done, so on startup the API and the worker compare
+fingerprints with a single query and skip all the DDL. With `auto_migrate`
+they migrate an outdated database themselves, one process at a time.
+"""
+
+import sys
+import hashlib
+import argparse
+from pathlib import Path
+from sqlalchemy import (
+    TIMESTAMP,
+    VARCHAR,
+    Column,
+    Connection,
+    Integer,
+    MetaData,
+    Table,
+    func,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex, CreateTable
+from .env import CONFIG, LOG
+from .connectors import get_db_engine, DATABASE_URL
+from .models.database import REG, Project, UserProfile, UserEvent, UserEventGist
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / "migrations"
+# pg_advisory_lock key, so concurrent processes migrate one after another
+MIGRATE_LOCK_ID = 0x6D656D6F
+
+SCHEMA_STATE = Table(
+    "memobase_schema",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("fingerprint", VARCHAR(64), nullable=False),
+    Column(
+        "migrated_at",
+        TIMESTAMP(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+    ),
+)
+
+# iterative index scans, which ANN searches filtered by user depend on
+PGVECTOR_ITERATIVE_SCAN_VERSION = (0, 8)
+
+# Values for the rows that existed before a column was added, run in the same transaction
+COLUMN_BACKFILLS = {
+    ("users", "profile_count"): """
+        UPDATE users SET profile_count = (
+            SELECT count(*) FROM user_profiles
+            WHERE user_profiles.user_id = users.id
+            AND user_profiles.project_id = users.project_id
+        )
+    """,
+    ("users", "event_count"): """
+        UPDATE users SET event_count = (
+            SELECT count(*) FROM user_events
+            WHERE user_events.user_id = users.id
+            AND user_events.project_id = users.project_id
+        )
+    """,
+}
+
+
+def schema_fingerprint() -> str:
+    """Hash of the DDL of the models and the alembic revision files.
+
+    The DDL depends on the config as well (`embedding_dim`, `embedding_index_type`),
+    so changing those makes the database outdated too.
+    """
+    dialect = postgresql.dialect()
+    h = hashlib.sha256()
+    for table in REG.metadata.sorted_tables:
+        h.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            h.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    for revision in sorted((MIGRATIONS_DIR / "versions").glob("*.py")):
+        h.update(revision.name.encode())
+    return h.hexdigest()
+
+
+def schema_is_current(conn: Connection, fingerprint: str) -> bool:
+    try:
+        stored = conn.execute(
+            select(SCHEMA_STATE.c.fingerprint).where(SCHEMA_STATE.c.id == 1)
+        ).scalar()
+    except ProgrammingError:
+        # never migrated
+        conn.rollback()
+        return False
+    conn.commit()
+    return stored == fingerprint
+
+
+def create_pgvector_extension(conn: Connection):
+    try:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        conn.commit()
+        LOG.info("pgvector extension created or already exists")
+    except Exception as e:
+        conn.rollback()
+        LOG.error(f"Failed to create pgvector extension: {e}")
+
+
+def check_pgvector_version(conn: Connection):
+    if CONFIG.embedding_index_type is None:
+        return
+    version = conn.execute(
+        text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    ).scalar()
+    conn.commit()
+    if (
+        version is None
+        or tuple(int(v) for v in version.split(".")[:2])
+        < PGVECTOR_ITERATIVE_SCAN_VERSION
+    ):
+        raise RuntimeError(
+            f"embedding_index_type requires pgvector >= 0.8 for iterative index scans, found {version}"
+        )
+
+
+def create_missing_columns(conn: Connection):
+    """Add nullable columns that were introduced after a table was created.
+
+    `create_all` never alters existing tables. Only nullable columns without
+    constraints are handled here, anything else needs an alembic revision.
+    """
+    existing_tables = set(inspect(conn).get_table_names())
+    for table in REG.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {c["name"] for c in inspect(conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(
+                text(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN IF NOT EXISTS "{column.name}" {column_type}'
+                )
+            )
+            LOG.info(f"Added column {table.name}.{column.name}")
+            backfill = COLUMN_BACKFILLS.get((table.name, column.name))
+            if backfill is not None:
+                conn.execute(text(backfill))
+                LOG.info(f"Backfilled column {table.name}.{column.name}")
+    conn.commit()
+
+
+def create_missing_indexes(conn: Connection):
+    """Create the indexes that are missing on tables that already exist.
+
+    `create_all` only creates indexes for new tables, so existing deployments
+    get new indexes (e.g. the configured ANN indexes) here. Building an index
+    on a large table can take a while, so it's built `CONCURRENTLY` and the
+    table stays writable meanwhile.
+    """
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    conn.execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        for table in REG.metadata.sorted_tables:
+            for index in table.indexes:
+                options = index.dialect_options["postgresql"]
+                options["concurrently"] = True
+                try:
+                    index.create(conn, checkfirst=True)
+                except Exception as e:
+                    LOG.error(f"Failed to create index {index.name}: {e}")
+                    # a failed concurrent build leaves an invalid index behind
+                    conn.execute(
+                        text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"')
+                    )
+                finally:
+                    options["concurrently"] = False
+    finally:
+        conn.commit()
+        conn.execution_options(isolation_level=conn.default_isolation_level)
+
+
+def create_tables(conn: Connection):
+    create_pgvector_extension(conn)
+    check_pgvector_version(conn)
+    REG.metadata.create_all(conn)
+    SCHEMA_STATE.create(conn, checkfirst=True)
+    conn.commit()
+    create_missing_columns(conn)
+    create_missing_indexes(conn)
+    with Session(bind=conn) as session:
+        Project.initialize_root_project(session)
+        UserProfile.check_legal_embedding_dim(session)
+        UserEvent.check_legal_embedding_dim(session)
+        UserEventGist.check_legal_embedding_dim(session)
+    conn.commit()
+    LOG.info("Database tables created successfully")
+
+
+def upgrade_revisions(conn: Connection):
+    from alembic import command
+    from alembic.config import Config as AlembicConfig
+
+    alembic_config = AlembicConfig()
+    alembic_config.set_main_option("script_location", str(MIGRATIONS_DIR))
+    alembic_config.set_main_option("sqlalchemy.url", DATABASE_URL)
+    alembic_config.attributes["connection"] = conn
+    command.upgrade(alembic_config, "head")
+    conn.commit()
+
+
+def migrate(force: bool = False) -> bool:
+    """Bring the database to the current schema, returns False if it already was"""
+    fingerprint = schema_fingerprint()
+    with get_db_engine().connect() as conn:
+        conn.execute(select(func.pg_advisory_lock(MIGRATE_LOCK_ID)))
+        conn.commit()
+        try:
+            # another process may have migrated while this one waited for the lock
+            if not force and schema_is_current(conn, fingerprint):
+                return False
+            create_tables(conn)
+            upgrade_revisions(conn)
+            conn.execute(
+                postgresql.insert(SCHEMA_STATE)
+                .values(id=1, fingerprint=fingerprint)
+                .on_conflict_do_update(
+                    index_elements=[SCHEMA_STATE.c.id],
+                    set_={"fingerprint": fingerprint, "migrated_at": func.now()},
+                )
+            )
+            conn.commit()
+        finally:
+            conn.execute(select(func.pg_advisory_unlock(MIGRATE_LOCK_ID)))
+            conn.commit()
+    LOG.info(f"Database schema migrated to {fingerprint[:12]}")
+    return True
+
+
+def ensure_schema():
+    """Startup check, a single query when the database is up to date"""
+    with get_db_engine().connect() as conn:
+        if schema_is_current(conn, schema_fingerprint()):
+            return
+    if not CONFIG.auto_migrate:
+        raise RuntimeError(
+            "Database schema is outdated, run `python -m memobase_server.migrate`"
+        )
+    migrate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m memobase_server.migrate")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit with 1 if the database needs a migration, without migrating",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="migrate even if the database looks up to date",
+    )
+    args = parser.parse_args()
+    try:
+        if args.check:
+            with get_db_engine().connect() as conn:
+                current = schema_is_current(conn, schema_fingerprint())
+            LOG.info(f"Database schema is {'current' if current else 'outdated'}")
+            sys.exit(0 if current else 1)
+        migrate(force=args.force)
+    finally:
+        get_db_engine().dispose()
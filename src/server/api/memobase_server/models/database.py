@@ -15,6 +15,7 @@ from sqlalchemy import (
     Boolean,
     PrimaryKeyConstraint,
     ForeignKeyConstraint,
+    cast,
 )
 from dataclasses import dataclass
 from sqlalchemy.dialects.postgresql import JSONB, UUID
@@ -53,6 +54,42 @@ def next_month_first_day() -> datetime:
     return datetime(today.year, today.month + 1, 1)
 
 
+def embedding_ann_indexes(table_name: str) -> tuple[Index, ...]:
+    """ANN index on the `embedding` column, based on `CONFIG.embedding_index_type`"""
+    if CONFIG.embedding_index_type == "hnsw":
+        index_with = {
+            "m": CONFIG.embedding_hnsw_m,
+            "ef_construction": CONFIG.embedding_hnsw_ef_construction,
+        }
+    elif CONFIG.embedding_index_type == "ivfflat":
+        index_with = {"lists": CONFIG.embedding_ivfflat_lists}
+    else:
+        return ()
+    return (
+        Index(
+            f"idx_{table_name}_embedding_{CONFIG.embedding_index_type}",
+            "embedding",
+            postgresql_using=CONFIG.embedding_index_type,
+            postgresql_with=index_with,
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
+
+
+def embedding_search_settings() -> dict[str, str]:
+    """Transaction-local planner settings for ANN searches"""
+    if CONFIG.embedding_index_type == "hnsw":
+        settings = {"hnsw.ef_search": str(CONFIG.embedding_hnsw_ef_search)}
+    elif CONFIG.embedding_index_type == "ivfflat":
+        settings = {"ivfflat.probes": str(CONFIG.embedding_ivfflat_probes)}
+    else:
+        return {}
+    settings[f"{CONFIG.embedding_index_type}.iterative_scan"] = (
+        CONFIG.embedding_index_iterative_scan
+    )
+    return settings
+
+
 def check_legal_embedding_dim(cls, session):
     try:
         # Use table_name from the ORM class to avoid hardcoding
@@ -276,12 +313,34 @@ class User(Base):
         "Project", back_populates="related_users", init=False, foreign_keys=[project_id]
     )
 
+    # Maintained in the transactions that add/delete profiles and events
+    profile_count: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=0, init=False
+    )
+    event_count: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=0, init=False
+    )
+
     __table_args__ = (
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_users_id_project_id", "id", "project_id"),
+        Index("idx_users_project_id_updated_at_id", "project_id", "updated_at", "id"),
+        Index(
+            "idx_users_project_id_profile_count_id", "project_id", "profile_count", "id"
+        ),
+        Index("idx_users_project_id_event_count_id", "project_id", "event_count", "id"),
     )
 
 
+# Prefix search on the user id, `LIKE 'abc%'` on `id::text` can use this index
+Index(
+    "idx_users_project_id_id_text",
+    User.project_id,
+    cast(User.id, TEXT).label("id_text"),
+    postgresql_ops={"id_text": "text_pattern_ops"},
+)
+
+
 @REG.mapped_as_dataclass
 class GeneralBlob(Base):
     __tablename__ = "general_blobs"
@@ -325,6 +384,14 @@ class GeneralBlob(Base):
         Index(
             "idx_general_blobs_user_id_blob_type", "user_id", "project_id", "blob_type"
         ),
+        Index(
+            "idx_general_blobs_user_id_blob_type_created_at",
+            "user_id",
+            "project_id",
+            "blob_type",
+            "created_at",
+            "id",
+        ),
         Index("idx_general_blobs_id_project_id", "id", "project_id", unique=True),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
@@ -415,6 +482,34 @@ class BufferZone(Base):
         self.blob_type = self.blob_type.value
 
 
+@REG.mapped_as_dataclass
+class BufferTokenCounter:
+    """Running token size of the idle buffers of one user and blob type"""
+
+    __tablename__ = "buffer_token_counters"
+
+    user_id: Mapped[UUID] = mapped_column(UUID(as_uuid=True), nullable=False)
+    project_id: Mapped[str] = mapped_column(VARCHAR(64), nullable=False)
+    blob_type: Mapped[str] = mapped_column(VARCHAR(SHORT_ENUM_SIZE), nullable=False)
+    token_size: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        init=False,
+    )
+
+    __table_args__ = (
+        PrimaryKeyConstraint("user_id", "project_id", "blob_type"),
+        ForeignKeyConstraint(
+            ["user_id", "project_id"],
+            ["users.id", "users.project_id"],
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+    )
+
+
 @REG.mapped_as_dataclass
 class UserProfile(Base):
     __tablename__ = "user_profiles"
@@ -435,6 +530,16 @@ class UserProfile(Base):
         default=DEFAULT_PROJECT_ID,
     )
 
+    # token size of the rendered `topic::sub_topic: content` line
+    token_size: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+
+    # embedding of the rendered line, only loaded when profiles are ranked
+    embedding: Mapped[Optional[Vector]] = mapped_column(
+        Vector(dim=CONFIG.embedding_dim), nullable=True, default=None, deferred=True
+    )
+
     user: Mapped[User] = relationship(
         "User",
         back_populates="related_user_profiles",
@@ -442,6 +547,9 @@ class UserProfile(Base):
         foreign_keys=[user_id, project_id],
     )
 
+    # fetch created_at/updated_at with RETURNING, the profile cache is written after commit
+    __mapper_args__ = {"eager_defaults": True}
+
     __table_args__ = (
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_user_profiles_user_id_project_id", "user_id", "project_id"),
@@ -454,6 +562,11 @@ class UserProfile(Base):
         ),
     )
 
+    @classmethod
+    def check_legal_embedding_dim(cls, session):
+        check_legal_embedding_dim(cls, session)
+        LOG.info("UserProfile embedding dimension checked")
+
 
 @REG.mapped_as_dataclass
 class UserEvent(Base):
@@ -497,6 +610,14 @@ class UserEvent(Base):
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_user_events_user_id_project_id", "user_id", "project_id"),
         Index("idx_user_events_user_id_id_project_id", "user_id", "project_id", "id"),
+        Index(
+            "idx_user_events_user_id_created_at",
+            "user_id",
+            "project_id",
+            "created_at",
+            "id",
+        ),
+        *embedding_ann_indexes("user_events"),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -554,6 +675,10 @@ class UserEventGist(Base):
         Vector(dim=CONFIG.embedding_dim), nullable=True, default=None
     )
 
+    token_size: Mapped[Optional[int]] = mapped_column(
+        Integer, nullable=True, default=None
+    )
+
     __table_args__ = (
         PrimaryKeyConstraint("id", "project_id"),
         Index("idx_user_event_gists_user_id_project_id", "user_id", "project_id"),
@@ -566,6 +691,7 @@ class UserEventGist(Base):
             "project_id",
             "event_id",
         ),
+        *embedding_ann_indexes("user_event_gists"),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
@@ -619,6 +745,14 @@ class UserStatus(Base):
             "idx_user_statuses_user_id_project_id_type", "user_id", "project_id", "type"
         ),
         Index("idx_user_statuses_user_id_id_project_id", "user_id", "project_id", "id"),
+        Index(
+            "idx_user_statuses_user_id_type_created_at",
+            "user_id",
+            "project_id",
+            "type",
+            "created_at",
+            "id",
+        ),
         ForeignKeyConstraint(
             ["user_id", "project_id"],
             ["users.id", "users.project_id"],
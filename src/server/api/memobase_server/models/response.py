@@ -50,6 +50,12 @@ class IdsData(BaseModel):
     ids: list[UUID] = Field(..., description="List of UUID identifiers")
 
 
+class IdsPageData(IdsData):
+    next_cursor: Optional[str] = Field(
+        None, description="Cursor of the next page, None on the last page"
+    )
+
+
 class ChatModalResponse(BaseModel):
     event_id: Optional[UUID] = Field(..., description="The event's unique identifier")
     add_profiles: Optional[list[UUID]] = Field(
@@ -81,6 +87,9 @@ class ProfileData(BaseModel):
         None,
         description="User profile attributes in JSON, containing 'topic', 'sub_topic'",
     )
+    token_size: Optional[int] = Field(
+        None, description="Token size of the profile line used in context"
+    )
 
 
 class ProfileDelta(BaseModel):
@@ -118,6 +127,9 @@ class UserEventGistData(BaseModel):
         None, description="Timestamp when the event gist was last updated"
     )
     similarity: Optional[float] = Field(None, description="Similarity score")
+    token_size: Optional[int] = Field(
+        None, description="Token size of the event gist content"
+    )
 
 
 class UserEventData(BaseModel):
@@ -134,6 +146,87 @@ class UserEventData(BaseModel):
 
 class ContextData(BaseModel):
     context: str = Field(..., description="Context string")
+    skipped_stages: list[str] = Field(
+        default_factory=list,
+        description="Stages skipped to meet `deadline_ms`: profile_filter, event_search, profiles, events",
+    )
+
+
+class ContextStreamChunk(BaseModel):
+    type: Literal["profile", "event", "context"] = Field(
+        ...,
+        description="Which part is ready: the profile section, the event section, or the final packed context",
+    )
+    content: str = Field(..., description="Section string, or the whole context")
+    count: int = Field(..., description="Number of profiles/event gists in it")
+    token_size: int = Field(..., description="Token size of the profiles/event gists")
+    skipped_stages: list[str] = Field(
+        default_factory=list,
+        description="Stages skipped to meet `deadline_ms`, set on the final packed context",
+    )
+
+
+class UsersContextRequest(BaseModel):
+    user_ids: list[UUID] = Field(..., description="The users to get the context of")
+    max_token_size: int = Field(1000, description="Max token size of each context")
+    prefer_topics: Optional[list[str]] = Field(
+        None, description="Rank prefer topics at first to try to keep them in filtering"
+    )
+    only_topics: Optional[list[str]] = Field(
+        None, description="Only return profiles with these topics, default is all"
+    )
+    max_subtopic_size: Optional[int] = Field(
+        None, description="Max subtopic size of the same topic in each context"
+    )
+    topic_limits: dict[str, int] = Field(
+        default_factory=dict,
+        description="Specific subtopic limits for topics, overrides `max_subtopic_size`",
+    )
+    profile_event_ratio: float = Field(0.6, description="Profile event ratio of each context")
+    require_event_summary: bool = Field(
+        False, description="Whether to require event summary in each context"
+    )
+    chats: list[OpenAICompatibleMessage] = Field(
+        default_factory=list,
+        description="Recent chats shared by the users, to search for relevant events",
+    )
+    event_similarity_threshold: float = Field(
+        0.2, description="Event similarity threshold of each context"
+    )
+    time_range_in_days: int = Field(
+        180, description="Only allow events within the past few days"
+    )
+    customize_context_prompt: Optional[str] = Field(
+        None, description="Customize context prompt template"
+    )
+    full_profile_and_only_search_event: bool = Field(
+        True,
+        description="If `False` and `chats` are passed, also search for relevant profiles",
+    )
+    fill_window_with_events: bool = Field(
+        False, description="Fill the token window with the rest events"
+    )
+
+
+class UserContextData(BaseModel):
+    user_id: UUID = Field(..., description="The ID of the user")
+    context: str = Field(..., description="Context string")
+
+
+class UsersContextData(BaseModel):
+    contexts: list[UserContextData] = Field(
+        ..., description="Context of each user, in the same order as the request"
+    )
+
+
+class UserBlobData(BlobData):
+    user_id: UUID = Field(..., description="The ID of the user this blob belongs to")
+
+
+class BlobsBatchData(BaseModel):
+    blobs: list[UserBlobData] = Field(
+        ..., description="Blobs to insert, they can belong to different users"
+    )
 
 
 class UserData(BaseModel):
@@ -153,6 +246,9 @@ class UserProfilesData(BaseModel):
 
 class UserEventsData(BaseModel):
     events: list[UserEventData] = Field(..., description="List of user events")
+    next_cursor: Optional[str] = Field(
+        None, description="Cursor of the next page, None on the last page"
+    )
 
 
 class UserEventGistsData(BaseModel):
@@ -201,6 +297,9 @@ class UserStatusData(BaseModel):
 
 class UserStatusesData(BaseModel):
     statuses: list[UserStatusData] = Field(..., description="List of user statuses")
+    next_cursor: Optional[str] = Field(
+        None, description="Cursor of the next page, None on the last page"
+    )
 
 
 class ProactiveTopicData(BaseModel):
@@ -230,7 +329,12 @@ class UserContextImport(BaseModel):
 
 class ProjectUsersData(BaseModel):
     users: list = Field(..., description="The user list")
-    count: int = Field(0, description="The user count")
+    count: Optional[int] = Field(
+        None, description="The user count, only returned when no cursor is given"
+    )
+    next_cursor: Optional[str] = Field(
+        None, description="Cursor of the next page, None on the last page"
+    )
 
 
 class DailyUsage(BaseModel):
@@ -258,6 +362,12 @@ class IdsResponse(BaseResponse):
     )
 
 
+class IdsPageResponse(BaseResponse):
+    data: Optional[IdsPageData] = Field(
+        None, description="Response containing one page of IDs"
+    )
+
+
 class ProfileConfigDataResponse(BaseResponse):
     data: Optional[ProfileConfigData] = Field(
         None, description="Response containing profile config data"
@@ -302,6 +412,18 @@ class UserContextDataResponse(BaseResponse):
     )
 
 
+class UsersContextDataResponse(BaseResponse):
+    data: Optional[UsersContextData] = Field(
+        None, description="Response containing the context of each user"
+    )
+
+
+class ContextStreamChunkResponse(BaseResponse):
+    data: Optional[ContextStreamChunk] = Field(
+        None, description="One line of the streamed user context"
+    )
+
+
 class BillingResponse(BaseResponse):
     data: Optional[BillingData] = Field(
         None, description="Response containing token left"
@@ -326,6 +448,19 @@ class BlobInsertResponse(BaseResponse):
     )
 
 
+class BlobsInsertData(IdsData):
+    chat_results: Optional[list[ChatModalResponse]] = Field(
+        None, description="List of chat modal data"
+    )
+
+
+class BlobsInsertResponse(BaseResponse):
+    data: Optional[BlobsInsertData] = Field(
+        None,
+        description="Response containing the inserted blob ids, in the same order as the request",
+    )
+
+
 class ProactiveTopicResponse(BaseResponse):
     data: Optional[ProactiveTopicData] = Field(
         None, description="Response containing proactive topic data"
@@ -89,11 +89,6 @@ Only extract the attributes with actual values, if the user does not provide any
 You need to first think, then extract the facts and preferences from the memo.
 
 
-#### Topics Guidelines
-Below is the list of topics and subtopics that you should focus on collecting and extracting:
-{topic_examples}
-
-
 Remember the following:
 - If the user mentions time-sensitive information, try to infer the specific date from the data.
 - Use specific dates when possible, never use relative dates like "today" or "yesterday" etc.
@@ -103,6 +98,10 @@ Remember the following:
 - Place all content related to this topic/sub_topic in one element, no repeat.
 - The memo will have two types of time, one is the time when the memo is mentioned, the other is the time when the event happened. Both are important, don't mix them up.
 
+#### Topics Guidelines
+Below is the list of topics and subtopics that you should focus on collecting and extracting:
+{topic_examples}
+
 Now perform your task.
 Following is a conversation between the user and the assistant. You have to extract/infer the relevant facts and preferences from the conversation and return them in the list format as shown above.
 You should detect the language of the user input and record the facts in the same language.
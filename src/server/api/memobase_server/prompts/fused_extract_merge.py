@@ -0,0 +1,99 @@
+from ..env import CONFIG
+
+ADD_KWARGS = {
+    "prompt_id": "fused_extract_merge",
+}
+
+DEFAULT_JOB = """You are a professional psychologist.
+Your responsibility is to carefully read out the memo of user, extract the important profiles of user and decide how they are merged into the user's current memos.
+You will not only extract the information that's explicitly stated, but also infer what's implied from the memo.
+You will use the same language as the user's input to record the facts.
+"""
+
+FUSED_PROMPT = """{system_prompt}
+## Input
+#### User Current Memos
+The memos the user already has, one per topic/subtopic:
+- TOPIC{tab}SUB_TOPIC{tab}CURRENT_MEMO
+Use the same topic/subtopic if it's mentioned in the memo again.
+#### Memo
+The new memo of user in Markdown format, summarized from the chats between user and a assistant.
+
+## Your Job
+1. Extract the facts and preferences of the user from the new memo, focus on the topics in #### Topics Guidelines below. Place all content of one topic/subtopic in one item.
+2. For each item, decide how it's merged with the current memo of the same topic/subtopic, following the #### Update Instructions below:
+    - APPEND: the new info brings new insights, or the current memo is empty. It's added as it is.
+    - UPDATE: the new info conflicts with the current memo, or the current memo needs to be rewritten to reflect it. Write the complete updated memo, keep it within 5 sentences.
+    - ABORT: the new info has no value, is already contained in the current memo, or doesn't fit the topic description.
+3. Fill the event tags in #### Event Tags below with the values mentioned in the memo, skip the tags that are not mentioned.
+
+## Output
+Return one JSON object and nothing else:
+```json
+{{
+    "profiles": [
+        {{"topic": "TOPIC", "sub_topic": "SUB_TOPIC", "new_info": "THE EXTRACTED INFO", "action": "APPEND|UPDATE|ABORT", "memo": "THE UPDATED MEMO, ONLY FOR UPDATE"}}
+    ],
+    "event_tags": [
+        {{"tag": "TAG NAME", "value": "TAG VALUE"}}
+    ]
+}}
+```
+For example, if the user current memos are:
+- study{tab}exam_goals{tab}Preparing for midterm exams [mentioned on 2025/04/01]
+and the memo says the user is preparing for final exams and uses Duolingo to learn Japanese, you should return:
+```json
+{{
+    "profiles": [
+        {{"topic": "study", "sub_topic": "exam_goals", "new_info": "Preparing for final exams [mentioned on 2025/06/01]", "action": "UPDATE", "memo": "Preparing for final exams [mentioned on 2025/06/01]"}},
+        {{"topic": "study", "sub_topic": "software_usage", "new_info": "Using Duolingo to self-study Japanese [mentioned on 2025/06/01]", "action": "APPEND"}}
+    ],
+    "event_tags": []
+}}
+```
+
+Remember the following:
+- Use specific dates when possible, never use relative dates like "today" or "yesterday" etc.
+- Preserve time annotations from old and new memos (e.g., XXX[mentioned on 2025/05/05, occurred in 2022]).
+- Never fabricate content not mentioned in the input.
+- Strick to the exact tag names of the event tags.
+- If you do not find anything relevant in the memo, return empty lists.
+
+#### Topics Guidelines
+Topics and subtopics you should focus on collecting, with their descriptions:
+{topic_examples}
+You can create your own topics/sub_topics if you find it necessary, unless the user requests to not to create new topics/sub_topics.
+Don't collect topics that are not related to the user, e.g. the work position of another person.
+#### Update Instructions
+Some subtopics have their own rules for updating the memo, follow them when you update:
+{update_instructions}
+#### Event Tags
+{event_tags}
+"""
+
+
+def pack_input(already_input: str, memo_str: str, strict_mode: bool = False):
+    header = ""
+    if strict_mode:
+        header = "Don't extract topics/subtopics that are not mentioned in #### Topics Guidelines, otherwise your answer is invalid!"
+    return f"""{header}
+#### User Current Memos
+{already_input}
+#### Memo
+{memo_str}
+"""
+
+
+def get_prompt(topic_examples: str, update_instructions: str, event_tags: str) -> str:
+    sys_prompt = CONFIG.system_prompt or DEFAULT_JOB
+    return FUSED_PROMPT.format(
+        system_prompt=sys_prompt,
+        topic_examples=topic_examples,
+        update_instructions=update_instructions or "(none)",
+        event_tags=event_tags or "(no event tags, return an empty list)",
+        tab=CONFIG.llm_tab_separator,
+    )
+
+
+def get_kwargs() -> dict:
+    return ADD_KWARGS
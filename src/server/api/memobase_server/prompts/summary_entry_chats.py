@@ -8,7 +8,6 @@ You will be given a chats between a user and an assistant.
 
 ## Requirement
 - You need to list all possible user info, schedule and events
-- {additional_requirements}
 - If the user event/schedule has specific mention time or event happen time. Convert the event date info in the message based on [TIME] after your log. for example
     Input: `[2024/04/30] user: I bought a new car yesterday!`
     Output: `user bought a new car. [mention 2024/04/30, buy car in 2024/04/29]`
@@ -22,17 +21,6 @@ You will be given a chats between a user and an assistant.
     Output: `user bought a new car.`
     Explain: because you don't know the exact date, so don't attach any date.
 
-### Important Info
-Below is the topics/subtopics you should log from the chats.
-<topics>
-{topics}
-</topics>
-Below is the important attributes you should log from the chats.
-<attributes>
-{attributes}
-</attributes>
-
-
 ## Input Format
 ### Already Logged
 You will receive a list of previous logging result, you should also log the relevant infos that maybe related to those already logged.
@@ -60,6 +48,16 @@ For example:
 Always add specific mention time of your log, and the event happen time if possible.
 Remember, make sure your logging is pure and concise, any time info should move to [TIME INFO] block.
 
+## Important Info
+Below is the topics/subtopics you should log from the chats.
+<topics>
+{topics}
+</topics>
+Below is the important attributes you should log from the chats.
+<attributes>
+{attributes}
+</attributes>
+
 ## Content Requirement
 - You need to list all possible user info, schedule and events
 - {additional_requirements}
@@ -92,10 +92,6 @@ POSSIBLE TOPICS THINKING
 {examples}
 请按上述格式返回事实和偏好。
 
-#### 主题建议
-以下是你应该重点收集和提取的主题和子主题列表：
-{topic_examples}
-
 请记住以下几点：
 - 如果用户提到时间敏感的信息，试图推理出具体的日期。
 - 当可能时，请使用具体日期，而不是使用"今天"或"昨天"等相对时间。
@@ -106,6 +102,10 @@ POSSIBLE TOPICS THINKING
 - 备忘录中会有两种时间，一种是这个备忘录被记录的时间，一种是备忘录中的事件发生的时间, 两种时间都很重要，不要混淆了, 你需要正确的提取时间信息并且在相关的memo后使用时间表示[...]
 - 只提取有实际值的属性，如果用户没有提供任何值，请不要提取。
 
+#### 主题建议
+以下是你应该重点收集和提取的主题和子主题列表：
+{topic_examples}
+
 现在开始执行你的任务。
 以下是用户的备忘录。你需要从中提取/推断相关的事实和偏好，并按上述格式返回。
 你应该检测用户输入的语言，并用相同的语言记录事实。
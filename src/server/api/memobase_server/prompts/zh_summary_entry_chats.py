@@ -8,7 +8,6 @@ SUMMARY_PROMPT = """你是一位从聊天记录中记录个人信息、日程安
 
 ## 要求
 - 你需要列出用户信息和日程安排
-- {additional_requirements}
 - 如果用户事件/日程有具体的提及时间或者事件发生的时间。根据消息中的[TIME]在你提取的事件和日程中补充相关的时间信息。例如：
     输入: `[2024/04/30] user: 我昨天买了一辆新车！`
     输出: `用户买了一辆新车[提及于 2024/04/30, 买车在2024/04/29]。`
@@ -22,16 +21,6 @@ SUMMARY_PROMPT = """你是一位从聊天记录中记录个人信息、日程安
     输出: `用户买了一辆新车。`
     说明: 因为你不知道具体日期，所以不要附加任何日期是错误的答案。
 
-### 重要信息
-以下是你应该从聊天中记录的主题/子主题。
-<topics>
-{topics}
-</topics>
-以下是你应该从聊天中记录的重要属性。
-<attributes>
-{attributes}
-</attributes>
-
 ## 输入格式
 ### 已记录
 你会收到一系列的已记录信息，你留意需要记录可能和已记录信息相关的信息。
@@ -58,6 +47,16 @@ TIME是此消息发生的时间，因此你需要根据TIME转换消息中的日
 始终添加你记录的具体提及时间，如果可能的话也要添加事件发生时间。
 记住，确保你的记录是纯正和简洁的，任何时间信息都应该移动到[TIME INFO]块中。
 
+## 重要信息
+以下是你应该从聊天中记录的主题/子主题。
+<topics>
+{topics}
+</topics>
+以下是你应该从聊天中记录的重要属性。
+<attributes>
+{attributes}
+</attributes>
+
 ## 内容要求
 - 你需要列出用户信息和日程安排
 - {additional_requirements}
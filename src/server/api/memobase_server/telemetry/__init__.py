@@ -1,3 +1,27 @@
-from .open_telemetry import telemetry_manager, CounterMetricName, HistogramMetricName
+from .open_telemetry import (
+    telemetry_manager,
+    CounterMetricName,
+    HistogramMetricName,
+    GaugeMetricName,
+)
+from .tracing import (
+    traced,
+    setup_tracing,
+    shutdown_tracing,
+    tag_current_span,
+    inject_trace_context,
+    continue_trace,
+)
 
-__all__ = ["telemetry_manager", "CounterMetricName", "HistogramMetricName"]
+__all__ = [
+    "telemetry_manager",
+    "CounterMetricName",
+    "HistogramMetricName",
+    "GaugeMetricName",
+    "traced",
+    "setup_tracing",
+    "shutdown_tracing",
+    "tag_current_span",
+    "inject_trace_context",
+    "continue_trace",
+]
@@ -1,6 +1,18 @@
+"""
+Usage counters of the projects, per day and per month, in Redis.
+
+`capture_int_key` is called on every insert and after every LLM call, so the
+increments are added up in memory and `TELEMETRY_COUNTERS` writes them in one
+pipelined transaction every `telemetry_flush_interval` seconds. The counters
+are eventually consistent, reads can miss the last interval of this process.
+Processes that don't run the flush loop (scripts, tests) write through.
+"""
+
+import asyncio
 from datetime import datetime, timedelta
 from ..connectors import get_redis_client, PROJECT_ID
 from ..models.database import DEFAULT_PROJECT_ID
+from ..env import CONFIG, LOG
 
 
 def date_key():
@@ -19,37 +31,110 @@ def head_key(project_id: str):
     return f"memobase_telemetry::{PROJECT_ID}::{project_id}"
 
 
+def int_key(name: str, project_id: str, period: str) -> str:
+    """`period` is a `date_key` or a `month_key`"""
+    return f"{head_key(project_id)}::{name}::{period}"
+
+
+class TelemetryCounters:
+    def __init__(self, interval: float):
+        self.interval = interval
+        # key -> (increment, expire seconds)
+        self.pending: dict[str, tuple[int, int]] = {}
+        self._running = False
+        self._stopped = asyncio.Event()
+
+    def add(self, key: str, value: int, expire_seconds: int):
+        count, _ = self.pending.get(key, (0, expire_seconds))
+        self.pending[key] = (count + value, expire_seconds)
+
+    async def write(self, counts: dict[str, tuple[int, int]]):
+        async with get_redis_client() as r_c:
+            async with r_c.pipeline(transaction=True) as pipe:
+                for key, (value, expire_seconds) in counts.items():
+                    pipe.incrby(key, value)
+                    pipe.expire(key, expire_seconds)
+                await pipe.execute()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        counts, self.pending = self.pending, {}
+        try:
+            await self.write(counts)
+        except Exception as e:
+            # keep them for the next flush, the counts must not be lost
+            LOG.warning(f"Failed to write {len(counts)} telemetry counters: {e}")
+            for key, (value, expire_seconds) in counts.items():
+                self.add(key, value, expire_seconds)
+
+    async def capture(self, counts: dict[str, tuple[int, int]]):
+        if self._running:
+            for key, (value, expire_seconds) in counts.items():
+                self.add(key, value, expire_seconds)
+            return
+        await self.write(counts)
+
+    async def run(self):
+        if self.interval <= 0:
+            return
+        self._running = True
+        self._stopped.clear()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                await self.flush()
+        finally:
+            self._running = False
+
+    async def stop(self):
+        """Write what's left, called before closing the connections"""
+        self._stopped.set()
+        await self.flush()
+
+
+TELEMETRY_COUNTERS = TelemetryCounters(CONFIG.telemetry_flush_interval)
+
+
+async def capture_int_keys(
+    values: dict[str, int],
+    expire_days: int = 14,
+    project_id: str = DEFAULT_PROJECT_ID,
+):
+    counts = {}
+    for name, value in values.items():
+        counts[int_key(name, project_id, date_key())] = (
+            value,
+            expire_days * 24 * 60 * 60,
+        )
+        counts[int_key(name, project_id, month_key())] = (
+            value,
+            30 * expire_days * 24 * 60 * 60,
+        )
+    await TELEMETRY_COUNTERS.capture(counts)
+
+
 async def capture_int_key(
     name: str,
     value: int = 1,
     expire_days: int = 14,
     project_id: str = DEFAULT_PROJECT_ID,
 ):
-    key = f"{head_key(project_id)}::{name}::{date_key()}"
-    key_month = f"{head_key(project_id)}::{name}::{month_key()}"
-    async with get_redis_client() as r_c:
-        await r_c.incrby(key, value)
-        await r_c.incrby(key_month, value)
-        await r_c.expire(key, expire_days * 24 * 60 * 60)
-        await r_c.expire(key_month, 30 * expire_days * 24 * 60 * 60)
+    await capture_int_keys({name: value}, expire_days, project_id)
 
 
-async def get_int_key(
-    name: str,
-    project_id: str = DEFAULT_PROJECT_ID,
-    in_month: bool = False,
-    use_date: str = None,
-) -> int:
-    if in_month:
-        key = f"{head_key(project_id)}::{name}::{month_key()}"
-    else:
-        using_date = use_date or date_key()
-        key = f"{head_key(project_id)}::{name}::{using_date}"
+async def get_int_keys(
+    names: list[str], project_id: str, periods: list[str]
+) -> dict[tuple[str, str], int]:
+    """Counters of every name in every period, in one MGET"""
+    pairs = [(name, period) for period in periods for name in names]
     async with get_redis_client() as r_c:
-        return int((await r_c.get(key)) or 0)
+        values = await r_c.mget([int_key(n, project_id, p) for n, p in pairs])
+    return {pair: int(v or 0) for pair, v in zip(pairs, values)}
 
 
 if __name__ == "__main__":
-    import asyncio
-
     print(asyncio.run(capture_int_key("test_key")))
@@ -1,6 +1,7 @@
 from enum import Enum
 from typing import Dict
 import os
+import errno
 import socket
 from prometheus_client import start_http_server
 from opentelemetry import metrics
@@ -36,6 +37,10 @@ class CounterMetricName(Enum):
     LLM_TOKENS_INPUT = "llm_input_tokens_total"
     LLM_TOKENS_OUTPUT = "llm_output_tokens_total"
     EMBEDDING_TOKENS = "embedding_tokens_total"
+    EMBEDDING_CACHE_HIT = "embedding_cache_hits_total"
+    EMBEDDING_CACHE_MISS = "embedding_cache_misses_total"
+    LLM_RATE_LIMITED = "llm_rate_limited_total"
+    LLM_TOKENS_INPUT_CACHED = "llm_cached_input_tokens_total"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
@@ -46,6 +51,10 @@ class CounterMetricName(Enum):
             CounterMetricName.LLM_TOKENS_INPUT: "Total number of input tokens",
             CounterMetricName.LLM_TOKENS_OUTPUT: "Total number of output tokens",
             CounterMetricName.EMBEDDING_TOKENS: "Total number of embedding tokens",
+            CounterMetricName.EMBEDDING_CACHE_HIT: "Total number of embedding cache hits, by tier",
+            CounterMetricName.EMBEDDING_CACHE_MISS: "Total number of embedding cache misses",
+            CounterMetricName.LLM_RATE_LIMITED: "Total number of LLM calls rejected by the provider with 429",
+            CounterMetricName.LLM_TOKENS_INPUT_CACHED: "Total number of input tokens served from the provider's prompt cache, by prompt",
         }
         return descriptions[self]
 
@@ -80,12 +89,18 @@ class GaugeMetricName(Enum):
 
     INPUT_TOKEN_COUNT = "input_token_count_per_call"
     OUTPUT_TOKEN_COUNT = "output_token_count_per_call"
+    LLM_RATE_LIMIT_QUEUE_DEPTH = "llm_rate_limit_queue_depth"
+    LLM_PROMPT_CACHE_HIT_RATIO = "llm_prompt_cache_hit_ratio"
+    LLM_PROMPT_FINGERPRINTS = "llm_prompt_fingerprints"
 
     def get_description(self) -> str:
         """Get the description for this metric."""
         descriptions = {
             GaugeMetricName.INPUT_TOKEN_COUNT: "Number of input tokens per call",
             GaugeMetricName.OUTPUT_TOKEN_COUNT: "Number of output tokens per call",
+            GaugeMetricName.LLM_RATE_LIMIT_QUEUE_DEPTH: "Number of LLM calls waiting for the rate limiter",
+            GaugeMetricName.LLM_PROMPT_CACHE_HIT_RATIO: "Share of input tokens served from the provider's prompt cache, by prompt",
+            GaugeMetricName.LLM_PROMPT_FINGERPRINTS: "Number of distinct system prompts seen, by prompt",
         }
         return descriptions[self]
 
@@ -124,20 +139,22 @@ class TelemetryManager:
         provider = MeterProvider(resource=resource, metric_readers=[reader])
         metrics.set_meter_provider(provider)
 
-        # Start Prometheus HTTP server, skip if port is already in use
+        # Initialize meter
+        self._meter = metrics.get_meter(self._service_name)
+
+    def start_prometheus_server(self) -> None:
+        """Serve the metrics, called by the long-running processes on startup, not on import"""
+        # skip if port is already in use
         try:
             start_http_server(self._prometheus_port)
         except OSError as e:
-            if e.errno == 48:  # Address already in use
+            if e.errno == errno.EADDRINUSE:
                 LOG.warning(
                     f"Prometheus HTTP server already running on port {self._prometheus_port}"
                 )
             else:
                 raise e
 
-        # Initialize meter
-        self._meter = metrics.get_meter(self._service_name)
-
     def _construct_attributes(self, **kwargs) -> Dict[str, str]:
 
         # if os.environ.get("POD_IP"):
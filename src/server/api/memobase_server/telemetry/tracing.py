@@ -0,0 +1,215 @@
+"""
+Request-scoped tracing with OpenTelemetry.
+
+Spans cover the LLM calls, the embedding calls, every DB query, the Redis
+caches of the context path and each stage of the flush pipeline. The server
+span of a request carries its `X-Request-ID`, and background flushes continue
+the trace of the request that enqueued the buffers.
+
+Tracing is off unless `tracing_exporter` is set:
+
+- `otlp` sends the spans to an OTLP/HTTP collector at `tracing_otlp_endpoint`,
+  it needs `opentelemetry-exporter-otlp-proto-http` installed,
+- `file` appends them to `tracing_file_path`, one JSON span per line.
+"""
+
+import os
+import inspect
+import structlog
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional
+from opentelemetry import trace, propagate
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource, DEPLOYMENT_ENVIRONMENT
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SpanExporter,
+    SpanProcessor,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from sqlalchemy import Engine, event
+from ..env import CONFIG, LOG
+
+TRACER = trace.get_tracer("memobase_server")
+# checked before creating a span, so disabled tracing costs nothing
+TRACING_ENABLED = False
+MAX_STATEMENT_SIZE = 2048
+# the request id travels with the trace context into background flushes
+REQUEST_ID_CARRIER_KEY = "x-request-id"
+
+_tracer_provider: Optional[TracerProvider] = None
+
+
+def get_span_exporter() -> SpanExporter:
+    if CONFIG.tracing_exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+        except ImportError as e:
+            raise RuntimeError(
+                "`tracing_exporter: otlp` needs `opentelemetry-exporter-otlp-proto-http`"
+            ) from e
+        return OTLPSpanExporter(endpoint=CONFIG.tracing_otlp_endpoint)
+    return ConsoleSpanExporter(
+        out=open(CONFIG.tracing_file_path, "a"),
+        formatter=lambda span: span.to_json(indent=None) + os.linesep,
+    )
+
+
+def setup_tracing(span_processor: SpanProcessor = None) -> None:
+    """Start exporting spans, called by the long-running processes on startup"""
+    global TRACING_ENABLED, _tracer_provider
+    if TRACING_ENABLED:
+        return
+    if span_processor is None:
+        if CONFIG.tracing_exporter is None:
+            return
+        span_processor = BatchSpanProcessor(get_span_exporter())
+    _tracer_provider = TracerProvider(
+        resource=Resource(
+            attributes={
+                SERVICE_NAME: "memobase-server",
+                DEPLOYMENT_ENVIRONMENT: CONFIG.telemetry_deployment_environment,
+            }
+        ),
+        sampler=ParentBased(TraceIdRatioBased(CONFIG.tracing_sample_ratio)),
+    )
+    _tracer_provider.add_span_processor(span_processor)
+    trace.set_tracer_provider(_tracer_provider)
+    instrument_db_queries()
+    TRACING_ENABLED = True
+    LOG.info(f"Tracing enabled, exporting to {CONFIG.tracing_exporter}")
+
+
+def shutdown_tracing() -> None:
+    """Flush the spans that are still buffered"""
+    if _tracer_provider is not None:
+        _tracer_provider.shutdown()
+
+
+def set_span_result(span: trace.Span, result) -> None:
+    # controllers report errors as rejected promises, not exceptions
+    ok = getattr(result, "ok", None)
+    if callable(ok) and not ok():
+        span.set_status(Status(StatusCode.ERROR, result.msg()))
+
+
+def traced(name: str):
+    """Run the decorated coroutine function in a span.
+
+    `project_id`/`user_id` arguments become span attributes, and a rejected
+    `Promise` marks the span as failed.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        attribute_args = [
+            arg for arg in ("project_id", "user_id") if arg in signature.parameters
+        ]
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not TRACING_ENABLED:
+                return await func(*args, **kwargs)
+            attributes = {}
+            if attribute_args:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                for arg in attribute_args:
+                    if bound.get(arg) is not None:
+                        attributes[f"memobase.{arg}"] = str(bound[arg])
+            with TRACER.start_as_current_span(name, attributes=attributes) as span:
+                result = await func(*args, **kwargs)
+                set_span_result(span, result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement else "QUERY"
+    context._memobase_span = TRACER.start_span(
+        f"db {operation}",
+        kind=SpanKind.CLIENT,
+        attributes={
+            "db.system": "postgresql",
+            "db.operation": operation,
+            "db.statement": statement[:MAX_STATEMENT_SIZE],
+        },
+    )
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, "_memobase_span", None)
+    if span is not None:
+        if cursor is not None and cursor.rowcount is not None:
+            span.set_attribute("db.rowcount", cursor.rowcount)
+        span.end()
+
+
+def _handle_error(exception_context):
+    span = getattr(exception_context.execution_context, "_memobase_span", None)
+    if span is not None:
+        span.record_exception(exception_context.original_exception)
+        span.set_status(
+            Status(StatusCode.ERROR, str(exception_context.original_exception))
+        )
+        span.end()
+
+
+def instrument_db_queries() -> None:
+    """A span for every statement of every engine, async engines included"""
+    if event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+
+def tag_current_span(**attributes) -> None:
+    """Set `memobase.*` attributes on the current span, e.g. the server span of a request"""
+    span = trace.get_current_span()
+    if not span.is_recording():
+        return
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if not isinstance(value, (str, bool, int, float)):
+            value = str(value)
+        span.set_attribute(f"memobase.{key}", value)
+
+
+def inject_trace_context() -> dict[str, str]:
+    """Carrier of the current trace context and request id, for queued work"""
+    carrier = {}
+    propagate.inject(carrier)
+    request_id = structlog.contextvars.get_contextvars().get("request_id")
+    if request_id is not None:
+        carrier[REQUEST_ID_CARRIER_KEY] = request_id
+    return carrier
+
+
+@contextmanager
+def continue_trace(name: str, carrier: dict[str, str] | None, **attributes):
+    """Span in the trace of the request that queued the work, its request id is bound to the logs"""
+    carrier = carrier or {}
+    with structlog.contextvars.bound_contextvars(
+        request_id=carrier.get(REQUEST_ID_CARRIER_KEY)
+    ):
+        if not TRACING_ENABLED:
+            yield
+            return
+        with TRACER.start_as_current_span(
+            name, context=propagate.extract(carrier), kind=SpanKind.CONSUMER
+        ):
+            tag_current_span(
+                request_id=carrier.get(REQUEST_ID_CARRIER_KEY), **attributes
+            )
+            yield
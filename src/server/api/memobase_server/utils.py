@@ -1,11 +1,13 @@
 import re
+import hashlib
 import yaml
 import json
 from typing import cast
 from datetime import timezone, datetime
 from functools import wraps
+from collections import OrderedDict
 from pydantic import ValidationError
-from .env import ENCODER, LOG, CONFIG, ProfileConfig
+from .env import LOG, CONFIG, ProfileConfig, get_encoder
 from .models.blob import (
     Blob,
     BlobType,
@@ -65,6 +67,37 @@ def event_embedding_str(event_data: EventData) -> str:
     return r
 
 
+class LRUCache:
+    """Bounded in-process LRU, not shared between workers"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
 def load_json_or_none(content: str) -> dict | None:
     try:
         return json.loads(content)
@@ -85,11 +118,41 @@ def find_list_int_or_none(content: str) -> list[int] | None:
 
 
 def get_encoded_tokens(content: str) -> list[int]:
-    return ENCODER.encode(content)
+    return get_encoder().encode(content)
+
+
+TOKEN_COUNT_CACHE = LRUCache(CONFIG.token_count_cache_size)
+
+
+def count_tokens(content: str, cache: bool = True) -> int:
+    """Token count of `content`, memoized by content hash.
+
+    Pass `cache=False` for one-off strings (LLM prompts/outputs) so they don't
+    evict the stored contents that are counted over and over.
+    """
+    if not content:
+        return 0
+    if not cache:
+        return len(get_encoder().encode_ordinary(content))
+    key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+    size = TOKEN_COUNT_CACHE.get(key)
+    if size is None:
+        size = len(get_encoder().encode_ordinary(content))
+        TOKEN_COUNT_CACHE.set(key, size)
+    return size
+
+
+def profile_str_repr(content: str, attributes: dict | None) -> str:
+    attributes = attributes or {}
+    return f"{attributes.get('topic')}::{attributes.get('sub_topic')}: {content}"
+
+
+def get_profile_token_size(content: str, attributes: dict | None) -> int:
+    return count_tokens(profile_str_repr(content, attributes))
 
 
 def get_decoded_tokens(tokens: list[int]) -> str:
-    return ENCODER.decode(tokens)
+    return get_encoder().decode(tokens)
 
 
 def truncate_string(content: str, max_tokens: int) -> str:
@@ -151,7 +214,7 @@ def get_blob_str(blob: Blob):
 
 
 def get_blob_token_size(blob: Blob):
-    return len(get_encoded_tokens(get_blob_str(blob)))
+    return count_tokens(get_blob_str(blob), cache=False)
 
 
 def seconds_from_now(dt: datetime):
@@ -0,0 +1,261 @@
+"""
+Flush worker pool shared by all users.
+
+`flush_buffer_by_ids_in_background` claims the buffers, pushes them to the
+user's buffer queue and marks the user as pending. The pool picks pending
+users and drains their queues with `flush_buffer_background_running`:
+
+- at most `flush_worker_concurrency` flushes run at once, across all the
+  worker pools sharing this Redis: each flush holds a slot of a Redis
+  semaphore, and a crashed process frees its slots after `FLUSH_SLOT_TTL_S`,
+- projects with pending users take turns, so one busy project can't hold
+  every slot,
+- inside a project, the user with the most pending tokens goes first.
+
+It runs inside the API process (`flush_worker_mode: in_process`), or alone
+with `flush_worker_mode: external`:
+
+    python -m memobase_server.worker
+"""
+
+import uuid
+import signal
+import asyncio
+import bisect
+import traceback
+import redis.exceptions as redis_exceptions
+from .env import CONFIG, LOG, TRACE_LOG
+from .models.blob import BlobType
+from .connectors import (
+    PROJECT_ID,
+    get_redis_client,
+    init_redis_pool,
+    close_connection,
+)
+from .migrate import ensure_schema
+from .telemetry import telemetry_manager, setup_tracing, shutdown_tracing
+from .telemetry.capture_key import TELEMETRY_COUNTERS
+from .controllers.billing import run_billing_reconciler
+from .controllers.buffer_background import (
+    FLUSH_PENDING_EVENT,
+    FLUSH_PENDING_PROJECTS_KEY,
+    flush_buffer_background_running,
+    get_flush_pending_key,
+    get_user_buffer_queue_key,
+    schedule_user_flush,
+    unpack_flush_job,
+)
+
+# other processes wake this one up through Redis only, so poll as well
+POLL_INTERVAL_S = 1
+
+# KEYS: project pending set, pending projects. ARGV: project id
+POP_PENDING_SCRIPT = """
+local job = redis.call('ZPOPMAX', KEYS[1])
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+return job[1]
+"""
+
+# running flushes of all processes, scored by the expiry of their slot
+FLUSH_SLOTS_KEY = f"memobase:flush_slots:{PROJECT_ID}"
+FLUSH_SLOT_TTL_S = 60
+
+# KEYS: flush slots. ARGV: limit, slot, ttl
+ACQUIRE_SLOT_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+return 1
+"""
+
+# KEYS: flush slots. ARGV: slot, ttl
+REFRESH_SLOT_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+
+class FlushWorker:
+    def __init__(self, concurrency: int, drain_timeout: float):
+        self.concurrency = concurrency
+        self.drain_timeout = drain_timeout
+        self._running: set[asyncio.Task] = set()
+        self._last_project: str = ""
+        self._stopping = False
+
+    async def next_job(self) -> tuple[str, str, BlobType] | None:
+        async with get_redis_client() as redis_client:
+            projects = sorted(await redis_client.smembers(FLUSH_PENDING_PROJECTS_KEY))
+            # round-robin: start after the project served last
+            start = bisect.bisect_right(projects, self._last_project)
+            for project_id in projects[start:] + projects[:start]:
+                job = await redis_client.eval(
+                    POP_PENDING_SCRIPT,
+                    2,
+                    get_flush_pending_key(project_id),
+                    FLUSH_PENDING_PROJECTS_KEY,
+                    project_id,
+                )
+                if job is not None:
+                    self._last_project = project_id
+                    user_id, blob_type = unpack_flush_job(job)
+                    return user_id, project_id, blob_type
+        return None
+
+    async def acquire_slot(self) -> str | None:
+        """Take a slot of the global flush semaphore, None if all are taken"""
+        slot = str(uuid.uuid4())
+        async with get_redis_client() as redis_client:
+            acquired = await redis_client.eval(
+                ACQUIRE_SLOT_SCRIPT,
+                1,
+                FLUSH_SLOTS_KEY,
+                self.concurrency,
+                slot,
+                FLUSH_SLOT_TTL_S,
+            )
+        return slot if acquired else None
+
+    async def keep_slot(self, slot: str):
+        while True:
+            await asyncio.sleep(FLUSH_SLOT_TTL_S / 3)
+            try:
+                async with get_redis_client() as redis_client:
+                    await redis_client.eval(
+                        REFRESH_SLOT_SCRIPT, 1, FLUSH_SLOTS_KEY, slot, FLUSH_SLOT_TTL_S
+                    )
+            except redis_exceptions.RedisError as e:
+                LOG.warning(f"Flush worker can't refresh its slot: {e}")
+
+    async def release_slot(self, slot: str):
+        try:
+            async with get_redis_client() as redis_client:
+                await redis_client.zrem(FLUSH_SLOTS_KEY, slot)
+        except redis_exceptions.RedisError as e:
+            # it expires after FLUSH_SLOT_TTL_S
+            LOG.warning(f"Flush worker can't release its slot: {e}")
+
+    async def flush_in_slot(
+        self, slot: str, user_id: str, project_id: str, blob_type: BlobType
+    ):
+        keeper = asyncio.create_task(self.keep_slot(slot))
+        try:
+            await self.flush(user_id, project_id, blob_type)
+        finally:
+            keeper.cancel()
+            await self.release_slot(slot)
+
+    async def flush(self, user_id: str, project_id: str, blob_type: BlobType):
+        try:
+            ran = await flush_buffer_background_running(user_id, project_id, blob_type)
+            if not ran:
+                # the lock holder checks the queue again after releasing it
+                return
+            async with get_redis_client() as redis_client:
+                left = await redis_client.llen(
+                    get_user_buffer_queue_key(
+                        user_id, project_id, f"flush_buffer_background_{blob_type}"
+                    )
+                )
+            if left:
+                await schedule_user_flush(user_id, project_id, blob_type, 0)
+        except asyncio.CancelledError:
+            # keep the queue reachable for the next worker
+            await schedule_user_flush(user_id, project_id, blob_type, 0)
+            raise
+        except Exception as e:
+            TRACE_LOG.error(
+                project_id,
+                user_id,
+                f"[worker] Error flushing {blob_type} buffer: {e}\n{traceback.format_exc()}",
+            )
+
+    async def run(self):
+        LOG.info(f"Flush worker started, concurrency: {self.concurrency}")
+        while not self._stopping:
+            if len(self._running) >= self.concurrency:
+                await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            # cleared before looking, so a job scheduled meanwhile wakes us up
+            FLUSH_PENDING_EVENT.clear()
+            slot = None
+            try:
+                slot = await self.acquire_slot()
+                if slot is None:
+                    # other pools hold the slots, they only free them through Redis
+                    if self._running:
+                        await asyncio.wait(
+                            self._running,
+                            timeout=POLL_INTERVAL_S,
+                            return_when=asyncio.FIRST_COMPLETED,
+                        )
+                    else:
+                        await asyncio.sleep(POLL_INTERVAL_S)
+                    continue
+                job = await self.next_job()
+            except redis_exceptions.RedisError as e:
+                LOG.warning(f"Flush worker can't read pending users, retrying: {e}")
+                if slot is not None:
+                    await self.release_slot(slot)
+                await asyncio.sleep(POLL_INTERVAL_S)
+                continue
+            if job is None:
+                await self.release_slot(slot)
+                try:
+                    await asyncio.wait_for(FLUSH_PENDING_EVENT.wait(), POLL_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self.flush_in_slot(slot, *job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def stop(self):
+        """Stop taking jobs and wait up to `drain_timeout` for the running ones"""
+        self._stopping = True
+        FLUSH_PENDING_EVENT.set()
+        if not self._running:
+            return
+        LOG.info(f"Flush worker draining {len(self._running)} flushes")
+        _, pending = await asyncio.wait(self._running, timeout=self.drain_timeout)
+        if pending:
+            LOG.warning(f"Flush worker cancelled {len(pending)} unfinished flushes")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+FLUSH_WORKER = FlushWorker(
+    CONFIG.flush_worker_concurrency, CONFIG.flush_worker_drain_timeout
+)
+
+
+async def main():
+    init_redis_pool()
+    telemetry_manager.start_prometheus_server()
+    setup_tracing()
+    await asyncio.to_thread(ensure_schema)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    worker_task = asyncio.create_task(FLUSH_WORKER.run())
+    telemetry_counters = asyncio.create_task(TELEMETRY_COUNTERS.run())
+    billing_reconciler = asyncio.create_task(run_billing_reconciler())
+    await stop.wait()
+    await FLUSH_WORKER.stop()
+    await worker_task
+    billing_reconciler.cancel()
+    await TELEMETRY_COUNTERS.stop()
+    await telemetry_counters
+    await close_connection()
+    shutdown_tracing()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,4 @@
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -5,6 +6,7 @@ from sqlalchemy import pool
 
 from alembic import context
 from memobase_server.models.database import REG
+from memobase_server.migrate import SCHEMA_STATE
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -19,7 +21,7 @@ if config.config_file_name is not None:
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
-target_metadata = [REG.metadata]
+target_metadata = [REG.metadata, SCHEMA_STATE.metadata]
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -39,7 +41,7 @@ def run_migrations_offline() -> None:
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
+    url = os.getenv("DATABASE_URL") or config.get_main_option("sqlalchemy.url")
     context.configure(
         url=url,
         target_metadata=target_metadata,
@@ -58,8 +60,19 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    # `python -m memobase_server.migrate` passes its own connection
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
+    section = config.get_section(config.config_ini_section, {})
+    if os.getenv("DATABASE_URL"):
+        section["sqlalchemy.url"] = os.getenv("DATABASE_URL")
     connectable = engine_from_config(
-        config.get_section(config.config_ini_section, {}),
+        section,
         prefix="sqlalchemy.",
         poolclass=pool.NullPool,
     )
@@ -0,0 +1,31 @@
+"""baseline
+
+The tables up to this revision are created by `create_tables` in
+`memobase_server.migrate`, which runs before the revisions. Later changes that
+`create_tables` can't make (non-nullable columns, type changes, data
+migrations) go in revisions on top of this one.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    pass
+
+
+def downgrade() -> None:
+    pass
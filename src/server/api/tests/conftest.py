@@ -1,7 +1,13 @@
 import pytest
 import pytest_asyncio
+import redis.exceptions as redis_exceptions
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine
 from api import app
+from memobase_server import connectors
 from memobase_server.env import CONFIG
+from memobase_server.migrate import ensure_schema
 from fastapi.testclient import TestClient
 
 PREFIX = "/api/v1"
@@ -14,6 +20,27 @@ CONFIG.event_tags = [
 CONFIG.enable_event_embedding = True
 CONFIG.persistent_chat_blobs = True
 CONFIG.llm_api_key = None
+# TestClient doesn't run the lifespan, so flush in the request's background tasks
+CONFIG.flush_worker_mode = "background"
+
+# asyncpg connections are bound to the event loop that opened them, and
+# TestClient/pytest-asyncio run a new loop per request/test, so don't pool them.
+connectors.DB_ASYNC_ENGINE = create_async_engine(
+    connectors.get_async_database_url(connectors.DATABASE_URL), poolclass=NullPool
+)
+connectors.AsyncSession.configure(bind=connectors.DB_ASYNC_ENGINE)
+
+
+# TestClient doesn't run the lifespan, so migrate the test database here
+@pytest.fixture(scope="session", autouse=True)
+def db_schema():
+    try:
+        ensure_schema()
+    except OperationalError:
+        # no database, `db_env` skips the tests that need it
+        pass
+    yield
+
 # @pytest.fixture(scope="session")
 # def event_loop():
 #     try:
@@ -33,3 +60,14 @@ async def db_env():
         yield
     else:
         pytest.skip("Database not available")
+
+
+@pytest_asyncio.fixture(scope="function")
+async def redis_env():
+    """For the tests that only need Redis, not the database"""
+    try:
+        async with connectors.get_redis_client() as client:
+            await client.ping()
+    except redis_exceptions.RedisError:
+        pytest.skip("Redis not available")
+    yield
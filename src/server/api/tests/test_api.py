@@ -1,10 +1,20 @@
 import os
+import gzip
+import json
+import uuid
 import pytest
+import asyncio
+import contextvars
+import structlog
 import numpy as np
 from unittest.mock import patch, Mock, AsyncMock
+from opentelemetry.trace import SpanKind
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
 from api import app
 from fastapi.testclient import TestClient
 from memobase_server import controllers
+from memobase_server.telemetry import tracing
 from memobase_server.models.database import DEFAULT_PROJECT_ID
 from memobase_server.models.blob import BlobType
 import numpy as np
@@ -224,6 +234,181 @@ def test_blob_api_curd(client, db_env):
     assert d["errno"] == 0
 
 
+def test_blob_api_batch_insert(client, db_env):
+    u_ids = []
+    for _ in range(2):
+        response = client.post(f"{PREFIX}/users", json={})
+        u_ids.append(response.json()["data"]["id"])
+
+    blobs = [
+        {
+            "user_id": u_ids[i % 2],
+            "blob_type": "doc",
+            "blob_data": {"content": f"Hello world {i}"},
+            "fields": {"index": i},
+        }
+        for i in range(5)
+    ]
+    response = client.post(f"{PREFIX}/blobs/insert", json={"blobs": blobs})
+    d = response.json()
+    assert response.status_code == 200
+    assert d["errno"] == 0
+    b_ids = d["data"]["ids"]
+    assert len(b_ids) == 5
+
+    # ids come back in request order
+    for i, b_id in enumerate(b_ids):
+        response = client.get(f"{PREFIX}/blobs/{u_ids[i % 2]}/{b_id}")
+        d = response.json()
+        assert d["errno"] == 0
+        assert d["data"]["blob_data"]["content"] == f"Hello world {i}"
+
+    response = client.get(f"{PREFIX}/users/blobs/{u_ids[0]}/{BlobType.doc}?page_size=10")
+    assert len(response.json()["data"]["ids"]) == 3
+
+    # unknown users fail the whole batch
+    response = client.post(
+        f"{PREFIX}/blobs/insert",
+        json={"blobs": [blobs[0], {**blobs[1], "user_id": str(uuid.uuid4())}]},
+    )
+    d = response.json()
+    assert d["errno"] != 0
+    response = client.get(f"{PREFIX}/users/blobs/{u_ids[0]}/{BlobType.doc}?page_size=10")
+    assert len(response.json()["data"]["ids"]) == 3
+
+    for u_id in u_ids:
+        client.delete(f"{PREFIX}/users/{u_id}")
+
+
+@pytest.mark.asyncio
+async def test_api_keyset_pagination(client, db_env):
+    # the ids share a prefix, so searching it only returns the users of this test
+    prefix = uuid.uuid4().hex[:8]
+    u_ids = [f"{prefix}-0000-4000-8000-{i:012d}" for i in range(5)]
+    for u_id in u_ids:
+        response = client.post(f"{PREFIX}/users", json={"id": u_id})
+        assert response.json()["errno"] == 0
+
+    with patch.object(CONFIG, "enable_event_embedding", False):
+        for i, u_id in enumerate(u_ids[1:], start=1):
+            p = await controllers.profile.add_user_profiles(
+                u_id,
+                DEFAULT_PROJECT_ID,
+                [f"user fact {j}" for j in range(i)],
+                [{"topic": "fact", "sub_topic": f"fact_{j}"} for j in range(i)],
+            )
+            assert p.ok()
+        p = await controllers.profile.delete_user_profile(
+            u_ids[4], DEFAULT_PROJECT_ID, p.data().ids[0]
+        )
+        assert p.ok()
+        event_ids = []
+        for i in range(3):
+            p = await controllers.event.append_user_event(
+                u_ids[0], DEFAULT_PROJECT_ID, {"event_tip": f"- went hiking {i}"}
+            )
+            assert p.ok()
+            event_ids.append(str(p.data()))
+        p = await controllers.event.delete_user_event(
+            u_ids[0], DEFAULT_PROJECT_ID, event_ids[0]
+        )
+        assert p.ok()
+
+    def list_users(**params):
+        users, counts, cursor = [], [], None
+        while True:
+            query = {"search": prefix, "limit": 2, **params}
+            if cursor is not None:
+                query["cursor"] = cursor
+            d = client.get(f"{PREFIX}/project/users", params=query).json()
+            assert d["errno"] == 0
+            users.extend(d["data"]["users"])
+            counts.append(d["data"]["count"])
+            cursor = d["data"]["next_cursor"]
+            if cursor is None:
+                return users, counts
+
+    users, counts = list_users(order_by="profile_count", order_desc=True)
+    assert [(u["id"], u["profile_count"]) for u in users] == [
+        (u_ids[4], 3),
+        (u_ids[3], 3),
+        (u_ids[2], 2),
+        (u_ids[1], 1),
+        (u_ids[0], 0),
+    ]
+    assert counts == [5, None, None]
+    users, _ = list_users(order_by="event_count", order_desc=False)
+    assert [(u["id"], u["event_count"]) for u in users] == [
+        (u_id, 0) for u_id in u_ids[1:]
+    ] + [(u_ids[0], 2)]
+    # counting profiles and events doesn't touch updated_at
+    users, _ = list_users(order_by="updated_at", order_desc=True)
+    assert [u["id"] for u in users] == u_ids[::-1]
+
+    # offset still works
+    d = client.get(
+        f"{PREFIX}/project/users",
+        params={"search": prefix, "limit": 2, "offset": 4, "order_desc": False},
+    ).json()
+    assert [u["id"] for u in d["data"]["users"]] == [u_ids[4]]
+    assert d["data"]["next_cursor"] is None
+    # the search is a prefix match and LIKE wildcards are escaped
+    d = client.get(f"{PREFIX}/project/users", params={"search": "%"}).json()
+    assert d["data"]["users"] == [] and d["data"]["count"] == 0
+    d = client.get(f"{PREFIX}/project/users", params={"search": prefix[1:]}).json()
+    assert d["data"]["users"] == []
+
+    d = client.get(
+        f"{PREFIX}/project/users",
+        params={"search": prefix, "limit": 2, "order_by": "profile_count"},
+    ).json()
+    cursor = d["data"]["next_cursor"]
+    for bad_params in (
+        {"cursor": cursor, "order_by": "updated_at"},
+        {"cursor": "not-a-cursor"},
+    ):
+        d = client.get(f"{PREFIX}/project/users", params=bad_params).json()
+        assert d["errno"] != 0
+
+    # blobs of one batch share created_at, the cursor breaks the tie by id
+    response = client.post(
+        f"{PREFIX}/blobs/insert",
+        json={
+            "blobs": [
+                {
+                    "user_id": u_ids[0],
+                    "blob_type": "doc",
+                    "blob_data": {"content": f"Hello world {i}"},
+                }
+                for i in range(5)
+            ]
+        },
+    )
+    b_ids = response.json()["data"]["ids"]
+    ids, cursor = [], None
+    while True:
+        url = f"{PREFIX}/users/blobs/{u_ids[0]}/{BlobType.doc}?page_size=2"
+        if cursor is not None:
+            url += f"&cursor={cursor}"
+        d = client.get(url).json()
+        assert d["errno"] == 0
+        ids.extend(d["data"]["ids"])
+        cursor = d["data"]["next_cursor"]
+        if cursor is None:
+            break
+    assert sorted(ids) == sorted(b_ids)
+
+    d = client.get(f"{PREFIX}/users/event/{u_ids[0]}?topk=1").json()
+    assert [e["id"] for e in d["data"]["events"]] == [event_ids[2]]
+    cursor = d["data"]["next_cursor"]
+    d = client.get(f"{PREFIX}/users/event/{u_ids[0]}?topk=1&cursor={cursor}").json()
+    assert [e["id"] for e in d["data"]["events"]] == [event_ids[1]]
+    assert d["data"]["next_cursor"] is None
+
+    for u_id in u_ids:
+        client.delete(f"{PREFIX}/users/{u_id}")
+
+
 @pytest.mark.asyncio
 async def test_api_user_profile(client, db_env):
     response = client.post(f"{PREFIX}/users", json={"data": {"test": 1}})
@@ -275,6 +460,44 @@ async def test_api_user_profile(client, db_env):
     d = response.json()
     assert response.status_code == 200
     assert d["errno"] == 0
+    context = d["data"]["context"]
+
+    response = client.get(
+        f"{PREFIX}/users/context/{u_id}?only_topics=interest&stream=true"
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert all(line["errno"] == 0 for line in lines)
+    chunks = {line["data"]["type"]: line["data"] for line in lines}
+    assert sorted(chunks) == ["context", "event", "profile"]
+    assert lines[-1]["data"]["type"] == "context"
+    assert chunks["context"]["content"] == context
+    assert chunks["profile"]["count"] == 1
+    assert "basketball" in chunks["profile"]["content"]
+    assert (
+        chunks["context"]["token_size"]
+        == chunks["profile"]["token_size"] + chunks["event"]["token_size"]
+    )
+
+    # the documented placeholders of a custom prompt
+    prompt = "# Custom\n{profile_section}\n## Events\n{event_section}"
+    params = {"only_topics": "interest", "customize_context_prompt": prompt}
+    response = client.get(f"{PREFIX}/users/context/{u_id}", params=params)
+    d = response.json()
+    assert response.status_code == 200
+    assert d["errno"] == 0
+    custom_context = d["data"]["context"]
+    assert custom_context.startswith("# Custom\n")
+    assert "basketball" in custom_context
+
+    response = client.get(
+        f"{PREFIX}/users/context/{u_id}", params={**params, "stream": "true"}
+    )
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert all(line["errno"] == 0 for line in lines)
+    assert lines[-1]["data"]["content"] == custom_context
 
     response = client.delete(f"{PREFIX}/users/profile/{u_id}/{id1}")
     d = response.json()
@@ -381,6 +604,104 @@ async def test_api_user_flush_buffer(
     assert d["errno"] == 0
 
 
+@pytest.fixture
+def span_exporter():
+    exporter = InMemorySpanExporter()
+    tracing.setup_tracing(SimpleSpanProcessor(exporter))
+    yield exporter
+    tracing.TRACING_ENABLED = False
+    exporter.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_api_tracing(
+    client,
+    db_env,
+    span_exporter,
+    mock_llm_complete,
+    mock_llm_validate_complete,
+    mock_event_summary_llm_complete,
+    mock_entry_summary_llm_complete,
+    mock_event_get_embedding,
+):
+    request_id = str(uuid.uuid4())
+    response = client.post(f"{PREFIX}/users", json={"data": {"test": 1}})
+    u_id = response.json()["data"]["id"]
+    response = client.post(
+        f"{PREFIX}/blobs/insert/{u_id}",
+        json={
+            "blob_type": "chat",
+            "blob_data": {
+                "messages": [
+                    {"role": "user", "content": "hello, I'm Gus"},
+                    {"role": "assistant", "content": "hi"},
+                ]
+            },
+        },
+    )
+    assert response.json()["errno"] == 0
+
+    span_exporter.clear()
+    response = client.get(
+        f"{PREFIX}/users/context/{u_id}", headers={"X-Request-ID": request_id}
+    )
+    assert response.json()["errno"] == 0
+    spans = span_exporter.get_finished_spans()
+    server_span = next(
+        s
+        for s in spans
+        if s.kind == SpanKind.SERVER
+        and s.attributes.get("memobase.request_id") == request_id
+    )
+    assert server_span.attributes["memobase.project_id"] == DEFAULT_PROJECT_ID
+    request_spans = [
+        s for s in spans if s.context.trace_id == server_span.context.trace_id
+    ]
+    names = {s.name for s in request_spans}
+    assert {"context", "context.profiles", "context.event_gists"} <= names
+    assert any(s.name.startswith("db SELECT") for s in request_spans)
+
+    # enqueue in a request, flush from a worker that shares no context with it
+    span_exporter.clear()
+    p = client.get(f"{PREFIX}/users/buffer/capacity/{u_id}/chat?status=idle")
+    buffer_ids = p.json()["data"]["ids"]
+    with patch.object(CONFIG, "flush_worker_mode", "external"), patch(
+        "memobase_server.controllers.buffer_background.schedule_user_flush"
+    ):
+        with tracing.TRACER.start_as_current_span("request") as request_span:
+            with structlog.contextvars.bound_contextvars(request_id=request_id):
+                await controllers.buffer_background.flush_buffer_by_ids_in_background(
+                    u_id, DEFAULT_PROJECT_ID, BlobType.chat, buffer_ids
+                )
+    await asyncio.create_task(
+        controllers.buffer_background.flush_buffer_background_running(
+            u_id, DEFAULT_PROJECT_ID, BlobType.chat
+        ),
+        context=contextvars.Context(),
+    )
+    spans = span_exporter.get_finished_spans()
+    flush_span = next(s for s in spans if s.name == "flush_buffer.background")
+    assert flush_span.context.trace_id == request_span.get_span_context().trace_id
+    assert flush_span.parent.span_id == request_span.get_span_context().span_id
+    assert flush_span.attributes["memobase.request_id"] == request_id
+    flush_spans = [
+        s for s in spans if s.context.trace_id == flush_span.context.trace_id
+    ]
+    stages = {
+        s.name: s
+        for s in flush_spans
+        if s.name in ("flush_buffer", "modal.chat", "modal.chat.extract")
+    }
+    assert len(stages) == 3
+    assert all(s.status.is_ok for s in stages.values())
+    assert all(s.attributes["memobase.user_id"] == u_id for s in stages.values())
+
+    response = client.get(f"{PREFIX}/users/profile/{u_id}")
+    assert [dp["content"] for dp in response.json()["data"]["profiles"]] == ["Gus"]
+    response = client.delete(f"{PREFIX}/users/{u_id}")
+    assert response.json()["errno"] == 0
+
+
 def test_chat_blob_param_api(client, db_env):
     response = client.post(f"{PREFIX}/users", json={})
     d = response.json()
@@ -556,6 +877,182 @@ overwrite_user_profiles:
     assert d["errno"] == 0
 
 
+@pytest.mark.asyncio
+async def test_api_users_context_batch(client, db_env, mock_event_get_embedding):
+    u_ids = []
+    for _ in range(2):
+        response = client.post(f"{PREFIX}/users", json={})
+        u_ids.append(response.json()["data"]["id"])
+    p = await controllers.profile.add_user_profiles(
+        u_ids[0],
+        DEFAULT_PROJECT_ID,
+        ["user likes to play basketball", "user is a junior school student"],
+        [
+            {"topic": "interest", "sub_topic": "sports"},
+            {"topic": "education", "sub_topic": "level"},
+        ],
+    )
+    assert p.ok()
+    p = await controllers.profile.add_user_profiles(
+        u_ids[1],
+        DEFAULT_PROJECT_ID,
+        ["user works at a bakery"],
+        [{"topic": "work", "sub_topic": "company"}],
+    )
+    assert p.ok()
+    for tip in ["- user went hiking", "- user bought a new car"]:
+        p = await controllers.event.append_user_event(
+            u_ids[0],
+            DEFAULT_PROJECT_ID,
+            {"profile_delta": [], "event_tip": tip, "event_tags": []},
+        )
+        assert p.ok()
+    # users without memory get an empty context
+    unknown_u_id = str(uuid.uuid4())
+    batch_ids = [u_ids[1], unknown_u_id, u_ids[0]]
+
+    response = client.post(
+        f"{PREFIX}/users/context/batch",
+        json={"user_ids": batch_ids, "max_token_size": 500},
+    )
+    d = response.json()
+    assert d["errno"] == 0
+    assert [c["user_id"] for c in d["data"]["contexts"]] == batch_ids
+    for u_id, c in zip(batch_ids, d["data"]["contexts"]):
+        single = client.get(f"{PREFIX}/users/context/{u_id}?max_token_size=500")
+        assert c["context"] == single.json()["data"]["context"]
+    assert "bakery" in d["data"]["contexts"][0]["context"]
+    assert "hiking" in d["data"]["contexts"][2]["context"]
+
+    chats = [
+        {"role": "user", "content": f"message {i}"} for i in range(5)
+    ] + [{"role": "user", "content": "Where did I go?"}]
+    mock_event_get_embedding.reset_mock()
+    # one vector for the event search query, one for the profile ranking query
+    mock_event_get_embedding.return_value.data = Mock(
+        return_value=np.array([[0.1 for _ in range(CONFIG.embedding_dim)]] * 2)
+    )
+    with patch(
+        "memobase_server.controllers.context.get_embedding",
+        mock_event_get_embedding,
+    ):
+        response = client.post(
+            f"{PREFIX}/users/context/batch",
+            json={
+                "user_ids": batch_ids,
+                "chats": chats,
+                "full_profile_and_only_search_event": False,
+            },
+        )
+    d = response.json()
+    assert d["errno"] == 0
+    # the chats are embedded once for all the users, with the texts the
+    # single-user context embeds
+    assert mock_event_get_embedding.await_count == 1
+    assert mock_event_get_embedding.await_args.kwargs["phase"] == "query"
+    assert mock_event_get_embedding.await_args.args[1] == [
+        "message 3\nmessage 4\nWhere did I go?",
+        "message 1\nmessage 2\nmessage 3\nmessage 4\nWhere did I go?",
+    ]
+    context = d["data"]["contexts"][2]["context"]
+    assert "hiking" in context and "new car" in context
+
+    with patch.object(CONFIG, "max_context_batch_size", 2):
+        response = client.post(
+            f"{PREFIX}/users/context/batch", json={"user_ids": batch_ids}
+        )
+    assert response.json()["errno"] != 0
+
+    for u_id in u_ids:
+        client.delete(f"{PREFIX}/users/{u_id}")
+
+
+@pytest.mark.asyncio
+async def test_api_project_archive(client, db_env, mock_event_get_embedding):
+    from sqlalchemy import insert, delete
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.models.database import Project
+
+    response = client.post(f"{PREFIX}/users", json={"data": {"test": 1}})
+    u_id = response.json()["data"]["id"]
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["user likes to play basketball"],
+        [{"topic": "interest", "sub_topic": "sports"}],
+    )
+    assert p.ok()
+    p = await controllers.event.append_user_event(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        {"profile_delta": [], "event_tip": "- user went hiking", "event_tags": []},
+    )
+    assert p.ok()
+
+    response = client.get(f"{PREFIX}/project/export?compress=true")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    lines = gzip.decompress(response.content).splitlines()
+    header = json.loads(lines[0])
+    assert header["project_id"] == DEFAULT_PROJECT_ID
+
+    def archive_rows(lines):
+        rows = []
+        for line in lines[1:]:
+            record = json.loads(line)
+            assert record["row"].pop("project_id") is not None
+            rows.append(json.dumps(record, sort_keys=True))
+        return sorted(rows)
+
+    rows = archive_rows(lines)
+    assert any(u_id in r and "hiking" in r for r in rows)
+    assert any(u_id in r and "basketball" in r for r in rows)
+
+    project_id = f"archive-{uuid.uuid4().hex[:8]}"
+    # the ORM guards the projects table
+    async with AsyncSession() as session:
+        await session.execute(
+            insert(Project.__table__).values(
+                id=uuid.uuid4(), project_id=project_id, project_secret="archive-test"
+            )
+        )
+        await session.commit()
+    try:
+        # a read before the import caches the user without profiles
+        p = await controllers.profile.get_user_profiles(u_id, project_id)
+        assert p.ok() and p.data().profiles == []
+        p = await controllers.archive.import_project_archive(lines, project_id)
+        assert p.ok(), p.msg()
+        assert p.data()["users"] > 0
+        assert sum(p.data().values()) == len(rows)
+        p = await controllers.profile.get_user_profiles(u_id, project_id)
+        assert [up.content for up in p.data().profiles] == [
+            "user likes to play basketball"
+        ]
+        # the users are in the target project now, a second import fails as a whole
+        p = await controllers.archive.import_project_archive(lines, project_id)
+        assert not p.ok()
+
+        chunks = [
+            c async for c in controllers.archive.export_project_archive(project_id)
+        ]
+        assert archive_rows(b"".join(chunks).splitlines()) == rows
+
+        p = await controllers.archive.import_project_archive(
+            [json.dumps({**header, "embedding_dim": 3}).encode()], project_id
+        )
+        assert not p.ok()
+    finally:
+        async with AsyncSession() as session:
+            await session.execute(
+                delete(Project.__table__).where(
+                    Project.__table__.c.project_id == project_id
+                )
+            )
+            await session.commit()
+    client.delete(f"{PREFIX}/users/{u_id}")
+
+
 @pytest.mark.asyncio
 async def test_api_event_search(
     client,
@@ -0,0 +1,146 @@
+import uuid
+import asyncio
+import pytest
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy import Engine, event, delete, insert, select
+from memobase_server.env import BillingStatus
+from memobase_server.models.response import CODE
+from memobase_server.connectors import AsyncSession, get_redis_client
+from memobase_server.controllers import billing
+from memobase_server.controllers.project_cache import (
+    PROJECT_LOCAL_CACHE,
+    get_project_cache_version,
+)
+from memobase_server.models.database import (
+    Billing,
+    Project,
+    ProjectBilling,
+    next_month_first_day,
+)
+from memobase_server.telemetry.capture_key import head_key
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, "before_cursor_execute", self)
+
+
+@asynccontextmanager
+async def billing_project(usage_left: int, next_refill_at: datetime):
+    project_id = f"test_billing_{uuid.uuid4().hex}"
+    billing_id = uuid.uuid4()
+    # the ORM guards the projects table
+    async with AsyncSession() as session:
+        await session.execute(
+            insert(Project.__table__).values(
+                id=uuid.uuid4(), project_id=project_id, project_secret="billing-test"
+            )
+        )
+        await session.execute(
+            insert(Billing.__table__).values(
+                id=billing_id,
+                usage_left=usage_left,
+                next_refill_at=next_refill_at,
+            )
+        )
+        await session.execute(
+            insert(ProjectBilling.__table__).values(
+                project_id=project_id, billing_id=billing_id
+            )
+        )
+        await session.commit()
+    try:
+        yield project_id, billing_id
+    finally:
+        async with AsyncSession() as session:
+            await session.execute(
+                delete(Project.__table__).where(
+                    Project.__table__.c.project_id == project_id
+                )
+            )
+            await session.execute(
+                delete(Billing.__table__).where(Billing.__table__.c.id == billing_id)
+            )
+            await session.commit()
+        PROJECT_LOCAL_CACHE.discard(project_id, "billing")
+        async with get_redis_client() as r_c:
+            keys = await r_c.keys(f"{head_key(project_id)}::*")
+            await r_c.delete(billing.billing_debit_key(project_id), *keys)
+            await r_c.srem(billing.BILLING_DEBIT_PROJECTS_KEY, project_id)
+
+
+async def get_usage_left(billing_id: uuid.UUID) -> int:
+    async with AsyncSession() as session:
+        return await session.scalar(
+            select(Billing.usage_left).where(Billing.id == billing_id)
+        )
+
+
+@pytest.mark.asyncio
+async def test_billing_debits_are_atomic_and_reconciled(db_env):
+    async with billing_project(1000, next_month_first_day()) as (
+        project_id,
+        billing_id,
+    ):
+        p = await billing.check_project_quota(project_id)
+        assert p.ok() and p.data().token_left == 1000
+
+        # concurrent LLM calls of one project, none of the debits is lost
+        await asyncio.gather(
+            *[billing.project_cost_token_billing(project_id, 7, 3) for _ in range(100)]
+        )
+        with QueryCounter() as queries:
+            p = await billing.check_project_quota(project_id)
+        assert queries.count == 0
+        assert p.ok() and p.data().token_left == 0
+        assert p.data().project_token_cost_month == 1000
+
+        await billing.project_cost_token_billing(project_id, 5, 0)
+        p = await billing.check_project_quota(project_id)
+        assert p.code() == CODE.SERVICE_UNAVAILABLE
+        assert "Left: -5" in p.msg()
+
+        version = await get_project_cache_version(project_id)
+        assert await billing.reconcile_billing_debits() >= 1005
+        assert await get_usage_left(billing_id) == -5
+        async with get_redis_client() as r_c:
+            assert not await r_c.exists(billing.billing_debit_key(project_id))
+            assert not await r_c.sismember(
+                billing.BILLING_DEBIT_PROJECTS_KEY, project_id
+            )
+        # every worker drops its cached row, not only the one that reconciled
+        assert await get_project_cache_version(project_id) > version
+        assert PROJECT_LOCAL_CACHE.get(project_id, "billing") is None
+        p = await billing.get_project_billing(project_id)
+        assert p.ok() and p.data().token_left == -5
+
+
+@pytest.mark.asyncio
+async def test_billing_refill_reconciles_the_old_month_first(db_env):
+    async with billing_project(100, datetime.now() - timedelta(days=1)) as (
+        project_id,
+        billing_id,
+    ):
+        await billing.project_cost_token_billing(project_id, 60, 0)
+        with patch.dict(
+            billing.BILLING_REFILL_AMOUNT_MAP, {BillingStatus.free: 1000}
+        ):
+            p = await billing.get_project_billing(project_id)
+            assert p.ok() and p.data().token_left == 1000
+            # the debit of the old month isn't taken from the refill later
+            assert await billing.reconcile_project_debit(project_id) == 0
+            assert await get_usage_left(billing_id) == 1000
+            p = await billing.get_project_billing(project_id)
+            assert p.ok() and p.data().token_left == 1000
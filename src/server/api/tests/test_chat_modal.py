@@ -369,3 +369,131 @@ async def test_chat_organize_modal(
     assert mock_extract_llm_complete.await_count == 1
     assert mock_merge_llm_complete.await_count == 1
     assert mock_organize_llm_complete.await_count == 1
+
+
+FUSED_RESPONSE = {
+    "profiles": [
+        {
+            "topic": "basic_info",
+            "sub_topic": "name",
+            "new_info": "Gus",
+            "action": "APPEND",
+        },
+        {
+            "topic": "interest",
+            "sub_topic": "foods",
+            "new_info": "user likes Chinese food",
+            "action": "UPDATE",
+            "memo": "user likes Chinese and Japanese food",
+        },
+        {
+            "topic": "interest",
+            "sub_topic": "sports",
+            "new_info": "user likes basketball",
+            "action": "ABORT",
+        },
+    ],
+    "event_tags": [],
+}
+
+
+@pytest.fixture
+def mock_fused_llm_complete():
+    with patch(
+        "memobase_server.controllers.modal.chat.fused.llm_complete"
+    ) as mock_llm:
+        mock_client1 = AsyncMock()
+        mock_client1.ok = Mock(return_value=True)
+        mock_client1.data = Mock(return_value=FUSED_RESPONSE)
+
+        mock_llm.side_effect = [mock_client1]
+        yield mock_llm
+
+
+async def insert_and_flush_chat(u_id: str):
+    blob = res.BlobData(
+        blob_type=BlobType.chat,
+        blob_data={
+            "messages": [
+                {"role": "user", "content": "Hello, this is Gus, how are you?"},
+                {"role": "assistant", "content": "I am fine, thank you!"},
+                {"role": "user", "content": "I really dig into Chinese food"},
+            ]
+        },
+    )
+    p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+    assert p.ok()
+    await controllers.buffer.insert_blob_to_buffer(
+        u_id, DEFAULT_PROJECT_ID, p.data().id, blob.to_blob()
+    )
+    await controllers.buffer.flush_buffer(u_id, DEFAULT_PROJECT_ID, BlobType.chat)
+
+
+@pytest.mark.asyncio
+async def test_chat_fused_modal(
+    db_env,
+    mock_fused_llm_complete,
+    mock_extract_llm_complete,
+    mock_merge_llm_complete,
+    mock_entry_summary_llm_complete,
+    mock_event_get_embedding,
+):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, PROFILES, PROFILE_ATTRS
+    )
+    assert p.ok()
+
+    with patch.object(CONFIG, "chat_process_mode", "fused"):
+        await insert_and_flush_chat(u_id)
+
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and len(p.data().profiles) == len(PROFILES) + 1
+    contents = {
+        (pf.attributes["topic"], pf.attributes["sub_topic"]): pf.content
+        for pf in p.data().profiles
+    }
+    assert contents[("basic_info", "name")] == "Gus"
+    assert contents[("interest", "foods")] == "user likes Chinese and Japanese food"
+    assert contents[("interest", "sports")] == "user likes to play basketball"
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+    assert mock_fused_llm_complete.await_count == 1
+    assert mock_extract_llm_complete.await_count == 0
+    assert mock_merge_llm_complete.await_count == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_fused_modal_fallback(
+    db_env,
+    mock_fused_llm_complete,
+    mock_extract_llm_complete,
+    mock_merge_llm_complete,
+    mock_event_tag_llm_complete,
+    mock_entry_summary_llm_complete,
+    mock_event_get_embedding,
+):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    malformed = AsyncMock()
+    malformed.ok = Mock(return_value=True)
+    malformed.data = Mock(return_value={"profiles": [{"topic": "interest"}]})
+    mock_fused_llm_complete.side_effect = [malformed]
+    with patch.object(CONFIG, "chat_process_mode", "fused"):
+        await insert_and_flush_chat(u_id)
+
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and len(p.data().profiles) == 4
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+    assert mock_fused_llm_complete.await_count == 1
+    assert mock_extract_llm_complete.await_count == 1
+    assert mock_merge_llm_complete.await_count == 1
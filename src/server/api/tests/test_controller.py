@@ -1,4 +1,6 @@
+import time
 import pytest
+import asyncio
 import numpy as np
 from unittest.mock import patch, AsyncMock, Mock
 from memobase_server.env import CONFIG
@@ -6,6 +8,13 @@ from memobase_server.controllers import full as controllers
 from memobase_server.models import response as res
 from memobase_server.models.blob import BlobType
 from memobase_server.models.database import DEFAULT_PROJECT_ID
+from memobase_server.models.utils import Promise
+from memobase_server.controllers.profile_cache import get_cached_user_profiles
+from memobase_server.utils import (
+    get_profile_token_size,
+    get_blob_token_size,
+    profile_str_repr,
+)
 
 
 @pytest.fixture
@@ -70,6 +79,10 @@ async def test_user_state_clean(db_env):
     d = p.data()
     assert len(d.profiles) == 1
     assert d.profiles[0].attributes == {"topic": "test", "sub_topic": "test"}
+    # token size of "test::test: test" is stored on write
+    assert d.profiles[0].token_size == get_profile_token_size(
+        "test", {"topic": "test", "sub_topic": "test"}
+    )
 
     p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
     assert p.ok()
@@ -454,3 +467,349 @@ async def test_filter_user_events_edge_cases(db_env, mock_event_get_embedding):
     # Cleanup
     p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
     assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_buffer_token_counter(db_env):
+    from memobase_server.connectors import AsyncSession
+    from memobase_server.controllers.buffer_counter import (
+        get_buffer_token_size,
+        claim_idle_buffers,
+    )
+
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    blob = res.BlobData(
+        blob_type=BlobType.chat,
+        blob_data={"messages": [{"role": "user", "content": "Hello world"}]},
+    )
+    blob_ids = []
+    for _ in range(3):
+        p = await controllers.blob.insert_blob(u_id, DEFAULT_PROJECT_ID, blob)
+        assert p.ok()
+        blob_ids.append(p.data().id)
+        p = await controllers.buffer.insert_blob_to_buffer(
+            u_id, DEFAULT_PROJECT_ID, blob_ids[-1], blob.to_blob()
+        )
+        assert p.ok()
+    one_size = get_blob_token_size(blob.to_blob())
+    async with AsyncSession() as session:
+        assert (
+            await get_buffer_token_size(session, u_id, DEFAULT_PROJECT_ID, BlobType.chat)
+            == one_size * 3
+        )
+
+    # the counter follows removed blobs
+    p = await controllers.blob.remove_blob(u_id, DEFAULT_PROJECT_ID, blob_ids[0])
+    assert p.ok()
+    async with AsyncSession() as session:
+        assert (
+            await get_buffer_token_size(session, u_id, DEFAULT_PROJECT_ID, BlobType.chat)
+            == one_size * 2
+        )
+
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat
+    )
+    buffer_ids = p.data().ids
+    assert len(buffer_ids) == 2
+
+    # parallel claims of the same buffers never share one
+    async def claim():
+        async with AsyncSession() as session:
+            claimed = await claim_idle_buffers(
+                session, u_id, DEFAULT_PROJECT_ID, BlobType.chat, buffer_ids
+            )
+            await session.commit()
+        return [row.id for row in claimed]
+
+    results = await asyncio.gather(*[claim() for _ in range(4)])
+    claimed = [i for ids in results for i in ids]
+    assert sorted(claimed) == sorted(buffer_ids)
+    async with AsyncSession() as session:
+        assert (
+            await get_buffer_token_size(session, u_id, DEFAULT_PROJECT_ID, BlobType.chat)
+            == 0
+        )
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_flush_large_buffer_in_batches(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+
+    # a replayed chat log, far more than one flush can process
+    blobs = [
+        res.UserBlobData(
+            user_id=u_id,
+            blob_type=BlobType.chat,
+            blob_data={
+                "messages": [{"role": "user", "content": f"chat {i} " + "hello " * 1000}]
+            },
+        )
+        for i in range(40)
+    ]
+    total_token_size = sum(get_blob_token_size(b.to_blob()) for b in blobs)
+    assert total_token_size > 2 * CONFIG.max_chat_blob_buffer_process_token_size
+
+    seen = []
+
+    async def entry_chat_summary(user_id, project_id, blobs, *args):
+        seen.extend(b.messages[0].content.split(" ", 2)[1] for b in blobs)
+        return Promise.resolve("")
+
+    with patch(
+        "memobase_server.controllers.modal.chat.entry_chat_summary",
+        entry_chat_summary,
+    ):
+        # background: one queue entry per batch
+        p = await controllers.blob.insert_blobs(DEFAULT_PROJECT_ID, blobs[:20])
+        assert p.ok()
+        p = await controllers.buffer.detect_buffer_full_or_not(
+            u_id, DEFAULT_PROJECT_ID, BlobType.chat
+        )
+        assert len(p.data().ids) == 20
+        await controllers.buffer_background.flush_buffer_by_ids_in_background(
+            u_id, DEFAULT_PROJECT_ID, BlobType.chat, p.data().ids
+        )
+        assert seen == [str(i) for i in range(20)]
+
+        # in the request: the batches are processed in turn
+        p = await controllers.blob.insert_blobs(DEFAULT_PROJECT_ID, blobs[20:])
+        assert p.ok()
+        p = await controllers.buffer.flush_buffer(
+            u_id, DEFAULT_PROJECT_ID, BlobType.chat
+        )
+        assert p.ok() and len(p.data()) >= 2
+        assert seen == [str(i) for i in range(40)]
+
+    p = await controllers.buffer.get_unprocessed_buffer_ids(
+        u_id, DEFAULT_PROJECT_ID, BlobType.chat, select_status="done"
+    )
+    assert len(p.data().ids) == 40
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_user_context_deadline(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        ["user likes to play basketball"],
+        [{"topic": "interest", "sub_topic": "sports"}],
+    )
+    assert p.ok()
+
+    async def slow(*args, **kwargs):
+        await asyncio.sleep(5)
+
+    context_kwargs = dict(
+        max_token_size=1000,
+        prefer_topics=None,
+        only_topics=None,
+        max_subtopic_size=None,
+        topic_limits={},
+        profile_event_ratio=0.6,
+        require_event_summary=False,
+        chats=[res.OpenAICompatibleMessage(role="user", content="Any sports?")],
+        event_similarity_threshold=0.2,
+        time_range_in_days=180,
+        full_profile_and_only_search_event=False,
+    )
+    with patch(
+        "memobase_server.controllers.context.filter_profiles_with_chats", slow
+    ), patch("memobase_server.controllers.context.search_user_event_gists", slow):
+        start = asyncio.get_running_loop().time()
+        p = await controllers.context.get_user_context(
+            u_id, DEFAULT_PROJECT_ID, deadline_ms=300, **context_kwargs
+        )
+        elapsed = asyncio.get_running_loop().time() - start
+    assert p.ok()
+    assert elapsed < 1
+    d = p.data()
+    assert "basketball" in d.context
+    assert sorted(d.skipped_stages) == ["event_search", "profile_filter"]
+
+    p = await controllers.context.get_user_context(
+        u_id,
+        DEFAULT_PROJECT_ID,
+        deadline_ms=60000,
+        **{**context_kwargs, "chats": []},
+    )
+    assert p.ok()
+    assert p.data().skipped_stages == []
+
+    # a profile load cut off by the deadline still fills the cache
+    await controllers.profile.refresh_user_profile_cache(u_id, DEFAULT_PROJECT_ID)
+    get_version = controllers.profile.get_user_profile_cache_version
+
+    async def slow_load(*args):
+        await asyncio.sleep(0.3)
+        return await get_version(*args)
+
+    with patch(
+        "memobase_server.controllers.profile.get_user_profile_cache_version",
+        slow_load,
+    ):
+        skipped_stages = []
+        p = await controllers.context.get_user_profiles_data(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            1000,
+            None,
+            None,
+            None,
+            {},
+            [],
+            True,
+            deadline=time.monotonic() + 0.05,
+            skipped_stages=skipped_stages,
+        )
+        assert p.ok() and p.data() == ("", [])
+        assert skipped_stages == ["profiles"]
+        await asyncio.sleep(0.5)
+    cached = await get_cached_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert cached is not None and "basketball" in cached.profiles[0].content
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_filter_profiles_with_embeddings(db_env):
+    from memobase_server.llms import embeddings
+    from memobase_server.controllers.post_process.profile import (
+        filter_profiles_with_chats,
+    )
+
+    async def bag_of_words_embedding(model, texts, phase):
+        vectors = np.zeros((len(texts), CONFIG.embedding_dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            for w in t.lower().replace(":", " ").replace("?", " ").split():
+                vectors[i, hash(w) % CONFIG.embedding_dim] += 1
+        return vectors
+
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    with patch.dict(
+        embeddings.FACTORIES, {CONFIG.embedding_provider: bag_of_words_embedding}
+    ), patch.object(CONFIG, "embedding_cache_enabled", False), patch(
+        "memobase_server.controllers.post_process.profile.llm_complete"
+    ) as mock_llm:
+        p = await controllers.profile.add_user_profiles(
+            u_id,
+            DEFAULT_PROJECT_ID,
+            [
+                "user is a junior school student",
+                "user likes to play basketball",
+                "user loves spicy food",
+            ],
+            [
+                {"topic": "education", "sub_topic": "level"},
+                {"topic": "interest", "sub_topic": "sports"},
+                {"topic": "interest", "sub_topic": "foods"},
+            ],
+        )
+        assert p.ok()
+        ids = p.data().ids
+        p = await controllers.profile.get_user_profile_embeddings(
+            u_id, DEFAULT_PROJECT_ID, [str(i) for i in ids]
+        )
+        assert p.ok() and len(p.data()) == 3
+
+        # an updated profile is embedded again, a NULL embedding is filled on the fly
+        with patch.object(CONFIG, "profile_filter_mode", "llm"):
+            p = await controllers.profile.update_user_profiles(
+                u_id, DEFAULT_PROJECT_ID, [ids[2]], ["user loves spicy hotpot"], [None]
+            )
+            assert p.ok()
+        p = await controllers.profile.get_user_profile_embeddings(
+            u_id, DEFAULT_PROJECT_ID, [str(i) for i in ids]
+        )
+        assert str(ids[2]) not in p.data()
+
+        profiles = (
+            await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+        ).data()
+        chats = [res.OpenAICompatibleMessage(role="user", content="any hotpot place?")]
+        p = await filter_profiles_with_chats(
+            u_id, DEFAULT_PROJECT_ID, profiles, chats, max_filter_num=2
+        )
+        assert p.ok()
+        assert [fp.content for fp in p.data()["profiles"]][0] == "user loves spicy hotpot"
+        assert len(p.data()["profiles"]) == 2
+
+        chats = [res.OpenAICompatibleMessage(role="user", content="basketball tonight?")]
+        p = await filter_profiles_with_chats(
+            u_id, DEFAULT_PROJECT_ID, profiles, chats, only_topics=["interest"]
+        )
+        assert p.ok()
+        assert [fp.content for fp in p.data()["profiles"]] == [
+            "user likes to play basketball",
+            "user loves spicy hotpot",
+        ]
+        mock_llm.assert_not_called()
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_profile_embedding_of_a_stale_update_is_dropped(db_env):
+    from memobase_server.llms import embeddings
+
+    async def length_embedding(model, texts, phase):
+        if any("first" in t for t in texts):
+            # the first update's embedding call is the slow one
+            await asyncio.sleep(0.3)
+        vectors = np.zeros((len(texts), CONFIG.embedding_dim), dtype=np.float32)
+        vectors[:, 0] = [len(t) for t in texts]
+        return vectors
+
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["x"], [{"topic": "interest", "sub_topic": "a"}]
+    )
+    assert p.ok()
+    profile_id = p.data().ids[0]
+
+    async def update_later(content: str, delay: float):
+        await asyncio.sleep(delay)
+        p = await controllers.profile.update_user_profiles(
+            u_id, DEFAULT_PROJECT_ID, [profile_id], [content], [None]
+        )
+        assert p.ok()
+
+    with patch.dict(
+        embeddings.FACTORIES, {CONFIG.embedding_provider: length_embedding}
+    ), patch.object(CONFIG, "embedding_cache_enabled", False), patch.object(
+        CONFIG, "profile_filter_mode", "embedding"
+    ):
+        await asyncio.gather(
+            update_later("user is first", 0), update_later("user is the second", 0.1)
+        )
+    p = await controllers.profile.get_user_profile_embeddings(
+        u_id, DEFAULT_PROJECT_ID, [str(profile_id)]
+    )
+    assert p.ok()
+    latest = profile_str_repr(
+        "user is the second", {"topic": "interest", "sub_topic": "a"}
+    )
+    assert p.data()[str(profile_id)][0] == len(latest)
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
@@ -1,15 +1,19 @@
 import pytest
+from unittest.mock import patch
+from sqlalchemy import text
 from sqlalchemy.inspection import inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+from memobase_server import connectors
 from memobase_server.models.database import User, GeneralBlob, UserProfile
 from memobase_server.models.blob import BlobType
 from memobase_server.connectors import (
     Session,
-    DB_ENGINE,
+    get_db_engine,
 )
 
 
 def test_correct_tables(db_env):
-    db_inspector = inspect(DB_ENGINE)
+    db_inspector = inspect(get_db_engine())
     assert "users" in db_inspector.get_table_names()
     assert "general_blobs" in db_inspector.get_table_names()
 
@@ -49,3 +53,24 @@ def test_general_blob_model(db_env):
         user = session.query(User).filter_by(id=test_user_id).first()
         session.delete(user)
         session.commit()
+
+
+@pytest.mark.asyncio
+async def test_pool_status_against_capacity(db_env):
+    # the tests run on a NullPool engine
+    engine = create_async_engine(
+        connectors.get_async_database_url(connectors.DATABASE_URL),
+        pool_size=5,
+        max_overflow=3,
+    )
+    try:
+        with patch.object(connectors, "DB_ASYNC_ENGINE", engine):
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+                status = connectors.get_pool_status()
+    finally:
+        await engine.dispose()
+    # against the pool's capacity, not the connections opened so far
+    assert status["checked_out"] == 1
+    assert status["total_capacity"] == 8
+    assert status["utilization_percent"] == 12.5
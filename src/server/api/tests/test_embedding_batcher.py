@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+import numpy as np
+from memobase_server.llms.embeddings.batcher import EmbeddingBatcher, MAX_BATCH_INPUTS
+
+
+def fake_provider(calls: list):
+    async def embedding(model, texts, phase):
+        calls.append(list(texts))
+        await asyncio.sleep(0.005)
+        return np.array([[float(len(t)), 1.0 if phase == "query" else 0.0] for t in texts])
+
+    return embedding
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_coalesces_calls():
+    calls = []
+    batcher = EmbeddingBatcher(lambda: fake_provider(calls), wait_ms=5, max_tokens=8192)
+    requests = [[f"event of user {i}", f"- gist {'x' * i}"] for i in range(50)]
+
+    results = await asyncio.gather(
+        *[batcher.embed("model", texts, "document") for texts in requests]
+    )
+
+    for texts, result in zip(requests, results):
+        assert result.shape == (len(texts), 2)
+        assert result[:, 0].tolist() == [float(len(t)) for t in texts]
+    assert len(calls) == 1
+    saved = len(requests) - len(calls)
+    assert saved == 49
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_token_budget_and_phase():
+    calls = []
+    batcher = EmbeddingBatcher(lambda: fake_provider(calls), wait_ms=5, max_tokens=20)
+    requests = [[f"hello world number {i}"] for i in range(10)]
+
+    docs, query = await asyncio.gather(
+        asyncio.gather(*[batcher.embed("model", t, "document") for t in requests]),
+        batcher.embed("model", ["hello"], "query"),
+    )
+
+    # queries and documents are never mixed in one provider call
+    assert ["hello"] in calls
+    assert query[0].tolist() == [5.0, 1.0]
+    # the token budget splits the documents into several provider calls
+    document_calls = [c for c in calls if c != ["hello"]]
+    assert 1 < len(document_calls) < len(requests)
+    assert all(len(d) == 1 for d in docs)
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_input_cap():
+    calls = []
+    batcher = EmbeddingBatcher(lambda: fake_provider(calls), wait_ms=5, max_tokens=10**9)
+    requests = [[f"text {i} {j}" for j in range(100)] for i in range(12)]
+    # one caller with more inputs than a provider request takes
+    large = [f"large {j}" for j in range(MAX_BATCH_INPUTS * 2 + 10)]
+
+    results = await asyncio.gather(
+        batcher.embed("model", large, "document"),
+        *[batcher.embed("model", texts, "document") for texts in requests],
+    )
+
+    assert all(len(c) <= MAX_BATCH_INPUTS for c in calls)
+    assert sum(len(c) for c in calls) == len(large) + 1200
+    for texts, result in zip([large] + requests, results):
+        assert result[:, 0].tolist() == [float(len(t)) for t in texts]
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_propagates_errors():
+    async def broken(model, texts, phase):
+        raise RuntimeError("provider down")
+
+    batcher = EmbeddingBatcher(lambda: broken, wait_ms=1, max_tokens=8192)
+    results = await asyncio.gather(
+        batcher.embed("model", ["a"], "document"),
+        batcher.embed("model", ["b"], "document"),
+        return_exceptions=True,
+    )
+    assert all(isinstance(r, RuntimeError) for r in results)
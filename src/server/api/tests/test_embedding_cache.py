@@ -0,0 +1,79 @@
+import uuid
+import pytest
+import numpy as np
+from unittest.mock import patch
+from memobase_server.env import CONFIG
+from memobase_server.connectors import get_redis_binary_client
+from memobase_server.llms.embeddings.cache import (
+    LOCAL_EMBEDDING_CACHE,
+    embedding_cache_key,
+    get_cached_embeddings,
+    set_cached_embeddings,
+)
+
+
+def random_embeddings(n: int) -> np.ndarray:
+    return np.random.default_rng(0).random((n, CONFIG.embedding_dim), dtype=np.float32)
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_round_trip(redis_env):
+    texts = [f"text {uuid.uuid4().hex}" for _ in range(3)]
+    keys = [embedding_cache_key("model", "document", t) for t in texts]
+    embeddings = random_embeddings(3)
+
+    assert await get_cached_embeddings("test", keys) == [None, None, None]
+    await set_cached_embeddings(keys[:2], embeddings[:2])
+
+    # in-process tier
+    results = await get_cached_embeddings("test", keys)
+    assert results[2] is None
+    for result, embedding in zip(results[:2], embeddings[:2]):
+        assert np.array_equal(result, embedding)
+
+    # redis tier, as another worker sees it
+    LOCAL_EMBEDDING_CACHE.clear()
+    results = await get_cached_embeddings("test", keys)
+    assert results[2] is None
+    for result, embedding in zip(results[:2], embeddings[:2]):
+        assert result.dtype == np.float32
+        assert np.array_equal(result, embedding)
+    assert LOCAL_EMBEDDING_CACHE.get(keys[0]) is not None
+
+    # phases and models don't share entries
+    assert embedding_cache_key("model", "query", texts[0]) != keys[0]
+    assert embedding_cache_key("other", "document", texts[0]) != keys[0]
+    async with get_redis_binary_client() as client:
+        await client.delete(*keys)
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_float16(redis_env):
+    text = f"text {uuid.uuid4().hex}"
+    embeddings = random_embeddings(1)
+    with patch.object(CONFIG, "embedding_cache_dtype", "float16"):
+        key = embedding_cache_key("model", "document", text)
+        await set_cached_embeddings([key], embeddings)
+        async with get_redis_binary_client() as client:
+            # raw bytes, half the size of float32
+            assert len(await client.get(key)) == CONFIG.embedding_dim * 2
+        LOCAL_EMBEDDING_CACHE.clear()
+        (result,) = await get_cached_embeddings("test", [key])
+    assert result.dtype == np.float32
+    assert np.allclose(result, embeddings[0], atol=1e-3)
+    # the dtype is part of the key, float32 readers never get float16 bytes
+    assert embedding_cache_key("model", "document", text) != key
+    async with get_redis_binary_client() as client:
+        await client.delete(key)
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_ignores_other_dimensions(redis_env):
+    key = embedding_cache_key("model", "document", f"text {uuid.uuid4().hex}")
+    async with get_redis_binary_client() as client:
+        await client.set(key, np.ones(8, dtype=np.float32).tobytes(), ex=60)
+    LOCAL_EMBEDDING_CACHE.clear()
+    # e.g. written before embedding_dim changed
+    assert await get_cached_embeddings("test", [key]) == [None]
+    async with get_redis_binary_client() as client:
+        await client.delete(key)
@@ -0,0 +1,139 @@
+import uuid
+import asyncio
+import pytest
+from unittest.mock import patch
+from memobase_server.models.blob import BlobType
+from memobase_server.connectors import get_redis_client
+from memobase_server.controllers.buffer_background import (
+    flush_buffer_background_running,
+    get_user_buffer_queue_key,
+    pack_buffer_batch,
+    schedule_user_flush,
+)
+from memobase_server.worker import FlushWorker
+
+
+async def drain_pending(worker: FlushWorker):
+    while await worker.next_job() is not None:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_flush_worker_fair_share_and_priority(redis_env):
+    worker = FlushWorker(concurrency=1, drain_timeout=1)
+    await drain_pending(worker)
+    suffix = uuid.uuid4().hex
+    p1, p2 = f"test_flush_p1_{suffix}", f"test_flush_p2_{suffix}"
+
+    await schedule_user_flush("small", p1, BlobType.chat, 100)
+    await schedule_user_flush("large", p1, BlobType.chat, 300)
+    await schedule_user_flush("large", p1, BlobType.chat, 200)
+    await schedule_user_flush("other", p2, BlobType.summary, 10)
+
+    jobs = [await worker.next_job() for _ in range(4)]
+    assert jobs == [
+        ("large", p1, BlobType.chat),
+        ("other", p2, BlobType.summary),
+        ("small", p1, BlobType.chat),
+        None,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_flush_worker_concurrency_and_drain(redis_env):
+    worker = FlushWorker(concurrency=2, drain_timeout=5)
+    await drain_pending(worker)
+    project_id = f"test_flush_{uuid.uuid4().hex}"
+    running = 0
+    max_running = 0
+    flushed = []
+
+    async def fake_flush(user_id, project_id, blob_type):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        flushed.append(user_id)
+        return True
+
+    with patch("memobase_server.worker.flush_buffer_background_running", fake_flush):
+        for i in range(5):
+            await schedule_user_flush(f"user_{i}", project_id, BlobType.chat, i)
+        worker_task = asyncio.create_task(worker.run())
+        for _ in range(100):
+            if len(flushed) + running >= 5:
+                break
+            await asyncio.sleep(0.02)
+        await worker.stop()
+        await worker_task
+
+    assert sorted(flushed) == [f"user_{i}" for i in range(5)]
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_flush_worker_concurrency_is_global(redis_env):
+    workers = [FlushWorker(concurrency=2, drain_timeout=5) for _ in range(2)]
+    await drain_pending(workers[0])
+    project_id = f"test_flush_{uuid.uuid4().hex}"
+    running = 0
+    max_running = 0
+    flushed = []
+
+    async def fake_flush(user_id, project_id, blob_type):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        flushed.append(user_id)
+        return True
+
+    with patch("memobase_server.worker.flush_buffer_background_running", fake_flush):
+        for i in range(8):
+            await schedule_user_flush(f"user_{i}", project_id, BlobType.chat, i)
+        # two pools, e.g. two API processes, share the slots
+        tasks = [asyncio.create_task(w.run()) for w in workers]
+        for _ in range(300):
+            if len(flushed) >= 8:
+                break
+            await asyncio.sleep(0.02)
+        for w in workers:
+            await w.stop()
+        await asyncio.gather(*tasks)
+
+    assert sorted(flushed) == [f"user_{i}" for i in range(8)]
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_flush_requeues_its_batch(redis_env):
+    user_id, project_id = "user", f"test_flush_{uuid.uuid4().hex}"
+    queue_key = get_user_buffer_queue_key(
+        user_id, project_id, f"flush_buffer_background_{BlobType.chat}"
+    )
+    batches = [pack_buffer_batch([str(uuid.uuid4())]) for _ in range(2)]
+    async with get_redis_client() as redis_client:
+        await redis_client.rpush(queue_key, *batches)
+    started = asyncio.Event()
+
+    async def slow_flush(*args, **kwargs):
+        started.set()
+        await asyncio.sleep(10)
+
+    with patch(
+        "memobase_server.controllers.buffer_background.flush_buffer_by_ids",
+        slow_flush,
+    ):
+        task = asyncio.create_task(
+            flush_buffer_background_running(user_id, project_id, BlobType.chat)
+        )
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    async with get_redis_client() as redis_client:
+        assert await redis_client.lrange(queue_key, 0, -1) == batches
+        await redis_client.delete(queue_key)
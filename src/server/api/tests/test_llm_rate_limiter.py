@@ -0,0 +1,78 @@
+import time
+import uuid
+import asyncio
+import pytest
+from unittest.mock import patch
+from memobase_server.env import CONFIG
+from memobase_server import llms
+from memobase_server.llms import llm_complete
+from memobase_server.llms.rate_limiter import LLMRateLimiter, LLMPriority
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+
+@pytest.mark.asyncio
+async def test_llm_rate_limiter_bucket_and_priority(redis_env):
+    limiter = LLMRateLimiter()
+    project_id = f"test_rate_{uuid.uuid4().hex}"
+    model = f"model_{uuid.uuid4().hex}"
+    order = []
+
+    async def call(name: str, priority: LLMPriority):
+        p = await limiter.acquire(project_id, model, 10, priority)
+        assert p.ok()
+        order.append(name)
+
+    # 600 rpm refills one request every 100ms
+    with patch.object(CONFIG, "llm_project_rpm_limit", 600):
+        start = time.monotonic()
+        await call("first", LLMPriority.background)
+        # the bucket starts full, so drain it before queueing
+        ((key, capacity, rate, _),) = limiter.buckets(project_id, model, 10)
+        assert await limiter.take([(key, capacity, rate, capacity)], force=True) == 0
+        waiting = [
+            asyncio.create_task(call("background_1", LLMPriority.background)),
+            asyncio.create_task(call("background_2", LLMPriority.background)),
+        ]
+        await asyncio.sleep(0.01)
+        waiting.append(asyncio.create_task(call("interactive", LLMPriority.interactive)))
+        await asyncio.sleep(0.01)
+        assert limiter.queue_depth(project_id, model) == 3
+        await asyncio.gather(*waiting)
+        elapsed = time.monotonic() - start
+
+    # the interactive caller overtakes the background ones queued before it
+    assert order == ["first", "interactive", "background_1", "background_2"]
+    assert elapsed >= 0.25
+    assert limiter.queue_depth(project_id, model) == 0
+
+
+@pytest.mark.asyncio
+async def test_llm_complete_retries_rate_limited_calls(redis_env):
+    calls = 0
+
+    async def flaky_complete(model, prompt, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise FakeRateLimitError("Too many requests")
+        return "ok"
+
+    with patch.dict(llms.FACTORIES, {CONFIG.llm_style: flaky_complete}), patch.object(
+        CONFIG, "llm_retry_base_delay", 0.01
+    ), patch.object(
+        llms.LLM_RATE_LIMITER, "acquire", wraps=llms.LLM_RATE_LIMITER.acquire
+    ) as acquire:
+        p = await llm_complete("test_rate_project", "hello", prompt_id="__test__")
+        assert p.ok() and p.data() == "ok"
+        assert calls == 3
+        # every retry takes a request and its tokens again
+        assert acquire.await_count == 3
+
+        calls = -10
+        with patch.object(CONFIG, "llm_retry_times", 1):
+            p = await llm_complete("test_rate_project", "hello", prompt_id="__test__")
+        assert not p.ok()
+        assert calls == -8
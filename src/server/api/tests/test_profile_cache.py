@@ -0,0 +1,186 @@
+import uuid
+import asyncio
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from memobase_server.connectors import get_redis_client
+from memobase_server.controllers import full as controllers
+from memobase_server.controllers import profile_cache
+from memobase_server.models import response as res
+from memobase_server.models.database import DEFAULT_PROJECT_ID
+
+
+def make_profiles(*contents: str) -> res.UserProfilesData:
+    return res.UserProfilesData(
+        profiles=[
+            res.ProfileData(
+                id=uuid.uuid4(),
+                content=c,
+                attributes={"topic": "interest", "sub_topic": "test"},
+                created_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
+            for c in contents
+        ]
+    )
+
+
+async def clear_cache_keys(user_id: str, project_id: str):
+    async with get_redis_client() as redis_client:
+        await redis_client.delete(
+            profile_cache.user_profiles_cache_key(user_id, project_id),
+            profile_cache.user_profiles_version_key(user_id, project_id),
+            profile_cache.user_profiles_lock_key(user_id, project_id),
+        )
+
+
+@pytest.mark.asyncio
+async def test_profile_cache_fill_after_write_is_dropped(redis_env):
+    user_id, project_id = str(uuid.uuid4()), "test_profile_cache"
+    version = await profile_cache.get_user_profile_cache_version(user_id, project_id)
+    # a write lands between reading the version and filling the cache
+    await profile_cache.invalidate_user_profile_cache(user_id, project_id)
+
+    stale = make_profiles("stale")
+    assert not await profile_cache.fill_user_profile_cache(
+        user_id, project_id, stale, version
+    )
+    assert await profile_cache.get_cached_user_profiles(user_id, project_id) is None
+
+    version = await profile_cache.get_user_profile_cache_version(user_id, project_id)
+    fresh = make_profiles("fresh")
+    assert await profile_cache.fill_user_profile_cache(
+        user_id, project_id, fresh, version
+    )
+    cached = await profile_cache.get_cached_user_profiles(user_id, project_id)
+    assert [p.content for p in cached.profiles] == ["fresh"]
+    await clear_cache_keys(user_id, project_id)
+
+
+@pytest.mark.asyncio
+async def test_profile_cache_write_through(redis_env):
+    user_id, project_id = str(uuid.uuid4()), "test_profile_cache"
+    # not cached, nothing to update, but a running fill is still fenced off
+    version = await profile_cache.get_user_profile_cache_version(user_id, project_id)
+    await profile_cache.write_through_user_profile_cache(
+        user_id, project_id, [], [str(uuid.uuid4())]
+    )
+    assert await profile_cache.get_cached_user_profiles(user_id, project_id) is None
+    assert (
+        await profile_cache.get_user_profile_cache_version(user_id, project_id)
+        != version
+    )
+
+    profiles = make_profiles("first", "second")
+    version = await profile_cache.get_user_profile_cache_version(user_id, project_id)
+    assert await profile_cache.fill_user_profile_cache(
+        user_id, project_id, profiles, version
+    )
+    await profile_cache.write_through_user_profile_cache(
+        user_id, project_id, [], [str(profiles.profiles[0].id)]
+    )
+    cached = await profile_cache.get_cached_user_profiles(user_id, project_id)
+    assert [p.content for p in cached.profiles] == ["second"]
+    await clear_cache_keys(user_id, project_id)
+
+
+@pytest.mark.asyncio
+async def test_profile_cache_load_lock_and_wait(redis_env):
+    user_id, project_id = str(uuid.uuid4()), "test_profile_cache"
+    assert await profile_cache.acquire_user_profile_load_lock(user_id, project_id)
+    # one loader per user across workers
+    assert not await profile_cache.acquire_user_profile_load_lock(user_id, project_id)
+
+    async def fill_later():
+        await asyncio.sleep(profile_cache.LOAD_WAIT_INTERVAL * 3)
+        version = await profile_cache.get_user_profile_cache_version(
+            user_id, project_id
+        )
+        await profile_cache.fill_user_profile_cache(
+            user_id, project_id, make_profiles("loaded"), version
+        )
+
+    cached, _ = await asyncio.gather(
+        profile_cache.wait_for_cached_user_profiles(user_id, project_id),
+        fill_later(),
+    )
+    assert [p.content for p in cached.profiles] == ["loaded"]
+
+    await profile_cache.release_user_profile_load_lock(user_id, project_id)
+    assert await profile_cache.acquire_user_profile_load_lock(user_id, project_id)
+    await clear_cache_keys(user_id, project_id)
+
+    # the loader never fills, waiters give up and load themselves
+    with patch.object(profile_cache, "LOAD_WAIT_ROUNDS", 3):
+        assert (
+            await profile_cache.wait_for_cached_user_profiles(user_id, project_id)
+            is None
+        )
+    await clear_cache_keys(user_id, project_id)
+
+
+@pytest.mark.asyncio
+async def test_profile_load_is_not_overwritten_by_stale_fill(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["old"], [{"topic": "interest", "sub_topic": "a"}]
+    )
+    assert p.ok()
+    profile_id = p.data().ids[0]
+    await controllers.profile.refresh_user_profile_cache(u_id, DEFAULT_PROJECT_ID)
+
+    fill = profile_cache.fill_user_profile_cache
+
+    async def update_then_fill(*args):
+        # a write commits after the load read the DB
+        p = await controllers.profile.update_user_profiles(
+            u_id, DEFAULT_PROJECT_ID, [profile_id], ["new"], [None]
+        )
+        assert p.ok()
+        return await fill(*args)
+
+    with patch.object(
+        controllers.profile, "fill_user_profile_cache", side_effect=update_then_fill
+    ):
+        p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().profiles[0].content == "old"
+    assert await profile_cache.get_cached_user_profiles(u_id, DEFAULT_PROJECT_ID) is None
+
+    p = await controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok() and p.data().profiles[0].content == "new"
+    cached = await profile_cache.get_cached_user_profiles(u_id, DEFAULT_PROJECT_ID)
+    assert [p.content for p in cached.profiles] == ["new"]
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
+
+
+@pytest.mark.asyncio
+async def test_profile_loads_are_single_flight(db_env):
+    p = await controllers.user.create_user(res.UserData(), DEFAULT_PROJECT_ID)
+    assert p.ok()
+    u_id = p.data().id
+    p = await controllers.profile.add_user_profiles(
+        u_id, DEFAULT_PROJECT_ID, ["profile"], [{"topic": "interest", "sub_topic": "a"}]
+    )
+    assert p.ok()
+    await controllers.profile.refresh_user_profile_cache(u_id, DEFAULT_PROJECT_ID)
+
+    with patch.object(
+        controllers.profile,
+        "load_and_cache_user_profiles",
+        wraps=controllers.profile.load_and_cache_user_profiles,
+    ) as load:
+        results = await asyncio.gather(
+            *[
+                controllers.profile.get_user_profiles(u_id, DEFAULT_PROJECT_ID)
+                for _ in range(10)
+            ]
+        )
+    assert load.await_count == 1
+    assert all(r.ok() and r.data().profiles[0].content == "profile" for r in results)
+
+    p = await controllers.user.delete_user(u_id, DEFAULT_PROJECT_ID)
+    assert p.ok()
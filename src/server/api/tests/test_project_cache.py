@@ -0,0 +1,75 @@
+import time
+import uuid
+import asyncio
+import pytest
+from unittest.mock import patch
+from memobase_server.connectors import get_redis_client
+from memobase_server.controllers import project_cache
+from memobase_server.controllers.project_cache import (
+    PROJECT_CACHE_CHANNEL,
+    PROJECT_LOCAL_CACHE,
+    ProjectLocalCache,
+    project_cache_version_key,
+)
+
+
+async def wait_until(condition, timeout: float = 2):
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_project_cache_invalidation_from_another_worker(redis_env):
+    project_id = f"test_project_cache_{uuid.uuid4().hex}"
+    other_project_id = f"test_project_cache_{uuid.uuid4().hex}"
+    PROJECT_LOCAL_CACHE.set(project_id, "marker", True, 0)
+
+    async def listener_subscribed() -> bool:
+        # the listener clears the cache right after subscribing
+        return PROJECT_LOCAL_CACHE.get(project_id, "marker") is None
+
+    listener = asyncio.create_task(project_cache.listen_project_cache_invalidation())
+    try:
+        await wait_until(listener_subscribed)
+        version = await project_cache.get_project_cache_version(project_id)
+        PROJECT_LOCAL_CACHE.set(project_id, "secret", "old-secret", version)
+        PROJECT_LOCAL_CACHE.set(other_project_id, "secret", "other-secret", 0)
+        assert PROJECT_LOCAL_CACHE.get(project_id, "secret") == "old-secret"
+
+        # what invalidate_project_cache does in another process, this one's
+        # local cache is only reached through the channel
+        async with get_redis_client() as client:
+            new_version = await client.incr(project_cache_version_key(project_id))
+            await client.publish(PROJECT_CACHE_CHANNEL, f"{new_version}:{project_id}")
+
+        async def evicted() -> bool:
+            return PROJECT_LOCAL_CACHE.get(project_id, "secret") is None
+
+        await wait_until(evicted)
+        assert PROJECT_LOCAL_CACHE.get(other_project_id, "secret") == "other-secret"
+        # a load that read the old version can't put the stale value back
+        PROJECT_LOCAL_CACHE.set(project_id, "secret", "old-secret", version)
+        assert PROJECT_LOCAL_CACHE.get(project_id, "secret") is None
+    finally:
+        listener.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await listener
+        PROJECT_LOCAL_CACHE.discard(other_project_id, "secret")
+        async with get_redis_client() as client:
+            await client.delete(project_cache_version_key(project_id))
+
+
+def test_project_cache_ttl():
+    cache = ProjectLocalCache(ttl=0.05)
+    cache.set("project", "secret", "value", 0)
+    assert cache.get("project", "secret") == "value"
+    with patch.object(project_cache.time, "monotonic", return_value=time.monotonic() + 1):
+        # bounds staleness when an invalidation message is lost
+        assert cache.get("project", "secret") is None
+    assert cache.get("project", "secret") is None
+
+    disabled = ProjectLocalCache(ttl=0)
+    disabled.set("project", "secret", "value", 0)
+    assert disabled.get("project", "secret") is None
@@ -0,0 +1,55 @@
+from memobase_server.prompts import (
+    extract_profile,
+    summary_entry_chats,
+    user_profile_topics,
+    fused_extract_merge,
+)
+from memobase_server.types import UserProfileTopic
+from memobase_server.llms.prompt_cache import PromptCacheRegistry
+
+PROJECT_A = user_profile_topics.get_prompt(
+    [UserProfileTopic("interest", sub_topics=["sports", "foods"])]
+)
+PROJECT_B = user_profile_topics.get_prompt(
+    [UserProfileTopic("work", sub_topics=["company", "title"])]
+)
+
+
+def test_prompts_put_project_content_last():
+    prompts = [
+        (
+            extract_profile.get_prompt(PROJECT_A),
+            extract_profile.get_prompt(PROJECT_B),
+        ),
+        (
+            summary_entry_chats.get_prompt(PROJECT_A, "- emotion", "theme a"),
+            summary_entry_chats.get_prompt(PROJECT_B, "- goal", "theme b"),
+        ),
+        (
+            fused_extract_merge.get_prompt(PROJECT_A, "", "- emotion"),
+            fused_extract_merge.get_prompt(PROJECT_B, "", "- goal"),
+        ),
+    ]
+    for a, b in prompts:
+        # everything before the project's own sections is shared
+        static_prefix = a[: a.index(PROJECT_A)]
+        assert static_prefix == b[: b.index(PROJECT_B)]
+        assert len(static_prefix) > 0.8 * len(a)
+
+
+def test_prompt_cache_registry():
+    registry = PromptCacheRegistry()
+    registry.record("extract_profile", "system a", 2000, 0)
+    registry.record("extract_profile", "system a", 2000, 1536)
+    registry.record("extract_profile", "system b", 1000, 0)
+    registry.record("merge_profile", None, 100, None)
+
+    summary = registry.summary()
+    assert summary["extract_profile"] == {
+        "calls": 3,
+        "prompt_tokens": 5000,
+        "cached_tokens": 1536,
+        "hit_ratio": 0.3072,
+        "fingerprints": 2,
+    }
+    assert summary["merge_profile"]["hit_ratio"] == 0.0
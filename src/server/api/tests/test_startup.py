@@ -0,0 +1,105 @@
+import os
+import sys
+import subprocess
+import pytest
+from unittest.mock import patch
+from sqlalchemy import event, text
+from memobase_server import migrate
+from memobase_server.connectors import get_db_engine
+from memobase_server.models.database import UserEventGist
+from memobase_server.env import CONFIG
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# generous for slow CI machines, a regression to connecting at import blows it anyway
+IMPORT_TIME_BUDGET_S = 5
+
+
+def import_time(module: str, env: dict) -> tuple[float, set[str]]:
+    """Cumulative import time of `module` in a fresh interpreter, and all the modules it loaded"""
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=API_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert r.returncode == 0, r.stderr[-2000:]
+    total, modules = None, set()
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name.strip())
+        if name.strip() == module:
+            total = int(cumulative) / 1e6
+    return total, modules
+
+
+def test_import_api_is_side_effect_free():
+    # nothing listens there, importing must not connect to the database or redis
+    env = {
+        **os.environ,
+        "DATABASE_URL": "postgresql://memobase@127.0.0.1:9/memobase",
+        "REDIS_URL": "redis://127.0.0.1:9/0",
+    }
+    total, modules = import_time("api", env)
+    print(f"import api: {total:.3f}s")
+    assert total < IMPORT_TIME_BUDGET_S
+    assert "volcenginesdkarkruntime" not in modules
+    assert "alembic" not in modules
+
+
+def test_ensure_schema_skips_current_database(db_env):
+    migrate.migrate()
+    with patch.object(migrate, "create_tables") as create_tables:
+        migrate.ensure_schema()
+        create_tables.assert_not_called()
+
+    # e.g. a new model index or `embedding_dim` changed
+    with patch.object(migrate, "schema_fingerprint", return_value="0" * 64):
+        with patch.object(CONFIG, "auto_migrate", False):
+            with pytest.raises(RuntimeError):
+                migrate.ensure_schema()
+    # the real fingerprint is still stored, nothing was migrated
+    migrate.ensure_schema()
+
+
+def test_migrate_builds_missing_indexes_concurrently(db_env):
+    index = sorted(UserEventGist.__table__.indexes, key=lambda i: i.name)[0]
+    with get_db_engine().connect() as conn:
+        conn.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+        conn.commit()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(get_db_engine(), "before_cursor_execute", record)
+    try:
+        migrate.migrate(force=True)
+    finally:
+        event.remove(get_db_engine(), "before_cursor_execute", record)
+    assert any(
+        s.startswith("CREATE INDEX CONCURRENTLY") and index.name in s
+        for s in statements
+    )
+    with get_db_engine().connect() as conn:
+        assert conn.execute(
+            text(
+                "SELECT indisvalid FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid "
+                "WHERE relname = :name"
+            ),
+            {"name": index.name},
+        ).scalar()
+
+
+def test_ann_index_requires_iterative_scan(db_env):
+    with patch.object(CONFIG, "embedding_index_type", "hnsw"):
+        with patch.object(migrate, "PGVECTOR_ITERATIVE_SCAN_VERSION", (99, 0)):
+            with get_db_engine().connect() as conn:
+                with pytest.raises(RuntimeError):
+                    migrate.check_pgvector_version(conn)
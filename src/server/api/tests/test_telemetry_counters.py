@@ -0,0 +1,91 @@
+import uuid
+import asyncio
+import pytest
+from unittest.mock import patch
+from memobase_server.env import TelemetryKeyName
+from memobase_server.connectors import get_redis_client
+from memobase_server.controllers.project import get_project_usage
+from memobase_server.telemetry import capture_key
+from memobase_server.telemetry.capture_key import (
+    TelemetryCounters,
+    capture_int_key,
+    capture_int_keys,
+    date_key,
+    month_key,
+    get_int_keys,
+)
+
+
+@pytest.mark.asyncio
+async def test_telemetry_counters_batch_writes(redis_env):
+    project_id = f"test_telemetry_{uuid.uuid4().hex}"
+    counters = TelemetryCounters(interval=0.05)
+    write = counters.write
+    writes = 0
+    fail_next = True
+
+    async def flaky_write(counts):
+        nonlocal writes, fail_next
+        writes += 1
+        if fail_next:
+            fail_next = False
+            raise ConnectionError("redis is down")
+        await write(counts)
+
+    name = TelemetryKeyName.insert_blob_request
+    with patch.object(capture_key, "TELEMETRY_COUNTERS", counters), patch.object(
+        counters, "write", flaky_write
+    ):
+        running = asyncio.create_task(counters.run())
+        await asyncio.sleep(0)
+        await asyncio.gather(
+            *[capture_int_key(name, project_id=project_id) for _ in range(100)]
+        )
+        await capture_int_keys(
+            {
+                TelemetryKeyName.llm_input_tokens: 30,
+                TelemetryKeyName.llm_output_tokens: 12,
+            },
+            project_id=project_id,
+        )
+        # nothing is written before the interval ends
+        assert writes == 0
+        counts = await get_int_keys([name], project_id, [date_key()])
+        assert counts[(name, date_key())] == 0
+
+        # the first write fails, the counts are kept for the next one
+        await asyncio.sleep(0.2)
+        await counters.stop()
+        await running
+    assert 2 <= writes <= 5
+    assert not counters.pending
+
+    counts = await get_int_keys(
+        [name, TelemetryKeyName.llm_input_tokens],
+        project_id,
+        [date_key(), month_key()],
+    )
+    assert counts == {
+        (name, date_key()): 100,
+        (TelemetryKeyName.llm_input_tokens, date_key()): 30,
+        (name, month_key()): 100,
+        (TelemetryKeyName.llm_input_tokens, month_key()): 30,
+    }
+    p = await get_project_usage(project_id, last_days=3)
+    assert p.ok()
+    today, *past = p.data()
+    assert (today.date, today.total_insert, today.total_output_token) == (
+        date_key(),
+        100,
+        12,
+    )
+    assert all(d.total_insert == 0 for d in past)
+
+    # without the flush loop, e.g. in scripts, captures are written right away
+    await capture_int_key(name, 5, project_id=project_id)
+    counts = await get_int_keys([name], project_id, [date_key()])
+    assert counts[(name, date_key())] == 105
+
+    async with get_redis_client() as r_c:
+        keys = await r_c.keys(f"{capture_key.head_key(project_id)}::*")
+        await r_c.delete(*keys)
@@ -0,0 +1,6 @@
+set -e
+
+# ./script/archive.sh export PROJECT_ID memobase.ndjson.gz
+# ./script/archive.sh import PROJECT_ID memobase.ndjson.gz
+# The archive path is inside the memobase-server-api container
+docker compose exec -T memobase-server-api /app/.venv/bin/python -m memobase_server.archive "$@"
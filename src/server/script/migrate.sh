@@ -0,0 +1,5 @@
+set -e
+
+# ./script/migrate.sh          create or upgrade the schema
+# ./script/migrate.sh --check  exit with 1 if the database needs a migration
+docker compose run --rm -T memobase-server-api /app/.venv/bin/python -m memobase_server.migrate "$@"